@@ -0,0 +1,192 @@
+"""
+Дневные агрегаты для дашборда админки (таблица daily_stats).
+
+Закрытые дни считаются один раз функцией stats-rollup (по расписанию)
+и лежат в daily_stats. Вживую считается только хвост после последнего
+свёрнутого дня — обычно это сегодняшний день, поэтому дашборд не
+замедляется с ростом таблиц. Удаление строк-источников и смена колонок, от
+которых зависят метрики (статус, тип, сумма), сбрасывают свёрнутые дни
+(триггеры invalidate_daily_stats*); такие пропуски тоже считаются вживую,
+пока stats-rollup их не перезапишет, поэтому итоги совпадают с живым COUNT(*). Каждая таблица-источник читается одним
+запросом с COUNT(*) FILTER (...) по диапазону created_at (работает индекс).
+
+Использование в admin-api (RealDictCursor):
+
+    from daily_stats import read_dashboard_stats
+    stats = read_dashboard_stats(cursor, datetime.now().date())
+"""
+
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+# Поля daily_stats в порядке колонок
+STAT_COLUMNS = [
+    'tryon_replicate',
+    'tryon_seedream',
+    'tryon_nanobana',
+    'payments_count',
+    'revenue',
+    'colortypes_total',
+    'colortypes_completed',
+    'colortypes_failed',
+    'refunds',
+    'charges_colortype',
+    'charges_tryon',
+    'charges_manual',
+]
+
+# Один проход по каждой таблице: все метрики за диапазон с группировкой по дню
+SOURCE_QUERIES = [
+    ('try_on_history', '''
+        COUNT(*) FILTER (WHERE model_used = 'replicate') AS tryon_replicate,
+        COUNT(*) FILTER (WHERE model_used = 'seedream') AS tryon_seedream,
+        COUNT(*) FILTER (WHERE model_used = 'nanobananapro') AS tryon_nanobana'''),
+    ('payment_transactions', '''
+        COUNT(*) FILTER (WHERE status = 'completed') AS payments_count,
+        COALESCE(SUM(amount) FILTER (WHERE status = 'completed'), 0) AS revenue'''),
+    ('color_type_history', '''
+        COUNT(*) AS colortypes_total,
+        COUNT(*) FILTER (WHERE status = 'completed') AS colortypes_completed,
+        COUNT(*) FILTER (WHERE status = 'failed') AS colortypes_failed'''),
+    ('balance_transactions', '''
+        COALESCE(SUM(amount) FILTER (WHERE type = 'refund'), 0) AS refunds,
+        COALESCE(SUM(ABS(amount)) FILTER (WHERE type = 'charge' AND color_type_id IS NOT NULL), 0) AS charges_colortype,
+        COALESCE(SUM(ABS(amount)) FILTER (WHERE type = 'charge' AND try_on_id IS NOT NULL), 0) AS charges_tryon,
+        COALESCE(SUM(ABS(amount)) FILTER (WHERE type = 'charge' AND color_type_id IS NULL AND try_on_id IS NULL), 0) AS charges_manual'''),
+]
+
+
+def _empty_stats() -> Dict[str, Any]:
+    return {col: 0 for col in STAT_COLUMNS}
+
+
+def stats_by_day(cursor, start: date, end: date) -> Dict[date, Dict[str, Any]]:
+    '''Метрики по дням за [start, end) — по одному запросу на таблицу-источник.'''
+    days: Dict[date, Dict[str, Any]] = {}
+    start_ts = datetime.combine(start, datetime.min.time())
+    end_ts = datetime.combine(end, datetime.min.time())
+    for table, select_list in SOURCE_QUERIES:
+        cursor.execute(
+            f'''SELECT created_at::date AS day, {select_list}
+                FROM {table}
+                WHERE created_at >= %s AND created_at < %s
+                GROUP BY 1''',
+            (start_ts, end_ts)
+        )
+        for row in cursor.fetchall():
+            row = dict(row)
+            day_stats = days.setdefault(row.pop('day'), _empty_stats())
+            day_stats.update(row)
+    return days
+
+
+def missing_days(cursor) -> List[date]:
+    '''Дни внутри свёрнутого диапазона, сброшенные после удаления строк-источников.'''
+    cursor.execute('''
+        SELECT gs::date AS day
+        FROM (SELECT MIN(day) AS first_day, MAX(day) AS last_day FROM daily_stats) bounds,
+             generate_series(bounds.first_day, bounds.last_day, INTERVAL '1 day') AS gs
+        WHERE NOT EXISTS (SELECT 1 FROM daily_stats ds WHERE ds.day = gs::date)
+        ORDER BY 1
+    ''')
+    return [dict(row)['day'] for row in cursor.fetchall()]
+
+
+def rollup_days(cursor, start: date, end: date) -> int:
+    '''
+    Пересчитывает daily_stats за [start, end). Пустые дни тоже записываются,
+    чтобы MAX(day) отражал, до какого дня свёртка актуальна.
+    Возвращает число записанных дней.
+    '''
+    computed = stats_by_day(cursor, start, end)
+    columns_sql = ', '.join(STAT_COLUMNS)
+    placeholders = ', '.join(['%s'] * len(STAT_COLUMNS))
+    updates_sql = ', '.join(f'{col} = EXCLUDED.{col}' for col in STAT_COLUMNS)
+    written = 0
+    day = start
+    while day < end:
+        values = computed.get(day) or _empty_stats()
+        cursor.execute(
+            f'''INSERT INTO daily_stats (day, {columns_sql}, updated_at)
+                VALUES (%s, {placeholders}, NOW())
+                ON CONFLICT (day) DO UPDATE SET {updates_sql}, updated_at = NOW()''',
+            [day] + [values[col] for col in STAT_COLUMNS]
+        )
+        written += 1
+        day += timedelta(days=1)
+    return written
+
+
+def read_dashboard_stats(cursor, today: date) -> Dict[str, Any]:
+    '''
+    Данные дашборда: свёрнутые дни из daily_stats + живой хвост после
+    последнего свёрнутого дня. Текущие значения (пользователи, лукбуки,
+    сумма балансов) — одним запросом.
+    '''
+    month_start = today - timedelta(days=30)
+
+    cursor.execute('''
+        SELECT
+            (SELECT COUNT(*) FROM users) AS total_users,
+            (SELECT COUNT(*) FROM lookbooks) AS total_lookbooks,
+            (SELECT COALESCE(SUM(balance), 0) FROM users) AS users_balance
+    ''')
+    snapshot = dict(cursor.fetchone())
+
+    sums_sql = ', '.join(f'COALESCE(SUM({col}), 0) AS {col}' for col in STAT_COLUMNS)
+    cursor.execute(
+        f'''SELECT MAX(day) AS last_day, {sums_sql},
+                   COALESCE(SUM(revenue) FILTER (WHERE day >= %s), 0) AS month_revenue
+            FROM daily_stats
+            WHERE day < %s''',
+        (month_start, today)
+    )
+    rolled = dict(cursor.fetchone())
+    last_day: Optional[date] = rolled.pop('last_day')
+
+    totals = {col: rolled[col] for col in STAT_COLUMNS}
+    month_revenue = rolled['month_revenue']
+    today_stats = _empty_stats()
+
+    # Живой хвост: с дня после последней свёртки (или с начала истории) по сегодня включительно
+    live_start = last_day + timedelta(days=1) if last_day else date(2000, 1, 1)
+    live_days = stats_by_day(cursor, live_start, today + timedelta(days=1))
+
+    # Сброшенные удалением дни внутри свёртки — одним проходом по их диапазону
+    holes = missing_days(cursor) if last_day else []
+    if holes:
+        hole_set = set(holes)
+        for day, values in stats_by_day(cursor, holes[0], holes[-1] + timedelta(days=1)).items():
+            if day in hole_set:
+                live_days[day] = values
+
+    for day, values in live_days.items():
+        for col in STAT_COLUMNS:
+            totals[col] += values[col]
+        if day >= month_start:
+            month_revenue += values['revenue']
+        if day == today:
+            today_stats = values
+
+    return {
+        'total_users': snapshot['total_users'],
+        'total_lookbooks': snapshot['total_lookbooks'],
+        'total_replicate': totals['tryon_replicate'],
+        'total_seedream': totals['tryon_seedream'],
+        'total_nanobana': totals['tryon_nanobana'],
+        'today_replicate': today_stats['tryon_replicate'],
+        'today_seedream': today_stats['tryon_seedream'],
+        'today_nanobana': today_stats['tryon_nanobana'],
+        'total_revenue': float(totals['revenue']),
+        'today_revenue': float(today_stats['revenue']),
+        'month_revenue': float(month_revenue),
+        'total_payments': totals['payments_count'],
+        'total_colortypes': totals['colortypes_total'],
+        'completed_colortypes': totals['colortypes_completed'],
+        'failed_colortypes': totals['colortypes_failed'],
+        'total_refunds': float(totals['refunds']),
+        'charges_colortype': float(totals['charges_colortype']),
+        'charges_tryon': float(totals['charges_tryon']),
+        'charges_manual': float(totals['charges_manual']),
+        'users_balance': float(snapshot['users_balance']),
+    }
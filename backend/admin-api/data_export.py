@@ -0,0 +1,238 @@
+"""
+Потоковая выгрузка больших списков админки в S3 (CSV / NDJSON, gzip).
+
+Строки читаются серверным (именованным) курсором пачками по EXPORT_BATCH,
+сразу сериализуются и сжимаются, а сжатые байты уходят в S3 частями
+multipart-загрузки. В памяти одновременно лежит одна пачка строк и
+не больше одной части загрузки — объём выгрузки на память не влияет.
+
+Использование в admin-api:
+
+    from data_export import export_dataset
+    result = export_dataset(conn, s3_client, bucket, 'payments', 'csv', query_params)
+    # result = {'url': presigned_url, 'key': ..., 'rows': N, 'format': 'csv'}
+"""
+
+import csv
+import gzip
+import io
+import json
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Dict, List
+
+from psycopg2.extras import RealDictCursor
+
+EXPORT_BATCH = 2000
+# Минимальная часть multipart-загрузки в S3 — 5 МБ (кроме последней)
+UPLOAD_PART_SIZE = 8 * 1024 * 1024
+EXPORT_URL_TTL = 3600
+EXPORT_PREFIX = 'exports/admin'
+EXPORT_FORMATS = {'csv', 'ndjson'}
+
+# Наборы данных: SQL с плейсхолдером {where} и фильтры, которые понимает выгрузка.
+# Базовые условия наборов совпадают с соответствующими action админки.
+EXPORT_DATASETS: Dict[str, Dict[str, Any]] = {
+    'payments': {
+        'sql': '''
+            SELECT bt.id, bt.user_id,
+                   COALESCE(u.email, bt.removed_user_email) AS user_email,
+                   COALESCE(u.name, bt.removed_user_name) AS user_name,
+                   bt.type, bt.amount, bt.balance_before, bt.balance_after,
+                   bt.description, bt.yookassa_payment_id,
+                   bt.try_on_id, bt.color_type_id, bt.created_at
+            FROM balance_transactions bt
+            LEFT JOIN users u ON bt.user_id = u.id
+            WHERE {where}
+            ORDER BY bt.created_at DESC, bt.id DESC
+        ''',
+        'filters': {
+            'user_id': 'bt.user_id = %s',
+            'type': 'bt.type = %s',
+            'date_from': 'bt.created_at >= %s',
+            'date_to': 'bt.created_at <= %s',
+        },
+    },
+    'generation_history': {
+        'sql': '''
+            SELECT h.id, h.user_id, u.email AS user_email, u.name AS user_name,
+                   h.model_used, h.saved_to_lookbook, h.cost, h.result_image, h.created_at
+            FROM try_on_history h
+            LEFT JOIN users u ON h.user_id = u.id
+            WHERE {where}
+            ORDER BY h.created_at DESC, h.id DESC
+        ''',
+        'filters': {
+            'user_id': 'h.user_id = %s',
+            'model': 'h.model_used = %s',
+            'date_from': 'h.created_at >= %s',
+            'date_to': 'h.created_at <= %s',
+        },
+    },
+    'freegen_history': {
+        'sql': '''
+            SELECT h.id, h.user_id, u.email AS user_email, u.name AS user_name,
+                   h.prompt, h.aspect_ratio, h.cost, h.result_image, h.created_at
+            FROM freegen_history h
+            LEFT JOIN users u ON h.user_id = u.id
+            WHERE {where} AND h.removed_at IS NULL
+            ORDER BY h.created_at DESC, h.id DESC
+        ''',
+        'filters': {
+            'user_id': 'h.user_id::text = %s',
+            'date_from': 'h.created_at >= %s',
+            'date_to': 'h.created_at <= %s',
+        },
+    },
+    'colortype_history': {
+        # person_image в старых записях — data:URI на мегабайты, в выгрузку не берём
+        'sql': '''
+            SELECT c.id, c.user_id, u.email AS user_email, u.name AS user_name,
+                   c.status, c.color_type, c.result_text,
+                   CASE WHEN c.person_image LIKE 'data:%%' THEN '' ELSE c.person_image END AS person_image,
+                   c.cdn_url, c.cost, c.refunded, c.created_at
+            FROM color_type_history c
+            LEFT JOIN users u ON c.user_id::uuid = u.id
+            WHERE {where}
+            ORDER BY c.created_at DESC, c.id DESC
+        ''',
+        'filters': {
+            'user_id': 'c.user_id = %s',
+            'status': 'c.status = %s',
+            'date_from': 'c.created_at >= %s',
+            'date_to': 'c.created_at <= %s',
+        },
+    },
+}
+
+
+class _S3MultipartSink(io.RawIOBase):
+    '''Файлоподобный приёмник: копит байты и отправляет их в S3 частями multipart-загрузки.'''
+
+    def __init__(self, s3_client, bucket: str, key: str, content_type: str):
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.buffer = bytearray()
+        self.parts: List[Dict[str, Any]] = []
+        upload = s3_client.create_multipart_upload(
+            Bucket=bucket, Key=key, ContentType=content_type, ContentEncoding='gzip'
+        )
+        self.upload_id = upload['UploadId']
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.buffer.extend(data)
+        if len(self.buffer) >= UPLOAD_PART_SIZE:
+            self._upload_part()
+        return len(data)
+
+    def _upload_part(self) -> None:
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=bytes(self.buffer)
+        )
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+        self.buffer = bytearray()
+
+    def complete(self) -> None:
+        # Последняя часть может быть меньше 5 МБ; пустой объект — тоже одна часть
+        if self.buffer or not self.parts:
+            self._upload_part()
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+
+    def abort(self) -> None:
+        try:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            print(f'[Export] Failed to abort multipart upload {self.key}: {e}')
+
+
+def _plain_value(value: Any) -> Any:
+    '''Значение из БД в JSON-совместимый вид.'''
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return value
+
+
+def _build_where(dataset: Dict[str, Any], params: Dict[str, Any]) -> tuple:
+    where_parts = []
+    values = []
+    for name, clause in dataset['filters'].items():
+        value = params.get(name)
+        if value:
+            where_parts.append(clause)
+            values.append(value)
+    return (' AND '.join(where_parts) if where_parts else 'TRUE'), values
+
+
+def export_dataset(conn, s3_client, bucket: str, dataset_name: str, fmt: str,
+                   params: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Выгружает набор данных в s3://bucket/exports/admin/... (gzip) и
+    возвращает временную ссылку на скачивание.
+    '''
+    dataset = EXPORT_DATASETS.get(dataset_name)
+    if not dataset:
+        raise ValueError(f'Unknown export dataset: {dataset_name}')
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format: {fmt}')
+
+    where_sql, values = _build_where(dataset, params)
+    stamp = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+    key = f'{EXPORT_PREFIX}/{dataset_name}/{stamp}-{uuid.uuid4().hex[:8]}.{fmt}.gz'
+    content_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+
+    sink = _S3MultipartSink(s3_client, bucket, key, content_type)
+    rows_written = 0
+    # Именованный курсор — строки остаются на сервере и приходят пачками
+    cursor = conn.cursor(name=f'admin_export_{uuid.uuid4().hex[:8]}', cursor_factory=RealDictCursor)
+    cursor.itersize = EXPORT_BATCH
+    try:
+        with gzip.GzipFile(fileobj=sink, mode='wb') as gz:
+            cursor.execute(dataset['sql'].format(where=where_sql), values)
+            header_written = False
+            while True:
+                batch = cursor.fetchmany(EXPORT_BATCH)
+                if not batch:
+                    break
+
+                chunk = io.StringIO()
+                if fmt == 'csv':
+                    writer = csv.writer(chunk)
+                    if not header_written:
+                        writer.writerow(list(batch[0].keys()))
+                        header_written = True
+                    for row in batch:
+                        writer.writerow([_plain_value(v) for v in row.values()])
+                else:
+                    for row in batch:
+                        chunk.write(json.dumps({k: _plain_value(v) for k, v in row.items()}, ensure_ascii=False))
+                        chunk.write('\n')
+
+                gz.write(chunk.getvalue().encode('utf-8'))
+                rows_written += len(batch)
+        sink.complete()
+    except Exception:
+        sink.abort()
+        raise
+    finally:
+        cursor.close()
+
+    url = s3_client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': bucket, 'Key': key},
+        ExpiresIn=EXPORT_URL_TTL
+    )
+    return {'url': url, 'key': key, 'rows': rows_written, 'format': fmt, 'expires_in': EXPORT_URL_TTL}
@@ -1,12 +1,16 @@
 import json
 import os
-from typing import Dict, Any
+from typing import Dict, Any, Tuple
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from datetime import datetime, timedelta
 import boto3
 from botocore.config import Config
 import jwt
+from daily_stats import read_dashboard_stats
+from data_export import export_dataset
+from media_refs import release_media_refs, release_media_prefix
+from page_cursor import encode_page_cursor, decode_page_cursor
 # redeploy v2
 
 def get_db_connection():
@@ -85,62 +89,51 @@ def verify_admin_password(provided_password: str, ip_address: str, cursor, conn)
     
     return (True, '')
 
-def delete_user_folder_from_s3(user_id: str) -> int:
+def enqueue_user_s3_deletion(cursor, user_id: str) -> None:
     '''
-    Delete ALL files of a user across every top-level folder in images/.
-    Removes any object whose key contains the segment "/{user_id}/" on any depth,
-    so new folders are handled automatically. Folders without per-user structure
-    (e.g. catalog) are skipped because they never contain "/{user_id}/".
-    Returns: number of deleted files
+    Ставит удаление файлов пользователя из S3 в очередь s3_deletion_jobs.
+    Вызывается в той же транзакции, что и удаление данных из БД; сами файлы
+    удаляет s3-gc (mode=user_jobs) по префиксам images/{folder}/{user_id}/
+    пачками delete_objects, без листинга всего бакета.
     '''
-    try:
-        s3_client = boto3.client(
-            's3',
-            endpoint_url='https://storage.yandexcloud.net',
-            aws_access_key_id=os.environ.get('S3_ACCESS_KEY'),
-            aws_secret_access_key=os.environ.get('S3_SECRET_KEY'),
-            region_name='ru-central1',
-            config=Config(signature_version='s3v4')
-        )
-
-        s3_bucket_name = os.environ.get('S3_BUCKET_NAME')
-        user_segment = f'/{user_id}/'
-
-        deleted_count = 0
-        continuation_token = None
-
-        # Scan the whole images/ tree once and delete any object that belongs
-        # to this user (path contains "/{user_id}/" at any nesting level).
-        while True:
-            list_params = {
-                'Bucket': s3_bucket_name,
-                'Prefix': 'images/'
-            }
-
-            if continuation_token:
-                list_params['ContinuationToken'] = continuation_token
-
-            response = s3_client.list_objects_v2(**list_params)
-
-            if 'Contents' in response:
-                for obj in response['Contents']:
-                    key = obj['Key']
-                    if user_segment in key:
-                        s3_client.delete_object(
-                            Bucket=s3_bucket_name,
-                            Key=key
-                        )
-                        deleted_count += 1
-
-            if response.get('IsTruncated'):
-                continuation_token = response.get('NextContinuationToken')
-            else:
-                break
+    cursor.execute(
+        "INSERT INTO s3_deletion_jobs (user_id, status) VALUES (%s, 'pending')",
+        (str(user_id),)
+    )
 
-        return deleted_count
-    except Exception as e:
-        print(f'Error deleting S3 folder for user {user_id}: {str(e)}')
-        return 0
+# Страница списков админки по умолчанию (payments/users); раньше было 1000 строк за раз
+ADMIN_PAGE_DEFAULT_LIMIT = 100
+
+# total в списках считается не дальше этого числа строк (total_capped = true —
+# строк больше): админка листает по offset и запрашивает total на каждой
+# странице, а полный COUNT(*) по большой выборке — второй проход по фильтрам
+ADMIN_COUNT_CAP = 10000
+
+# Поиск по платежам: каждая ветка UNION использует свой триграммный индекс (V0106),
+# вместо OR по колонкам двух таблиц, который всегда читает balance_transactions целиком
+PAYMENTS_SEARCH_SQL = """bt.id IN (
+    SELECT s.id FROM balance_transactions s
+    JOIN users su ON su.id = s.user_id
+    WHERE su.email ILIKE %s OR su.name ILIKE %s
+    UNION
+    SELECT s.id FROM balance_transactions s
+    WHERE s.yookassa_payment_id ILIKE %s OR s.description ILIKE %s
+       OR s.removed_user_email ILIKE %s OR s.removed_user_name ILIKE %s
+)"""
+
+# Этапы для action=latency: (имя, начало, конец) по колонкам task_timings, секунды.
+# Этап считается только у задач, где конец не раньше начала: у цветотипа
+# colorguide uploaded (исходное фото) стоит до submitted, и этап upload для него
+# в перцентили не попадает. finalize отсчитывается от последнего из uploaded и
+# provider_done — так он есть и у сервисов без загрузки результата.
+LATENCY_STAGES = [
+    ('queue_wait', 'queued_at', 'admitted_at'),
+    ('submit', 'admitted_at', 'submitted_at'),
+    ('provider', 'submitted_at', 'provider_done_at'),
+    ('upload', 'provider_done_at', 'uploaded_at'),
+    ('finalize', 'GREATEST(uploaded_at, provider_done_at)', 'finalized_at'),
+    ('total', 'queued_at', 'finalized_at'),
+]
 
 # Названия услуг для админки (колонка «Сервис»).
 CG_SERVICE_LABELS = {
@@ -157,6 +150,16 @@ CG_SERVICE_LABELS = {
 }
 
 
+def capped_count(cursor, from_where_sql: str, params: list) -> Tuple[int, bool]:
+    '''COUNT(*) по выборке, но не дальше ADMIN_COUNT_CAP строк. Возвращает (total, capped).'''
+    cursor.execute(
+        f'SELECT COUNT(*) AS total FROM (SELECT 1 FROM {from_where_sql} LIMIT %s) capped',
+        list(params) + [ADMIN_COUNT_CAP + 1]
+    )
+    total = cursor.fetchone()['total']
+    return min(total, ADMIN_COUNT_CAP), total > ADMIN_COUNT_CAP
+
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Admin API for managing users, lookbooks and viewing statistics
@@ -240,92 +243,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             }
         
         if action == 'stats':
-            cursor.execute("SELECT COUNT(*) as total FROM users")
-            total_users = cursor.fetchone()['total']
-            
-            cursor.execute("SELECT COUNT(*) as total FROM lookbooks")
-            total_lookbooks = cursor.fetchone()['total']
-            
-            cursor.execute("SELECT COUNT(*) as total FROM try_on_history WHERE model_used = 'replicate'")
-            total_replicate = cursor.fetchone()['total']
-            
-            cursor.execute("SELECT COUNT(*) as total FROM try_on_history WHERE model_used = 'seedream'")
-            total_seedream = cursor.fetchone()['total']
-            
-            cursor.execute("SELECT COUNT(*) as total FROM try_on_history WHERE model_used = 'nanobananapro'")
-            total_nanobana = cursor.fetchone()['total']
-            
-            today = datetime.now().date()
-            cursor.execute(
-                "SELECT COUNT(*) as total FROM try_on_history WHERE DATE(created_at) = %s AND model_used = 'replicate'",
-                (today,)
-            )
-            today_replicate = cursor.fetchone()['total']
-            
-            cursor.execute(
-                "SELECT COUNT(*) as total FROM try_on_history WHERE DATE(created_at) = %s AND model_used = 'seedream'",
-                (today,)
-            )
-            today_seedream = cursor.fetchone()['total']
-            
-            cursor.execute(
-                "SELECT COUNT(*) as total FROM try_on_history WHERE DATE(created_at) = %s AND model_used = 'nanobananapro'",
-                (today,)
-            )
-            today_nanobana = cursor.fetchone()['total']
-            
-            cursor.execute(
-                "SELECT COALESCE(SUM(amount), 0) as total FROM payment_transactions WHERE status = 'completed'"
-            )
-            total_revenue = cursor.fetchone()['total']
-            
-            cursor.execute(
-                "SELECT COALESCE(SUM(amount), 0) as total FROM payment_transactions WHERE status = 'completed' AND DATE(created_at) = %s",
-                (today,)
-            )
-            today_revenue = cursor.fetchone()['total']
-            
-            cursor.execute(
-                "SELECT COUNT(*) as total FROM payment_transactions WHERE status = 'completed'"
-            )
-            total_payments = cursor.fetchone()['total']
-            
-            thirty_days_ago = today - timedelta(days=30)
-            cursor.execute(
-                "SELECT COALESCE(SUM(amount), 0) as total FROM payment_transactions WHERE status = 'completed' AND created_at >= %s",
-                (thirty_days_ago,)
-            )
-            month_revenue = cursor.fetchone()['total']
-            
-            # Color type stats
-            cursor.execute("SELECT COUNT(*) as total FROM color_type_history")
-            total_colortypes = cursor.fetchone()['total']
-            
-            cursor.execute("SELECT COUNT(*) as total FROM color_type_history WHERE status = 'completed'")
-            completed_colortypes = cursor.fetchone()['total']
-            
-            cursor.execute("SELECT COUNT(*) as total FROM color_type_history WHERE status = 'failed'")
-            failed_colortypes = cursor.fetchone()['total']
-            
-            # Balance transactions stats
-            cursor.execute("SELECT COALESCE(SUM(amount), 0) as total FROM balance_transactions WHERE type = 'refund'")
-            total_refunds = cursor.fetchone()['total']
-            
-            # Charges for color type
-            cursor.execute("SELECT COALESCE(SUM(ABS(amount)), 0) as total FROM balance_transactions WHERE type = 'charge' AND color_type_id IS NOT NULL")
-            charges_colortype = cursor.fetchone()['total']
-            
-            # Charges for try-on
-            cursor.execute("SELECT COALESCE(SUM(ABS(amount)), 0) as total FROM balance_transactions WHERE type = 'charge' AND try_on_id IS NOT NULL")
-            charges_tryon = cursor.fetchone()['total']
-            
-            # Manual charges (no color_type_id and no try_on_id)
-            cursor.execute("SELECT COALESCE(SUM(ABS(amount)), 0) as total FROM balance_transactions WHERE type = 'charge' AND color_type_id IS NULL AND try_on_id IS NULL")
-            charges_manual = cursor.fetchone()['total']
-            
-            # Total user balances
-            cursor.execute("SELECT COALESCE(SUM(balance), 0) as total FROM users")
-            users_balance = cursor.fetchone()['total']
+            stats = read_dashboard_stats(cursor, datetime.now().date())
             
             return {
                 'statusCode': 200,
@@ -334,28 +252,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'Access-Control-Allow-Origin': get_cors_origin(event),
                 },
                 'isBase64Encoded': False,
-                'body': json.dumps({
-                    'total_users': total_users,
-                    'total_lookbooks': total_lookbooks,
-                    'total_replicate': total_replicate,
-                    'total_seedream': total_seedream,
-                    'total_nanobana': total_nanobana,
-                    'today_replicate': today_replicate,
-                    'today_seedream': today_seedream,
-                    'today_nanobana': today_nanobana,
-                    'total_revenue': float(total_revenue),
-                    'today_revenue': float(today_revenue),
-                    'month_revenue': float(month_revenue),
-                    'total_payments': total_payments,
-                    'total_colortypes': total_colortypes,
-                    'completed_colortypes': completed_colortypes,
-                    'failed_colortypes': failed_colortypes,
-                    'total_refunds': float(total_refunds),
-                    'charges_colortype': float(charges_colortype),
-                    'charges_tryon': float(charges_tryon),
-                    'charges_manual': float(charges_manual),
-                    'users_balance': float(users_balance)
-                })
+                'body': json.dumps(stats)
             }
         
         elif action == 'colortype_history':
@@ -870,12 +767,16 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             owner_id_val = row['user_id'] if row and row.get('user_id') else None
 
             cursor.execute('DELETE FROM color_guide_tasks WHERE id::text = %s', (task_id,))
+            # Снимаем ссылки в той же транзакции, иначе s3-gc считает файлы живыми
+            s3_bucket_name = os.environ.get('S3_BUCKET_NAME', 'fitting-room-images')
+            s3_url_prefix = f'https://storage.yandexcloud.net/{s3_bucket_name}/'
+            release_media_refs(cursor, [photo_url_to_delete])
+            if owner_id_val:
+                release_media_prefix(cursor, owner_id_val, f'{s3_url_prefix}images/colorguide/{owner_id_val}/{task_id}')
             conn.commit()
 
             # Удаляем фото из Яндекс Облака
             try:
-                s3_bucket_name = os.environ.get('S3_BUCKET_NAME', 'fitting-room-images')
-                s3_url_prefix = f'https://storage.yandexcloud.net/{s3_bucket_name}/'
                 s3_client = boto3.client(
                     's3',
                     endpoint_url='https://storage.yandexcloud.net',
@@ -963,6 +864,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         elif action == 'users':
             limit = query_params.get('limit', '1000')
             offset = query_params.get('offset', '0')
+            after = query_params.get('after')
+            search = query_params.get('search', '').strip()
             
             try:
                 limit = int(limit)
@@ -971,15 +874,47 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 limit = 1000
                 offset = 0
             
-            cursor.execute("SELECT COUNT(*) as total FROM users")
-            total = cursor.fetchone()['total']
+            where_parts = []
+            params = []
+            
+            if search:
+                # ILIKE по email/name обслуживают триграммные индексы (V0106)
+                where_parts.append("(email ILIKE %s OR name ILIKE %s)")
+                search_pattern = f'%{search}%'
+                params.extend([search_pattern, search_pattern])
+            
+            where_sql = ' AND '.join(where_parts) if where_parts else 'TRUE'
+            
+            page_sql = ''
+            page_params = []
+            if after:
+                after_created_at, after_id = decode_page_cursor(after)
+                page_sql = "AND (created_at, id) < (%s, %s)"
+                page_params = [after_created_at, after_id]
+                offset = 0
             
+            # Курсор, ORDER BY и LIMIT прямо на users — страница читается
+            # по индексу (created_at DESC, id DESC), без сортировки всей выборки
             cursor.execute(
-                "SELECT id, email, name, balance, free_tries_used, unlimited_access, created_at, vk_id, oauth_provider, phone, avatar_url FROM users ORDER BY created_at DESC LIMIT %s OFFSET %s",
-                (limit, offset)
+                f'''SELECT id, email, name, balance, free_tries_used, unlimited_access, created_at, vk_id, oauth_provider, phone, avatar_url
+                FROM users
+                WHERE {where_sql} {page_sql}
+                ORDER BY created_at DESC, id DESC
+                LIMIT %s OFFSET %s''',
+                params + page_params + [limit, offset]
             )
             users = cursor.fetchall()
             
+            # total (с потолком ADMIN_COUNT_CAP) — только без курсора: страницы
+            # по курсору его не пересчитывают
+            total, total_capped = None, False
+            if not after:
+                total, total_capped = capped_count(cursor, f'users WHERE {where_sql}', params)
+            
+            next_after = None
+            if len(users) == limit:
+                next_after = encode_page_cursor(users[-1]['created_at'], users[-1]['id'])
+            
             def display_email(raw):
                 if isinstance(raw, str) and raw.endswith('@vk.local'):
                     return ''
@@ -1008,7 +943,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'phone': u.get('phone') or '',
                         'avatar_url': u.get('avatar_url') or ''
                     } for u in users],
-                    'total': total
+                    'total': total,
+                    'total_capped': total_capped,
+                    'next_after': next_after
                 })
             }
         
@@ -1338,9 +1275,177 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 } for h in history])
             }
         
+        elif action == 'activity':
+            # Общая лента по всем сервисам из user_activity (поддерживается триггерами, V0107)
+            limit = query_params.get('limit', str(ADMIN_PAGE_DEFAULT_LIMIT))
+            after = query_params.get('after')
+            user_id_filter = query_params.get('user_id')
+            service_filter = query_params.get('service')
+            
+            try:
+                limit = int(limit)
+            except ValueError:
+                limit = ADMIN_PAGE_DEFAULT_LIMIT
+            
+            where_parts = []
+            params = []
+            
+            if user_id_filter:
+                where_parts.append("a.user_id = %s")
+                params.append(user_id_filter)
+            
+            if service_filter:
+                where_parts.append("a.service = %s")
+                params.append(service_filter)
+            
+            if after:
+                after_created_at, after_id = decode_page_cursor(after)
+                where_parts.append("(a.created_at, a.id) < (%s, %s)")
+                params.extend([after_created_at, after_id])
+            
+            where_sql = ' AND '.join(where_parts) if where_parts else 'TRUE'
+            
+            # users присоединяются только к строкам страницы
+            cursor.execute(f"""
+                SELECT p.*, u.email AS user_email, u.name AS user_name
+                FROM (
+                    SELECT a.service, a.id, a.user_id, a.status, a.cost, a.thumbnail,
+                           a.title, a.created_at, a.removed_at
+                    FROM user_activity a
+                    WHERE {where_sql}
+                    ORDER BY a.created_at DESC, a.id DESC
+                    LIMIT %s
+                ) p
+                LEFT JOIN users u ON u.id = p.user_id::uuid
+                ORDER BY p.created_at DESC, p.id DESC
+            """, params + [limit])
+            rows = cursor.fetchall()
+            
+            next_after = None
+            if len(rows) == limit:
+                next_after = encode_page_cursor(rows[-1]['created_at'], rows[-1]['id'])
+            
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': get_cors_origin(event),
+                },
+                'isBase64Encoded': False,
+                'body': json.dumps({
+                    'activity': [{
+                        'service': r['service'],
+                        'id': r['id'],
+                        'user_id': r['user_id'],
+                        'user_email': r['user_email'],
+                        'user_name': r['user_name'],
+                        'status': r['status'],
+                        'cost': float(r['cost'] or 0),
+                        'thumbnail': r['thumbnail'],
+                        'title': r['title'],
+                        'created_at': r['created_at'].isoformat() if r['created_at'] else None,
+                        'removed': r['removed_at'] is not None
+                    } for r in rows],
+                    'next_after': next_after
+                })
+            }
+        
+        elif action == 'latency':
+            # Перцентили длительности этапов задач по сервисам за окно (таблица task_timings)
+            try:
+                hours = int(query_params.get('hours', '24'))
+            except ValueError:
+                hours = 24
+            hours = max(1, min(hours, 24 * 90))
+            service_filter = query_params.get('service')
+            
+            stage_sql = ',\n'.join(
+                f"""percentile_cont(ARRAY[0.5, 0.9, 0.99]) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM {end_col} - {start_col}))
+                    FILTER (WHERE {end_col} >= {start_col}) AS {name}"""
+                for name, start_col, end_col in LATENCY_STAGES
+            )
+            where_sql = "queued_at >= NOW() - %s * INTERVAL '1 hour'"
+            params = [hours]
+            if service_filter:
+                where_sql += " AND service = %s"
+                params.append(service_filter)
+            
+            cursor.execute(f"""
+                SELECT service, COUNT(*) AS tasks, COUNT(finalized_at) AS finalized,
+                       {stage_sql}
+                FROM task_timings
+                WHERE {where_sql}
+                GROUP BY service
+                ORDER BY service
+            """, params)
+            rows = cursor.fetchall()
+            
+            def percentiles(values):
+                if not values:
+                    return None
+                return {label: round(float(v), 3) if v is not None else None
+                        for label, v in zip(('p50', 'p90', 'p99'), values)}
+            
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': get_cors_origin(event),
+                },
+                'isBase64Encoded': False,
+                'body': json.dumps({
+                    'hours': hours,
+                    'services': [{
+                        'service': r['service'],
+                        'tasks': r['tasks'],
+                        'finalized': r['finalized'],
+                        'stages': {name: percentiles(r[name]) for name, _, _ in LATENCY_STAGES}
+                    } for r in rows]
+                })
+            }
+        
+        elif action == 'export':
+            # Потоковая выгрузка большого списка в S3 (gzip CSV/NDJSON) вместо limit=100000 в JSON
+            dataset_name = query_params.get('dataset', 'payments')
+            export_format = query_params.get('format', 'csv')
+            
+            s3_client = boto3.client(
+                's3',
+                endpoint_url='https://storage.yandexcloud.net',
+                aws_access_key_id=os.environ.get('S3_ACCESS_KEY'),
+                aws_secret_access_key=os.environ.get('S3_SECRET_KEY'),
+                region_name='ru-central1',
+                config=Config(signature_version='s3v4')
+            )
+            bucket = os.environ.get('S3_BUCKET_NAME', 'fitting-room-images')
+            
+            try:
+                result = export_dataset(conn, s3_client, bucket, dataset_name, export_format, query_params)
+            except ValueError as e:
+                return {
+                    'statusCode': 400,
+                    'headers': {
+                        'Content-Type': 'application/json',
+                        'Access-Control-Allow-Origin': get_cors_origin(event),
+                    },
+                    'isBase64Encoded': False,
+                    'body': json.dumps({'error': str(e)})
+                }
+            
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': get_cors_origin(event),
+                },
+                'isBase64Encoded': False,
+                'body': json.dumps(result)
+            }
+        
         elif action == 'payments':
-            limit = query_params.get('limit', '1000')
+            limit = query_params.get('limit', str(ADMIN_PAGE_DEFAULT_LIMIT))
             offset = query_params.get('offset', '0')
+            after = query_params.get('after')
             type_filter = query_params.get('type')
             date_from = query_params.get('date_from')
             date_to = query_params.get('date_to')
@@ -1355,58 +1460,66 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 limit = int(limit)
                 offset = int(offset)
             except ValueError:
-                limit = 1000
+                limit = ADMIN_PAGE_DEFAULT_LIMIT
                 offset = 0
             
-            # Count total transactions
-            count_query = '''
-                SELECT COUNT(*) as total
-                FROM balance_transactions bt
-                LEFT JOIN users u ON bt.user_id = u.id
-                WHERE 1=1
-            '''
-            count_params = []
+            # Фильтры собираются один раз и идут и в страницу, и в total;
+            # total — отдельный COUNT с потолком ADMIN_COUNT_CAP (capped_count)
+            where_parts = []
+            params = []
             
             if type_filter:
-                count_query += " AND bt.type = %s"
-                count_params.append(type_filter)
+                where_parts.append("bt.type = %s")
+                params.append(type_filter)
             
             if date_from:
-                count_query += " AND bt.created_at >= %s"
-                count_params.append(date_from)
+                where_parts.append("bt.created_at >= %s")
+                params.append(date_from)
             
             if date_to:
-                count_query += " AND bt.created_at <= %s"
-                count_params.append(date_to)
+                where_parts.append("bt.created_at <= %s")
+                params.append(date_to)
             
             if search:
-                count_query += " AND (LOWER(u.email) LIKE LOWER(%s) OR LOWER(u.name) LIKE LOWER(%s) OR LOWER(bt.yookassa_payment_id) LIKE LOWER(%s) OR LOWER(bt.description) LIKE LOWER(%s) OR LOWER(bt.removed_user_email) LIKE LOWER(%s) OR LOWER(bt.removed_user_name) LIKE LOWER(%s))"
+                where_parts.append(PAYMENTS_SEARCH_SQL)
                 search_pattern = f'%{search}%'
-                count_params.extend([search_pattern, search_pattern, search_pattern, search_pattern, search_pattern, search_pattern])
+                params.extend([search_pattern] * 6)
             
             if has_yookassa_id == 'true':
-                count_query += " AND bt.yookassa_payment_id IS NOT NULL"
+                where_parts.append("bt.yookassa_payment_id IS NOT NULL")
             elif has_yookassa_id == 'false':
-                count_query += " AND bt.yookassa_payment_id IS NULL"
+                where_parts.append("bt.yookassa_payment_id IS NULL")
             
             if user_id_filter:
-                count_query += " AND bt.user_id = %s"
-                count_params.append(user_id_filter)
+                where_parts.append("bt.user_id = %s")
+                params.append(user_id_filter)
             
             if deleted_only == 'true':
-                count_query += " AND bt.user_id IS NULL"
+                where_parts.append("bt.user_id IS NULL")
             elif hide_deleted == 'true':
-                count_query += " AND bt.user_id IS NOT NULL"
+                where_parts.append("bt.user_id IS NOT NULL")
             
             if hide_unlimited == 'true':
-                count_query += " AND NOT (bt.type = 'charge' AND bt.amount = 0)"
-            
-            cursor.execute(count_query, count_params)
-            total = cursor.fetchone()['total']
+                where_parts.append("NOT (bt.type = 'charge' AND bt.amount = 0)")
+            
+            where_sql = ' AND '.join(where_parts) if where_parts else 'TRUE'
+            
+            # Keyset-пагинация: after — курсор из next_after предыдущей страницы,
+            # offset остаётся для перехода на произвольную страницу
+            page_sql = ''
+            page_params = []
+            if after:
+                after_created_at, after_id = decode_page_cursor(after)
+                page_sql = "AND (bt.created_at, bt.id) < (%s, %s)"
+                page_params = [after_created_at, after_id]
+                offset = 0
             
             # Get transactions with pagination
-            # Use u.balance (single source of truth) instead of bt.balance_after
-            query = '''
+            # Use u.balance (single source of truth) instead of bt.balance_after.
+            # Курсор, ORDER BY и LIMIT стоят на balance_transactions: страница идёт
+            # по индексу (created_at DESC, id DESC), а соединения по первичным
+            # ключам выполняются только для строк страницы
+            query = f'''
                 SELECT 
                     bt.id,
                     bt.user_id,
@@ -1432,49 +1545,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 LEFT JOIN users u ON bt.user_id = u.id
                 LEFT JOIN try_on_history th ON bt.try_on_id = th.id
                 LEFT JOIN color_type_history ct ON bt.color_type_id = ct.id
-                WHERE 1=1
+                WHERE {where_sql} {page_sql}
+                ORDER BY bt.created_at DESC, bt.id DESC
+                LIMIT %s OFFSET %s
             '''
-            params = []
-            
-            if type_filter:
-                query += " AND bt.type = %s"
-                params.append(type_filter)
-            
-            if date_from:
-                query += " AND bt.created_at >= %s"
-                params.append(date_from)
             
-            if date_to:
-                query += " AND bt.created_at <= %s"
-                params.append(date_to)
-            
-            if search:
-                query += " AND (LOWER(u.email) LIKE LOWER(%s) OR LOWER(u.name) LIKE LOWER(%s) OR LOWER(bt.yookassa_payment_id) LIKE LOWER(%s) OR LOWER(bt.description) LIKE LOWER(%s) OR LOWER(bt.removed_user_email) LIKE LOWER(%s) OR LOWER(bt.removed_user_name) LIKE LOWER(%s))"
-                search_pattern = f'%{search}%'
-                params.extend([search_pattern, search_pattern, search_pattern, search_pattern, search_pattern, search_pattern])
-            
-            if has_yookassa_id == 'true':
-                query += " AND bt.yookassa_payment_id IS NOT NULL"
-            elif has_yookassa_id == 'false':
-                query += " AND bt.yookassa_payment_id IS NULL"
-            
-            if user_id_filter:
-                query += " AND bt.user_id = %s"
-                params.append(user_id_filter)
-            
-            if deleted_only == 'true':
-                query += " AND bt.user_id IS NULL"
-            elif hide_deleted == 'true':
-                query += " AND bt.user_id IS NOT NULL"
-            
-            if hide_unlimited == 'true':
-                query += " AND NOT (bt.type = 'charge' AND bt.amount = 0)"
+            cursor.execute(query, params + page_params + [limit, offset])
+            transactions = cursor.fetchall()
             
-            query += " ORDER BY bt.created_at DESC LIMIT %s OFFSET %s"
-            params.extend([limit, offset])
+            # total (с потолком ADMIN_COUNT_CAP) — только без курсора. Фильтры
+            # users не касаются, поэтому соединение для подсчёта не нужно
+            total, total_capped = None, False
+            if not after:
+                total, total_capped = capped_count(cursor, f'balance_transactions bt WHERE {where_sql}', params)
             
-            cursor.execute(query, params)
-            transactions = cursor.fetchall()
+            next_after = None
+            if len(transactions) == limit:
+                next_after = encode_page_cursor(transactions[-1]['created_at'], transactions[-1]['id'])
             
             result_transactions = []
             for t in transactions:
@@ -1520,7 +1607,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False,
                 'body': json.dumps({
                     'payments': result_transactions,
-                    'total': total
+                    'total': total,
+                    'total_capped': total_capped,
+                    'next_after': next_after
                 })
             }
         
@@ -1746,8 +1835,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'body': json.dumps({'error': 'Missing user_id'})
                 }
             
-            cursor.execute("DELETE FROM try_on_history WHERE user_id = %s", (user_id,))
-            cursor.execute("DELETE FROM lookbooks WHERE user_id = %s", (user_id,))
+            # Ссылки на файлы снимаем в той же транзакции, что и удаление записей
+            cursor.execute("DELETE FROM try_on_history WHERE user_id = %s RETURNING result_image", (user_id,))
+            release_media_refs(cursor, [r['result_image'] for r in cursor.fetchall()])
+            cursor.execute("DELETE FROM lookbooks WHERE user_id = %s RETURNING photos", (user_id,))
+            for r in cursor.fetchall():
+                release_media_refs(cursor, r['photos'] or [])
             cursor.execute("DELETE FROM email_verifications WHERE user_id = %s", (user_id,))
             cursor.execute("DELETE FROM password_reset_tokens WHERE user_id = %s", (user_id,))
             cursor.execute("DELETE FROM payment_transactions WHERE user_id = %s", (user_id,))
@@ -1758,10 +1851,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             cursor.execute("DELETE FROM login_attempts WHERE email = (SELECT email FROM users WHERE id = %s)", (user_id,))
             cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
             
-            conn.commit()
+            # Файлы пользователя в S3 удалит фоновая задача (s3-gc)
+            enqueue_user_s3_deletion(cursor, user_id)
             
-            # Delete user's S3 folder after successful DB deletion
-            deleted_files_count = delete_user_folder_from_s3(user_id)
+            conn.commit()
             
             return {
                 'statusCode': 200,
@@ -1788,7 +1881,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'body': json.dumps({'error': 'Missing lookbook_id'})
                 }
             
-            cursor.execute("DELETE FROM lookbooks WHERE id = %s", (lookbook_id,))
+            cursor.execute("DELETE FROM lookbooks WHERE id = %s RETURNING photos", (lookbook_id,))
+            for r in cursor.fetchall():
+                release_media_refs(cursor, r['photos'] or [])
             conn.commit()
             
             return {
@@ -1802,8 +1897,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             }
         
         elif action == 'clear_generation_history' and method == 'DELETE':
-            cursor.execute("DELETE FROM try_on_history")
-            deleted_count = cursor.rowcount
+            cursor.execute("DELETE FROM try_on_history RETURNING result_image")
+            removed_images = [r['result_image'] for r in cursor.fetchall()]
+            deleted_count = len(removed_images)
+            release_media_refs(cursor, removed_images)
             conn.commit()
             
             return {
@@ -1831,7 +1928,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'body': json.dumps({'error': 'Missing analysis_id'})
                 }
             
-            cursor.execute("DELETE FROM color_type_history WHERE id = %s", (analysis_id,))
+            cursor.execute("DELETE FROM color_type_history WHERE id = %s RETURNING cdn_url", (analysis_id,))
+            release_media_refs(cursor, [r['cdn_url'] for r in cursor.fetchall()])
             conn.commit()
             
             return {
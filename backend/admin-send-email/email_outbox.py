@@ -0,0 +1,45 @@
+"""Очередь исходящих писем (email_outbox).
+
+Функции не ходят в SMTP сами: письмо кладётся в таблицу одной вставкой,
+и ответ уходит сразу. Отправляет функция email-sender — пачкой, через одну
+SMTP-сессию, с ограничением частоты и повторами. Файл общий: копия лежит в
+каждой функции, которая отправляет письма.
+"""
+
+import os
+
+OUTBOX_TABLE = 't_p29007832_virtual_fitting_room.email_outbox'
+DEFAULT_FROM = 'virtualfitting@mail.ru'
+
+
+def enqueue_email(cursor, to_email, subject, text_body, html_body=None,
+                  source='', from_addr=DEFAULT_FROM):
+    """Кладёт письмо в очередь в транзакции вызывающего. Возвращает id.
+
+    Коммит — за вызывающим: письмо уйдёт, только если сохранилось и то,
+    ради чего оно пишется (токен сброса, запись в журнале и т.п.).
+    """
+    cursor.execute(
+        f"""INSERT INTO {OUTBOX_TABLE}
+            (to_email, from_addr, subject, text_body, html_body, source)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            RETURNING id""",
+        (to_email, from_addr, subject, text_body, html_body, source),
+    )
+    row = cursor.fetchone()
+    return row['id'] if isinstance(row, dict) else row[0]
+
+
+def wake_sender():
+    """Будит email-sender, чтобы письмо ушло сразу, а не с ближайшим
+    запуском по расписанию. Ответ не ждём; не дошло — не страшно."""
+    sender_url = os.environ.get('EMAIL_SENDER_URL')
+    if not sender_url:
+        return
+    try:
+        import urllib.request
+        req = urllib.request.Request(sender_url, method='GET')
+        urllib.request.urlopen(req, timeout=1)
+    except Exception as e:
+        if 'timed out' not in str(e):
+            print(f'Email sender trigger (non-critical): {e}')
@@ -1,10 +1,7 @@
 import json
 import os
-import smtplib
 import html as html_lib
 from typing import Dict, Any
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 
 try:
     import psycopg2
@@ -15,6 +12,8 @@ except ImportError:
 
 import jwt
 
+from email_outbox import enqueue_email, wake_sender
+
 
 def get_db_connection():
     dsn = os.environ.get('DATABASE_URL')
@@ -65,35 +64,12 @@ def build_html(subject: str, body_text: str) -> str:
 </html>"""
 
 
-def send_email_smtp(to_email: str, subject: str, body_text: str) -> None:
-    smtp_host = os.environ.get('SMTP_HOST')
-    smtp_port = int(os.environ.get('SMTP_PORT', '587'))
-    smtp_user = os.environ.get('SMTP_USER')
-    smtp_password = os.environ.get('SMTP_PASSWORD')
-
-    if not (smtp_host and smtp_user and smtp_password):
-        raise Exception('SMTP credentials not configured')
-
-    message = MIMEMultipart('alternative')
-    message['Subject'] = subject
-    message['From'] = 'virtualfitting@mail.ru'
-    message['To'] = to_email
-
+def enqueue_admin_email(cursor, to_email: str, subject: str, body_text: str) -> int:
+    '''Кладёт письмо в очередь email_outbox; отправит функция email-sender.'''
     full_text = body_text.rstrip() + '\n\n---\nС уважением,\nкоманда Fitting Room'
     html_content = build_html(subject, body_text)
-
-    message.attach(MIMEText(full_text, 'plain', 'utf-8'))
-    message.attach(MIMEText(html_content, 'html', 'utf-8'))
-
-    if smtp_port == 465:
-        with smtplib.SMTP_SSL(smtp_host, smtp_port) as server:
-            server.login(smtp_user, smtp_password)
-            server.send_message(message)
-    else:
-        with smtplib.SMTP(smtp_host, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.send_message(message)
+    return enqueue_email(cursor, to_email, subject, full_text, html_content,
+                         source='admin-send-email')
 
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
@@ -192,11 +168,18 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             total_row = cursor_h.fetchone()
             total = int(total_row['cnt']) if total_row else 0
 
+            # Статус письма из очереди: queued, пока email-sender его не отправил
             cursor_h.execute(
-                '''SELECT id, subject, body_text, status, error_message, sent_at
-                   FROM admin_emails_log
-                   WHERE user_id = %s
-                   ORDER BY sent_at DESC
+                '''SELECT l.id, l.subject, l.body_text,
+                          CASE WHEN o.id IS NULL THEN l.status
+                               WHEN o.status IN ('pending', 'sending') THEN 'queued'
+                               ELSE o.status END AS status,
+                          COALESCE(o.last_error, l.error_message) AS error_message,
+                          l.sent_at
+                   FROM admin_emails_log l
+                   LEFT JOIN email_outbox o ON o.id = l.outbox_id
+                   WHERE l.user_id = %s
+                   ORDER BY l.sent_at DESC
                    LIMIT %s OFFSET %s''',
                 (str(user_id_q), limit, offset),
             )
@@ -276,35 +259,21 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         to_email = user_row['email']
         to_name = user_row.get('name') or ''
 
-        try:
-            send_email_smtp(to_email, subject, body_text)
-            status = 'sent'
-            error_message = None
-        except Exception as e:
-            status = 'failed'
-            error_message = str(e)[:500]
-            print(f'[AdminSendEmail] SMTP error: {error_message}')
-
+        outbox_id = enqueue_admin_email(cursor, to_email, subject, body_text)
         cursor.execute(
             '''INSERT INTO admin_emails_log
-               (user_id, to_email, to_name, subject, body_text, status, error_message)
-               VALUES (%s, %s, %s, %s, %s, %s, %s)''',
-            (str(user_id), to_email, to_name, subject, body_text, status, error_message),
+               (user_id, to_email, to_name, subject, body_text, status, outbox_id)
+               VALUES (%s, %s, %s, %s, %s, 'queued', %s)''',
+            (str(user_id), to_email, to_name, subject, body_text, outbox_id),
         )
         conn.commit()
+        wake_sender()
 
-        if status == 'sent':
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': get_cors_origin(event)},
-                'isBase64Encoded': False,
-                'body': json.dumps({'success': True, 'to_email': to_email}),
-            }
         return {
-            'statusCode': 500,
+            'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': get_cors_origin(event)},
             'isBase64Encoded': False,
-            'body': json.dumps({'success': False, 'error': error_message or 'Send failed'}),
+            'body': json.dumps({'success': True, 'queued': True, 'to_email': to_email}),
         }
     finally:
         cursor.close()
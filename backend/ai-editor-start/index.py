@@ -5,9 +5,11 @@ import os
 import psycopg2
 import uuid
 import base64
+import boto3
 from datetime import datetime
 
 from session_utils import validate_session
+from task_timings import mark_stage
 from lenormand import build_lenormand_prompt, normalize_spread_id
 from divination import pricing
 
@@ -68,6 +70,30 @@ def sql_escape_b64(val):
     return "'" + encoded + "'"
 
 
+def upload_archive(task_id, archive_b64):
+    """Кладёт исходный архив в S3 один раз при создании задачи. Возвращает ключ
+    или None — тогда архив по-старому хранится base64 в строке задачи."""
+    if not (os.environ.get('S3_ACCESS_KEY') and os.environ.get('S3_SECRET_KEY')):
+        return None
+    try:
+        zip_bytes = base64.b64decode(archive_b64)
+        s3 = boto3.client(
+            's3',
+            endpoint_url='https://storage.yandexcloud.net',
+            aws_access_key_id=os.environ.get('S3_ACCESS_KEY'),
+            aws_secret_access_key=os.environ.get('S3_SECRET_KEY'),
+        )
+        key = f'ai-editor/{task_id}/source.zip'
+        s3.put_object(
+            Bucket=os.environ.get('S3_BUCKET_NAME', 'fitting-room-images'),
+            Key=key, Body=zip_bytes, ContentType='application/zip',
+        )
+        return key
+    except Exception as e:
+        print(f'Archive upload (fallback to db): {e}')
+        return None
+
+
 def trigger_worker(task_id):
     try:
         import urllib.request
@@ -142,6 +168,7 @@ def handle_lenormand(event, body, cors_headers):
                                 false, %s::jsonb, %s, %s)""",
                     (task_id, model, prompt, user_id, cost, meta_json, now, now)
                 )
+                mark_stage(cur, 'divination', task_id, 'queued')
 
                 model_code = LENORMAND_MODEL_CODES.get(model, '')
                 code_suffix = f' ({model_code})' if model_code else ''
@@ -230,24 +257,26 @@ def handler(event, context):
 
     prompt_b64 = sql_escape_b64(prompt)
     file_content_b64 = sql_escape_b64(file_content_val) if file_content_val else 'NULL'
-    archive_b64 = sql_escape(archive_val) if archive_val else 'NULL'
+    archive_key = upload_archive(task_id, archive_val) if archive_val else None
+    archive_b64 = sql_escape(archive_val) if archive_val and not archive_key else 'NULL'
 
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
             sql = f"""INSERT INTO {DB_SCHEMA}.ai_editor_tasks
                     (id, status, mode, model, prompt, filename, file_content, archive_base64,
-                     task_type, user_id, created_at, updated_at)
+                     archive_s3_key, task_type, user_id, created_at, updated_at)
                     VALUES (
                         {sql_escape(task_id)}, 'pending', {sql_escape(mode)}, {sql_escape(model)},
                         convert_from(decode({prompt_b64}, 'base64'), 'UTF8'),
                         {sql_escape(body.get('filename', ''))},
                         {('convert_from(decode(' + file_content_b64 + ", 'base64'), 'UTF8')") if file_content_val else 'NULL'},
-                        {archive_b64},
+                        {archive_b64}, {sql_escape(archive_key)},
                         'editor', {sql_escape(current_user_id)},
                         {sql_escape(now)}, {sql_escape(now)}
                     )"""
             cur.execute(sql)
+            mark_stage(cur, 'ai_editor', task_id, 'queued')
         conn.commit()
     finally:
         conn.close()
@@ -3,6 +3,7 @@
 import json
 import os
 import base64
+import zlib
 import psycopg2
 
 from session_utils import validate_session
@@ -58,7 +59,14 @@ def build_progress(mode, status, plan_files, step_index):
 def build_result(task_id, row):
     (status, mode, ai_response, result_file_content, result_archive_base64,
      files_count, model_used, error_message, filename, created_at,
-     task_type, divination_meta, plan_files, step_index, partial_len) = row
+     task_type, divination_meta, plan_files, plan_z, step_index, partial_len) = row
+
+    # План пишется сжатым в bytea; plan_files — формат задач, начатых раньше
+    if plan_z is not None:
+        try:
+            plan_files = json.loads(zlib.decompress(bytes(plan_z)).decode('utf-8'))
+        except (zlib.error, ValueError):
+            plan_files = None
 
     result = {
         'task_id': str(task_id),
@@ -105,6 +113,29 @@ def build_result(task_id, row):
     return result
 
 
+def load_chunks_since(cur, task_id, since_seq):
+    """Куски черновика после since_seq — фронт дописывает их к уже показанному."""
+    safe_id = str(task_id).replace("'", "''")
+    cur.execute(
+        f"""SELECT seq, body, data FROM {DB_SCHEMA}.ai_editor_chunks
+            WHERE task_id = '{safe_id}' AND seq > {int(since_seq)}
+            ORDER BY seq"""
+    )
+    chunks = []
+    for seq, body, data in cur.fetchall():
+        if data is not None:
+            chunks.append({'seq': seq, 'text': zlib.decompress(bytes(data)).decode('utf-8')})
+            continue
+        text = body or ''
+        if text.startswith('b64:'):
+            try:
+                text = base64.b64decode(text[4:]).decode('utf-8')
+            except Exception:
+                pass
+        chunks.append({'seq': seq, 'text': text})
+    return chunks
+
+
 def trigger_next_step(task_id):
     """Пинает воркер для следующего шага. Ошибки некритичны — следующий опрос повторит."""
     try:
@@ -132,6 +163,7 @@ def handler(event, context):
     params = event.get('queryStringParameters') or {}
     task_id = params.get('task_id', '')
     latest = params.get('latest', '')
+    since_seq = params.get('since_seq', '')
 
     if not task_id and latest != 'true':
         return {'statusCode': 400, 'headers': cors_headers, 'body': json.dumps({'error': 'task_id required'})}
@@ -150,14 +182,16 @@ def handler(event, context):
                 cur.execute(
                     f"""SELECT id, status, mode, ai_response, result_file_content, result_archive_base64,
                                files_count, model_used, error_message, filename, created_at,
-                               task_type, divination_meta, plan_files, step_index,
+                               task_type, divination_meta, plan_files, plan_z, step_index,
                                CASE WHEN partial_text LIKE 'b64:%'
                                     THEN (LENGTH(partial_text) - 4) * 3 / 4
-                                    ELSE COALESCE(LENGTH(partial_text), 0) END,
+                                    ELSE COALESCE(LENGTH(partial_text), 0) END
+                               + COALESCE((SELECT SUM(c.chars) FROM {DB_SCHEMA}.ai_editor_chunks c
+                                           WHERE c.task_id = t.id), 0),
                                (stream_lock IS NOT NULL
                                 AND stream_lock < NOW() - INTERVAL '60 seconds'
                                 AND resume_count < 6) AS stalled
-                        FROM {DB_SCHEMA}.ai_editor_tasks
+                        FROM {DB_SCHEMA}.ai_editor_tasks t
                         WHERE status IN ('completed', 'failed', 'processing')
                           AND user_id = '{safe_uid}'
                           AND task_type = 'editor'
@@ -174,15 +208,17 @@ def handler(event, context):
                 cur.execute(
                     f"""SELECT status, mode, ai_response, result_file_content, result_archive_base64,
                                files_count, model_used, error_message, filename, created_at,
-                               task_type, divination_meta, plan_files, step_index,
+                               task_type, divination_meta, plan_files, plan_z, step_index,
                                CASE WHEN partial_text LIKE 'b64:%'
                                     THEN (LENGTH(partial_text) - 4) * 3 / 4
-                                    ELSE COALESCE(LENGTH(partial_text), 0) END,
+                                    ELSE COALESCE(LENGTH(partial_text), 0) END
+                               + COALESCE((SELECT SUM(c.chars) FROM {DB_SCHEMA}.ai_editor_chunks c
+                                           WHERE c.task_id = t.id), 0),
                                (stream_lock IS NOT NULL
                                 AND stream_lock < NOW() - INTERVAL '60 seconds'
                                 AND resume_count < 6) AS stalled,
                                user_id
-                        FROM {DB_SCHEMA}.ai_editor_tasks WHERE id = '{safe_id}'"""
+                        FROM {DB_SCHEMA}.ai_editor_tasks t WHERE id = '{safe_id}'"""
                 )
                 row = cur.fetchone()
                 if not row:
@@ -200,11 +236,18 @@ def handler(event, context):
 
                 found_id = task_id
                 data_row = row[:-1]
+
+            # Клиент, передавший since_seq, получает только новые куски черновика
+            new_chunks = None
+            if since_seq.isdigit() and data_row[0] in ('pending', 'processing'):
+                new_chunks = load_chunks_since(cur, found_id, int(since_seq))
     finally:
         conn.close()
 
     stalled = bool(data_row[-1])
     result = build_result(found_id, data_row[:-1])
+    if new_chunks is not None:
+        result['chunks'] = new_chunks
 
     # Архивные задачи выполняются по шагам: каждый опрос статуса продвигает
     # следующий шаг. Вызов fire-and-forget, ответ не ждём.
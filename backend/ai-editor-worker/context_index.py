@@ -0,0 +1,271 @@
+"""Локальный индекс кода архива для выбора контекста шагов AI-редактора.
+
+Индекс строится один раз на архив (лежит в манифесте рядом с текстами):
+граф импортов, таблица символов и статистика BM25 по содержимому файлов.
+На шаге в промпт попадает целевой файл и самые связанные с ним файлы в
+пределах бюджета знаков, а не весь проект — модель читает в разы меньше
+и первый знак приходит быстрее. Проект меньше бюджета показывается целиком.
+"""
+
+import math
+import posixpath
+import re
+from collections import Counter
+
+# Бюджет содержимого файлов на один вызов модели (знаков)
+STEP_CONTEXT_BUDGET = 120000
+PLAN_CONTEXT_BUDGET = 160000
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Надбавки к релевантности за прямые связи с целевым файлом
+IMPORT_BOOST = 4.0
+SYMBOL_BOOST = 1.5
+DONE_BOOST = 1.0
+
+# Сколько терминов и символов храним на файл: индекс лежит в S3 одним JSON
+MAX_TERMS_PER_FILE = 400
+MAX_SYMBOLS_PER_FILE = 200
+
+WORD_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*|[А-Яа-яЁё]{3,}')
+PART_RE = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+')
+
+STOP_WORDS = {
+    'import', 'from', 'export', 'default', 'return', 'const', 'let', 'var',
+    'function', 'def', 'class', 'self', 'this', 'if', 'else', 'for', 'in',
+    'and', 'or', 'not', 'true', 'false', 'null', 'none', 'the', 'to', 'of',
+    'is', 'new', 'async', 'await', 'div', 'span',
+}
+
+IMPORT_PATTERNS = [
+    re.compile(r'''\b(?:import|export)\s[^'";]*?\bfrom\s+['"]([^'"]+)['"]'''),
+    re.compile(r'''\bimport\s*\(?\s*['"]([^'"]+)['"]'''),
+    re.compile(r'''\brequire\(\s*['"]([^'"]+)['"]\s*\)'''),
+    re.compile(r'^\s*from\s+(\.*[\w.]*)\s+import\b', re.M),
+    re.compile(r'^\s*import\s+([\w.]+)\s*$', re.M),
+    re.compile(r'''@import\s+(?:url\()?['"]([^'"]+)['"]'''),
+    re.compile(r'''<(?:script|link)\b[^>]*?\b(?:src|href)=['"]([^'"]+)['"]'''),
+]
+
+SYMBOL_PATTERNS = [
+    re.compile(r'^\s*(?:async\s+)?def\s+(\w+)', re.M),
+    re.compile(r'^\s*(?:export\s+)?(?:default\s+)?(?:abstract\s+)?class\s+(\w+)', re.M),
+    re.compile(r'\bfunction\s+(\w+)'),
+    re.compile(r'\b(?:interface|type|enum)\s+([A-Z]\w*)'),
+    re.compile(r'\bexport\s+(?:const|let|var)\s+(\w+)'),
+    re.compile(r'^(?:const|let)\s+([A-Z]\w*)\s*=', re.M),
+    # Классы CSS: их имена — общий договор между разметкой и стилями
+    re.compile(r'^\s*\.([A-Za-z][\w-]*)[^{\n]*\{', re.M),
+]
+
+RESOLVE_EXTENSIONS = (
+    '', '.ts', '.tsx', '.js', '.jsx', '.mjs', '.vue', '.svelte', '.py',
+    '.css', '.scss', '.less', '.json',
+)
+
+
+def tokenize(text):
+    """Слова в нижнем регистре; составные имена (camelCase, snake_case)
+    дают ещё и свои части — запрос «user card» найдёт UserCard."""
+    terms = []
+    for word in WORD_RE.findall(text or ''):
+        low = word.lower()
+        if low not in STOP_WORDS and len(low) > 1:
+            terms.append(low)
+        parts = PART_RE.findall(word)
+        if len(parts) > 1:
+            terms.extend(p.lower() for p in parts if len(p) > 2 and p.lower() not in STOP_WORDS)
+    return terms
+
+
+def extract_symbols(text):
+    found = []
+    seen = set()
+    for pattern in SYMBOL_PATTERNS:
+        for name in pattern.findall(text or ''):
+            if name not in seen and len(name) > 2:
+                seen.add(name)
+                found.append(name)
+    return found[:MAX_SYMBOLS_PER_FILE]
+
+
+def _module_keys(path):
+    """Под какими именами файл могут импортировать: без расширения и
+    без /index, а для Python — через точки."""
+    stem, _ = posixpath.splitext(path)
+    keys = {path, stem}
+    if posixpath.basename(stem) in ('index', '__init__'):
+        keys.add(posixpath.dirname(stem))
+    keys.add(stem.replace('/', '.'))
+    return keys
+
+
+def _resolve(spec, src_path, by_key):
+    spec = spec.split('?')[0].split('#')[0]
+    if not spec or spec.startswith(('http:', 'https:', '//', 'data:')):
+        return None
+    base = posixpath.dirname(src_path)
+    candidates = []
+    if spec.startswith('.') and '/' not in spec and src_path.endswith('.py'):
+        # Относительный импорт Python: from .models / from ..utils
+        level = len(spec) - len(spec.lstrip('.'))
+        pkg = base
+        for _ in range(level - 1):
+            pkg = posixpath.dirname(pkg)
+        rest = spec.lstrip('.').replace('.', '/')
+        candidates.append(posixpath.join(pkg, rest) if rest else pkg)
+    elif spec.startswith('.'):
+        candidates.append(posixpath.normpath(posixpath.join(base, spec)))
+    elif spec.startswith('/'):
+        candidates.append(spec.lstrip('/'))
+    else:
+        if spec.startswith('@/'):
+            candidates.append('src/' + spec[2:])
+        candidates.append(spec)
+        candidates.append(spec.replace('.', '/'))
+
+    # Вторым проходом — по хвосту пути: архив часто упакован с корневой
+    # папкой (project/src/App.tsx), а импорты пишут от корня проекта
+    for prefix in ('', '*/'):
+        for cand in candidates:
+            cand = cand.strip('/')
+            for ext in RESOLVE_EXTENSIONS:
+                hit = by_key.get(prefix + cand + ext)
+                if hit:
+                    return hit
+    return None
+
+
+def build_index(files):
+    """Индекс по {путь: текст}. Результат сериализуется в JSON как есть."""
+    by_key = {}
+    for path in files:
+        for key in _module_keys(path):
+            by_key.setdefault(key, path)
+            parts = key.split('/')
+            # Хвосты пути для архивов с корневой папкой (project/src/App.tsx)
+            for i in range(1, len(parts)):
+                by_key.setdefault('*/' + '/'.join(parts[i:]), path)
+
+    entries = {}
+    df = Counter()
+    total_len = 0
+    for path, text in files.items():
+        counts = Counter(tokenize(path.replace('/', ' ')) + tokenize(text))
+        doc_len = sum(counts.values())
+        total_len += doc_len
+        df.update(counts.keys())
+
+        imports = []
+        for pattern in IMPORT_PATTERNS:
+            for spec in pattern.findall(text or ''):
+                target = _resolve(spec, path, by_key)
+                if target and target != path and target not in imports:
+                    imports.append(target)
+
+        entries[path] = {
+            'len': doc_len,
+            'tf': dict(counts.most_common(MAX_TERMS_PER_FILE)),
+            'imports': imports,
+            'symbols': extract_symbols(text),
+        }
+
+    return {
+        'files': entries,
+        'df': dict(df),
+        'n': len(files),
+        'avgdl': (total_len / len(files)) if files else 0.0,
+    }
+
+
+def bm25_scores(index, query_terms):
+    entries = index.get('files') or {}
+    df = index.get('df') or {}
+    n = index.get('n') or len(entries) or 1
+    avgdl = index.get('avgdl') or 1.0
+    weights = Counter(query_terms)
+
+    scores = {}
+    for path, entry in entries.items():
+        tf = entry.get('tf') or {}
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * (entry.get('len') or 0) / avgdl)
+        score = 0.0
+        for term, qw in weights.items():
+            f = tf.get(term)
+            if not f:
+                continue
+            idf = math.log(1 + (n - df.get(term, 0) + 0.5) / (df.get(term, 0) + 0.5))
+            score += qw * idf * f * (BM25_K1 + 1) / (f + norm)
+        if score:
+            scores[path] = score
+    return scores
+
+
+def rank_files(index, files, query, target=None, done_paths=None):
+    """Файлы по убыванию связи с шагом: BM25 по запросу плюс надбавки за
+    импорт из/в целевой файл, общие символы и правки прошлых шагов."""
+    entries = index.get('files') or {}
+    done_paths = set(done_paths or [])
+
+    query_terms = tokenize(query)
+    if target:
+        query_terms += tokenize(target.replace('/', ' '))
+    scores = bm25_scores(index, query_terms)
+    top = max(scores.values()) if scores else 0.0
+    # BM25 приводим к 0..1, чтобы надбавки за граф весили одинаково в любом проекте
+    ranked = {path: (s / top if top else 0.0) for path, s in scores.items()}
+
+    if target:
+        target_text = files.get(target) or ''
+        target_words = set(WORD_RE.findall(target_text))
+        direct = set((entries.get(target) or {}).get('imports') or [])
+        for path, entry in entries.items():
+            if path == target:
+                continue
+            boost = 0.0
+            if path in direct or target in (entry.get('imports') or []):
+                boost += IMPORT_BOOST
+            shared = sum(1 for sym in entry.get('symbols') or [] if sym in target_words)
+            boost += SYMBOL_BOOST * min(shared, 3)
+            if boost:
+                ranked[path] = ranked.get(path, 0.0) + boost
+
+    for path in done_paths:
+        if path in files and path != target:
+            ranked[path] = ranked.get(path, 0.0) + DONE_BOOST
+
+    return sorted(
+        (p for p in files if p != target),
+        key=lambda p: (-ranked.get(p, 0.0), p),
+    )
+
+
+def select_context(index, files, query, budget, target=None, done_paths=None):
+    """Возвращает (показываемые файлы, пути без содержимого).
+
+    Целевой файл показывается всегда, остальные — по убыванию релевантности,
+    пока хватает бюджета. Без индекса или если проект влезает в бюджет —
+    весь проект, как раньше."""
+    total = sum(len(t) for t in files.values())
+    if not index or total <= budget:
+        return dict(files), []
+
+    shown = {}
+    used = 0
+    if target and target in files:
+        shown[target] = files[target]
+        used += len(files[target])
+
+    for path in rank_files(index, files, query, target=target, done_paths=done_paths):
+        size = len(files[path])
+        if used + size > budget:
+            continue
+        shown[path] = files[path]
+        used += size
+
+    omitted = sorted(p for p in files if p not in shown)
+    return shown, omitted
+
+
+def symbols_of(index, path, limit=8):
+    return ((index or {}).get('files', {}).get(path) or {}).get('symbols', [])[:limit]
@@ -7,33 +7,28 @@ import zipfile
 import io
 import re
 import time
-import requests
+import zlib
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import boto3
 import psycopg2
 from datetime import datetime
-
-OPENROUTER_API_KEY = (os.environ.get("OPENROUTER_API_KEY_NEW") or os.environ.get("OPENROUTER_API_KEY_OLD") or "").strip()
-OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
-
-
-def get_openrouter_proxies():
-    proxy_url = (os.environ.get("OPENROUTER_PROXY_URL") or "").strip()
-    if not proxy_url:
-        return None
-    return {"http": proxy_url, "https": proxy_url}
-
+from task_timings import mark_stage
+import profiling
+import context_index
+import zip_rewrite
+from openrouter_stream import (
+    NETWORK_ERROR_MARK, build_continue_prompt, call_openrouter_retrying,
+)
 
 DB_SCHEMA = 't_p29007832_virtual_fitting_room'
 
-# Как часто сбрасывать в БД уже написанный текст (сек)
-PARTIAL_SAVE_SEC = 15
 # Через сколько секунд работы аккуратно прерваться и дописать следующим заходом.
 # Заметно меньше таймаута облачной функции, чтобы успеть сохранить.
 SOFT_DEADLINE_SEC = 210
 # Сколько раз максимум дописываем один ответ
 MAX_RESUMES = 6
-# Метка сетевого сбоя: связь не дошла до модели, значит запрос бесплатный
-# и его безопасно повторить
-NETWORK_ERROR_MARK = 'Обрыв связи'
 # Сколько раз повторяем сорвавшийся шаг архива, прежде чем признать неудачу
 MAX_STEP_RETRIES = 3
 # Признаки временного сбоя: такой шаг имеет смысл повторить, а не хоронить
@@ -90,10 +85,13 @@ def should_skip_path(filepath):
     return any(part in SKIP_DIRS for part in parts)
 
 
-def extract_text_files(zip_bytes):
+def extract_text_files(zip_src):
+    """zip_src — байты архива или файловый объект (временный файл из S3)."""
     files = {}
     total_size = 0
-    with zipfile.ZipFile(io.BytesIO(zip_bytes), 'r') as zf:
+    if isinstance(zip_src, (bytes, bytearray)):
+        zip_src = io.BytesIO(zip_src)
+    with zipfile.ZipFile(zip_src, 'r') as zf:
         for info in zf.infolist():
             if info.is_dir() or should_skip_path(info.filename) or not is_text_file(info.filename):
                 continue
@@ -110,6 +108,136 @@ def extract_text_files(zip_bytes):
     return files
 
 
+def s3_configured():
+    return bool(os.environ.get('S3_ACCESS_KEY') and os.environ.get('S3_SECRET_KEY'))
+
+
+def get_s3_client():
+    return boto3.client(
+        's3',
+        endpoint_url='https://storage.yandexcloud.net',
+        aws_access_key_id=os.environ.get('S3_ACCESS_KEY'),
+        aws_secret_access_key=os.environ.get('S3_SECRET_KEY'),
+    )
+
+
+def s3_bucket():
+    return os.environ.get('S3_BUCKET_NAME', 'fitting-room-images')
+
+
+def archive_object_key(task_id, name):
+    """Ключ объекта задачи в S3 — тот же формат, что в ai-editor-start."""
+    return f'ai-editor/{task_id}/{name}'
+
+
+def open_archive_zip(archive):
+    """Исходный zip задачи во временном файле: из S3 потоком или (старые
+    задачи) из base64 в строке задачи. Нужен только при сборке результата —
+    шагам хватает манифеста."""
+    zip_file = tempfile.TemporaryFile()
+    if archive.get('s3_key'):
+        get_s3_client().download_fileobj(s3_bucket(), archive['s3_key'], zip_file)
+    else:
+        zip_file.write(base64.b64decode(archive.get('base64') or ''))
+    zip_file.seek(0)
+    return zip_file
+
+
+def build_manifest(text_files):
+    return {
+        path: {
+            'sha256': hashlib.sha256(content.encode('utf-8')).hexdigest(),
+            'size': len(content),
+            'text': content,
+        }
+        for path, content in text_files.items()
+    }
+
+
+# Версия формата манифеста: со 2-й рядом с текстами лежит индекс кода
+MANIFEST_VERSION = 2
+
+
+def save_manifest(task_id, text_files, index):
+    """Сохраняет манифест и индекс кода в S3 и запоминает ключ в задаче.
+    Возвращает ключ (None — не сохранили). Некритично: без манифеста
+    следующий шаг просто распакует архив заново."""
+    if not s3_configured():
+        return None
+    safe_id = str(task_id).replace("'", "''")
+    key = archive_object_key(task_id, 'manifest.json')
+    try:
+        get_s3_client().put_object(
+            Bucket=s3_bucket(), Key=key,
+            Body=json.dumps({
+                'version': MANIFEST_VERSION,
+                'files': build_manifest(text_files),
+                'index': index,
+            }, ensure_ascii=False).encode('utf-8'),
+            ContentType='application/json',
+        )
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""UPDATE {DB_SCHEMA}.ai_editor_tasks
+                        SET archive_manifest_key = {sql_escape(key)}
+                        WHERE id = '{safe_id}'"""
+                )
+            conn.commit()
+        finally:
+            conn.close()
+        return key
+    except Exception as e:
+        print(f'[{task_id}] manifest save (non-critical): {e}')
+        return None
+
+
+def load_text_files(task_id, archive):
+    """Текстовые файлы архива и индекс кода. Манифест читается одним объектом,
+    без декодирования и распаковки всего архива; строится на первом шаге.
+    Возвращает (text_files, index, zip_file) — zip_file только если пришлось
+    распаковывать, чтобы не качать архив второй раз."""
+    if archive.get('manifest_key'):
+        try:
+            obj = get_s3_client().get_object(Bucket=s3_bucket(), Key=archive['manifest_key'])
+            manifest = json.loads(obj['Body'].read().decode('utf-8'))
+            if manifest.get('version') == MANIFEST_VERSION:
+                text_files = {path: entry['text'] for path, entry in manifest['files'].items()}
+                return text_files, manifest.get('index'), None
+            # Манифест первого формата — без индекса
+            text_files = {path: entry['text'] for path, entry in manifest.items()}
+            return text_files, context_index.build_index(text_files), None
+        except Exception as e:
+            print(f'[{task_id}] manifest load failed, распаковываю архив: {e}')
+
+    zip_file = open_archive_zip(archive)
+    text_files = extract_text_files(zip_file)
+    index = None
+    if text_files:
+        index = context_index.build_index(text_files)
+        # Ключ — в тот же archive: если задача закончится этим же шагом,
+        # drop_archive_objects должен удалить и только что записанный манифест
+        manifest_key = save_manifest(task_id, text_files, index)
+        if manifest_key:
+            archive['manifest_key'] = manifest_key
+    return text_files, index, zip_file
+
+
+def drop_archive_objects(task_id, archive):
+    """Задача завершена — исходный архив и манифест в S3 больше не нужны."""
+    keys = [k for k in (archive.get('s3_key'), archive.get('manifest_key')) if k]
+    if not keys or not s3_configured():
+        return
+    try:
+        get_s3_client().delete_objects(
+            Bucket=s3_bucket(),
+            Delete={'Objects': [{'Key': k} for k in keys]},
+        )
+    except Exception as e:
+        print(f'[{task_id}] archive cleanup (non-critical): {e}')
+
+
 def build_archive_prompt(files, user_prompt):
     file_list = "\n".join(f"- {f}" for f in sorted(files.keys()))
     files_content = ""
@@ -142,9 +270,17 @@ def build_archive_prompt(files, user_prompt):
 """
 
 
-def build_plan_prompt(files, user_prompt):
-    """Шаг 1: модель только планирует, какие файлы менять. Ответ короткий."""
-    file_list = "\n".join(f"- {f}" for f in sorted(files.keys()))
+def build_plan_prompt(files, user_prompt, omitted=None, index=None):
+    """Шаг 1: модель только планирует, какие файлы менять. Ответ короткий.
+
+    omitted — файлы, не вошедшие в бюджет контекста: показываем путь и
+    объявленные в них имена, чтобы план мог их затронуть."""
+    lines = [f"- {f}" for f in sorted(files.keys())]
+    for path in omitted or []:
+        symbols = context_index.symbols_of(index, path)
+        hint = f" (объявляет: {', '.join(symbols)})" if symbols else ''
+        lines.append(f"- {path}  [содержимое не показано]{hint}")
+    file_list = "\n".join(lines)
     files_content = ""
     for path, content in sorted(files.items()):
         files_content += f"\n--- FILE: {path} ---\n{content}\n"
@@ -185,7 +321,7 @@ def build_plan_prompt(files, user_prompt):
 
 
 def build_step_file_prompt(files, user_prompt, target_path, what_to_do, plan_summary,
-                           conventions=None, done_paths=None, pending=None):
+                           conventions=None, done_paths=None, pending=None, omitted=None):
     """Шаг 2..N: модель возвращает ОДИН файл целиком.
 
     files здесь — проект в АКТУАЛЬНОМ виде: файлы, уже написанные на прошлых
@@ -193,6 +329,7 @@ def build_step_file_prompt(files, user_prompt, target_path, what_to_do, plan_sum
     разметку и выдумывает имена классов заново.
     pending — файлы из плана, до которых очередь ещё не дошла: о них нужно
     знать, чтобы подключать их, а не переписывать их содержимое внутрь себя.
+    omitted — файлы проекта, не связанные с шагом: только путь, без содержимого.
     """
     done_paths = set(done_paths or [])
     pending = pending or []
@@ -201,6 +338,8 @@ def build_step_file_prompt(files, user_prompt, target_path, what_to_do, plan_sum
     for f in sorted(files.keys()):
         mark = '  [уже обновлён на прошлом шаге]' if f in done_paths else ''
         lines.append(f"- {f}{mark}")
+    for f in omitted or []:
+        lines.append(f"- {f}  [существует, содержимое не показано]")
     for item in pending:
         note = item.get('what') or ''
         lines.append(
@@ -358,194 +497,25 @@ def parse_single_file_response(response_text, filename, original_content):
     return original_content
 
 
-def build_result_zip(original_zip_bytes, updated_text_files, deleted_paths=None):
-    deleted = set(deleted_paths or ())
-    result_buffer = io.BytesIO()
-    with zipfile.ZipFile(io.BytesIO(original_zip_bytes), 'r') as original_zf:
-        with zipfile.ZipFile(result_buffer, 'w', zipfile.ZIP_DEFLATED) as result_zf:
-            processed = set()
-            for info in original_zf.infolist():
-                if info.is_dir():
-                    result_zf.writestr(info, '')
-                    continue
-                if info.filename in deleted:
-                    processed.add(info.filename)
-                    continue
-                if info.filename in updated_text_files:
-                    result_zf.writestr(info.filename, updated_text_files[info.filename].encode('utf-8'))
-                    processed.add(info.filename)
-                else:
-                    result_zf.writestr(info, original_zf.read(info.filename))
-            for filepath, content in updated_text_files.items():
-                if filepath not in processed:
-                    result_zf.writestr(filepath, content.encode('utf-8'))
-    return result_buffer.getvalue()
-
-
-def call_openrouter(model, prompt_text, on_partial=None, soft_deadline=None):
-    """Запрашивает модель в потоковом режиме.
-
-    Ответ приходит частями, поэтому соединение не простаивает и шлюз не рвёт его
-    по таймауту бездействия. Куски склеиваются в единый текст — результат
-    полностью совпадает с обычным (непотоковым) ответом.
-
-    on_partial — колбэк, которому раз в PARTIAL_SAVE_SEC отдаётся накопленный
-    текст: так уже написанное переживёт обрыв функции.
-    soft_deadline — момент (time.time()), после которого поток обрывается
-    аккуратно: возвращаем написанное с пометкой incomplete, чтобы дописать
-    следующим запуском, а не потерять всё по таймауту облака.
-    """
-    t0 = time.time()
-    try:
-        response = requests.post(
-            OPENROUTER_URL,
-            headers={
-                'Authorization': f'Bearer {OPENROUTER_API_KEY}',
-                'Content-Type': 'application/json',
-                'Accept': 'text/event-stream',
-            },
-            json={
-                'model': model,
-                'messages': [{'role': 'user', 'content': prompt_text}],
-                'max_tokens': 100000,
-                'stream': True,
-            },
-            timeout=(30, 570),
-            proxies=get_openrouter_proxies(),
-            stream=True,
-        )
-    except requests.exceptions.RequestException as e:
-        # Связь оборвалась до ответа — модель ничего не считала и денег не взяла
-        print(f'[openrouter-fail] model={model} связь не установлена: {str(e)[:300]}')
-        return None, f'{NETWORK_ERROR_MARK}: {str(e)[:400]}', False
-
-    t_headers = time.time() - t0
-    if response.status_code != 200:
-        return None, f'OpenRouter ошибка ({response.status_code}): {response.text[:500]}', False
-
-    # Без явной кодировки поток декодируется как latin-1 и кириллица ломается.
-    response.encoding = 'utf-8'
-
-    chunks = []
-    stream_error = None
-    t_first_chunk = None
-    truncated = False
-    last_save = time.time()
-    net_broke = []
-
-    def safe_lines():
-        """Обрыв связи посреди ответа не должен ронять уже полученный текст."""
-        try:
-            for line in response.iter_lines(decode_unicode=True):
-                yield line
-        except requests.exceptions.RequestException as e:
-            net_broke.append(str(e)[:300])
-            print(f'[openrouter-fail] model={model} связь оборвалась: {str(e)[:300]}')
-
-    for raw_line in safe_lines():
-        # Не даём облаку убить функцию на полуслове: сохраняем и выходим сами
-        if soft_deadline and time.time() > soft_deadline:
-            truncated = True
-            break
-        if on_partial and chunks and time.time() - last_save >= PARTIAL_SAVE_SEC:
-            on_partial(''.join(chunks))
-            last_save = time.time()
-        if not raw_line:
-            continue
-        if raw_line.startswith(':'):
-            continue
-        if not raw_line.startswith('data: '):
-            continue
-
-        payload = raw_line[6:].strip()
-        if payload == '[DONE]':
-            break
-
-        try:
-            parsed = json.loads(payload)
-        except ValueError:
-            continue
-
-        if parsed.get('error'):
-            err = parsed['error']
-            stream_error = err.get('message') if isinstance(err, dict) else str(err)
-            # Полный текст отказа — иначе потом не разобрать, кто и почему отказал
-            print(
-                f'[openrouter-fail] model={model} provider={parsed.get("provider")} '
-                f'err={json.dumps(err, ensure_ascii=False)[:400]}'
-            )
-            break
-
-        for choice in parsed.get('choices') or []:
-            piece = (choice.get('delta') or {}).get('content')
-            if piece:
-                if t_first_chunk is None:
-                    t_first_chunk = time.time() - t0
-                chunks.append(piece)
-
-    total = time.time() - t0
-    print(
-        f'[timing] model={model} prompt_chars={len(prompt_text)} '
-        f'headers={t_headers:.1f}s first_chunk={t_first_chunk if t_first_chunk is None else round(t_first_chunk, 1)}s '
-        f'total={total:.1f}s out_chars={sum(len(c) for c in chunks)} truncated={truncated}'
-    )
-
-    ai_text = ''.join(chunks)
-
-    if stream_error:
-        # Часть текста уже написана — сохраняем её и дописываем следующим заходом
-        if ai_text:
-            return ai_text, None, True
-        return None, f'OpenRouter ошибка: {stream_error[:500]}', False
-
-    if net_broke:
-        # Успели что-то получить — отдаём как незаконченное, допишем следующим
-        # заходом. Пусто — это сетевой сбой, его имеет смысл повторить
-        if ai_text:
-            return ai_text, None, True
-        return None, f'{NETWORK_ERROR_MARK}: {net_broke[0]}', False
-
-    if not ai_text:
-        print(f'[openrouter-fail] model={model} поток пуст, ни одного знака')
-        return None, 'Модель не вернула ответ', False
-    return ai_text, None, truncated
-
-
-def call_openrouter_retrying(model, prompt_text, on_partial=None, soft_deadline=None,
-                             attempts=3):
-    """Повторяет запрос, если модель не написала НИ ОДНОГО знака.
-
-    Два случая для повтора, и оба бесплатны — платного ответа не было:
-    обрыв связи по дороге и мгновенный пустой отказ провайдера.
-    Как только пошёл текст, повторов нет: написанное дороже, а второй заход
-    к модели — это второй платный запрос.
-    """
-    started = time.time()
-    last_error = None
-    for i in range(attempts):
-        text, error, truncated = call_openrouter(
-            model, prompt_text, on_partial=on_partial, soft_deadline=soft_deadline
-        )
-        if text or not error:
-            if i:
-                print(f'[openrouter-retry] успех с попытки {i + 1}')
-            return text, error, truncated
-        last_error = error
-        is_network = NETWORK_ERROR_MARK in (error or '')
-
-        # Времени до предела функции не осталось — повторять нечем
-        no_time = soft_deadline and time.time() + 40 > soft_deadline
-        # Пустой отказ повторяем только если он пришёл быстро: долгое молчание
-        # означает, что модель работала, и повтор будет платным впустую.
-        # Обрыв связи повторяем всегда — до модели запрос не дошёл
-        spent = time.time() - started
-        too_long = (not is_network) and spent > 60
-
-        if i == attempts - 1 or no_time or too_long:
-            break
-        print(f'[openrouter-retry] попытка {i + 1} неудачна ({str(error)[:120]}), повтор')
-        time.sleep(2 * (i + 1) if is_network else 1.5 * (i + 1))
-    return None, last_error, False
+def build_result_zip(original_zip, updated_text_files, deleted_paths=None,
+                     original_text_files=None):
+    """Собирает архив результата. Неизменённые записи копируются из исходного
+    архива без пересжатия (zip_rewrite), сжимаются только изменённые и новые
+    файлы. original_text_files — тексты исходного архива: файлы, совпадающие
+    с ними, считаются неизменёнными. Архив собирается во временном файле."""
+    if isinstance(original_zip, (bytes, bytearray)):
+        original_zip = io.BytesIO(original_zip)
+    if original_text_files is None:
+        changed = dict(updated_text_files)
+    else:
+        changed = {
+            path: content for path, content in updated_text_files.items()
+            if original_text_files.get(path) != content
+        }
+    with tempfile.TemporaryFile() as result_file:
+        zip_rewrite.rewrite_zip(original_zip, result_file, changed, deleted_paths)
+        result_file.seek(0)
+        return result_file.read()
 
 
 def sql_escape(val):
@@ -554,16 +524,26 @@ def sql_escape(val):
     return "'" + str(val).replace("'", "''") + "'"
 
 
-# Содержимое файлов кладём в БД в base64: сторожевой фильтр соединения
-# принимает код со скобками, кавычками и комментариями за попытку внедрения
-# SQL и рвёт запрос. Base64 — только буквы и цифры, придраться не к чему.
-B64_PREFIX = 'b64:'
+# Тексты (план, файлы шагов, черновики) пишутся в bytea-колонки сжатыми
+# zlib и передаются параметрами запроса. psycopg2 подставляет bytea
+# шестнадцатеричным литералом — сторожевому фильтру соединения, который
+# принимает код со скобками и кавычками за внедрение SQL, придраться не к
+# чему, а сжатый текст меньше и base64, и исходника.
+def pack_blob(text):
+    """Готовит текст к записи в bytea-колонку."""
+    return psycopg2.Binary(zlib.compress((text or '').encode('utf-8'), 6))
 
 
-def pack_text(text):
-    """Готовит текст файла к записи в БД."""
-    raw = (text or '').encode('utf-8')
-    return B64_PREFIX + base64.b64encode(raw).decode('ascii')
+def unpack_blob(value):
+    """Читает текст из bytea-колонки."""
+    if value is None:
+        return ''
+    return zlib.decompress(bytes(value)).decode('utf-8')
+
+
+# Старый формат: base64 с префиксом прямо в тексте запроса. Только чтение —
+# задачи, начатые до перехода на bytea, дочитываются как есть.
+B64_PREFIX = 'b64:'
 
 
 def unpack_text(value):
@@ -579,15 +559,8 @@ def unpack_text(value):
         return text
 
 
-def pack_json_sql(data):
-    """Кладёт структуру в jsonb-поле закодированной строкой — в описаниях
-    плана попадаются куски кода, на которых спотыкается тот же фильтр."""
-    packed = pack_text(json.dumps(data, ensure_ascii=False))
-    return f'to_jsonb({sql_escape(packed)}::text)'
-
-
 def unpack_json(value, default):
-    """Читает такое поле. Понимает и старый формат — обычный JSON."""
+    """Читает jsonb-поле старого формата — закодированную строку или обычный JSON."""
     if value is None:
         return default
     if isinstance(value, str):
@@ -599,10 +572,6 @@ def unpack_json(value, default):
     return value
 
 
-def pack_done_files(done_files):
-    return {path: pack_text(content) for path, content in (done_files or {}).items()}
-
-
 def unpack_done_files(done_files):
     return {path: unpack_text(content) for path, content in (done_files or {}).items()}
 
@@ -652,18 +621,263 @@ def refund_lenormand(task_id):
 
 
 STEP_LOCK_TIMEOUT_SEC = 300
+# Сколько файлов плана пишется одновременно за один вызов воркера
+ARCHIVE_PARALLEL = 4
+
+
+def plan_dependencies(targets, index):
+    """Для каждого файла плана — номера более ранних файлов, от которых он
+    зависит и которые поэтому должен увидеть уже написанными: связь по
+    импорту в любую сторону, упоминание создаваемого файла в задании шага
+    или повторная правка того же пути. Остальные файлы пишутся параллельно."""
+    entries = (index or {}).get('files') or {}
+    deps = []
+    for i, target in enumerate(targets):
+        path = target.get('path') or ''
+        what = target.get('what') or ''
+        mine = set((entries.get(path) or {}).get('imports') or [])
+        needs = []
+        for j in range(i):
+            other = targets[j].get('path') or ''
+            stem = os.path.splitext(os.path.basename(other))[0]
+            related = (
+                other == path
+                or other in mine
+                or path in ((entries.get(other) or {}).get('imports') or [])
+                or (targets[j].get('action') == 'create' and len(stem) > 2 and stem in what)
+            )
+            if related:
+                needs.append(j)
+        deps.append(needs)
+    return deps
 
 
-def process_archive_step(task_id, model, prompt, archive_base64):
-    """Обрабатывает ОДИН шаг архивной задачи и возвращает (done, error).
+def ensure_substeps(cur, task_id, targets, index, step_index):
+    """Заводит строки под-шагов для файлов плана один раз. Для задач, начатых
+    до параллельного режима, первые step_index файлов уже написаны."""
+    safe_id = str(task_id).replace("'", "''")
+    cur.execute(
+        f"SELECT 1 FROM {DB_SCHEMA}.ai_editor_substeps WHERE task_id = '{safe_id}' LIMIT 1"
+    )
+    if cur.fetchone():
+        return
+    deps = plan_dependencies(targets, index)
+    values = []
+    for i, target in enumerate(targets):
+        status = 'done' if i < step_index else 'pending'
+        dep_sql = 'ARRAY[' + ','.join(str(d) for d in deps[i]) + ']::int[]'
+        values.append(
+            f"('{safe_id}', {i}, {sql_escape(target.get('path') or '')}, '{status}', {dep_sql})"
+        )
+    cur.execute(
+        f"""INSERT INTO {DB_SCHEMA}.ai_editor_substeps (task_id, idx, path, status, depends_on)
+            VALUES {', '.join(values)}
+            ON CONFLICT (task_id, idx) DO NOTHING"""
+    )
 
-    Шаг 1 — план (какие файлы менять), далее по одному файлу за вызов.
-    Каждый вызов короткий, поэтому не упирается в лимит соединения.
-    """
+
+def claim_substeps(cur, task_id, limit):
+    """Берёт под замок до limit готовых к работе под-шагов: их зависимости
+    уже написаны. Подхватывает и брошенные оборвавшимся вызовом."""
     safe_id = str(task_id).replace("'", "''")
+    cur.execute(
+        f"""UPDATE {DB_SCHEMA}.ai_editor_substeps
+            SET status = 'processing', lock_at = NOW(), updated_at = NOW()
+            WHERE (task_id, idx) IN (
+                SELECT s.task_id, s.idx FROM {DB_SCHEMA}.ai_editor_substeps s
+                WHERE s.task_id = '{safe_id}'
+                  AND (s.status = 'pending'
+                       OR (s.status = 'processing'
+                           AND s.lock_at < NOW() - INTERVAL '{STEP_LOCK_TIMEOUT_SEC} seconds'))
+                  AND NOT EXISTS (
+                      SELECT 1 FROM {DB_SCHEMA}.ai_editor_substeps d
+                      WHERE d.task_id = s.task_id AND d.idx = ANY(s.depends_on)
+                        AND d.status <> 'done')
+                ORDER BY s.idx
+                LIMIT {int(limit)}
+                FOR UPDATE SKIP LOCKED)
+            RETURNING idx, retries"""
+    )
+    return sorted(cur.fetchall())
+
 
-    zip_bytes = base64.b64decode(archive_base64)
-    text_files = extract_text_files(zip_bytes)
+def save_substep_result(task_id, idx, content):
+    """Под-шаг готов: файл ложится в свою строку под-шага, поэтому
+    параллельные под-шаги не затирают результаты друг друга.
+    step_index считает готовые файлы — по нему status показывает прогресс."""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""UPDATE {DB_SCHEMA}.ai_editor_substeps
+                    SET status = 'done', content = %s, error = NULL, updated_at = NOW()
+                    WHERE task_id = %s AND idx = %s AND status <> 'done'
+                    RETURNING idx""",
+                (pack_blob(content), task_id, int(idx))
+            )
+            if cur.fetchone():
+                cur.execute(
+                    f"""UPDATE {DB_SCHEMA}.ai_editor_tasks
+                        SET step_index = COALESCE(step_index, 0) + 1, updated_at = NOW()
+                        WHERE id = %s""",
+                    (task_id,)
+                )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def register_substep_failure(task_id, idx, retries, error):
+    """Свой счётчик попыток у каждого под-шага. Возвращает True, если
+    попытки ещё остались — тогда под-шаг вернётся в очередь."""
+    safe_id = str(task_id).replace("'", "''")
+    retry = is_retryable_error(error) and retries + 1 < MAX_STEP_RETRIES
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""UPDATE {DB_SCHEMA}.ai_editor_substeps
+                    SET status = '{'pending' if retry else 'failed'}',
+                        retries = retries + 1,
+                        error = {sql_escape(safe_error_text(error))},
+                        updated_at = NOW()
+                    WHERE task_id = '{safe_id}' AND idx = {int(idx)}"""
+            )
+        conn.commit()
+    finally:
+        conn.close()
+    return retry
+
+
+def write_plan_file(task_id, model, prompt, text_files, index, targets, idx,
+                    done_files, plan_summary, conventions, deletes):
+    """Пишет один файл плана. Возвращает (content, error)."""
+    target = targets[idx]
+    path = target.get('path')
+    print(f'[{task_id}] Шаг {idx + 1}/{len(targets)}: файл {path}')
+
+    # Показываем проект в актуальном виде: то, что уже написано на прошлых
+    # шагах, вместо исходных версий. Иначе модель не видит собственную
+    # разметку и придумывает имена классов заново
+    current_files = dict(text_files)
+    current_files.update(done_files)
+    for dead in deletes:
+        current_files.pop(dead, None)
+
+    # Файлы, которые ещё не написаны (в том числе пишущиеся сейчас рядом):
+    # их нужно подключать как готовые, а не переписывать внутрь текущего файла
+    pending = []
+    for other in targets:
+        other_path = other.get('path')
+        if other_path and other_path != path and other_path not in done_files:
+            if any(p['path'] == other_path for p in pending):
+                continue
+            pending.append({'path': other_path, 'what': other.get('what') or ''})
+            # Ещё не созданный файл не должен показываться пустым
+            if other.get('action') == 'create':
+                current_files.pop(other_path, None)
+
+    # В контекст — целевой файл и связанные с ним (импорты, общие имена,
+    # совпадение по тексту задачи), а не весь проект
+    what = target.get('what') or ''
+    shown, omitted = context_index.select_context(
+        index, current_files,
+        ' '.join([prompt, what, plan_summary] + [str(c) for c in conventions]),
+        context_index.STEP_CONTEXT_BUDGET,
+        target=path, done_paths=done_files.keys(),
+    )
+    if omitted:
+        print(f'[{task_id}] Контекст шага {idx + 1}: файлов={len(shown)}, без содержимого={len(omitted)}')
+
+    prompt_text = build_step_file_prompt(
+        shown, prompt, path, what, plan_summary,
+        conventions=conventions,
+        done_paths=set(done_files.keys()) & set(shown.keys()),
+        pending=pending,
+        omitted=omitted,
+    )
+    ai_text, error, _ = call_openrouter_retrying(model, prompt_text)
+    if error:
+        return None, error
+    return parse_single_file_response(ai_text, path, current_files.get(path, '')), None
+
+
+def process_file_steps(task_id, model, prompt, text_files, index, plan_files,
+                       done_files, plan_summary, conventions, step_index):
+    """Файлы плана: каждый — свой под-шаг (ai_editor_substeps) со своим
+    счётчиком попыток. За вызов пишется до ARCHIVE_PARALLEL файлов, чьи
+    зависимости уже готовы, — независимые файлы не ждут друг друга."""
+    safe_id = str(task_id).replace("'", "''")
+    targets = plan_files.get('targets') or []
+    deletes = plan_files.get('delete') or []
+
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            ensure_substeps(cur, task_id, targets, index, step_index)
+            cur.execute(
+                f"""SELECT path, retries FROM {DB_SCHEMA}.ai_editor_substeps
+                    WHERE task_id = '{safe_id}' AND status = 'failed'
+                    ORDER BY idx LIMIT 1"""
+            )
+            failed = cur.fetchone()
+            batch = [] if failed else claim_substeps(cur, task_id, ARCHIVE_PARALLEL)
+        conn.commit()
+    finally:
+        conn.close()
+
+    if failed:
+        # Текст без признаков временного сбоя: попытки под-шага уже исчерпаны,
+        # повторять всю задачу ещё раз не нужно
+        return True, f'Не удалось обработать файл {failed[0]} после {failed[1]} попыток'
+
+    if batch:
+        print(f'[{task_id}] Параллельно пишу файлов: {len(batch)} ({[i for i, _ in batch]})')
+
+        def run(item):
+            idx, retries = item
+            try:
+                content, error = write_plan_file(
+                    task_id, model, prompt, text_files, index, targets, idx,
+                    done_files, plan_summary, conventions, deletes,
+                )
+            except Exception as e:
+                content, error = None, str(e)[:1000]
+            if error:
+                print(f'[{task_id}] Шаг {idx + 1} сорвался (попытка {retries + 1}): {str(error)[:200]}')
+                register_substep_failure(task_id, idx, retries, error)
+                return
+            save_substep_result(task_id, idx, content)
+
+        with ThreadPoolExecutor(max_workers=ARCHIVE_PARALLEL) as pool:
+            list(pool.map(run, batch))
+
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""UPDATE {DB_SCHEMA}.ai_editor_tasks
+                    SET step_lock = NULL, updated_at = NOW()
+                    WHERE id = '{safe_id}'"""
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+    # Не ждём следующего опроса статуса: следующая пачка или сборка архива
+    if batch:
+        trigger_self(task_id)
+    return False, None
+
+
+def process_archive_step(task_id, model, prompt, archive):
+    """Обрабатывает ОДИН шаг архивной задачи и возвращает (done, error).
+
+    Шаг 1 — план (какие файлы менять), далее файлы плана: за вызов — пачка
+    независимых друг от друга файлов (см. process_file_steps).
+    archive — где лежит исходник: {'s3_key', 'manifest_key', 'base64'}.
+    """
+    text_files, index, zip_file = load_text_files(task_id, archive)
     if not text_files:
         return True, 'Не найдено текстовых файлов в архиве'
 
@@ -672,25 +886,45 @@ def process_archive_step(task_id, model, prompt, archive_base64):
         with conn.cursor() as cur:
             cur.execute(
                 f"""SELECT plan_files, done_files, step_index, plan_summary,
-                           plan_conventions
-                    FROM {DB_SCHEMA}.ai_editor_tasks WHERE id = '{safe_id}'"""
+                           plan_conventions, plan_z
+                    FROM {DB_SCHEMA}.ai_editor_tasks WHERE id = %s""",
+                (task_id,)
             )
             row = cur.fetchone()
+            # Файлы, написанные под-шагами, лежат в их строках
+            cur.execute(
+                f"""SELECT path, content FROM {DB_SCHEMA}.ai_editor_substeps
+                    WHERE task_id = %s AND status = 'done' AND content IS NOT NULL
+                    ORDER BY idx""",
+                (task_id,)
+            )
+            written = cur.fetchall()
     finally:
         conn.close()
 
-    plan_files = unpack_json(row[0] if row else None, None)
-    done_files = unpack_json(row[1] if row else None, {}) or {}
     step_index = (row[2] if row and row[2] is not None else 0)
-    plan_summary = unpack_text(row[3] if row else '') or ''
-    conventions = unpack_json(row[4] if row else None, []) or []
-    done_files = unpack_done_files(done_files)
+    if row and row[5] is not None:
+        plan = json.loads(unpack_blob(row[5]))
+        plan_files = {'targets': plan.get('targets') or [], 'delete': plan.get('delete') or []}
+        plan_summary = plan.get('summary') or ''
+        conventions = plan.get('conventions') or []
+    else:
+        # Задача начата до перехода на bytea: план в старых колонках
+        plan_files = unpack_json(row[0] if row else None, None)
+        plan_summary = unpack_text(row[3] if row else '') or ''
+        conventions = unpack_json(row[4] if row else None, []) or []
+    done_files = unpack_done_files(unpack_json(row[1] if row else None, {}) or {})
+    for path, content in written:
+        done_files[path] = unpack_blob(content)
 
     # --- Шаг 1: построить план ---
     if plan_files is None:
-        print(f'[{task_id}] Шаг: планирование, файлов на входе={len(text_files)}')
+        shown, omitted = context_index.select_context(
+            index, text_files, prompt, context_index.PLAN_CONTEXT_BUDGET,
+        )
+        print(f'[{task_id}] Шаг: планирование, файлов на входе={len(text_files)}, в контексте={len(shown)}')
         plan_text, error, _ = call_openrouter_retrying(
-            model, build_plan_prompt(text_files, prompt)
+            model, build_plan_prompt(shown, prompt, omitted=omitted, index=index)
         )
         if error:
             return True, error
@@ -704,7 +938,9 @@ def process_archive_step(task_id, model, prompt, archive_base64):
 
         if not targets and not deletes:
             # Менять нечего — сразу отдаём исходный архив.
-            result_zip = build_result_zip(zip_bytes, dict(text_files))
+            if zip_file is None:
+                zip_file = open_archive_zip(archive)
+            result_zip = build_result_zip(zip_file, {}, original_text_files=text_files)
             save_archive_result(
                 task_id, model,
                 plan['summary'] or 'Изменения не потребовались',
@@ -712,84 +948,38 @@ def process_archive_step(task_id, model, prompt, archive_base64):
             )
             return True, None
 
-        payload = {'targets': targets, 'delete': deletes}
+        payload = {
+            'targets': targets, 'delete': deletes,
+            'summary': plan['summary'], 'conventions': plan['conventions'],
+        }
         conn = get_db_connection()
         try:
             with conn.cursor() as cur:
                 cur.execute(
                     f"""UPDATE {DB_SCHEMA}.ai_editor_tasks
-                        SET plan_files = {pack_json_sql(payload)},
-                            plan_summary = {sql_escape(pack_text(plan['summary']))},
-                            plan_conventions = {pack_json_sql(plan['conventions'])},
+                        SET plan_z = %s,
                             done_files = '{{}}'::jsonb,
                             step_index = 0,
                             step_lock = NULL,
-                            updated_at = '{datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}'
-                        WHERE id = '{safe_id}'"""
+                            updated_at = %s
+                        WHERE id = %s""",
+                    (pack_blob(json.dumps(payload, ensure_ascii=False)),
+                     datetime.utcnow(), task_id)
                 )
             conn.commit()
         finally:
             conn.close()
         return False, None
 
-    # --- Шаг 2..N: по одному файлу ---
+    # --- Шаг 2..N: файлы плана, независимые — параллельно ---
     targets = plan_files.get('targets') or []
     deletes = plan_files.get('delete') or []
 
     if step_index < len(targets):
-        target = targets[step_index]
-        path = target.get('path')
-        print(f'[{task_id}] Шаг {step_index + 1}/{len(targets)}: файл {path}')
-
-        # Показываем проект в актуальном виде: то, что уже написано на прошлых
-        # шагах, вместо исходных версий. Иначе модель не видит собственную
-        # разметку и придумывает имена классов заново
-        current_files = dict(text_files)
-        current_files.update(done_files)
-        for dead in deletes:
-            current_files.pop(dead, None)
-        # Текущий файл модель пишет сама — исходник ей уже показан в контексте
-        # шага, дублировать не нужно, но и прятать вредно: пусть видит основу
-
-        # Файлы, до которых очередь не дошла: их нужно подключать как готовые,
-        # а не переписывать внутрь текущего файла
-        pending = []
-        for later in targets[step_index + 1:]:
-            later_path = later.get('path')
-            if later_path and later_path != path:
-                pending.append({'path': later_path, 'what': later.get('what') or ''})
-                # Ещё не созданный файл не должен показываться пустым
-                if later.get('action') == 'create':
-                    current_files.pop(later_path, None)
-
-        prompt_text = build_step_file_prompt(
-            current_files, prompt, path, target.get('what') or '', plan_summary,
-            conventions=conventions,
-            done_paths=set(done_files.keys()),
-            pending=pending,
+        return process_file_steps(
+            task_id, model, prompt, text_files, index, plan_files,
+            done_files, plan_summary, conventions, step_index,
         )
-        ai_text, error, _ = call_openrouter_retrying(model, prompt_text)
-        if error:
-            return True, error
-
-        content = parse_single_file_response(ai_text, path, current_files.get(path, ''))
-        done_files[path] = content
-
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cur:
-                cur.execute(
-                    f"""UPDATE {DB_SCHEMA}.ai_editor_tasks
-                        SET done_files = {sql_escape(json.dumps(pack_done_files(done_files), ensure_ascii=False))}::jsonb,
-                            step_index = {step_index + 1},
-                            step_lock = NULL,
-                            updated_at = '{datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')}'
-                        WHERE id = '{safe_id}'"""
-                )
-            conn.commit()
-        finally:
-            conn.close()
-        return False, None
 
     # --- Финал: собрать архив ---
     print(f'[{task_id}] Сборка архива: изменено файлов={len(done_files)}')
@@ -798,7 +988,11 @@ def process_archive_step(task_id, model, prompt, archive_base64):
     for path in deletes:
         updated_files.pop(path, None)
 
-    result_zip = build_result_zip(zip_bytes, updated_files, deletes)
+    if zip_file is None:
+        zip_file = open_archive_zip(archive)
+    result_zip = build_result_zip(
+        zip_file, updated_files, deletes, original_text_files=text_files,
+    )
 
     lines = [plan_summary] if plan_summary else []
     if done_files:
@@ -950,7 +1144,8 @@ def process_archive_task(task_id):
                       AND status IN ('pending', 'processing')
                       AND (step_lock IS NULL
                            OR step_lock < NOW() - INTERVAL '{STEP_LOCK_TIMEOUT_SEC} seconds')
-                    RETURNING model, prompt, archive_base64"""
+                    RETURNING model, prompt, archive_base64, archive_s3_key,
+                              archive_manifest_key"""
             )
             row = cur.fetchone()
             if not row:
@@ -959,15 +1154,18 @@ def process_archive_task(task_id):
     finally:
         conn.close()
 
-    model, prompt, archive_base64 = row
+    model, prompt = row[0], row[1]
+    archive = {'base64': row[2], 's3_key': row[3], 'manifest_key': row[4]}
 
     try:
-        done, error = process_archive_step(task_id, model, prompt, archive_base64)
+        done, error = process_archive_step(task_id, model, prompt, archive)
     except Exception as e:
         done, error = True, str(e)[:1000]
 
     if not error:
         reset_step_failures(task_id)
+        if done:
+            drop_archive_objects(task_id, archive)
         return
 
     print(f'[{task_id}] Ошибка шага: {error}')
@@ -979,85 +1177,52 @@ def process_archive_task(task_id):
         return
 
     fail_task(task_id, error)
+    drop_archive_objects(task_id, archive)
 
 
-def extract_outline(text):
-    """Собирает оглавление уже написанного — заголовки разделов.
-
-    Хвоста в 4000 знаков мало: при продолжении модель не помнит, что разбирала
-    в начале, и повторяет мысли. Список заголовков занимает пару сотен знаков,
-    но показывает всю пройденную дорогу целиком.
-    """
-    titles = []
-    for line in (text or '').split('\n'):
-        line = line.strip()
-        if not line.startswith('#'):
-            continue
-        title = line.lstrip('#').strip().strip('*').strip()
-        # Заголовок первого уровня — название расклада, в оглавлении не нужен
-        if not title or line.startswith('# '):
-            continue
-        if title not in titles:
-            titles.append(title)
-    return titles
-
-
-def build_continue_prompt(original_prompt, done_text):
-    """Просит модель дописать оборванный ответ ровно с места разрыва.
-
-    Даём две опоры: оглавление уже написанного (чтобы не повторяться) и хвост
-    текста целиком (чтобы подхватить оборванную фразу).
-    """
-    tail = done_text[-4000:]
-
-    outline = extract_outline(done_text)
-    outline_block = ''
-    if outline:
-        # Последний заголовок — раздел, на котором текст оборвался:
-        # его надо дописать, а не пропустить вместе с остальными
-        lines = [f'- {t}' for t in outline[:-1]]
-        lines.append(f'- {outline[-1]}  ← НЕ ДОПИСАН, обрывается на полуслове')
-        listed = '\n'.join(lines)
-        outline_block = (
-            '\n=== УЖЕ РАЗОБРАНО (оглавление написанной части) ===\n'
-            f'{listed}\n'
-            'Разделы без пометки уже раскрыты полностью: НЕ разбирай их '
-            'заново, не пересказывай и не повторяй сказанное в них. '
-            'Допиши последний раздел с места обрыва и переходи к тому, '
-            'что ещё не раскрыто.\n'
-        )
-
-    return (
-        f'{original_prompt}\n\n'
-        '=== ВАЖНО ===\n'
-        'Ты уже начал писать этот ответ, но он оборвался на середине. '
-        'Ниже — оглавление уже написанного и КОНЕЦ текста. Продолжи ровно '
-        'с того места, где он обрывается: не здоровайся заново, не повторяй '
-        'написанное, не пересказывай начало и не пиши вступление. Просто '
-        'продолжи фразу и доведи ответ до конца.\n'
-        f'{outline_block}\n'
-        f'=== КОНЕЦ УЖЕ НАПИСАННОГО ===\n{tail}\n=== ПРОДОЛЖИ ОТСЮДА ==='
+def load_chunks(cur, task_id):
+    """Склеивает черновик из кусков ai_editor_chunks — один раз при захвате задачи."""
+    safe_id = str(task_id).replace("'", "''")
+    cur.execute(
+        f"""SELECT body, data FROM {DB_SCHEMA}.ai_editor_chunks
+            WHERE task_id = '{safe_id}' ORDER BY seq"""
+    )
+    return ''.join(
+        unpack_blob(data) if data is not None else unpack_text(body)
+        for body, data in cur.fetchall()
     )
 
 
-def save_partial(task_id, text, bump=False):
-    """Складывает уже написанный кусок в БД, чтобы он пережил обрыв функции.
-    Заодно обновляет stream_lock — признак того, что воркер жив."""
+def save_partial(task_id, delta, bump=False):
+    """Дописывает в черновик только новый кусок текста, чтобы он пережил обрыв
+    функции. Весь текст не перезаписываем: на длинных ответах это квадратичный
+    объём записи. Заодно обновляет stream_lock — признак того, что воркер жив.
+    bump — заход закончен и передаёт работу следующему: stream_lock снимается,
+    иначе разбуженный trigger_self воркер счёл бы задачу занятой.
+    Возвращает True, если кусок сохранён."""
     safe_id = str(task_id).replace("'", "''")
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
+            if delta:
+                cur.execute(
+                    f"""INSERT INTO {DB_SCHEMA}.ai_editor_chunks (task_id, seq, data, chars)
+                        SELECT %s, COALESCE(MAX(seq), 0) + 1, %s, %s
+                        FROM {DB_SCHEMA}.ai_editor_chunks WHERE task_id = %s""",
+                    (task_id, pack_blob(delta), len(delta), task_id)
+                )
             cur.execute(
                 f"""UPDATE {DB_SCHEMA}.ai_editor_tasks
-                    SET partial_text = {sql_escape(pack_text(text))},
-                        stream_lock = NOW(),
+                    SET stream_lock = {'NULL' if bump else 'NOW()'},
                         resume_count = resume_count + {1 if bump else 0},
                         updated_at = NOW()
                     WHERE id = '{safe_id}'"""
             )
         conn.commit()
+        return True
     except Exception as e:
         print(f'[{task_id}] partial save (non-critical): {e}')
+        return False
     finally:
         conn.close()
 
@@ -1094,18 +1259,24 @@ def process_task(task_id):
                                AND (stream_lock IS NULL
                                     OR stream_lock < NOW() - INTERVAL '60 seconds')))
                     RETURNING id, mode, model, prompt, filename, file_content, archive_base64,
-                              partial_text, resume_count"""
+                              partial_text, resume_count, task_type"""
             )
             row = cur.fetchone()
             if not row:
                 print(f'Task {task_id} not found or already processing')
                 return
+            timing_service = 'divination' if row[9] == 'lenormand' else 'ai_editor'
+            mark_stage(cur, timing_service, task_id, 'admitted')
+            # partial_text — черновик старого формата (целиком), дальше идут куски
+            done_before = unpack_text(row[7])
+            if row[1] == 'chat':
+                done_before += load_chunks(cur, task_id)
         conn.commit()
     finally:
         conn.close()
 
     (_, mode, model, prompt, filename, file_content, archive_base64,
-     partial_text, resume_count) = row
+     _partial_text, resume_count, _task_type) = row
     print(f'[{task_id}] Задача загружена: mode={mode}, model={model}, archive_size={len(archive_base64) if archive_base64 else 0}')
 
     ai_text = None
@@ -1113,18 +1284,26 @@ def process_task(task_id):
     result_archive_base64 = None
     files_count = None
     error = None
+    # Вызов модели идёт без коннекта к БД — время этапов пишем при сохранении
+    submitted_at = time.monotonic()
 
     try:
         if mode == 'chat':
-            done_before = unpack_text(partial_text)
             # Продолжаем с места обрыва: модель видит начало и дописывает хвост
             ask = prompt if not done_before else build_continue_prompt(prompt, done_before)
             print(f'[{task_id}] Отправляю в OpenRouter (chat), уже написано={len(done_before)}, попытка={resume_count}...')
 
+            # Сколько знаков нового текста уже лежит в ai_editor_chunks
+            saved = [0]
+
+            def on_partial(txt):
+                if save_partial(task_id, txt[saved[0]:]):
+                    saved[0] = len(txt)
+
             new_text, error, truncated = call_openrouter_retrying(
                 model,
                 ask,
-                on_partial=lambda txt: save_partial(task_id, done_before + txt),
+                on_partial=on_partial,
                 soft_deadline=task_started + SOFT_DEADLINE_SEC,
             )
             print(f'[{task_id}] OpenRouter ответил: error={error}, len={len(new_text) if new_text else 0}, truncated={truncated}')
@@ -1144,7 +1323,7 @@ def process_task(task_id):
             # полный расклад лучше, чем ошибка и возврат денег.
             if truncated and ai_text:
                 if resume_count + 1 < MAX_RESUMES:
-                    save_partial(task_id, ai_text, bump=True)
+                    save_partial(task_id, (new_text or '')[saved[0]:], bump=True)
                     print(f'[{task_id}] Сохранено {len(ai_text)} знаков, продолжу следующим заходом')
                     trigger_self(task_id)
                     return
@@ -1172,11 +1351,12 @@ def process_task(task_id):
                 print(f'[{task_id}] OpenRouter ответил: error={error}, len={len(ai_text) if ai_text else 0}')
                 if ai_text:
                     updated_files = parse_ai_response(ai_text, text_files)
-                    result_zip = build_result_zip(zip_bytes, updated_files)
+                    result_zip = build_result_zip(zip_bytes, updated_files, original_text_files=text_files)
                     result_archive_base64 = base64.b64encode(result_zip).decode('utf-8')
                     files_count = len(text_files)
     except Exception as e:
         error = str(e)[:1000]
+    provider_done_at = time.monotonic()
 
     conn2 = get_db_connection()
     _is_lenormand = False
@@ -1207,6 +1387,12 @@ def process_task(task_id):
                             files_count = {files_count_sql}, model_used = {sql_escape(model)}, updated_at = '{now}'
                         WHERE id = '{safe_id}'"""
                 )
+            # Ответ собран целиком (или задача упала) — куски черновика больше не нужны
+            if mode == 'chat':
+                cur.execute(f"DELETE FROM {DB_SCHEMA}.ai_editor_chunks WHERE task_id = '{safe_id}'")
+            mark_stage(cur, timing_service, task_id, 'submitted', since=submitted_at)
+            mark_stage(cur, timing_service, task_id, 'provider_done', since=provider_done_at)
+            mark_stage(cur, timing_service, task_id, 'finalized')
         conn2.commit()
         print(
             f'Task {task_id} finished: {"failed" if error else "completed"} '
@@ -1221,6 +1407,7 @@ def process_task(task_id):
         refund_lenormand(task_id)
 
 
+@profiling.profiled('ai-editor-worker')
 def handler(event, context):
     """Worker: обрабатывает задачу AI-редактирования из БД."""
 
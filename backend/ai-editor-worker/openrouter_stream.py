@@ -0,0 +1,292 @@
+"""Потоковый вызов OpenRouter с сохранением написанного и дописыванием.
+
+Общий модуль воркеров, которые ждут от модели длинный текст (AI-редактор,
+диалог-гадание). Ответ идёт потоком, уже написанное раз в PARTIAL_SAVE_SEC
+отдаётся колбэку на сохранение, а перед мягким дедлайном поток обрывается
+аккуратно — следующий запуск воркера продолжает текст с места обрыва
+(build_continue_prompt), а не начинает заново.
+"""
+
+import json
+import os
+import time
+
+import requests
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+# Как часто сбрасывать в БД уже написанный текст (сек)
+PARTIAL_SAVE_SEC = 15
+# Метка сетевого сбоя: связь не дошла до модели, значит запрос бесплатный
+# и его безопасно повторить
+NETWORK_ERROR_MARK = 'Обрыв связи'
+
+
+def get_api_key():
+    return (os.environ.get("OPENROUTER_API_KEY_NEW") or os.environ.get("OPENROUTER_API_KEY_OLD") or "").strip()
+
+
+def get_openrouter_proxies():
+    proxy_url = (os.environ.get("OPENROUTER_PROXY_URL") or "").strip()
+    if not proxy_url:
+        return None
+    return {"http": proxy_url, "https": proxy_url}
+
+
+def call_openrouter(model, prompt_text, on_partial=None, soft_deadline=None,
+                    max_tokens=100000, temperature=None, read_timeout=570,
+                    system_text=None):
+    """Запрашивает модель в потоковом режиме.
+
+    Ответ приходит частями, поэтому соединение не простаивает и шлюз не рвёт его
+    по таймауту бездействия. Куски склеиваются в единый текст — результат
+    полностью совпадает с обычным (непотоковым) ответом.
+
+    on_partial — колбэк, которому раз в PARTIAL_SAVE_SEC отдаётся накопленный
+    текст: так уже написанное переживёт обрыв функции.
+    soft_deadline — момент (time.time()), после которого поток обрывается
+    аккуратно: возвращаем написанное с пометкой incomplete, чтобы дописать
+    следующим запуском, а не потерять всё по таймауту облака.
+
+    system_text — постоянная часть промпта (роль, правила). Идёт отдельным
+    системным сообщением с пометкой cache_control: провайдеры с кэшем промптов
+    не пересчитывают её от запроса к запросу, а остальные пометку пропускают.
+
+    Возвращает (text, error, truncated): truncated — текст недописан и его
+    стоит продолжить (build_continue_prompt).
+    """
+    api_key = get_api_key()
+    if not api_key:
+        return None, 'Ключ OpenRouter не настроен', False
+
+    messages = [{'role': 'user', 'content': prompt_text}]
+    if system_text:
+        messages.insert(0, {'role': 'system', 'content': [{
+            'type': 'text',
+            'text': system_text,
+            'cache_control': {'type': 'ephemeral'},
+        }]})
+
+    payload = {
+        'model': model,
+        'messages': messages,
+        'max_tokens': max_tokens,
+        'stream': True,
+        # Расход токенов в последнем куске потока — по нему видно, сработал ли кэш
+        'usage': {'include': True},
+    }
+    if temperature is not None:
+        payload['temperature'] = temperature
+
+    t0 = time.time()
+    try:
+        response = requests.post(
+            OPENROUTER_URL,
+            headers={
+                'Authorization': f'Bearer {api_key}',
+                'Content-Type': 'application/json',
+                'Accept': 'text/event-stream',
+            },
+            json=payload,
+            timeout=(30, read_timeout),
+            proxies=get_openrouter_proxies(),
+            stream=True,
+        )
+    except requests.exceptions.RequestException as e:
+        # Связь оборвалась до ответа — модель ничего не считала и денег не взяла
+        print(f'[openrouter-fail] model={model} связь не установлена: {str(e)[:300]}')
+        return None, f'{NETWORK_ERROR_MARK}: {str(e)[:400]}', False
+
+    t_headers = time.time() - t0
+    if response.status_code != 200:
+        return None, f'OpenRouter ошибка ({response.status_code}): {response.text[:500]}', False
+
+    # Без явной кодировки поток декодируется как latin-1 и кириллица ломается.
+    response.encoding = 'utf-8'
+
+    chunks = []
+    stream_error = None
+    t_first_chunk = None
+    truncated = False
+    last_save = time.time()
+    net_broke = []
+    usage = {}
+
+    def safe_lines():
+        """Обрыв связи посреди ответа не должен ронять уже полученный текст."""
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                yield line
+        except requests.exceptions.RequestException as e:
+            net_broke.append(str(e)[:300])
+            print(f'[openrouter-fail] model={model} связь оборвалась: {str(e)[:300]}')
+
+    for raw_line in safe_lines():
+        # Не даём облаку убить функцию на полуслове: сохраняем и выходим сами
+        if soft_deadline and time.time() > soft_deadline:
+            truncated = True
+            break
+        if on_partial and chunks and time.time() - last_save >= PARTIAL_SAVE_SEC:
+            on_partial(''.join(chunks))
+            last_save = time.time()
+        if not raw_line:
+            continue
+        if raw_line.startswith(':'):
+            continue
+        if not raw_line.startswith('data: '):
+            continue
+
+        payload = raw_line[6:].strip()
+        if payload == '[DONE]':
+            break
+
+        try:
+            parsed = json.loads(payload)
+        except ValueError:
+            continue
+
+        if parsed.get('error'):
+            err = parsed['error']
+            stream_error = err.get('message') if isinstance(err, dict) else str(err)
+            # Полный текст отказа — иначе потом не разобрать, кто и почему отказал
+            print(
+                f'[openrouter-fail] model={model} provider={parsed.get("provider")} '
+                f'err={json.dumps(err, ensure_ascii=False)[:400]}'
+            )
+            break
+
+        if parsed.get('usage'):
+            usage = parsed['usage']
+
+        for choice in parsed.get('choices') or []:
+            piece = (choice.get('delta') or {}).get('content')
+            if piece:
+                if t_first_chunk is None:
+                    t_first_chunk = time.time() - t0
+                chunks.append(piece)
+
+    total = time.time() - t0
+    cached = (usage.get('prompt_tokens_details') or {}).get('cached_tokens')
+    print(
+        f'[timing] model={model} prompt_chars={len(prompt_text) + len(system_text or "")} '
+        f'headers={t_headers:.1f}s first_chunk={t_first_chunk if t_first_chunk is None else round(t_first_chunk, 1)}s '
+        f'total={total:.1f}s out_chars={sum(len(c) for c in chunks)} truncated={truncated} '
+        f'prompt_tokens={usage.get("prompt_tokens")} cached_tokens={cached}'
+    )
+
+    ai_text = ''.join(chunks)
+
+    if stream_error:
+        # Часть текста уже написана — сохраняем её и дописываем следующим заходом
+        if ai_text:
+            return ai_text, None, True
+        return None, f'OpenRouter ошибка: {stream_error[:500]}', False
+
+    if net_broke:
+        # Успели что-то получить — отдаём как незаконченное, допишем следующим
+        # заходом. Пусто — это сетевой сбой, его имеет смысл повторить
+        if ai_text:
+            return ai_text, None, True
+        return None, f'{NETWORK_ERROR_MARK}: {net_broke[0]}', False
+
+    if not ai_text:
+        print(f'[openrouter-fail] model={model} поток пуст, ни одного знака')
+        return None, 'Модель не вернула ответ', False
+    return ai_text, None, truncated
+
+
+def call_openrouter_retrying(model, prompt_text, on_partial=None, soft_deadline=None,
+                             attempts=3, **options):
+    """Повторяет запрос, если модель не написала НИ ОДНОГО знака.
+
+    Два случая для повтора, и оба бесплатны — платного ответа не было:
+    обрыв связи по дороге и мгновенный пустой отказ провайдера.
+    Как только пошёл текст, повторов нет: написанное дороже, а второй заход
+    к модели — это второй платный запрос.
+    """
+    started = time.time()
+    last_error = None
+    for i in range(attempts):
+        text, error, truncated = call_openrouter(
+            model, prompt_text, on_partial=on_partial, soft_deadline=soft_deadline,
+            **options
+        )
+        if text or not error:
+            if i:
+                print(f'[openrouter-retry] успех с попытки {i + 1}')
+            return text, error, truncated
+        last_error = error
+        is_network = NETWORK_ERROR_MARK in (error or '')
+
+        # Времени до предела функции не осталось — повторять нечем
+        no_time = soft_deadline and time.time() + 40 > soft_deadline
+        # Пустой отказ повторяем только если он пришёл быстро: долгое молчание
+        # означает, что модель работала, и повтор будет платным впустую.
+        # Обрыв связи повторяем всегда — до модели запрос не дошёл
+        spent = time.time() - started
+        too_long = (not is_network) and spent > 60
+
+        if i == attempts - 1 or no_time or too_long:
+            break
+        print(f'[openrouter-retry] попытка {i + 1} неудачна ({str(error)[:120]}), повтор')
+        time.sleep(2 * (i + 1) if is_network else 1.5 * (i + 1))
+    return None, last_error, False
+
+
+def extract_outline(text):
+    """Собирает оглавление уже написанного — заголовки разделов.
+
+    Хвоста в 4000 знаков мало: при продолжении модель не помнит, что разбирала
+    в начале, и повторяет мысли. Список заголовков занимает пару сотен знаков,
+    но показывает всю пройденную дорогу целиком.
+    """
+    titles = []
+    for line in (text or '').split('\n'):
+        line = line.strip()
+        if not line.startswith('#'):
+            continue
+        title = line.lstrip('#').strip().strip('*').strip()
+        # Заголовок первого уровня — название расклада, в оглавлении не нужен
+        if not title or line.startswith('# '):
+            continue
+        if title not in titles:
+            titles.append(title)
+    return titles
+
+
+def build_continue_prompt(original_prompt, done_text):
+    """Просит модель дописать оборванный ответ ровно с места разрыва.
+
+    Даём две опоры: оглавление уже написанного (чтобы не повторяться) и хвост
+    текста целиком (чтобы подхватить оборванную фразу).
+    """
+    tail = done_text[-4000:]
+
+    outline = extract_outline(done_text)
+    outline_block = ''
+    if outline:
+        # Последний заголовок — раздел, на котором текст оборвался:
+        # его надо дописать, а не пропустить вместе с остальными
+        lines = [f'- {t}' for t in outline[:-1]]
+        lines.append(f'- {outline[-1]}  ← НЕ ДОПИСАН, обрывается на полуслове')
+        listed = '\n'.join(lines)
+        outline_block = (
+            '\n=== УЖЕ РАЗОБРАНО (оглавление написанной части) ===\n'
+            f'{listed}\n'
+            'Разделы без пометки уже раскрыты полностью: НЕ разбирай их '
+            'заново, не пересказывай и не повторяй сказанное в них. '
+            'Допиши последний раздел с места обрыва и переходи к тому, '
+            'что ещё не раскрыто.\n'
+        )
+
+    return (
+        f'{original_prompt}\n\n'
+        '=== ВАЖНО ===\n'
+        'Ты уже начал писать этот ответ, но он оборвался на середине. '
+        'Ниже — оглавление уже написанного и КОНЕЦ текста. Продолжи ровно '
+        'с того места, где он обрывается: не здоровайся заново, не повторяй '
+        'написанное, не пересказывай начало и не пиши вступление. Просто '
+        'продолжи фразу и доведи ответ до конца.\n'
+        f'{outline_block}\n'
+        f'=== КОНЕЦ УЖЕ НАПИСАННОГО ===\n{tail}\n=== ПРОДОЛЖИ ОТСЮДА ==='
+    )
@@ -0,0 +1,208 @@
+"""Пересборка zip-архива результата без пересжатия.
+
+Неизменённые записи (картинки, шрифты, нетронутый код) копируются из
+исходного архива как есть — сжатые байты и заголовки без распаковки.
+Сжимаются только изменённые и новые текстовые файлы. Архив пишется в
+файловый объект потоком, поэтому целиком в памяти не держится.
+"""
+
+import struct
+import time
+import zipfile
+import zlib
+
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+LOCAL_SIG = b'PK\x03\x04'
+CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+CENTRAL_SIG = b'PK\x01\x02'
+END_RECORD = struct.Struct('<4s4H2LH')
+END_SIG = b'PK\x05\x06'
+DESCRIPTOR_SIG = b'PK\x07\x08'
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_MAX_ENTRIES = 0xFFFF
+COPY_CHUNK = 1024 * 1024
+
+
+def _dos_datetime(date_time):
+    year, month, day, hour, minute, second = date_time
+    dosdate = (max(year, 1980) - 1980) << 9 | month << 5 | day
+    dostime = hour << 11 | minute << 5 | second // 2
+    return dostime, dosdate
+
+
+def _encode_name(name, flag_bits):
+    if flag_bits & FLAG_UTF8:
+        return name.encode('utf-8')
+    try:
+        return name.encode('cp437')
+    except UnicodeEncodeError:
+        return name.encode('utf-8')
+
+
+def _copy_range(src, out, start, length):
+    src.seek(start)
+    while length > 0:
+        chunk = src.read(min(COPY_CHUNK, length))
+        if not chunk:
+            raise zipfile.BadZipFile('Архив обрезан')
+        out.write(chunk)
+        length -= len(chunk)
+
+
+def _copy_raw(src, out, info):
+    """Переносит запись целиком: локальный заголовок, сжатые данные и
+    дескриптор данных, если он есть. Возвращает новое смещение заголовка."""
+    src.seek(info.header_offset)
+    header = src.read(LOCAL_HEADER.size)
+    fields = LOCAL_HEADER.unpack(header)
+    if fields[0] != LOCAL_SIG:
+        raise zipfile.BadZipFile(f'Неверный локальный заголовок: {info.filename}')
+    name_len, extra_len = fields[10], fields[11]
+    length = LOCAL_HEADER.size + name_len + extra_len + info.compress_size
+
+    if info.flag_bits & FLAG_DATA_DESCRIPTOR:
+        src.seek(info.header_offset + length)
+        # Подпись дескриптора необязательна: 16 байт с ней, 12 без
+        length += 16 if src.read(4) == DESCRIPTOR_SIG else 12
+
+    offset = out.tell()
+    _copy_range(src, out, info.header_offset, length)
+    return offset
+
+
+def _write_new(out, name, data, like=None):
+    """Пишет изменённый или новый файл, сжимая только его."""
+    info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+    if like is not None:
+        info.external_attr = like.external_attr
+        info.create_system = like.create_system
+    else:
+        info.external_attr = 0o600 << 16
+    info.file_size = len(data)
+    info.CRC = zlib.crc32(data) & 0xFFFFFFFF
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    packed = compressor.compress(data) + compressor.flush()
+    if len(packed) < len(data):
+        info.compress_type = zipfile.ZIP_DEFLATED
+    else:
+        info.compress_type = zipfile.ZIP_STORED
+        packed = data
+    info.compress_size = len(packed)
+    info.flag_bits = 0 if name.isascii() else FLAG_UTF8
+    info.create_version = info.extract_version = 20
+    info.extra = b''
+
+    name_bytes = _encode_name(name, info.flag_bits)
+    dostime, dosdate = _dos_datetime(info.date_time)
+    offset = out.tell()
+    out.write(LOCAL_HEADER.pack(
+        LOCAL_SIG, info.extract_version, 0, info.flag_bits, info.compress_type,
+        dostime, dosdate, info.CRC, info.compress_size, info.file_size,
+        len(name_bytes), 0,
+    ))
+    out.write(name_bytes)
+    out.write(packed)
+    return info, offset
+
+
+def _central_record(info, offset):
+    name_bytes = _encode_name(info.orig_filename, info.flag_bits)
+    extra = info.extra or b''
+    comment = info.comment or b''
+    dostime, dosdate = _dos_datetime(info.date_time)
+    return CENTRAL_HEADER.pack(
+        CENTRAL_SIG, info.create_version, info.create_system,
+        info.extract_version, info.reserved, info.flag_bits, info.compress_type,
+        dostime, dosdate, info.CRC, info.compress_size, info.file_size,
+        len(name_bytes), len(extra), len(comment), 0,
+        info.internal_attr, info.external_attr, offset,
+    ) + name_bytes + extra + comment
+
+
+def _has_zip64_extra(extra):
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, size = struct.unpack('<HH', extra[pos:pos + 4])
+        if tag == 0x0001:
+            return True
+        pos += 4 + size
+    return False
+
+
+def _needs_zip64(infos, changed):
+    if len(infos) + len(changed) >= ZIP_MAX_ENTRIES:
+        return True
+    return any(
+        i.header_offset >= ZIP64_LIMIT or i.compress_size >= ZIP64_LIMIT
+        or i.file_size >= ZIP64_LIMIT or _has_zip64_extra(i.extra or b'')
+        for i in infos
+    )
+
+
+def _rewrite_recompress(zf, out, changed, deleted):
+    """Запасной путь для ZIP64-архивов: пересобираем средствами zipfile."""
+    written = set()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as result_zf:
+        for info in zf.infolist():
+            if info.filename in deleted:
+                continue
+            if info.filename in changed:
+                result_zf.writestr(info.filename, changed[info.filename].encode('utf-8'))
+                written.add(info.filename)
+            elif info.is_dir():
+                result_zf.writestr(info, '')
+            else:
+                with zf.open(info) as src_member, result_zf.open(info, 'w') as dst_member:
+                    while True:
+                        chunk = src_member.read(COPY_CHUNK)
+                        if not chunk:
+                            break
+                        dst_member.write(chunk)
+        for name, text in changed.items():
+            if name not in written and name not in deleted:
+                result_zf.writestr(name, text.encode('utf-8'))
+
+
+def rewrite_zip(src, out, changed, deleted=None):
+    """Собирает архив результата в out (файл, открытый на запись).
+
+    src — исходный архив (файловый объект с seek), changed — {путь: текст}
+    изменённых и новых файлов, deleted — пути, которые нужно убрать.
+    Остальные записи переносятся без распаковки и пересжатия.
+    """
+    deleted = set(deleted or ())
+    with zipfile.ZipFile(src, 'r') as zf:
+        infos = zf.infolist()
+        if _needs_zip64(infos, changed):
+            _rewrite_recompress(zf, out, changed, deleted)
+            return
+
+        entries = []
+        written = set()
+        for info in infos:
+            name = info.filename
+            if name in deleted:
+                continue
+            if name in changed and not info.is_dir():
+                entries.append(_write_new(out, name, changed[name].encode('utf-8'), like=info))
+                written.add(name)
+                continue
+            entries.append((info, _copy_raw(src, out, info)))
+
+        for name, text in changed.items():
+            if name not in written and name not in deleted:
+                entries.append(_write_new(out, name, text.encode('utf-8')))
+
+        cd_offset = out.tell()
+        for info, offset in entries:
+            out.write(_central_record(info, offset))
+        cd_size = out.tell() - cd_offset
+        comment = zf.comment or b''
+        out.write(END_RECORD.pack(
+            END_SIG, 0, 0, len(entries), len(entries), cd_size, cd_offset, len(comment),
+        ))
+        out.write(comment)
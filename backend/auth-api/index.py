@@ -2,16 +2,15 @@ import json
 import os
 import hashlib
 import secrets
-import smtplib
 from typing import Dict, Any
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from datetime import datetime, timedelta
 from typing import Dict, Any
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import bcrypt
 
+from email_outbox import enqueue_email, wake_sender
+
 def get_db_connection():
     # Force redeploy v2
     dsn = os.environ.get('DATABASE_URL')
@@ -127,20 +126,10 @@ def log_login_attempt(cursor, conn, ip_address: str, email: str, success: bool):
     )
     conn.commit()
 
-def send_verification_email(email: str, token: str, user_name: str):
-    smtp_host = os.environ.get('SMTP_HOST')
-    smtp_port = int(os.environ.get('SMTP_PORT', '587'))
-    smtp_user = os.environ.get('SMTP_USER')
-    smtp_password = os.environ.get('SMTP_PASSWORD')
-    
+def send_verification_email(cursor, email: str, token: str, user_name: str):
     site_url = 'https://fitting-room.ru'
     verify_url = f"{site_url}/verify-email?token={token}"
     
-    message = MIMEMultipart('alternative')
-    message['Subject'] = 'Подтвердите email - Виртуальная примерочная'
-    message['From'] = 'virtualfitting@mail.ru'
-    message['To'] = email
-    
     text_content = f"""
 Здравствуйте, {user_name}!
 
@@ -180,21 +169,11 @@ def send_verification_email(email: str, token: str, user_name: str):
 </html>
 """
     
-    text_part = MIMEText(text_content, 'plain', 'utf-8')
-    html_part = MIMEText(html_content, 'html', 'utf-8')
-    
-    message.attach(text_part)
-    message.attach(html_part)
-    
-    if smtp_port == 465:
-        with smtplib.SMTP_SSL(smtp_host, smtp_port) as server:
-            server.login(smtp_user, smtp_password)
-            server.send_message(message)
-    else:
-        with smtplib.SMTP(smtp_host, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.send_message(message)
+    # Письмо уходит через очередь email_outbox — запрос не ждёт SMTP
+    enqueue_email(
+        cursor, email, 'Подтвердите email - Виртуальная примерочная',
+        text_content, html_content, source='auth-api',
+    )
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -341,9 +320,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 (user_id, verification_token, expires_at)
             )
             
+            send_verification_email(cursor, email, verification_token, name)
             conn.commit()
-            
-            send_verification_email(email, verification_token, name)
+            wake_sender()
             
             return {
                 'statusCode': 201,
@@ -5,6 +5,7 @@ from typing import Dict, Any
 import uuid
 from datetime import datetime
 from session_utils import validate_session
+from task_timings import mark_stage
 
 COLORGUIDE_COST = 50
 
@@ -250,6 +251,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             INSERT INTO color_guide_tasks (id, user_id, status, person_image, cost, created_at, service_type, height, form_params, forced_colortype_slug, forced_colortype_slug_alt, partner_image)
             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
         ''', (task_id, user_id, 'pending', person_image, cost, datetime.utcnow(), service_type, height, form_params_json, forced_slug, forced_slug_alt, partner_image))
+        mark_stage(cursor, 'colorguide', task_id, 'queued')
 
         if cost > 0:
             balance_after = balance - cost
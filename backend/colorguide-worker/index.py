@@ -13,6 +13,10 @@ import psycopg2
 import boto3
 
 import registry
+from task_timings import mark_stage
+from balance_ledger import refund_task
+from media_refs import hold_media_ref
+import profiling
 
 
 def _open_openrouter(req, timeout):
@@ -181,6 +185,9 @@ def upload_to_s3(image_data_url: str, task_id: str, user_id: str) -> str:
     return f'https://storage.yandexcloud.net/{s3_bucket}/{s3_key}'
 
 
+# Сколько зависших задач разбирает один запуск в режиме sweep (его вызывает task-sweeper)
+SWEEP_BATCH = 20
+
 HEX_PATTERN = '^#[0-9A-Fa-f]{6}$'
 
 COLOR_ITEM_SCHEMA = {
@@ -778,6 +785,8 @@ def process_image_service(task_id: str, service_type: str, person_image: str, us
     text_only = registry.is_text_only(service_type)
     # Готовый разбор: если он уже есть, а картинка не удалась — сохраним текст и вернём деньги.
     analysis = None
+    # Загруженные нами исходные фото: на них держим ссылку в media_refs
+    source_urls = []
 
     try:
         if text_only:
@@ -785,6 +794,7 @@ def process_image_service(task_id: str, service_type: str, person_image: str, us
             print('[COLORGUIDE-WORKER] Text-only service: фото не требуется')
         else:
             person_url = upload_to_s3(person_image, task_id, str(user_id))
+            source_urls.append(person_url)
             print(f'[COLORGUIDE-WORKER] Person uploaded to {person_url}')
 
         # Фото партнёра — ТОЛЬКО для анализа, в генерацию картинки не идёт.
@@ -797,6 +807,7 @@ def process_image_service(task_id: str, service_type: str, person_image: str, us
                     print(f'[COLORGUIDE-WORKER] Partner photo by URL: {partner_url}')
                 else:
                     partner_url = upload_to_s3(partner_image, f'{task_id}-partner', str(user_id))
+                    source_urls.append(partner_url)
                     print(f'[COLORGUIDE-WORKER] Partner photo uploaded to {partner_url}')
             except Exception as p_err:
                 print(f'[COLORGUIDE-WORKER] Partner photo skipped: {p_err}')
@@ -893,6 +904,9 @@ def process_image_service(task_id: str, service_type: str, person_image: str, us
 
         cdn_url = None
         last_no_media_err = None
+        # Этапы проходят без коннекта к БД — время запоминаем и пишем при сохранении
+        provider_done_at = None
+        uploaded_at = None
         for gen_attempt in range(2):
             try:
                 status_url, response_url = fal_submit(
@@ -901,9 +915,11 @@ def process_image_service(task_id: str, service_type: str, person_image: str, us
                     service.ASPECT_RATIO
                 )
                 print(f'[COLORGUIDE-WORKER] STEP fal submitted: {status_url}')
-                save_fal_urls(task_id, status_url, response_url, analysis)
+                save_fal_urls(task_id, status_url, response_url, analysis, user_id, source_urls)
                 result_image_url = fal_poll_result(status_url, response_url)
+                provider_done_at = time.monotonic()
                 cdn_url = upload_result_to_s3(result_image_url, task_id, str(user_id))
+                uploaded_at = time.monotonic()
                 print(f'[COLORGUIDE-WORKER] Result image saved: {cdn_url}')
                 break
             except Exception as gen_err:
@@ -915,13 +931,13 @@ def process_image_service(task_id: str, service_type: str, person_image: str, us
     except urllib.error.HTTPError as e:
         err_body = e.read().decode('utf-8', errors='replace')[:600] if hasattr(e, 'read') else ''
         print(f'[COLORGUIDE-WORKER] ERROR (image service) HTTP {e.code}: {err_body}')
-        if analysis and _save_result_without_image(task_id, analysis, NO_IMAGE_NOTE):
+        if analysis and _save_result_without_image(task_id, analysis, NO_IMAGE_NOTE, source_urls):
             return
         mark_failed_and_refund(task_id, _image_error_message(e), 'ошибка генерации')
         return
     except Exception as e:
         print(f'[COLORGUIDE-WORKER] ERROR (image service): {e}')
-        if analysis and _save_result_without_image(task_id, analysis, NO_IMAGE_NOTE):
+        if analysis and _save_result_without_image(task_id, analysis, NO_IMAGE_NOTE, source_urls):
             return
         mark_failed_and_refund(task_id, _image_error_message(e), 'ошибка генерации')
         return
@@ -941,6 +957,10 @@ def process_image_service(task_id: str, service_type: str, person_image: str, us
                     updated_at = %s
                 WHERE id = %s
             ''', (json.dumps(analysis, ensure_ascii=False), cdn_url, datetime.utcnow(), task_id))
+            hold_source_refs(cursor, user_id, source_urls)
+            mark_stage(cursor, 'colorguide', task_id, 'provider_done', since=provider_done_at)
+            mark_stage(cursor, 'colorguide', task_id, 'uploaded', since=uploaded_at)
+            mark_stage(cursor, 'colorguide', task_id, 'finalized')
             conn.commit()
             print(f'[COLORGUIDE-WORKER] Task {task_id} ({service_type}) completed')
         finally:
@@ -965,6 +985,7 @@ def _save_text_only_result(task_id: str, analysis: dict):
                     updated_at = %s
                 WHERE id = %s
             ''', (json.dumps(analysis, ensure_ascii=False), datetime.utcnow(), task_id))
+            mark_stage(cursor, 'colorguide', task_id, 'finalized')
             conn.commit()
             print(f'[COLORGUIDE-WORKER] Task {task_id} completed (text-only)')
         finally:
@@ -975,7 +996,7 @@ def _save_text_only_result(task_id: str, analysis: dict):
         mark_failed_and_refund(task_id, 'Ошибка сервиса. Деньги вернутся на баланс автоматически сразу или чуть позже администратором. Попробуйте позже.', 'ошибка обработки')
 
 
-def _save_result_without_image(task_id: str, analysis: dict, note: str):
+def _save_result_without_image(task_id: str, analysis: dict, note: str, source_urls=None):
     """Картинка не сгенерировалась, но текстовый разбор готов: сохраняем его как выполненный
     результат и ВОЗВРАЩАЕМ деньги — услуга без картинки не считается оплаченной."""
     try:
@@ -991,6 +1012,7 @@ def _save_result_without_image(task_id: str, analysis: dict, note: str):
                 u_id, t_cost, t_refunded = r
                 if not t_refunded and t_cost and t_cost > 0:
                     refund_user(cursor, task_id, u_id, t_cost, 'картинка не сгенерирована')
+                hold_source_refs(cursor, u_id, source_urls)
             cursor.execute('''
                 UPDATE color_guide_tasks
                 SET status = 'completed',
@@ -1003,6 +1025,7 @@ def _save_result_without_image(task_id: str, analysis: dict, note: str):
                     updated_at = %s
                 WHERE id = %s
             ''', (json.dumps(analysis, ensure_ascii=False), note[:500], datetime.utcnow(), task_id))
+            mark_stage(cursor, 'colorguide', task_id, 'finalized')
             conn.commit()
             print(f'[COLORGUIDE-WORKER] Task {task_id} saved without image (refunded)')
             return True
@@ -1014,19 +1037,29 @@ def _save_result_without_image(task_id: str, analysis: dict, note: str):
         return False
 
 
-def save_fal_urls(task_id: str, status_url: str, response_url: str, analysis: dict):
+def hold_source_refs(cursor, user_id, source_urls):
+    """Исходные фото задачи после обработки ни в одной колонке не остаются —
+    ссылка в media_refs не даёт s3-gc удалить их, пока задача существует."""
+    for url in source_urls or []:
+        hold_media_ref(cursor, user_id, url)
+
+
+def save_fal_urls(task_id: str, status_url: str, response_url: str, analysis: dict,
+                  user_id=None, source_urls=None):
     """Сохраняет ссылки на задание fal и готовый анализ, чтобы результат можно было
     забрать позже, если текущий вызов оборвётся (сбой сети/таймаут функции)."""
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
         try:
+            hold_source_refs(cursor, user_id, source_urls)
             cursor.execute('''
                 UPDATE color_guide_tasks
                 SET fal_status_url = %s, fal_response_url = %s, result_json = %s, updated_at = %s
                 WHERE id = %s
             ''', (status_url, response_url, json.dumps(analysis, ensure_ascii=False),
                   datetime.utcnow(), task_id))
+            mark_stage(cursor, 'colorguide', task_id, 'submitted')
             conn.commit()
         finally:
             cursor.close()
@@ -1035,10 +1068,11 @@ def save_fal_urls(task_id: str, status_url: str, response_url: str, analysis: di
         print(f'[COLORGUIDE-WORKER] save_fal_urls failed (non-critical): {e}')
 
 
-def recover_stuck_tasks(current_task_id: str = None):
+def recover_stuck_tasks(current_task_id: str = None, limit: int = SWEEP_BATCH) -> int:
     """Подхватывает задачи, оборвавшиеся из-за сбоя связи: если картинка у fal уже
     готова — дочитывает её и завершает задачу (результат попадёт в историю).
-    Через 12 минут возвращает деньги, но подхват продолжается до 24 часов."""
+    Через 12 минут возвращает деньги, но подхват продолжается до 24 часов.
+    Вызывается пачкой в режиме sweep (task-sweeper). Возвращает число разобранных задач."""
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
@@ -1054,8 +1088,8 @@ def recover_stuck_tasks(current_task_id: str = None):
                   AND created_at > NOW() - INTERVAL '24 hours'
                   AND (%s IS NULL OR id <> %s::uuid)
                 ORDER BY created_at ASC
-                LIMIT 3
-            ''', (current_task_id, current_task_id))
+                LIMIT %s
+            ''', (current_task_id, current_task_id, limit))
             rows = cursor.fetchall()
         finally:
             cursor.close()
@@ -1101,6 +1135,8 @@ def recover_stuck_tasks(current_task_id: str = None):
                 print(f'[COLORGUIDE-WORKER] recovery of {s_id} skipped: {e}')
     except Exception as e:
         print(f'[COLORGUIDE-WORKER] recover_stuck_tasks failed (non-critical): {e}')
+        return 0
+    return len(rows)
 
 
 def refund_user(cursor, task_id: str, user_id, cost: int, reason: str):
@@ -1108,23 +1144,15 @@ def refund_user(cursor, task_id: str, user_id, cost: int, reason: str):
     if not cost or cost <= 0:
         return False
     try:
-        cursor.execute('SELECT balance FROM users WHERE id = %s', (user_id,))
-        row = cursor.fetchone()
-        if not row:
-            return False
-        balance_before = float(row[0])
-        balance_after = balance_before + cost
-
-        cursor.execute('UPDATE users SET balance = balance + %s WHERE id = %s', (cost, user_id))
-        cursor.execute('''
-            INSERT INTO balance_transactions
-            (user_id, type, amount, balance_before, balance_after, description)
-            VALUES (%s, 'refund', %s, %s, %s, %s)
-        ''', (user_id, cost, balance_before, balance_after, f'Возврат: Гид по цвету ({reason})'))
-        cursor.execute(
-            'UPDATE color_guide_tasks SET refunded = TRUE WHERE id = %s',
-            (task_id,)
+        # Флаг refunded, баланс и запись в журнале — одним запросом. Сумма
+        # берётся из задачи — это реально списанные деньги, поэтому
+        # возвращаем и безлимитным
+        claimed, balance_after = refund_task(
+            cursor, 'color_guide_tasks', task_id, user_id, cost,
+            f'Возврат: Гид по цвету ({reason})', unless_unlimited=False,
         )
+        if not claimed or balance_after is None:
+            return False
         print(f'[COLORGUIDE-WORKER] Refunded {cost} to user {user_id} for task {task_id}')
         return True
     except Exception as e:
@@ -1151,6 +1179,7 @@ def mark_failed_and_refund(task_id: str, error_message: str, refund_reason: str)
                 "UPDATE color_guide_tasks SET status = 'failed', error_message = %s, partner_image = NULL, updated_at = %s WHERE id = %s",
                 (error_message[:500], datetime.utcnow(), task_id)
             )
+            mark_stage(cursor, 'colorguide', task_id, 'finalized')
             conn.commit()
         finally:
             cursor.close()
@@ -1194,6 +1223,7 @@ def process_task(task_id: str):
                 "UPDATE color_guide_tasks SET status = 'processing', updated_at = %s WHERE id = %s",
                 (datetime.utcnow(), task_id)
             )
+            mark_stage(cursor, 'colorguide', task_id, 'admitted')
             conn.commit()
         finally:
             cursor.close()
@@ -1211,9 +1241,12 @@ def process_task(task_id: str):
     # Сегмент 2 (без открытого коннекта): S3 + Gemini — долгая часть
     try:
         cdn_url = upload_to_s3(person_image, task_id, str(user_id))
+        uploaded_at = time.monotonic()
         print(f'[COLORGUIDE-WORKER] Uploaded to {cdn_url}')
 
+        submitted_at = time.monotonic()
         result = call_gemini(cdn_url, forced_colortype_slug, forced_colortype_slug_alt)
+        provider_done_at = time.monotonic()
         print(f'[COLORGUIDE-WORKER] colortype returned keys: {list(result.keys())}')
     except Exception as e:
         print(f'[COLORGUIDE-WORKER] ERROR (Gemini/S3): {e}')
@@ -1275,6 +1308,11 @@ def process_task(task_id: str):
                     updated_at = %s
                 WHERE id = %s
             ''', (slug, json.dumps(result, ensure_ascii=False), cdn_url, datetime.utcnow(), task_id))
+            # Отметки сегмента 2 (коннект тогда не держали) — задним числом через since
+            mark_stage(cursor, 'colorguide', task_id, 'uploaded', since=uploaded_at)
+            mark_stage(cursor, 'colorguide', task_id, 'submitted', since=submitted_at)
+            mark_stage(cursor, 'colorguide', task_id, 'provider_done', since=provider_done_at)
+            mark_stage(cursor, 'colorguide', task_id, 'finalized')
             conn.commit()
             print(f'[COLORGUIDE-WORKER] Task {task_id} completed successfully')
         finally:
@@ -1285,6 +1323,18 @@ def process_task(task_id: str):
         mark_failed_and_refund(task_id, 'Ошибка сервиса. Деньги вернутся на баланс автоматически сразу или чуть позже администратором. Попробуйте позже.', 'ошибка обработки')
 
 
+
+def is_sweep_request(event: Dict[str, Any], params: Dict[str, Any]) -> bool:
+    """Режим sweep: ?sweep=1 и системный токен (JWT_SECRET_KEY), как у крон-функций."""
+    if params.get('sweep') != '1':
+        return False
+    headers = event.get('headers', {})
+    provided_token = headers.get('x-system-token') or headers.get('X-System-Token')
+    expected = os.environ.get('JWT_SECRET_KEY')
+    return bool(expected) and provided_token == expected
+
+
+@profiling.profiled('colorguide-worker')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Воркер обработки задачи Гида по цвету: вызов Gemini и сохранение результата
@@ -1306,6 +1356,17 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 
     params = event.get('queryStringParameters') or {}
     task_id = params.get('task_id')
+
+    # Подхват оборвавшихся задач — пачкой по расписанию (task-sweeper), а не после каждой задачи
+    if is_sweep_request(event, params):
+        recovered = recover_stuck_tasks()
+        return {
+            'statusCode': 200,
+            'headers': cors_headers(event),
+            'isBase64Encoded': False,
+            'body': json.dumps({'ok': True, 'stuck_tasks_processed': recovered})
+        }
+
     if not task_id:
         return {
             'statusCode': 400,
@@ -1316,37 +1377,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 
     process_task(task_id)
 
-    # Подхват задач, оборвавшихся из-за сбоя связи у другого пользователя
-    recover_stuck_tasks(task_id)
-
-    # Единая очередь: после завершения своей задачи будим следующую pending (FIFO)
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute('''
-                SELECT id FROM color_guide_tasks
-                WHERE status = 'pending'
-                  AND id != %s
-                ORDER BY created_at ASC
-                LIMIT 1
-            ''', (task_id,))
-            next_row = cursor.fetchone()
-        finally:
-            cursor.close()
-            conn.close()
-        if next_row:
-            next_id = next_row[0]
-            print(f'[COLORGUIDE-WORKER] Waking next pending task {next_id}')
-            try:
-                worker_url = f'https://functions.poehali.dev/12f108e3-fe83-4618-9e8b-48411bb69390?task_id={next_id}'
-                req = urllib.request.Request(worker_url, method='GET')
-                urllib.request.urlopen(req, timeout=2)
-            except Exception as te:
-                print(f'[COLORGUIDE-WORKER] Wake-next trigger failed (non-critical): {te}')
-    except Exception as e:
-        print(f'[COLORGUIDE-WORKER] Wake-next scan error (non-critical): {e}')
-
     return {
         'statusCode': 200,
         'headers': cors_headers(event),
@@ -0,0 +1,131 @@
+"""
+Профилирование вызова функции по запросу: cProfile + tracemalloc.
+
+По умолчанию выключено и ничего не стоит. Включается переменными окружения:
+
+    PROFILE_ENABLED=1        — профилировать каждый вызов
+    PROFILE_SAMPLE_RATE=N    — профилировать в среднем 1 вызов из N
+    PROFILE_TOP_N=30         — сколько строк в сводке (функции и места аллокаций)
+    PROFILE_DIR=/tmp/profiles — локальная папка для .prof и .txt
+    PROFILE_S3_PREFIX=profiles/<функция> — если задан, файлы уходят ещё и в S3
+                               (бакет S3_BUCKET_NAME, ключи S3_ACCESS_KEY / S3_SECRET_KEY)
+
+На каждый профилированный вызов пишутся два файла: сырой <name>-<stamp>.prof
+(открывается snakeviz / pstats) и текстовая сводка .txt — топ функций по
+cumulative time и топ мест выделения памяти по tracemalloc.
+
+Использование:
+
+    import profiling
+
+    @profiling.profiled('colortype-worker')
+    def handler(event, context): ...
+
+Внутренние горячие функции (match_colortype, build_result_zip,
+_extract_json_object) видны в сводке по cumulative time.
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import random
+import time
+import tracemalloc
+import uuid
+from functools import wraps
+
+
+def _should_profile() -> bool:
+    if os.environ.get('PROFILE_ENABLED', '').lower() in ('1', 'true', 'yes'):
+        return True
+    try:
+        rate = int(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+    except ValueError:
+        return False
+    return rate > 0 and random.randrange(rate) == 0
+
+
+def _summary(name: str, profiler: cProfile.Profile, snapshot, elapsed_ms: float, top_n: int) -> str:
+    out = io.StringIO()
+    out.write(f'# {name}: {elapsed_ms:.1f} ms\n\n')
+    out.write(f'## cProfile (top {top_n} by cumulative time)\n')
+    stats = pstats.Stats(profiler, stream=out)
+    stats.strip_dirs().sort_stats('cumulative').print_stats(top_n)
+
+    current, peak = tracemalloc.get_traced_memory()
+    out.write(f'\n## tracemalloc (current={current / 1024:.1f} KiB, peak={peak / 1024:.1f} KiB, top {top_n} by size)\n')
+    for stat in snapshot.statistics('lineno')[:top_n]:
+        out.write(f'{stat}\n')
+    return out.getvalue()
+
+
+def _upload_to_s3(prefix: str, filename: str, body: bytes) -> None:
+    import boto3
+    s3 = boto3.client(
+        's3',
+        endpoint_url='https://storage.yandexcloud.net',
+        aws_access_key_id=os.environ.get('S3_ACCESS_KEY'),
+        aws_secret_access_key=os.environ.get('S3_SECRET_KEY'),
+    )
+    s3.put_object(
+        Bucket=os.environ.get('S3_BUCKET_NAME', 'fitting-room-images'),
+        Key=f"{prefix.rstrip('/')}/{filename}",
+        Body=body,
+    )
+
+
+def _write_results(name: str, profiler: cProfile.Profile, summary: str) -> None:
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+    base = f'{name}-{stamp}-{uuid.uuid4().hex[:6]}'
+    directory = os.environ.get('PROFILE_DIR', '/tmp/profiles')
+    os.makedirs(directory, exist_ok=True)
+
+    prof_path = os.path.join(directory, f'{base}.prof')
+    profiler.dump_stats(prof_path)
+    with open(os.path.join(directory, f'{base}.txt'), 'w') as f:
+        f.write(summary)
+    print(f'[Profiling] {name}: written {prof_path}')
+
+    prefix = os.environ.get('PROFILE_S3_PREFIX')
+    if prefix:
+        with open(prof_path, 'rb') as f:
+            _upload_to_s3(prefix, f'{base}.prof', f.read())
+        _upload_to_s3(prefix, f'{base}.txt', summary.encode('utf-8'))
+        print(f'[Profiling] {name}: uploaded to {prefix}/{base}.*')
+
+
+def profiled(name: str):
+    '''
+    Декоратор: при включённом профилировании (или попадании в выборку) снимает
+    cProfile и tracemalloc на время вызова. Ошибки записи результатов не ломают вызов.
+    '''
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _should_profile():
+                return fn(*args, **kwargs)
+
+            top_n = int(os.environ.get('PROFILE_TOP_N', '30'))
+            started_tracemalloc = not tracemalloc.is_tracing()
+            if started_tracemalloc:
+                tracemalloc.start(10)
+            profiler = cProfile.Profile()
+            started = time.perf_counter()
+            profiler.enable()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profiler.disable()
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                try:
+                    snapshot = tracemalloc.take_snapshot()
+                    summary = _summary(name, profiler, snapshot, elapsed_ms, top_n)
+                    _write_results(name, profiler, summary)
+                except Exception as e:
+                    print(f'[Profiling] {name}: failed to save profile (non-critical): {e}')
+                finally:
+                    if started_tracemalloc:
+                        tracemalloc.stop()
+        return wrapper
+    return decorator
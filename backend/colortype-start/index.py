@@ -5,6 +5,7 @@ from typing import Dict, Any
 import uuid
 from datetime import datetime
 from session_utils import validate_session
+from task_timings import mark_stage
 
 COLORTYPE_COST = 50
 
@@ -183,6 +184,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             datetime.utcnow(),
             eye_color
         ))
+        mark_stage(cursor, 'colortype', task_id, 'queued')
         
         # Record balance transaction
         if cost > 0:
@@ -0,0 +1,175 @@
+"""Баланс пользователя: списание и возврат одним запросом.
+
+Каждая операция — один SQL с CTE: UPDATE users ... RETURNING отдаёт баланс
+до и после, и тот же запрос пишет строку в balance_transactions. Между
+чтением и записью баланса нет окна, поэтому одновременные списания и
+возвраты не теряют друг друга, а условие «хватает денег» проверяется по
+самой свежей версии строки. Файл общий: копия лежит в каждой функции,
+которая двигает баланс.
+"""
+
+SCHEMA = 't_p29007832_virtual_fitting_room'
+
+# Таблицы задач с флагом refunded — имя таблицы нельзя передать параметром
+REFUND_TASK_TABLES = {
+    'nanobananapro_tasks',
+    'freegen_tasks',
+    'color_type_history',
+    'color_guide_tasks',
+}
+
+CHARGE_SQL = f'''
+    WITH u AS (
+        SELECT balance, COALESCE(unlimited_access, FALSE) AS unlimited
+        FROM {SCHEMA}.users WHERE id = %(user_id)s
+    ), paid AS (
+        UPDATE {SCHEMA}.users
+        SET balance = balance - %(amount)s, updated_at = CURRENT_TIMESTAMP
+        WHERE id = %(user_id)s
+          AND NOT COALESCE(unlimited_access, FALSE)
+          AND balance >= %(amount)s
+        RETURNING balance + %(amount)s AS balance_before, balance AS balance_after
+    ), paid_entry AS (
+        INSERT INTO {SCHEMA}.balance_transactions
+            (user_id, type, amount, balance_before, balance_after, description,
+             try_on_id, color_type_id)
+        SELECT %(user_id)s::uuid, 'charge', 0 - %(amount)s::numeric,
+               balance_before, balance_after, %(description)s,
+               %(try_on_id)s::uuid, %(color_type_id)s::uuid
+        FROM paid
+    ), free_entry AS (
+        INSERT INTO {SCHEMA}.balance_transactions
+            (user_id, type, amount, balance_before, balance_after, description,
+             try_on_id, color_type_id)
+        SELECT %(user_id)s::uuid, 'charge', 0, balance, balance, %(unlimited_description)s,
+               %(try_on_id)s::uuid, %(color_type_id)s::uuid
+        FROM u WHERE unlimited AND %(log_unlimited)s
+    )
+    SELECT u.unlimited, u.balance, paid.balance_before, paid.balance_after
+    FROM u LEFT JOIN paid ON TRUE
+'''
+
+REFUND_SQL = f'''
+    WITH u AS (
+        SELECT balance, COALESCE(unlimited_access, FALSE) AS unlimited
+        FROM {SCHEMA}.users WHERE id = %(user_id)s
+    ), paid AS (
+        UPDATE {SCHEMA}.users
+        SET balance = balance + %(amount)s, updated_at = CURRENT_TIMESTAMP
+        WHERE id = %(user_id)s
+          AND (NOT %(unless_unlimited)s OR NOT COALESCE(unlimited_access, FALSE))
+        RETURNING balance - %(amount)s AS balance_before, balance AS balance_after
+    ), entry AS (
+        INSERT INTO {SCHEMA}.balance_transactions
+            (user_id, type, amount, balance_before, balance_after, description,
+             try_on_id, color_type_id)
+        SELECT %(user_id)s::uuid, 'refund', %(amount)s::numeric,
+               balance_before, balance_after, %(description)s,
+               %(try_on_id)s::uuid, %(color_type_id)s::uuid
+        FROM paid
+    )
+    SELECT u.unlimited, u.balance, paid.balance_before, paid.balance_after
+    FROM u LEFT JOIN paid ON TRUE
+'''
+
+# Возврат за задачу: флаг refunded снимается тем же запросом, что и деньги.
+# Вторая параллельная попытка ждёт блокировку строки задачи, видит
+# refunded = TRUE и ничего не делает — двойного возврата не бывает.
+REFUND_TASK_SQL = '''
+    WITH task AS (
+        UPDATE {schema}.{table} SET refunded = TRUE
+        WHERE id = %(task_id)s AND COALESCE(refunded, FALSE) = FALSE
+        RETURNING id
+    ), paid AS (
+        UPDATE {schema}.users
+        SET balance = balance + %(amount)s, updated_at = CURRENT_TIMESTAMP
+        WHERE id = %(user_id)s
+          AND %(amount)s > 0
+          AND EXISTS (SELECT 1 FROM task)
+          AND (NOT %(unless_unlimited)s OR NOT COALESCE(unlimited_access, FALSE))
+        RETURNING balance - %(amount)s AS balance_before, balance AS balance_after
+    ), entry AS (
+        INSERT INTO {schema}.balance_transactions
+            (user_id, type, amount, balance_before, balance_after, description,
+             try_on_id, color_type_id)
+        SELECT %(user_id)s::uuid, 'refund', %(amount)s::numeric,
+               balance_before, balance_after, %(description)s,
+               %(try_on_id)s::uuid, %(color_type_id)s::uuid
+        FROM paid
+    )
+    SELECT EXISTS (SELECT 1 FROM task),
+           (SELECT balance_before FROM paid),
+           (SELECT balance_after FROM paid)
+'''
+
+
+def _result(row):
+    if not row:
+        return None
+    unlimited, balance, before, after = row
+    return {
+        'unlimited': bool(unlimited),
+        'done': after is not None,
+        'balance_before': float(before if before is not None else balance),
+        'balance_after': float(after if after is not None else balance),
+    }
+
+
+def charge(cursor, user_id, amount, description, unlimited_description=None,
+           try_on_id=None, color_type_id=None):
+    """Списывает amount, если денег хватает. Безлимитному пользователю
+    ничего не списывает, но пишет в журнал нулевую строку
+    (unlimited_description; None — не писать).
+
+    Возвращает None, если пользователя нет, иначе словарь: unlimited,
+    done (деньги списаны), balance_before, balance_after.
+    """
+    cursor.execute(CHARGE_SQL, {
+        'user_id': str(user_id),
+        'amount': amount,
+        'description': description,
+        'unlimited_description': unlimited_description or description,
+        'log_unlimited': unlimited_description is not None,
+        'try_on_id': try_on_id,
+        'color_type_id': color_type_id,
+    })
+    return _result(cursor.fetchone())
+
+
+def refund(cursor, user_id, amount, description, try_on_id=None,
+           color_type_id=None, unless_unlimited=True):
+    """Возвращает amount на баланс. Безлимитному пользователю возвращать
+    нечего (unless_unlimited=False — вернуть всё равно). Ответ — как у charge."""
+    cursor.execute(REFUND_SQL, {
+        'user_id': str(user_id),
+        'amount': amount,
+        'description': description,
+        'unless_unlimited': unless_unlimited,
+        'try_on_id': try_on_id,
+        'color_type_id': color_type_id,
+    })
+    return _result(cursor.fetchone())
+
+
+def refund_task(cursor, task_table, task_id, user_id, amount, description,
+                try_on_id=None, color_type_id=None, unless_unlimited=True):
+    """Возврат за задачу ровно один раз: помечает задачу refunded и
+    возвращает деньги одним запросом.
+
+    Возвращает (claimed, balance_after): claimed — задача помечена сейчас
+    (False — возврат уже был); balance_after — None, если деньги не
+    двигались (безлимит или нулевая сумма).
+    """
+    if task_table not in REFUND_TASK_TABLES:
+        raise ValueError(f'Unknown task table: {task_table}')
+    cursor.execute(REFUND_TASK_SQL.format(schema=SCHEMA, table=task_table), {
+        'task_id': str(task_id),
+        'user_id': str(user_id),
+        'amount': amount,
+        'description': description,
+        'unless_unlimited': unless_unlimited,
+        'try_on_id': try_on_id,
+        'color_type_id': color_type_id,
+    })
+    claimed, _, balance_after = cursor.fetchone()
+    return bool(claimed), (float(balance_after) if balance_after is not None else None)
@@ -9,8 +9,16 @@ import time
 import uuid
 import base64
 
+import profiling
+import tracing
+from balance_ledger import refund_task
+from task_timings import mark_stage
+
 COLORTYPE_COST = 50
 
+# Сколько зависших задач закрывает один запуск в режиме sweep (его вызывает task-sweeper)
+SWEEP_BATCH = 20
+
 # Ответ ИИ пришёл повреждённым и не разобрался — разовый сбой сервиса.
 COLORTYPE_PARSE_ERROR = (
     'Сервис не смог обработать фото — ответ пришёл повреждённым. '
@@ -413,12 +421,12 @@ def upload_to_yandex_storage(image_data: str, user_id: str, task_id: str) -> str
             ext = 'jpg'
     
     image_bytes = base64.b64decode(image_data)
-    print(f'[Yandex] Decoded {len(image_bytes)} bytes, content_type={content_type}')
+    tracing.debug('[Yandex] Decoded %s bytes, content_type=%s', len(image_bytes), content_type)
     
     # Generate filename with correct extension
     s3_key = f'images/colortypes/{user_id}/{task_id}.{ext}'
     
-    print(f'[Yandex] Uploading to: {s3_key}')
+    tracing.debug('[Yandex] Uploading to: %s', s3_key)
     
     # Upload to Yandex Object Storage
     s3 = boto3.client('s3',
@@ -427,16 +435,18 @@ def upload_to_yandex_storage(image_data: str, user_id: str, task_id: str) -> str
         aws_secret_access_key=s3_secret_key
     )
     
-    s3.put_object(
-        Bucket=s3_bucket,
-        Key=s3_key,
-        Body=image_bytes,
-        ContentType=content_type
-    )
+    with tracing.span('s3_put'):
+        s3.put_object(
+            Bucket=s3_bucket,
+            Key=s3_key,
+            Body=image_bytes,
+            ContentType=content_type
+        )
+    tracing.count('s3_put', 'bytes', len(image_bytes))
     
     # Build Yandex Cloud Storage URL
     cdn_url = f'https://storage.yandexcloud.net/{s3_bucket}/{s3_key}'
-    print(f'[Yandex] Upload complete! URL: {cdn_url}')
+    tracing.debug('[Yandex] Upload complete! URL: %s', cdn_url)
     
     return cdn_url
 
@@ -463,7 +473,7 @@ def submit_to_openai(image_url: str, eye_color: str = 'brown') -> dict:
     # Load reference schemes from Python module (better for Cloud Functions deployment)
     from colortype_data import COLORTYPE_REFERENCES_DATA
     colortype_refs = COLORTYPE_REFERENCES_DATA
-    print(f'[OpenRouter] Loaded {len(colortype_refs)} colortype references')
+    tracing.debug('[OpenRouter] Loaded %s colortype references', len(colortype_refs))
     
     # Helper function to encode URL (replace spaces with %20)
     def encode_url(url: str) -> str:
@@ -534,37 +544,40 @@ def submit_to_openai(image_url: str, eye_color: str = 'brown') -> dict:
     
     # Debug: count images in request
     image_count = sum(1 for item in content if item.get('type') == 'image_url')
-    print(f'[OpenRouter] Request contains {image_count} images')
-    print(f'[OpenRouter] User photo URL: {image_url}')
-    print(f'[OpenRouter] Submitting to GPT-4o Vision via OpenRouter...')
-    response = requests.post(
-        'https://openrouter.ai/api/v1/chat/completions',
-        headers=headers,
-        json=payload,
-        timeout=60,
-        proxies=get_openrouter_proxies()
-    )
-    
-    print(f'[OpenRouter] Response status: {response.status_code}, Content-Type: {response.headers.get("Content-Type", "unknown")}')
+    tracing.debug('[OpenRouter] Request contains %s images', image_count)
+    tracing.debug('[OpenRouter] User photo URL: %s', image_url)
+    tracing.debug('[OpenRouter] Submitting to GPT-4o Vision via OpenRouter...')
+    with tracing.span('openrouter'):
+        response = requests.post(
+            'https://openrouter.ai/api/v1/chat/completions',
+            headers=headers,
+            json=payload,
+            timeout=60,
+            proxies=get_openrouter_proxies()
+        )
+    tracing.count('openrouter', 'bytes', len(response.content))
+    
+    tracing.debug('[OpenRouter] Response status: %s, Content-Type: %s', response.status_code, response.headers.get("Content-Type", "unknown"))
     
     # Check if response is HTML error page (Cloudflare 500 etc)
     content_type = response.headers.get('Content-Type', '')
     if 'text/html' in content_type:
         error_text = response.text[:500]
-        print(f'[OpenRouter] ERROR: Got HTML instead of JSON. Response: {error_text}')
+        tracing.error(f'[OpenRouter] ERROR: Got HTML instead of JSON. Response: {error_text}')
         raise Exception(f'OpenRouter returned HTML error page (status {response.status_code}). This is usually a temporary server issue. Please try again.')
     
     if response.status_code != 200:
         diag_headers = {k: response.headers.get(k) for k in ['Server', 'CF-Ray', 'CF-Cache-Status', 'cf-mitigated', 'Content-Type', 'Date', 'Via', 'X-Clerk-Auth-Reason'] if response.headers.get(k)}
-        print(f'[OpenRouter] NON-200 status={response.status_code}')
-        print(f'[OpenRouter] NON-200 response headers: {json.dumps(diag_headers)}')
-        print(f'[OpenRouter] NON-200 FULL body: {response.text}')
+        tracing.error(f'[OpenRouter] NON-200 status={response.status_code}')
+        if tracing.enabled('debug'):
+            tracing.debug('[OpenRouter] NON-200 response headers: %s', json.dumps(diag_headers))
+            tracing.debug('[OpenRouter] NON-200 FULL body: %s', response.text)
 
     if response.status_code == 200:
         try:
             result = response.json()
             if 'choices' not in result or not result['choices']:
-                print(f'[OpenRouter] ERROR: Invalid response structure: {result}')
+                tracing.error(f'[OpenRouter] ERROR: Invalid response structure: {result}')
                 raise Exception('OpenRouter response missing "choices" field')
             
             choice = result['choices'][0]
@@ -576,19 +589,20 @@ def submit_to_openai(image_url: str, eye_color: str = 'brown') -> dict:
             if not content:
                 reasoning = message.get('reasoning')
                 refusal = message.get('refusal')
-                print(f'[OpenRouter] DIAG: content is empty. finish_reason={finish_reason}, refusal={refusal}, has_reasoning={bool(reasoning)}')
-                print(f'[OpenRouter] DIAG: message keys={list(message.keys())}')
-                print(f'[OpenRouter] DIAG: choice keys={list(choice.keys())}')
-                print(f'[OpenRouter] DIAG: full message: {json.dumps(message)[:1500]}')
-                if reasoning:
-                    print(f'[OpenRouter] DIAG: reasoning preview: {reasoning[:500]}')
+                tracing.warning(f'[OpenRouter] DIAG: content is empty. finish_reason={finish_reason}, refusal={refusal}, has_reasoning={bool(reasoning)}')
+                if tracing.enabled('debug'):
+                    tracing.debug('[OpenRouter] DIAG: message keys=%s', list(message.keys()))
+                    tracing.debug('[OpenRouter] DIAG: choice keys=%s', list(choice.keys()))
+                    tracing.debug('[OpenRouter] DIAG: full message: %s', json.dumps(message)[:1500])
+                    if reasoning:
+                        tracing.debug('[OpenRouter] DIAG: reasoning preview: %s', reasoning[:500])
                 # Fallback: some models put answer into "reasoning" instead of "content"
                 if reasoning:
                     content = reasoning
                 else:
                     raise Exception(f'OpenRouter returned empty content (finish_reason={finish_reason}, refusal={refusal})')
             
-            print(f'[OpenRouter] Got response (finish_reason={finish_reason}): {content[:200]}...')
+            tracing.debug('[OpenRouter] Got response (finish_reason=%s): %s...', finish_reason, content[:200])
 
             # Ответ оборван на середине (сбой провайдера или упёрлись в лимит длины) —
             # разобрать такой JSON невозможно, считаем попытку неуспешной,
@@ -600,7 +614,7 @@ def submit_to_openai(image_url: str, eye_color: str = 'brown') -> dict:
 
             return {'status': 'succeeded', 'output': content}
         except (KeyError, IndexError, json.JSONDecodeError) as e:
-            print(f'[OpenRouter] ERROR parsing response: {str(e)}. Response: {response.text[:300]}')
+            tracing.error(f'[OpenRouter] ERROR parsing response: {str(e)}. Response: {response.text[:300]}')
             raise Exception(f'Failed to parse OpenRouter response: {str(e)}')
     
     raise Exception(f'Failed to submit to OpenRouter: {response.status_code} - {response.text[:2000]}')
@@ -608,57 +622,24 @@ def submit_to_openai(image_url: str, eye_color: str = 'brown') -> dict:
 def refund_balance_if_needed(conn, user_id: str, task_id: str) -> None:
     '''Refund 50 rubles to user balance if not unlimited and not already refunded'''
     try:
-        cursor = conn.cursor()
-        
-        # Check if already refunded
-        cursor.execute('SELECT refunded FROM color_type_history WHERE id = %s', (task_id,))
-        refund_row = cursor.fetchone()
-        
-        if refund_row and refund_row[0]:
-            print(f'[Refund] Task {task_id} already refunded, skipping')
-            cursor.close()
-            return
-        
-        # Check if user has unlimited access
-        cursor.execute('SELECT unlimited_access FROM users WHERE id = %s', (user_id,))
-        user_row = cursor.fetchone()
-        
-        if not user_row:
-            print(f'[Refund] User {user_id} not found')
-            cursor.close()
-            return
-        
-        unlimited_access = user_row[0]
-        
-        if unlimited_access:
-            print(f'[Refund] User {user_id} has unlimited access, no refund needed')
-            cursor.execute('UPDATE color_type_history SET refunded = true WHERE id = %s', (task_id,))
-            conn.commit()
-            cursor.close()
-            return
-        
-        # Get current balance for transaction record
-        cursor.execute('SELECT balance FROM users WHERE id = %s', (user_id,))
-        balance_row = cursor.fetchone()
-        balance_before = float(balance_row[0]) if balance_row else 0
-        balance_after = balance_before + COLORTYPE_COST
-        
-        cursor.execute('UPDATE users SET balance = balance + %s WHERE id = %s', (COLORTYPE_COST, user_id))
-        cursor.execute('UPDATE color_type_history SET refunded = true WHERE id = %s', (task_id,))
-        
-        cursor.execute('''
-            INSERT INTO balance_transactions
-            (user_id, type, amount, balance_before, balance_after, description, color_type_id)
-            VALUES (%s, 'refund', %s, %s, %s, 'Возврат: технический сбой цветотипа', %s)
-        ''', (user_id, COLORTYPE_COST, balance_before, balance_after, task_id))
-        
+        cursor = tracing.TracedCursor(conn.cursor())
+        # Флаг refunded, баланс и запись в журнале — одним запросом
+        claimed, balance_after = refund_task(
+            cursor, 'color_type_history', task_id, user_id, COLORTYPE_COST,
+            'Возврат: технический сбой цветотипа', color_type_id=task_id,
+        )
         conn.commit()
-        
-        print(f'[Refund] Refunded {COLORTYPE_COST} rubles to user {user_id} for task {task_id}')
         cursor.close()
-        
+
+        if not claimed:
+            tracing.debug('[Refund] Task %s already refunded, skipping', task_id)
+        elif balance_after is None:
+            tracing.debug('[Refund] User %s has unlimited access, no refund needed', user_id)
+        else:
+            tracing.warning(f'[Refund] Refunded {COLORTYPE_COST} rubles to user {user_id} for task {task_id}')
+
     except Exception as e:
-        print(f'[Refund] Error refunding balance: {str(e)}')
+        tracing.error(f'[Refund] Error refunding balance: {str(e)}')
 
 # Lightness combinations allowed for each colortype (hair, skin, eyes)
 COLORTYPE_LIGHTNESS_COMBINATIONS = {
@@ -1016,9 +997,9 @@ def match_colortype(analysis: dict, gpt_suggested_type: str = None) -> tuple:
     eyes = analysis.get('eye_color', '')
     skin = analysis.get('skin_color', '')
     
-    print(f'[Match] Analyzing: {undertone}/{saturation}/{contrast}')
-    print(f'[Match] Lightness: hair={hair_lightness}, skin={skin_lightness}, eyes={eyes_lightness}')
-    print(f'[Match] Colors: hair="{hair}", skin="{skin}", eyes="{eyes}"')
+    tracing.debug('[Match] Analyzing: %s/%s/%s', undertone, saturation, contrast)
+    tracing.debug('[Match] Lightness: hair=%s, skin=%s, eyes=%s', hair_lightness, skin_lightness, eyes_lightness)
+    tracing.debug('[Match] Colors: hair="%s", skin="%s", eyes="%s"', hair, skin, eyes)
     
     # Determine exclusions based on eyes, hair, and skin
     eyes_lower = eyes.lower()
@@ -1029,29 +1010,29 @@ def match_colortype(analysis: dict, gpt_suggested_type: str = None) -> tuple:
     # Rule 1: Brown eyes → exclude GENTLE AUTUMN, GENTLE SPRING, BRIGHT SPRING (NOT VIBRANT SPRING - it can have brown eyes), all SUMMER, and SOFT WINTER
     if any(keyword in eyes_lower for keyword in ['black-brown', 'brown', 'brown-green', 'dark brown', 'deep brown', 'chestnut', 'chocolate', 'amber']):
         excluded_types.update(['GENTLE AUTUMN', 'GENTLE SPRING', 'BRIGHT SPRING', 'SOFT SUMMER', 'DUSTY SUMMER', 'VIVID SUMMER', 'SOFT WINTER'])
-        print(f'[Match] Brown eyes detected → excluding GENTLE AUTUMN, GENTLE SPRING, BRIGHT SPRING (keeping VIBRANT SPRING), all SUMMER, and SOFT WINTER')
+        tracing.debug('[Match] Brown eyes detected → excluding GENTLE AUTUMN, GENTLE SPRING, BRIGHT SPRING (keeping VIBRANT SPRING), all SUMMER, and SOFT WINTER')
     
     # Rule 2: Cool light eyes → exclude VIVID AUTUMN and VIVID WINTER
     if any(keyword in eyes_lower for keyword in ['blue', 'gray', 'grey', 'gray-green', 'gray-blue', 'grey-green', 'grey-blue', 'blue-gray', 'blue-grey']):
         excluded_types.update(['VIVID AUTUMN', 'VIVID WINTER'])
-        print(f'[Match] Cool light eyes detected → excluding VIVID AUTUMN and VIVID WINTER')
+        tracing.debug('[Match] Cool light eyes detected → excluding VIVID AUTUMN and VIVID WINTER')
     
     # Rule 3: Chestnut brown hair → exclude BRIGHT SPRING
     if any(keyword in hair_lower for keyword in ['chestnut brown', 'chestnut', 'medium brown', 'warm brown']):
         excluded_types.add('BRIGHT SPRING')
-        print(f'[Match] Chestnut brown hair detected → excluding BRIGHT SPRING')
+        tracing.debug('[Match] Chestnut brown hair detected → excluding BRIGHT SPRING')
     
     # Rule 4: Light skin + blue/grey-blue eyes → exclude GENTLE AUTUMN
     light_skin = any(keyword in skin_lower for keyword in ['light', 'pale', 'ivory', 'porcelain', 'fair', 'alabaster'])
     cool_eyes = any(keyword in eyes_lower for keyword in ['blue', 'gray-blue', 'grey-blue', 'blue-gray', 'blue-grey'])
     if light_skin and cool_eyes:
         excluded_types.add('GENTLE AUTUMN')
-        print(f'[Match] Light skin + cool blue eyes detected → excluding GENTLE AUTUMN')
+        tracing.debug('[Match] Light skin + cool blue eyes detected → excluding GENTLE AUTUMN')
     
     # Rule 5: Golden blonde or blonde hair → exclude FIERY AUTUMN and VIVID AUTUMN
     if any(keyword in hair_lower for keyword in ['golden blond', 'golden blonde', 'blonde', 'blond', 'light blond', 'light blonde', 'honey blond', 'honey blonde']):
         excluded_types.update(['FIERY AUTUMN', 'VIVID AUTUMN'])
-        print(f'[Match] Golden blonde/blonde hair detected → excluding FIERY AUTUMN and VIVID AUTUMN')
+        tracing.debug('[Match] Golden blonde/blonde hair detected → excluding FIERY AUTUMN and VIVID AUTUMN')
     
     # Rule 6: Copper hair (medium-dark warm reddish) → exclude GENTLE SPRING
     # Exception: LIGHT COPPER (pale golden-reddish blonde) CAN be gentle spring
@@ -1060,24 +1041,24 @@ def match_colortype(analysis: dict, gpt_suggested_type: str = None) -> tuple:
         is_light_copper = any(light_keyword in hair_lower for light_keyword in ['light copper', 'pale copper', 'light golden', 'pale golden', 'golden blonde', 'strawberry blonde', 'strawberry blond'])
         if not is_light_copper:
             excluded_types.add('GENTLE SPRING')
-            print(f'[Match] Copper/auburn/red hair (NOT light) detected → excluding GENTLE SPRING')
+            tracing.debug('[Match] Copper/auburn/red hair (NOT light) detected → excluding GENTLE SPRING')
     
     # Rule 7: Gray/grey eyes → exclude VIBRANT SPRING (gray eyes = VIVID SUMMER or SOFT WINTER characteristic)
     if any(keyword in eyes_lower for keyword in ['gray', 'grey', 'gray-blue', 'grey-blue', 'gray-green', 'grey-green']):
         excluded_types.add('VIBRANT SPRING')
-        print(f'[Match] Gray eyes detected → excluding VIBRANT SPRING (gray = VIVID SUMMER or SOFT WINTER)')
+        tracing.debug('[Match] Gray eyes detected → excluding VIBRANT SPRING (gray = VIVID SUMMER or SOFT WINTER)')
     
     # Rule 8: Bright blue/bright green eyes → exclude VIVID SUMMER (bright eyes = VIBRANT SPRING or BRIGHT WINTER)
     if any(keyword in eyes_lower for keyword in ['bright blue', 'bright green', 'bright blue-green', 'яркий']):
         excluded_types.add('VIVID SUMMER')
-        print(f'[Match] Bright colored eyes detected → excluding VIVID SUMMER (bright eyes = VIBRANT SPRING or BRIGHT WINTER)')
+        tracing.debug('[Match] Bright colored eyes detected → excluding VIVID SUMMER (bright eyes = VIBRANT SPRING or BRIGHT WINTER)')
     
     # Rule 9: Light blue/light green/light turquoise eyes → ONLY SOFT SUMMER or GENTLE SPRING (exclude all others)
     if any(keyword in eyes_lower for keyword in ['light blue', 'light green', 'light turquoise', 'светло-голубые', 'светло-зелёные', 'светло-лазурные']):
         # Keep only SOFT SUMMER and GENTLE SPRING
         all_types = {'VIBRANT SPRING', 'BRIGHT SPRING', 'VIVID SUMMER', 'DUSTY SUMMER', 'GENTLE AUTUMN', 'FIERY AUTUMN', 'VIVID AUTUMN', 'SOFT WINTER', 'BRIGHT WINTER', 'VIVID WINTER'}
         excluded_types.update(all_types)
-        print(f'[Match] Light colored eyes detected → ONLY SOFT SUMMER or GENTLE SPRING allowed')
+        tracing.debug('[Match] Light colored eyes detected → ONLY SOFT SUMMER or GENTLE SPRING allowed')
     
     # Rule 10: Bright eyes (bright blue, bright green, bright blue-green, bright brown) → ONLY VIBRANT SPRING or BRIGHT WINTER
     # This is more specific than Rule 8, so check last
@@ -1085,21 +1066,21 @@ def match_colortype(analysis: dict, gpt_suggested_type: str = None) -> tuple:
         # Keep only VIBRANT SPRING and BRIGHT WINTER
         all_types = {'GENTLE SPRING', 'BRIGHT SPRING', 'SOFT SUMMER', 'DUSTY SUMMER', 'VIVID SUMMER', 'GENTLE AUTUMN', 'FIERY AUTUMN', 'VIVID AUTUMN', 'SOFT WINTER', 'VIVID WINTER'}
         excluded_types.update(all_types)
-        print(f'[Match] Bright eyes detected → ONLY VIBRANT SPRING or BRIGHT WINTER allowed')
+        tracing.debug('[Match] Bright eyes detected → ONLY VIBRANT SPRING or BRIGHT WINTER allowed')
     
     # Rule 11: Dark/deep brown hair + bright eyes → BRIGHT WINTER (NOT VIBRANT SPRING, NOT SOFT WINTER)
     has_dark_hair = any(keyword in hair_lower for keyword in ['dark brown', 'deep brown', 'black', 'espresso', 'dark chestnut', 'dark cool brown'])
     has_bright_blue_eyes = any(keyword in eyes_lower for keyword in ['bright blue', 'bright gray-blue', 'bright grey-blue', 'ярко-голубые', 'яркие серо-голубые'])
     if has_dark_hair and has_bright_blue_eyes:
         excluded_types.update(['VIBRANT SPRING', 'SOFT WINTER'])
-        print(f'[Match] Dark/deep brown hair + bright eyes → BRIGHT WINTER (excluding VIBRANT SPRING, SOFT WINTER)')
+        tracing.debug('[Match] Dark/deep brown hair + bright eyes → BRIGHT WINTER (excluding VIBRANT SPRING, SOFT WINTER)')
     
     # Rule 12: Dark/deep brown hair + soft/muted gray eyes → SOFT WINTER or VIVID SUMMER (NOT BRIGHT WINTER)
     # FIXED: VIVID SUMMER can also have dark hair + soft gray eyes at LOW-MEDIUM contrast!
     has_soft_gray_eyes = any(keyword in eyes_lower for keyword in ['soft gray', 'soft gray-blue', 'soft grey-blue', 'soft gray-green', 'мягкие серо-голубые', 'мягкие серые'])
     if has_dark_hair and has_soft_gray_eyes:
         excluded_types.add('BRIGHT WINTER')
-        print(f'[Match] Dark/deep brown hair + soft/muted gray eyes → SOFT WINTER or VIVID SUMMER (excluding BRIGHT WINTER only)')
+        tracing.debug('[Match] Dark/deep brown hair + soft/muted gray eyes → SOFT WINTER or VIVID SUMMER (excluding BRIGHT WINTER only)')
     
     # Rule 13: Dark brown hair + warm undertone + brown eyes → VIVID AUTUMN (NOT VIBRANT SPRING, NOT GENTLE AUTUMN, NOT FIERY AUTUMN)
     has_dark_brown_hair = any(keyword in hair_lower for keyword in ['dark brown', 'deep brown', 'dark chestnut', 'espresso', 'black'])
@@ -1107,66 +1088,66 @@ def match_colortype(analysis: dict, gpt_suggested_type: str = None) -> tuple:
     is_warm_undertone = undertone == 'WARM-UNDERTONE'
     if has_dark_brown_hair and is_warm_undertone and has_brown_eyes:
         excluded_types.update(['VIBRANT SPRING', 'GENTLE AUTUMN', 'FIERY AUTUMN'])
-        print(f'[Match] Dark brown hair + warm undertone + brown eyes → VIVID AUTUMN (excluding VIBRANT SPRING, GENTLE AUTUMN, FIERY AUTUMN)')
+        tracing.debug('[Match] Dark brown hair + warm undertone + brown eyes → VIVID AUTUMN (excluding VIBRANT SPRING, GENTLE AUTUMN, FIERY AUTUMN)')
     
     # Rule 14: BRIGHT WINTER, DEEP WINTER, VIVID AUTUMN → ONLY dark hair allowed (validation)
     has_light_hair = any(keyword in hair_lower for keyword in ['light brown', 'light', 'blonde', 'blond', 'golden blond', 'ash blond', 'honey', 'caramel', 'strawberry'])
     dark_types_requiring_dark_hair = {'BRIGHT WINTER', 'DEEP WINTER', 'VIVID AUTUMN'}
     if has_light_hair:
         excluded_types.update(dark_types_requiring_dark_hair)
-        print(f'[Match] Light hair detected → excluding {dark_types_requiring_dark_hair} (these types require dark hair ONLY)')
+        tracing.debug('[Match] Light hair detected → excluding %s (these types require dark hair ONLY)', dark_types_requiring_dark_hair)
     
     # Rule 15: Brown hair (any shade) OR auburn hair + brown eyes → exclude VIBRANT SPRING (this is VIVID AUTUMN characteristic)
     # VIBRANT SPRING: bright eyes (blue/green/hazel), NOT brown eyes
     has_any_brown_or_auburn_hair = any(keyword in hair_lower for keyword in ['brown', 'chestnut', 'auburn', 'espresso', 'chocolate', 'dark', 'medium brown', 'light brown', 'golden brown', 'warm brown', 'copper', 'red'])
     if has_any_brown_or_auburn_hair and has_brown_eyes:
         excluded_types.add('VIBRANT SPRING')
-        print(f'[Match] Brown/auburn hair + brown eyes → excluding VIBRANT SPRING (characteristic of VIVID AUTUMN)')
+        tracing.debug('[Match] Brown/auburn hair + brown eyes → excluding VIBRANT SPRING (characteristic of VIVID AUTUMN)')
     
     # Rule 16: Brown hair (any shade) → exclude GENTLE SPRING (GENTLE SPRING requires ONLY blonde hair)
     has_any_brown_hair = any(keyword in hair_lower for keyword in ['brown', 'chestnut', 'espresso', 'chocolate', 'dark', 'medium brown', 'light brown', 'golden brown', 'warm brown'])
     if has_any_brown_hair:
         excluded_types.add('GENTLE SPRING')
-        print(f'[Match] Brown hair detected → excluding GENTLE SPRING (requires blonde hair ONLY)')
+        tracing.debug('[Match] Brown hair detected → excluding GENTLE SPRING (requires blonde hair ONLY)')
     
     # Rule 17: Medium ash brown hair → exclude SOFT SUMMER (SOFT SUMMER requires light/blonde hair)
     has_medium_ash_brown = any(keyword in hair_lower for keyword in ['medium ash brown', 'medium cool brown', 'ash brown'])
     if has_medium_ash_brown:
         excluded_types.add('SOFT SUMMER')
-        print(f'[Match] Medium ash brown hair detected → excluding SOFT SUMMER (requires light/blonde hair)')
+        tracing.debug('[Match] Medium ash brown hair detected → excluding SOFT SUMMER (requires light/blonde hair)')
     
     # Rule 18: Blonde hair (any shade) → exclude VIVID SUMMER (VIVID SUMMER requires medium/dark hair)
     has_blonde_hair = any(keyword in hair_lower for keyword in ['blonde', 'blond', 'golden blond', 'golden blonde', 'ash blond', 'ash blonde', 'light blond', 'light blonde', 'honey blond', 'honey blonde', 'platinum', 'strawberry blond', 'strawberry blonde'])
     if has_blonde_hair:
         excluded_types.add('VIVID SUMMER')
-        print(f'[Match] Blonde hair detected → excluding VIVID SUMMER (requires medium/dark hair)')
+        tracing.debug('[Match] Blonde hair detected → excluding VIVID SUMMER (requires medium/dark hair)')
     
     # Rule 19: Medium golden brown hair OR brown hair → exclude BRIGHT SPRING
     has_medium_golden_brown_or_brown = any(keyword in hair_lower for keyword in ['medium golden brown', 'brown hair', 'brown', 'golden brown'])
     if has_medium_golden_brown_or_brown:
         excluded_types.add('BRIGHT SPRING')
-        print(f'[Match] Medium golden brown/brown hair detected → excluding BRIGHT SPRING')
+        tracing.debug('[Match] Medium golden brown/brown hair detected → excluding BRIGHT SPRING')
     
     # Rule 20: Any brown hair (except ash brown) → exclude SOFT SUMMER (SOFT SUMMER requires light/blonde hair ONLY)
     has_any_brown_except_ash = any(keyword in hair_lower for keyword in ['medium brown', 'dark brown', 'light brown', 'golden brown', 'warm brown', 'medium golden brown', 'chestnut'])
     has_ash_qualifier = any(keyword in hair_lower for keyword in ['ash brown', 'cool brown', 'ash'])
     if has_any_brown_except_ash and not has_ash_qualifier:
         excluded_types.add('SOFT SUMMER')
-        print(f'[Match] Brown hair (non-ash) detected → excluding SOFT SUMMER (requires light/blonde hair ONLY)')
+        tracing.debug('[Match] Brown hair (non-ash) detected → excluding SOFT SUMMER (requires light/blonde hair ONLY)')
     
     if excluded_types:
-        print(f'[Match] Excluded types: {excluded_types}')
+        tracing.debug('[Match] Excluded types: %s', excluded_types)
     
     # ============ STAGE 1: Prepare lightness scoring (NO FILTERING) ============
     lightness_key = (hair_lightness, skin_lightness, eyes_lightness)
-    print(f'[Match] STAGE 1: Lightness combination ({lightness_key}) - will be used for SCORING, not filtering')
+    tracing.debug('[Match] STAGE 1: Lightness combination (%s) - will be used for SCORING, not filtering', lightness_key)
     
     # Start with all colortypes (except excluded by rules)
     stage1_candidates = [ct for ct in COLORTYPE_REFERENCES.keys() if ct not in excluded_types]
-    print(f'[Match] After exclusion rules: {len(stage1_candidates)} candidates: {stage1_candidates}')
+    tracing.debug('[Match] After exclusion rules: %s candidates: %s', len(stage1_candidates), stage1_candidates)
     
     if not stage1_candidates:
-        print(f'[Match] WARNING: All candidates excluded! Using fallback')
+        tracing.warning(f'[Match] WARNING: All candidates excluded! Using fallback')
         stage1_candidates = list(COLORTYPE_REFERENCES.keys())
     
     # ============ STAGE 2: Check (undertone, saturation, contrast) ============
@@ -1176,11 +1157,11 @@ def match_colortype(analysis: dict, gpt_suggested_type: str = None) -> tuple:
     if ambiguous_candidates:
         # Intersect with stage1 candidates
         stage2_candidates = [ct for ct in ambiguous_candidates if ct in stage1_candidates]
-        print(f'[Match] STAGE 2: AMBIGUOUS params ({param_key}) → {ambiguous_candidates}')
-        print(f'[Match] After stage1 filter: {stage2_candidates}')
+        tracing.debug('[Match] STAGE 2: AMBIGUOUS params (%s) → %s', param_key, ambiguous_candidates)
+        tracing.debug('[Match] After stage1 filter: %s', stage2_candidates)
         
         if not stage2_candidates:
-            print(f'[Match] No intersection with stage1! Using stage1 candidates')
+            tracing.debug('[Match] No intersection with stage1! Using stage1 candidates')
             stage2_candidates = stage1_candidates
     else:
         # Check COLORTYPE_MAP for matching colortypes
@@ -1191,19 +1172,19 @@ def match_colortype(analysis: dict, gpt_suggested_type: str = None) -> tuple:
         
         if matching_colortypes:
             stage2_candidates = matching_colortypes
-            print(f'[Match] STAGE 2: Exact params match → {stage2_candidates}')
+            tracing.debug('[Match] STAGE 2: Exact params match → %s', stage2_candidates)
         else:
             # No exact match - score all stage1 candidates by parameter closeness
-            print(f'[Match] STAGE 2: No exact match. Scoring all stage1 candidates')
+            tracing.debug('[Match] STAGE 2: No exact match. Scoring all stage1 candidates')
             stage2_candidates = stage1_candidates
     
     # ============ STAGE 3: Final selection by color keyword matching ============
-    print(f'[Match] STAGE 3: Scoring {len(stage2_candidates)} candidates by color matching + params')
+    tracing.debug('[Match] STAGE 3: Scoring %s candidates by color matching + params', len(stage2_candidates))
     
     # Check if current param_key is ambiguous (multiple colortypes share same parameters)
     is_ambiguous_combination = param_key in AMBIGUOUS_COMBINATIONS
     if is_ambiguous_combination:
-        print(f'[Match] AMBIGUOUS combination detected → all candidates will get param_match=1.0')
+        tracing.debug('[Match] AMBIGUOUS combination detected → all candidates will get param_match=1.0')
     
     # Detect characteristic features
     has_auburn_hair = any(keyword in hair_lower for keyword in ['auburn', 'copper', 'red', 'bright auburn', 'ginger'])
@@ -1219,7 +1200,7 @@ def match_colortype(analysis: dict, gpt_suggested_type: str = None) -> tuple:
     is_warm_undertone = undertone == 'WARM-UNDERTONE'
     is_cool_undertone = undertone == 'COOL-UNDERTONE'
     
-    print(f'[Match] Auburn/red hair: {has_auburn_hair}, Gray eyes: {has_gray_eyes}, Green eyes: {has_green_eyes}, Dark hair: {has_dark_hair}, Bright eyes: {has_bright_eyes}, Soft/muted eyes: {has_soft_muted_eyes}, Warm undertone: {is_warm_undertone}')
+    tracing.debug('[Match] Auburn/red hair: %s, Gray eyes: %s, Green eyes: %s, Dark hair: %s, Bright eyes: %s, Soft/muted eyes: %s, Warm undertone: %s', has_auburn_hair, has_gray_eyes, has_green_eyes, has_dark_hair, has_bright_eyes, has_soft_muted_eyes, is_warm_undertone)
     
     best_colortype = None
     best_total_score = 0.0
@@ -1241,7 +1222,7 @@ def match_colortype(analysis: dict, gpt_suggested_type: str = None) -> tuple:
             saturation_match = 1.0
             contrast_match = 1.0
             param_match = 1.0
-            print(f'[Match] {colortype}: AMBIGUOUS → param_match=1.0 (equal for all candidates)')
+            tracing.debug('[Match] %s: AMBIGUOUS → param_match=1.0 (equal for all candidates)', colortype)
         else:
             # Normal logic: check COLORTYPE_MAP for exact or closest match
             params_list = get_colortype_params(colortype)
@@ -1291,139 +1272,139 @@ def match_colortype(analysis: dict, gpt_suggested_type: str = None) -> tuple:
         if colortype in COLORTYPE_LIGHTNESS_COMBINATIONS:
             if lightness_key in COLORTYPE_LIGHTNESS_COMBINATIONS[colortype]:
                 color_score += 0.30
-                print(f'[Match] {colortype}: BONUS +0.30 for lightness combination match {lightness_key}')
+                tracing.debug('[Match] %s: BONUS +0.30 for lightness combination match %s', colortype, lightness_key)
         
         
         # BONUS: Auburn/copper/red hair → +0.15 for VIBRANT SPRING
         if has_auburn_hair and colortype == 'VIBRANT SPRING':
             color_score += 0.15
-            print(f'[Match] {colortype}: BONUS +0.15 for auburn/copper hair (characteristic color)')
+            tracing.debug('[Match] %s: BONUS +0.15 for auburn/copper hair (characteristic color)', colortype)
         
         # BONUS: Auburn/copper/red hair → +0.15 for BRIGHT SPRING
         if has_auburn_hair and colortype == 'BRIGHT SPRING':
             color_score += 0.15
-            print(f'[Match] {colortype}: BONUS +0.15 for auburn/copper hair (characteristic color)')
+            tracing.debug('[Match] %s: BONUS +0.15 for auburn/copper hair (characteristic color)', colortype)
         
         # BONUS: Auburn/copper/red hair + brown eyes → +1.00 for FIERY AUTUMN (signature combination)
         if has_auburn_hair and has_brown_eyes and colortype == 'FIERY AUTUMN':
             color_score += 1.00
-            print(f'[Match] {colortype}: BONUS +1.00 for auburn hair + brown eyes (signature FIERY AUTUMN)')
+            tracing.debug('[Match] %s: BONUS +1.00 for auburn hair + brown eyes (signature FIERY AUTUMN)', colortype)
         
         # BONUS: Dark hair + BRIGHT eyes → +0.25 for BRIGHT WINTER (signature combination)
         if has_dark_hair and has_bright_eyes and colortype == 'BRIGHT WINTER':
             color_score += 0.25
-            print(f'[Match] {colortype}: BONUS +0.25 for dark hair + bright eyes (signature BRIGHT WINTER)')
+            tracing.debug('[Match] %s: BONUS +0.25 for dark hair + bright eyes (signature BRIGHT WINTER)', colortype)
         
         # BONUS: Dark hair + SOFT/MUTED gray eyes → +0.25 for SOFT WINTER (signature combination)
         if has_dark_hair and has_soft_muted_eyes and colortype == 'SOFT WINTER':
             color_score += 0.25
-            print(f'[Match] {colortype}: BONUS +0.25 for dark hair + soft/muted gray eyes (signature SOFT WINTER)')
+            tracing.debug('[Match] %s: BONUS +0.25 for dark hair + soft/muted gray eyes (signature SOFT WINTER)', colortype)
         
         # BONUS: Dark hair + ANY gray eyes + HIGH-CONTRAST → +0.20 for SOFT WINTER (characteristic combination)
         # This covers cases where GPT doesn't specify "soft" in gray eyes description
         if has_dark_hair and has_gray_eyes and contrast == 'HIGH-CONTRAST' and colortype == 'SOFT WINTER' and not has_soft_muted_eyes:
             color_score += 0.20
-            print(f'[Match] {colortype}: BONUS +0.20 for dark hair + gray eyes + HIGH-CONTRAST (characteristic SOFT WINTER)')
+            tracing.debug('[Match] %s: BONUS +0.20 for dark hair + gray eyes + HIGH-CONTRAST (characteristic SOFT WINTER)', colortype)
         
         # BONUS: Gray eyes → +0.15 for SOFT WINTER, VIVID SUMMER, DUSTY SUMMER (if not already applied above)
         if has_gray_eyes and colortype == 'SOFT WINTER' and not has_soft_muted_eyes and contrast != 'HIGH-CONTRAST':
             color_score += 0.15
-            print(f'[Match] {colortype}: BONUS +0.15 for gray eyes (characteristic color)')
+            tracing.debug('[Match] %s: BONUS +0.15 for gray eyes (characteristic color)', colortype)
         
         if has_gray_eyes and colortype == 'VIVID SUMMER':
             color_score += 0.15
-            print(f'[Match] {colortype}: BONUS +0.15 for gray eyes (characteristic color)')
+            tracing.debug('[Match] %s: BONUS +0.15 for gray eyes (characteristic color)', colortype)
         
         if has_gray_eyes and colortype == 'DUSTY SUMMER':
             color_score += 0.15
-            print(f'[Match] {colortype}: BONUS +0.15 for gray eyes (characteristic color)')
+            tracing.debug('[Match] %s: BONUS +0.15 for gray eyes (characteristic color)', colortype)
         
         # BONUS: Green eyes → +0.15 for WARM undertone types (Spring/Autumn)
         if has_green_eyes and is_warm_undertone and colortype in ['GENTLE SPRING', 'BRIGHT SPRING', 'VIBRANT SPRING', 'GENTLE AUTUMN', 'FIERY AUTUMN', 'VIVID AUTUMN']:
             color_score += 0.15
-            print(f'[Match] {colortype}: BONUS +0.15 for green eyes (more often warm undertone)')
+            tracing.debug('[Match] %s: BONUS +0.15 for green eyes (more often warm undertone)', colortype)
         
         # BONUS: Gray eyes → +0.15 for COOL undertone types (Winter/Summer) - general bonus
         if has_gray_eyes and is_cool_undertone and colortype in ['SOFT WINTER', 'BRIGHT WINTER', 'VIVID WINTER', 'SOFT SUMMER', 'DUSTY SUMMER', 'VIVID SUMMER']:
             # Only apply if not already applied above (SOFT WINTER, VIVID SUMMER, DUSTY SUMMER)
             if colortype not in ['SOFT WINTER', 'VIVID SUMMER', 'DUSTY SUMMER']:
                 color_score += 0.15
-                print(f'[Match] {colortype}: BONUS +0.15 for gray eyes (more often cool undertone)')
+                tracing.debug('[Match] %s: BONUS +0.15 for gray eyes (more often cool undertone)', colortype)
         
         # BONUS: Light ash blonde hair → +0.20 for SOFT SUMMER (signature hair color)
         has_light_ash_blonde = any(keyword in hair_lower for keyword in ['light ash blonde', 'light ash blond', 'pale ash blonde', 'pale ash blond', 'ash blonde', 'ash blond', 'platinum'])
         if has_light_ash_blonde and colortype == 'SOFT SUMMER':
             color_score += 0.20
-            print(f'[Match] {colortype}: BONUS +0.20 for light ash blonde hair (signature SOFT SUMMER)')
+            tracing.debug('[Match] %s: BONUS +0.20 for light ash blonde hair (signature SOFT SUMMER)', colortype)
         
         # BONUS: Ash blond hair (any ash blonde shade) → +0.15 for SOFT SUMMER (characteristic hair color)
         has_ash_blond = any(keyword in hair_lower for keyword in ['ash blond', 'ash blonde'])
         if has_ash_blond and colortype == 'SOFT SUMMER' and not has_light_ash_blonde:
             color_score += 0.15
-            print(f'[Match] {colortype}: BONUS +0.15 for ash blond hair (characteristic SOFT SUMMER)')
+            tracing.debug('[Match] %s: BONUS +0.15 for ash blond hair (characteristic SOFT SUMMER)', colortype)
         
         # BONUS: Light ash blond hair → +0.30 for SOFT SUMMER (signature hair color)
         has_light_ash_blond_hair = any(keyword in hair_lower for keyword in ['light ash blond', 'light ash blonde'])
         if has_light_ash_blond_hair and colortype == 'SOFT SUMMER':
             color_score += 0.30
-            print(f'[Match] {colortype}: BONUS +0.30 for light ash blond hair (signature SOFT SUMMER)')
+            tracing.debug('[Match] %s: BONUS +0.30 for light ash blond hair (signature SOFT SUMMER)', colortype)
         
         # BONUS: Medium ash blonde hair → +0.25 for DUSTY SUMMER (signature hair color)
         has_medium_ash_blonde_hair = any(keyword in hair_lower for keyword in ['medium ash blonde', 'medium ash blond'])
         if has_medium_ash_blonde_hair and colortype == 'DUSTY SUMMER':
             color_score += 0.25
-            print(f'[Match] {colortype}: BONUS +0.25 for medium ash blonde hair (signature DUSTY SUMMER)')
+            tracing.debug('[Match] %s: BONUS +0.25 for medium ash blonde hair (signature DUSTY SUMMER)', colortype)
         
         # BONUS: Medium ash brown hair → +0.25 for DUSTY SUMMER and VIVID SUMMER (signature hair color)
         has_medium_ash_brown_hair = any(keyword in hair_lower for keyword in ['medium ash brown', 'medium cool brown', 'ash brown', 'cool brown'])
         if has_medium_ash_brown_hair and colortype == 'DUSTY SUMMER':
             color_score += 0.25
-            print(f'[Match] {colortype}: BONUS +0.25 for medium ash brown hair (signature DUSTY SUMMER)')
+            tracing.debug('[Match] %s: BONUS +0.25 for medium ash brown hair (signature DUSTY SUMMER)', colortype)
         
         if has_medium_ash_brown_hair and colortype == 'VIVID SUMMER':
             color_score += 0.25
-            print(f'[Match] {colortype}: BONUS +0.25 for medium ash brown hair (signature VIVID SUMMER)')
+            tracing.debug('[Match] %s: BONUS +0.25 for medium ash brown hair (signature VIVID SUMMER)', colortype)
         
         # BONUS: Medium golden brown hair + golden brown/brown eyes → +0.25 for FIERY AUTUMN (characteristic combination)
         has_medium_golden_brown_hair = any(keyword in hair_lower for keyword in ['medium golden brown', 'golden brown'])
         has_golden_brown_eyes = any(keyword in eyes_lower for keyword in ['golden brown', 'brown', 'dark brown', 'light brown'])
         if has_medium_golden_brown_hair and has_golden_brown_eyes and colortype == 'FIERY AUTUMN':
             color_score += 0.25
-            print(f'[Match] {colortype}: BONUS +0.25 for medium golden brown hair + golden brown/brown eyes (characteristic FIERY AUTUMN)')
+            tracing.debug('[Match] %s: BONUS +0.25 for medium golden brown hair + golden brown/brown eyes (characteristic FIERY AUTUMN)', colortype)
         
         # PENALTY: Non-bright eyes → -0.25 for VIBRANT SPRING (BUT light blue/light green/blue/green ARE acceptable!)
         has_acceptable_light_eyes = any(keyword in eyes_lower for keyword in ['light blue', 'light green', 'light turquoise', 'blue-green', 'blue', 'green', 'hazel'])
         if not has_bright_eyes_keyword and not has_acceptable_light_eyes and colortype == 'VIBRANT SPRING':
             color_score -= 0.25
-            print(f'[Match] {colortype}: PENALTY -0.25 for non-bright eyes (VIBRANT SPRING prefers bright eyes)')
+            tracing.debug('[Match] %s: PENALTY -0.25 for non-bright eyes (VIBRANT SPRING prefers bright eyes)', colortype)
         
         # PENALTY: Medium brown hair → -0.30 for BRIGHT WINTER (requires dark/deep hair only)
         has_medium_brown_hair = any(keyword in hair_lower for keyword in ['medium brown', 'medium ash brown', 'medium cool brown', 'medium warm brown'])
         if has_medium_brown_hair and colortype == 'BRIGHT WINTER':
             color_score -= 0.30
-            print(f'[Match] {colortype}: PENALTY -0.30 for medium brown hair (BRIGHT WINTER requires dark/deep hair only)')
+            tracing.debug('[Match] %s: PENALTY -0.30 for medium brown hair (BRIGHT WINTER requires dark/deep hair only)', colortype)
         
         # PENALTY: Medium brown hair → -0.20 for SOFT WINTER (requires dark/deep hair only)
         if has_medium_brown_hair and colortype == 'SOFT WINTER':
             color_score -= 0.20
-            print(f'[Match] {colortype}: PENALTY -0.20 for medium brown hair (SOFT WINTER requires dark/deep hair only)')
+            tracing.debug('[Match] %s: PENALTY -0.20 for medium brown hair (SOFT WINTER requires dark/deep hair only)', colortype)
         
         # BONUS: Black-brown eyes → +0.15 for VIVID WINTER (characteristic eye color)
         has_black_brown_eyes = any(keyword in eyes_lower for keyword in ['black-brown', 'black brown', 'very dark brown', 'blackish brown'])
         if has_black_brown_eyes and colortype == 'VIVID WINTER':
             color_score += 0.15
-            print(f'[Match] {colortype}: BONUS +0.15 for black-brown eyes (characteristic VIVID WINTER)')
+            tracing.debug('[Match] %s: BONUS +0.15 for black-brown eyes (characteristic VIVID WINTER)', colortype)
         
         # PENALTY: Dark brown hair → -0.30 for DUSTY SUMMER and VIVID SUMMER (require light/medium hair)
         has_dark_brown_hair_color = any(keyword in hair_lower for keyword in ['dark brown', 'deep brown', 'dark cool brown', 'dark ash brown'])
         if has_dark_brown_hair_color and colortype in ['DUSTY SUMMER', 'VIVID SUMMER']:
             color_score -= 0.30
-            print(f'[Match] {colortype}: PENALTY -0.30 for dark brown hair ({colortype} requires light/medium hair only)')
+            tracing.debug('[Match] %s: PENALTY -0.30 for dark brown hair (%s requires light/medium hair only)', colortype, colortype)
         
         # Total score: 1.5x parameters + 1x colors
         total_score = (param_match * 1.5) + (color_score * 1.0)
         
-        print(f'[Match] {colortype}: param={param_match:.2f} (U:{undertone_match:.0f} S:{saturation_match:.0f} C:{contrast_match:.0f}), color={color_score:.2f} (h:{hair_score:.2f}*{hair_weight:.2f} s:{skin_score:.2f}*{skin_weight:.2f} e:{eyes_score:.2f}*{eyes_weight:.2f}), total={total_score:.2f}')
+        tracing.debug('[Match] %s: param=%.2f (U:%.0f S:%.0f C:%.0f), color=%.2f (h:%.2f*%.2f s:%.2f*%.2f e:%.2f*%.2f), total=%.2f', colortype, param_match, undertone_match, saturation_match, contrast_match, color_score, hair_score, hair_weight, skin_score, skin_weight, eyes_score, eyes_weight, total_score)
         
         if total_score > best_total_score:
             best_total_score = total_score
@@ -1433,7 +1414,7 @@ def match_colortype(analysis: dict, gpt_suggested_type: str = None) -> tuple:
     
     # FALLBACK: If no colortype found, use color-only scoring
     if best_colortype is None:
-        print(f'[Match] FALLBACK: No candidates! Scoring all colortypes by color only...')
+        tracing.warning(f'[Match] FALLBACK: No candidates! Scoring all colortypes by color only...')
         
         for colortype in COLORTYPE_REFERENCES.keys():
             ref = COLORTYPE_REFERENCES[colortype]
@@ -1443,7 +1424,7 @@ def match_colortype(analysis: dict, gpt_suggested_type: str = None) -> tuple:
             
             color_score = (hair_score * 0.32) + (skin_score * 0.32) + (eyes_score * 0.36)
             
-            print(f'[Match] {colortype}: color={color_score:.2f} (h:{hair_score:.2f} s:{skin_score:.2f} e:{eyes_score:.2f})')
+            tracing.debug('[Match] %s: color=%.2f (h:%.2f s:%.2f e:%.2f)', colortype, color_score, hair_score, skin_score, eyes_score)
             
             if color_score > best_color_score:
                 best_color_score = color_score
@@ -1452,12 +1433,12 @@ def match_colortype(analysis: dict, gpt_suggested_type: str = None) -> tuple:
         
         if best_colortype:
             explanation = format_result(best_colortype, hair, skin, eyes, undertone, saturation, contrast, 'fallback2', gpt_suggested_type)
-            print(f'[Match] FALLBACK SUCCESS: {best_colortype} with color_score {best_color_score:.2f}')
+            tracing.warning(f'[Match] FALLBACK SUCCESS: {best_colortype} with color_score {best_color_score:.2f}')
             return best_colortype, explanation
     
     explanation = format_result(best_colortype, hair, skin, eyes, undertone, saturation, contrast, 'standard', gpt_suggested_type)
     
-    print(f'[Match] FINAL: {best_colortype} with score {best_total_score:.2f}')
+    tracing.debug('[Match] FINAL: %s with score %.2f', best_colortype, best_total_score)
     
     return best_colortype, explanation
 
@@ -1513,8 +1494,8 @@ def calculate_contrast(hair_lightness: str, skin_lightness: str, eyes_lightness:
     # Sum both differences (max = 4)
     total_diff = hair_skin_diff + eyes_skin_diff
     
-    print(f'[Contrast] hair={hair_lightness}({hair_level}), skin={skin_lightness}({skin_level}), eyes={eyes_lightness}({eyes_level})')
-    print(f'[Contrast] hair-skin={hair_skin_diff}, eyes-skin={eyes_skin_diff}, total={total_diff}')
+    tracing.debug('[Contrast] hair=%s(%s), skin=%s(%s), eyes=%s(%s)', hair_lightness, hair_level, skin_lightness, skin_level, eyes_lightness, eyes_level)
+    tracing.debug('[Contrast] hair-skin=%s, eyes-skin=%s, total=%s', hair_skin_diff, eyes_skin_diff, total_diff)
     
     if total_diff == 0:
         return 'LOW-CONTRAST'
@@ -1525,6 +1506,68 @@ def calculate_contrast(hair_lightness: str, skin_lightness: str, eyes_lightness:
     else:  # total_diff >= 3
         return 'HIGH-CONTRAST'
 
+def fail_stuck_tasks(conn, cursor, limit: int = SWEEP_BATCH) -> int:
+    '''
+    Зависшие задачи OpenRouter старше 3 минут (запрос не дошёл до API или воркер
+    упал) помечаются failed с возвратом денег. Вызывается в режиме sweep.
+    '''
+    cursor.execute('''
+        SELECT id, user_id, created_at
+        FROM color_type_history
+        WHERE status = 'processing' 
+          AND replicate_prediction_id IS NULL
+          AND created_at < NOW() - INTERVAL '3 minutes'
+        ORDER BY created_at ASC
+        LIMIT %s
+    ''', (limit,))
+    
+    stuck_openai_tasks = cursor.fetchall()
+    tracing.debug('[ColorType-Worker] Found %s stuck OpenAI tasks', len(stuck_openai_tasks))
+    
+    for stuck_task in stuck_openai_tasks:
+        stuck_id, stuck_user_id, stuck_created = stuck_task
+        tracing.warning(f'[ColorType-Worker] Marking stuck OpenAI task {stuck_id} as failed (timeout)')
+        
+        try:
+            cursor.execute('''
+                UPDATE color_type_history
+                SET status = 'failed', result_text = %s, updated_at = %s
+                WHERE id = %s AND status = 'processing'
+            ''', ('Анализ занял слишком много времени. Деньги возвращены на баланс. Попробуйте позже.', datetime.utcnow(), stuck_id))
+            if cursor.rowcount != 1:
+                # Задачу успел завершить воркер — возвращать нечего
+                conn.rollback()
+                continue
+            
+            # Возврат — пользователь результата не получил. В той же транзакции,
+            # что и перевод в failed: либо оба, либо ничего
+            refund_task(
+                cursor, 'color_type_history', stuck_id, stuck_user_id, COLORTYPE_COST,
+                'Возврат: технический сбой цветотипа', color_type_id=stuck_id,
+            )
+            mark_stage(cursor, 'colortype', stuck_id, 'finalized')
+            conn.commit()
+            tracing.warning(f'[ColorType-Worker] Stuck OpenAI task {stuck_id} marked as failed and refunded')
+            
+        except Exception as e:
+            conn.rollback()
+            tracing.error(f'[ColorType-Worker] Error handling stuck OpenAI task {stuck_id}: {str(e)}')
+    
+    return len(stuck_openai_tasks)
+
+
+def is_sweep_request(event: Dict[str, Any], params: Dict[str, Any]) -> bool:
+    '''Режим sweep: ?sweep=1 и системный токен (JWT_SECRET_KEY), как у крон-функций.'''
+    if params.get('sweep') != '1':
+        return False
+    headers = event.get('headers', {})
+    provided_token = headers.get('x-system-token') or headers.get('X-System-Token')
+    expected = os.environ.get('JWT_SECRET_KEY')
+    return bool(expected) and provided_token == expected
+
+
+@profiling.profiled('colortype-worker')
+@tracing.traced('colortype-worker')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Worker анализа цветотипа
@@ -1553,6 +1596,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     query_params = event.get('queryStringParameters') or {}
     task_id = query_params.get('task_id')
     
+    # Зависшие задачи закрываются пачкой по расписанию (task-sweeper), а не в каждом вызове
+    if is_sweep_request(event, query_params):
+        tracing.annotate(mode='sweep')
+        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        cursor = tracing.TracedCursor(conn.cursor())
+        try:
+            failed = fail_stuck_tasks(conn, cursor)
+        finally:
+            cursor.close()
+            conn.close()
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': get_cors_origin(event)},
+            'isBase64Encoded': False,
+            'body': json.dumps({'status': 'swept', 'stuck_tasks_failed': failed})
+        }
+    
     if not task_id:
         return {
             'statusCode': 400,
@@ -1561,7 +1621,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'task_id parameter is required'})
         }
     
-    print(f'[ColorType-Worker] Processing task: {task_id}, checking DATABASE_URL...')
+    tracing.annotate(task_id=task_id)
+    tracing.debug('[ColorType-Worker] Processing task: %s, checking DATABASE_URL...', task_id)
     
     database_url = os.environ.get('DATABASE_URL')
     if not database_url:
@@ -1573,42 +1634,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     try:
-        conn = psycopg2.connect(database_url)
-        cursor = conn.cursor()
-        
-        # FIRST: Check for stuck OpenAI/OpenRouter tasks older than 3 minutes (timeout = request never reached API, refund money)
-        print(f'[ColorType-Worker] Checking for stuck OpenAI tasks older than 3 minutes...')
-        cursor.execute('''
-            SELECT id, user_id, created_at
-            FROM color_type_history
-            WHERE status = 'processing' 
-              AND replicate_prediction_id IS NULL
-              AND created_at < NOW() - INTERVAL '3 minutes'
-            ORDER BY created_at ASC
-            LIMIT 10
-        ''')
-        
-        stuck_openai_tasks = cursor.fetchall()
-        print(f'[ColorType-Worker] Found {len(stuck_openai_tasks)} stuck OpenAI tasks')
-        
-        for stuck_task in stuck_openai_tasks:
-            stuck_id, stuck_user_id, stuck_created = stuck_task
-            print(f'[ColorType-Worker] Marking stuck OpenAI task {stuck_id} as failed (timeout)')
-            
-            try:
-                cursor.execute('''
-                    UPDATE color_type_history
-                    SET status = 'failed', result_text = %s, updated_at = %s
-                    WHERE id = %s
-                ''', ('Анализ занял слишком много времени. Деньги возвращены на баланс. Попробуйте позже.', datetime.utcnow(), stuck_id))
-                conn.commit()
-                
-                # Возврат — пользователь результата не получил
-                refund_balance_if_needed(conn, stuck_user_id, stuck_id)
-                print(f'[ColorType-Worker] Stuck OpenAI task {stuck_id} marked as failed and refunded')
-                
-            except Exception as e:
-                print(f'[ColorType-Worker] Error handling stuck OpenAI task {stuck_id}: {str(e)}')
+        with tracing.span('db_connect'):
+            conn = psycopg2.connect(database_url)
+        cursor = tracing.TracedCursor(conn.cursor())
         
         # Get current task
         cursor.execute('''
@@ -1620,7 +1648,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         task_row = cursor.fetchone()
         
         if not task_row:
-            print(f'[ColorType-Worker] Task {task_id} not found')
+            tracing.warning(f'[ColorType-Worker] Task {task_id} not found')
             cursor.close()
             conn.close()
             return {
@@ -1635,7 +1663,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         # Check if already processed
         if saved_to_history:
-            print(f'[ColorType-Worker] Task {task_id} already saved to history, skipping')
+            tracing.debug('[ColorType-Worker] Task %s already saved to history, skipping', task_id)
             cursor.close()
             conn.close()
             return {
@@ -1649,7 +1677,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         if task_status == 'pending':
             if not replicate_prediction_id:
                 # ATOMIC: Mark as processing FIRST
-                print(f'[ColorType-Worker] Task {task_id}: ATOMIC UPDATE to prevent duplicate submission')
+                tracing.debug('[ColorType-Worker] Task %s: ATOMIC UPDATE to prevent duplicate submission', task_id)
                 cursor.execute('''
                     UPDATE color_type_history
                     SET status = 'processing', updated_at = %s
@@ -1657,10 +1685,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     RETURNING id
                 ''', (datetime.utcnow(), task_id))
                 updated_row = cursor.fetchone()
+                if updated_row:
+                    mark_stage(cursor, 'colortype', task_id, 'admitted')
                 conn.commit()
                 
                 if not updated_row:
-                    print(f'[ColorType-Worker] Task {task_id} already being processed, skipping')
+                    tracing.debug('[ColorType-Worker] Task %s already being processed, skipping', task_id)
                     cursor.close()
                     conn.close()
                     return {
@@ -1670,14 +1700,17 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'body': json.dumps({'status': 'task_already_processing'})
                     }
                 
-                print(f'[ColorType-Worker] Task {task_id} marked as processing')
+                tracing.debug('[ColorType-Worker] Task %s marked as processing', task_id)
                 
                 # Upload image to Yandex Storage
-                print(f'[ColorType-Worker] Uploading image to Yandex Storage')
+                tracing.debug('[ColorType-Worker] Uploading image to Yandex Storage')
                 cdn_url = upload_to_yandex_storage(person_image, user_id, task_id)
+                # Коммит сразу: на время запроса к модели транзакция не висит открытой
+                mark_stage(cursor, 'colortype', task_id, 'submitted')
+                conn.commit()
                 
                 # Submit to OpenAI GPT-4 Vision (synchronous - returns immediately)
-                print(f'[ColorType-Worker] Submitting to OpenAI GPT-4o Vision with user eye_color: {eye_color}')
+                tracing.debug('[ColorType-Worker] Submitting to OpenAI GPT-4o Vision with user eye_color: %s', eye_color)
                 try:
                     # Retry up to 2 times on image-fetch errors (CDN/provider delays)
                     openai_result = None
@@ -1701,15 +1734,17 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                             )
                             if is_fetch_err and attempt < 2:
                                 pause = 2 * (attempt + 1)
-                                print(f'[ColorType-Worker] Image fetch error on attempt {attempt+1}, retrying in {pause}s: {str(retry_err)[:200]}')
+                                tracing.count('openrouter', 'retries')
+                                tracing.warning(f'[ColorType-Worker] Image fetch error on attempt {attempt+1}, retrying in {pause}s: {str(retry_err)[:200]}')
                                 time.sleep(pause)
                                 continue
                             raise
                     if openai_result is None:
                         raise last_err if last_err else Exception('Unknown OpenAI error')
                     raw_result = openai_result.get('output', '')
+                    mark_stage(cursor, 'colortype', task_id, 'provider_done')
                     
-                    print(f'[ColorType-Worker] OpenAI response: {raw_result[:200]}...')
+                    tracing.debug('[ColorType-Worker] OpenAI response: %s...', raw_result[:200])
                     
                     # Defensive defaults — avoid UnboundLocalError in outer except / DB write
                     gpt_suggested_type = None
@@ -1760,29 +1795,31 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                                             return s[start:i+1]
                             return s[start:]
                         
-                        json_str = _extract_first_json_object(json_str)
+                        with tracing.span('json_extract'):
+                            json_str = _extract_first_json_object(json_str)
                         
                         # If the model ignored the assistant-prefill, the prefill fragment
                         # `{"suggested_colortype": "` may appear at the start without a closing
                         # quote, breaking parsing. If we can't parse, try a fallback that
                         # strips a leading broken prefill line.
-                        print(f'[ColorType-Worker] Cleaned JSON: {json_str[:300]}...')
+                        tracing.debug('[ColorType-Worker] Cleaned JSON: %s...', json_str[:300])
                         
-                        try:
-                            analysis = json.loads(json_str)
-                        except json.JSONDecodeError:
-                            # Fallback: search for a fresh balanced object after the broken prefill
-                            second_start = json_str.find('{', 1)
-                            if second_start != -1:
-                                fallback = _extract_first_json_object(json_str[second_start:])
-                                print(f'[ColorType-Worker] Fallback JSON: {fallback[:300]}...')
-                                analysis = json.loads(fallback)
-                            else:
-                                raise
+                        with tracing.span('json_parse'):
+                            try:
+                                analysis = json.loads(json_str)
+                            except json.JSONDecodeError:
+                                # Fallback: search for a fresh balanced object after the broken prefill
+                                second_start = json_str.find('{', 1)
+                                if second_start != -1:
+                                    fallback = _extract_first_json_object(json_str[second_start:])
+                                    tracing.debug('[ColorType-Worker] Fallback JSON: %s...', fallback[:300])
+                                    analysis = json.loads(fallback)
+                                else:
+                                    raise
                         
                         # Override eye_color with user's choice
                         analysis['eye_color'] = eye_color
-                        print(f'[ColorType-Worker] Overridden eye_color with user hint: {eye_color}')
+                        tracing.debug('[ColorType-Worker] Overridden eye_color with user hint: %s', eye_color)
                         
                         # Map user's eye color to lightness level (NEW 3-level system: LIGHT/MEDIUM/DEEP)
                         EYE_COLOR_TO_LIGHTNESS = {
@@ -1817,7 +1854,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         
                         eyes_lightness = EYE_COLOR_TO_LIGHTNESS.get(eye_color.lower(), 'MEDIUM-EYES-COLORS')
                         analysis['eyes_lightness'] = eyes_lightness
-                        print(f'[ColorType-Worker] Mapped eye_color "{eye_color}" to eyes_lightness: {eyes_lightness}')
+                        tracing.debug('[ColorType-Worker] Mapped eye_color "%s" to eyes_lightness: %s', eye_color, eyes_lightness)
                         
                         # Calculate contrast based on hair_lightness, skin_lightness, eyes_lightness
                         contrast = calculate_contrast(
@@ -1826,27 +1863,28 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                             eyes_lightness
                         )
                         analysis['contrast'] = contrast
-                        print(f'[ColorType-Worker] Calculated contrast: {contrast}')
+                        tracing.debug('[ColorType-Worker] Calculated contrast: %s', contrast)
                         
-                        print(f'[ColorType-Worker] Parsed analysis: {analysis}')
+                        tracing.debug('[ColorType-Worker] Parsed analysis: %s', analysis)
                         
                         # Extract GPT suggestion
                         gpt_suggested_type = analysis.get('suggested_colortype', '').strip().upper()
-                        print(f'[ColorType-Worker] GPT suggested colortype: {gpt_suggested_type}')
+                        tracing.debug('[ColorType-Worker] GPT suggested colortype: %s', gpt_suggested_type)
                         
                         # Calculate colortype via formula (primary method)
-                        color_type, explanation = match_colortype(analysis, gpt_suggested_type)
+                        with tracing.span('match'):
+                            color_type, explanation = match_colortype(analysis, gpt_suggested_type)
                         result_text_value = explanation
                         
-                        print(f'[ColorType-Worker] Formula calculated: {color_type}')
-                        print(f'[ColorType-Worker] Explanation: {explanation}')
+                        tracing.debug('[ColorType-Worker] Formula calculated: %s', color_type)
+                        tracing.debug('[ColorType-Worker] Explanation: %s', explanation)
                         
                         # Compare GPT suggestion with formula result
                         if gpt_suggested_type and gpt_suggested_type == color_type:
-                            print(f'[ColorType-Worker] ✅ GPT and Formula MATCH: {color_type}')
+                            tracing.debug('[ColorType-Worker] ✅ GPT and Formula MATCH: %s', color_type)
                             # Text already added in format_result
                         elif gpt_suggested_type:
-                            print(f'[ColorType-Worker] ⚠️ MISMATCH: GPT={gpt_suggested_type}, Formula={color_type}')
+                            tracing.warning(f'[ColorType-Worker] ⚠️ MISMATCH: GPT={gpt_suggested_type}, Formula={color_type}')
                             gpt_colortype_ru = COLORTYPE_NAMES_RU.get(gpt_suggested_type, gpt_suggested_type)
                             formula_colortype_ru = COLORTYPE_NAMES_RU.get(color_type, color_type)
                             result_text_value += f'\n\n⚠️ Ваша внешность находится на границе двух типов:\n\n**{gpt_colortype_ru} (по визуальному анализу ИИ):**\nИИ сравнил вашу внешность с референсными фото и определил наибольшее сходство с этим типом.\n\n**{formula_colortype_ru} (по формуле параметров):**\nМатематический анализ характеристик (подтон, насыщенность, контраст) указывает на этот тип.\n\nРекомендуем попробовать палитры обоих типов и выбрать ту, в которой вы чувствуете себя наиболее гармонично.'
@@ -1855,12 +1893,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         # Ответ ИИ не разобрался — это НЕ успех.
                         # Раньше сюда сохранялся сырой обрывок как готовый результат
                         # и деньги не возвращались.
-                        print(f'[ColorType-Worker] Failed to parse JSON: {e}')
+                        tracing.error(f'[ColorType-Worker] Failed to parse JSON: {e}')
                         cursor.execute('''
                             UPDATE color_type_history
                             SET status = 'failed', error_message = %s, updated_at = %s
                             WHERE id = %s
                         ''', (COLORTYPE_PARSE_ERROR, datetime.utcnow(), task_id))
+                        mark_stage(cursor, 'colortype', task_id, 'finalized')
                         conn.commit()
                         refund_balance_if_needed(conn, user_id, task_id)
                         cursor.close()
@@ -1879,9 +1918,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                             cdn_url = %s, saved_to_history = true, updated_at = %s
                         WHERE id = %s
                     ''', (result_text_value, color_type, gpt_suggested_type if gpt_suggested_type else None, cdn_url, datetime.utcnow(), task_id))
+                    mark_stage(cursor, 'colortype', task_id, 'finalized')
                     conn.commit()
                     
-                    print(f'[ColorType-Worker] Task {task_id} completed successfully')
+                    tracing.debug('[ColorType-Worker] Task %s completed successfully', task_id)
                     
                     cursor.close()
                     conn.close()
@@ -1903,7 +1943,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     )
                     is_timeout = 'timeout' in error_msg or 'timed out' in error_msg
                     
-                    print(f'[ColorType-Worker] OpenAI API error: {str(e)} (image_fetch_error: {is_image_fetch_error}, timeout: {is_timeout})')
+                    tracing.error(f'[ColorType-Worker] OpenAI API error: {str(e)} (image_fetch_error: {is_image_fetch_error}, timeout: {is_timeout})')
                     
                     # User-friendly message — все случаи с возвратом средств
                     if is_image_fetch_error:
@@ -1918,11 +1958,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         SET status = 'failed', result_text = %s, updated_at = %s
                         WHERE id = %s
                     ''', (user_msg, datetime.utcnow(), task_id))
+                    mark_stage(cursor, 'colortype', task_id, 'finalized')
                     conn.commit()
                     
                     # Возврат во всех случаях ошибки — результата пользователь не получил
                     refund_balance_if_needed(conn, user_id, task_id)
-                    print(f'[ColorType-Worker] Refunded due to error (image_fetch={is_image_fetch_error}, timeout={is_timeout})')
+                    tracing.warning(f'[ColorType-Worker] Refunded due to error (image_fetch={is_image_fetch_error}, timeout={is_timeout})')
                     
                     cursor.close()
                     conn.close()
@@ -1945,7 +1986,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
         
     except Exception as e:
-        print(f'[ColorType-Worker] ERROR: {str(e)}')
+        tracing.error(f'[ColorType-Worker] ERROR: {str(e)}')
         return {
             'statusCode': 500,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': get_cors_origin(event)},
@@ -0,0 +1,183 @@
+"""
+Лёгкая трассировка вызова функции: спаны + одна компактная JSON-строка на вызов.
+
+Вместо сотен print на задачу вызов копит счётчики по спанам (время,
+количество, байты, повторы) и в конце печатает одну строку:
+
+    {"trace":"colortype-worker","ms":8123.4,"status":200,
+     "spans":{"db":{"n":7,"ms":41.2,"max_ms":12.0},
+              "openrouter":{"n":1,"ms":7800.1,"max_ms":7800.1,"bytes":2311,"retries":0}, ...}}
+
+Подробные строки прогресса идут через debug() и печатаются только при
+LOG_LEVEL=debug. Уровни: debug < info (по умолчанию) < warning < error.
+Аргументы передаются отдельно, в стиле logging, — строка собирается,
+только если уровень включён:
+
+    tracing.debug('[Match] %s: score=%.2f', colortype, score)
+
+Использование:
+
+    import tracing
+
+    @tracing.traced('colortype-worker')
+    def handler(event, context): ...
+
+    with tracing.span('s3_put'):
+        s3.put_object(...)
+    tracing.count('s3_put', 'bytes', len(body))
+
+    cursor = tracing.TracedCursor(conn.cursor())   # каждый execute — спан 'db'
+"""
+
+import json
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Dict
+
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+_level = LEVELS.get(os.environ.get('LOG_LEVEL', 'info').strip().lower(), 20)
+
+
+class Trace:
+    '''Счётчики одного вызова функции.'''
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans: Dict[str, Dict[str, Any]] = {}
+        self.fields: Dict[str, Any] = {}
+
+    def _stat(self, name: str) -> Dict[str, Any]:
+        return self.spans.setdefault(name, {'n': 0, 'ms': 0.0, 'max_ms': 0.0})
+
+    @contextmanager
+    def span(self, name: str):
+        stat = self._stat(name)
+        start = time.perf_counter()
+        try:
+            yield stat
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            stat['n'] += 1
+            stat['ms'] += elapsed
+            stat['max_ms'] = max(stat['max_ms'], elapsed)
+
+    def count(self, name: str, key: str, value: int = 1) -> None:
+        stat = self._stat(name)
+        stat[key] = stat.get(key, 0) + value
+
+    def summary(self) -> Dict[str, Any]:
+        spans = {
+            name: {k: round(v, 1) if isinstance(v, float) else v for k, v in stat.items()}
+            for name, stat in self.spans.items()
+        }
+        return {
+            'trace': self.name,
+            'ms': round((time.perf_counter() - self.started) * 1000, 1),
+            **self.fields,
+            'spans': spans,
+        }
+
+
+_current = Trace('unknown')
+
+
+def current() -> Trace:
+    return _current
+
+
+def span(name: str):
+    return _current.span(name)
+
+
+def count(name: str, key: str, value: int = 1) -> None:
+    _current.count(name, key, value)
+
+
+def annotate(**fields) -> None:
+    '''Добавить поля в итоговую строку (task_id, итоговый статус и т.п.).'''
+    _current.fields.update(fields)
+
+
+def enabled(level: str) -> bool:
+    return _level <= LEVELS[level]
+
+
+def _log(level: str, msg: str, args: tuple) -> None:
+    if _level <= LEVELS[level]:
+        if args:
+            msg = msg % args
+        print(msg if level in ('debug', 'info') else f'[{level.upper()}] {msg}')
+
+
+def debug(msg: str, *args) -> None:
+    '''Строка прогресса. Аргументы подставляются в msg через % только при
+    LOG_LEVEL=debug — на обычном уровне вызов почти ничего не стоит.'''
+    _log('debug', msg, args)
+
+
+def info(msg: str, *args) -> None:
+    _log('info', msg, args)
+
+
+def warning(msg: str, *args) -> None:
+    _log('warning', msg, args)
+
+
+def error(msg: str, *args) -> None:
+    _log('error', msg, args)
+
+
+def traced(name: str):
+    '''Декоратор handler: новая трасса на вызов и итоговая JSON-строка в конце.'''
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(event, context):
+            global _current
+            _current = Trace(name)
+            status = None
+            try:
+                response = fn(event, context)
+                if isinstance(response, dict):
+                    status = response.get('statusCode')
+                return response
+            except Exception:
+                status = 'exception'
+                raise
+            finally:
+                _current.fields['status'] = status
+                if _level <= LEVELS['info']:
+                    print(json.dumps(_current.summary(), ensure_ascii=False, separators=(',', ':'), default=str))
+        return wrapper
+    return decorator
+
+
+class TracedCursor:
+    '''Обёртка над курсором psycopg2: execute/executemany попадают в спан 'db'.'''
+
+    def __init__(self, cursor, span_name: str = 'db'):
+        self._cursor = cursor
+        self._span_name = span_name
+
+    def execute(self, query, params=None):
+        with _current.span(self._span_name):
+            return self._cursor.execute(query, params)
+
+    def executemany(self, query, params_seq):
+        with _current.span(self._span_name):
+            return self._cursor.executemany(query, params_seq)
+
+    def __getattr__(self, item):
+        return getattr(self._cursor, item)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._cursor.close()
+        return False
@@ -6,8 +6,91 @@ import boto3
 from botocore.config import Config
 from typing import Dict, Any, List, Optional
 from session_utils import validate_session
+from page_cursor import encode_page_cursor, decode_page_cursor
+from media_refs import add_media_refs, release_media_refs, release_media_prefix, media_ref_count
 # redeploy v2
 
+# Именованные проекции для таблиц с тяжёлыми колонками (base64-фото, garments, result_json).
+# Без columns селект отдаёт проекцию 'list'; 'detail' — для карточки одной записи;
+# полная строка (SELECT *) — только по явному projection='full'.
+TABLE_PROJECTIONS = {
+    'nanobananapro_tasks': {
+        'list': ['id', 'user_id', 'status', 'result_url', 'error_message', 'saved_to_history',
+                 'refunded', 'first_result_at', 'created_at', 'updated_at'],
+        'detail': ['id', 'user_id', 'status', 'result_url', 'error_message', 'saved_to_history',
+                   'refunded', 'first_result_at', 'created_at', 'updated_at',
+                   'garments', 'prompt_hints', 'fal_request_id'],
+    },
+    'color_type_history': {
+        'list': ['id', 'user_id', 'status', 'color_type', 'color_type_ai', 'cdn_url', 'eye_color',
+                 'guide_task_id', 'guide_chosen_slug', 'cost', 'refunded', 'created_at', 'updated_at'],
+        'detail': ['id', 'user_id', 'status', 'color_type', 'color_type_ai', 'cdn_url', 'eye_color',
+                   'guide_task_id', 'guide_chosen_slug', 'cost', 'refunded', 'created_at', 'updated_at',
+                   'result_text', 'error_message', 'saved_to_history'],
+    },
+    'color_guide_tasks': {
+        'list': ['id', 'user_id', 'status', 'service_type', 'cdn_url', 'colortype_slug', 'cost',
+                 'refunded', 'error_message', 'colortype_history_id', 'created_at', 'updated_at'],
+        'detail': ['id', 'user_id', 'status', 'service_type', 'cdn_url', 'colortype_slug', 'cost',
+                   'refunded', 'error_message', 'colortype_history_id', 'created_at', 'updated_at',
+                   'result_json', 'form_params', 'height', 'forced_colortype_slug',
+                   'forced_colortype_slug_alt'],
+    },
+}
+
+
+def _resolve_projection(table: str, projection: Optional[str]) -> Optional[List[str]]:
+    '''
+    Колонки для селекта без явного columns.
+    None — SELECT * (таблица без проекций или projection='full').
+    '''
+    projections = TABLE_PROJECTIONS.get(table)
+    if projection == 'full':
+        return None
+    if not projections:
+        if projection in (None, 'list', 'detail'):
+            return None
+        raise Exception(f'Unknown projection: {projection}')
+    name = projection or 'list'
+    if name not in projections:
+        raise Exception(f'Unknown projection: {projection}')
+    return list(projections[name])
+
+
+# Если оценка планировщика ниже порога — считаем точно (дёшево и без погрешности)
+ESTIMATE_EXACT_THRESHOLD = 1000
+
+
+def _estimate_count(cursor, from_where: str, params: list) -> Optional[int]:
+    '''
+    Оценка количества строк без полного COUNT(*):
+    без фильтра — pg_class.reltuples, с фильтром — оценка строк из EXPLAIN.
+    Для маленьких оценок (< ESTIMATE_EXACT_THRESHOLD) делаем точный COUNT —
+    он всё равно дешёвый, а оценки по user_id у планировщика грубые.
+    EXPLAIN идёт под SAVEPOINT: если он упадёт (таймаут, ошибка планировщика),
+    транзакция запроса не прерывается и вызывающий код досчитает точно.
+    '''
+    cursor.execute('SAVEPOINT count_estimate')
+    try:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) SELECT 1 FROM {from_where}', list(params))
+        plan = cursor.fetchone()[0]
+    except Exception as e:
+        print(f'[DB-Query] Count estimate failed: {e}')
+        cursor.execute('ROLLBACK TO SAVEPOINT count_estimate')
+        return None
+    cursor.execute('RELEASE SAVEPOINT count_estimate')
+    try:
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        estimate = int(plan[0]['Plan']['Plan Rows'])
+    except Exception as e:
+        print(f'[DB-Query] Count estimate failed: {e}')
+        return None
+    if estimate < ESTIMATE_EXACT_THRESHOLD:
+        cursor.execute(f'SELECT COUNT(*) FROM {from_where}', list(params))
+        return cursor.fetchone()[0]
+    return estimate
+
 
 def _adapt_value(value: Any) -> Any:
     '''dict -> jsonb (через Json), остальное без изменений (list -> text[] адаптирует psycopg2).'''
@@ -26,48 +109,31 @@ def delete_from_s3_if_orphaned(photo_url: str, user_id: str, cursor, schema: str
     if not photo_url or not photo_url.startswith(s3_url_prefix):
         return
     
-    # Проверяем наличие в try_on_history
-    cursor.execute(
-        f"SELECT COUNT(*) as count FROM {schema}.try_on_history WHERE user_id = %s AND result_image = %s",
-        (user_id, photo_url)
-    )
-    history_count = cursor.fetchone()[0]
-    
-    # Проверяем наличие в freegen_history (генерации тоже можно добавлять в лукбуки)
-    cursor.execute(
-        f"SELECT COUNT(*) as count FROM {schema}.freegen_history WHERE user_id = %s AND result_image = %s",
-        (user_id, photo_url)
-    )
-    freegen_count = cursor.fetchone()[0]
-    
-    # Проверяем наличие в lookbooks
-    cursor.execute(
-        f"SELECT COUNT(*) as count FROM {schema}.lookbooks WHERE user_id = %s AND %s = ANY(photos)",
-        (user_id, photo_url)
-    )
-    lookbooks_count = cursor.fetchone()[0]
+    # Ссылки из истории и лукбуков учитываются в media_refs — один поиск по PK.
+    # Отслеживаемый файл без ссылок уже стоит в очереди s3-gc — inline не удаляем.
+    if media_ref_count(cursor, photo_url) is not None:
+        return
     
     # Если фото нигде не используется - удаляем из S3
-    if history_count == 0 and freegen_count == 0 and lookbooks_count == 0:
-        try:
-            s3_key = photo_url.replace(s3_url_prefix, '')
-            
-            s3_client = boto3.client(
-                's3',
-                endpoint_url='https://storage.yandexcloud.net',
-                aws_access_key_id=os.environ.get('S3_ACCESS_KEY'),
-                aws_secret_access_key=os.environ.get('S3_SECRET_KEY'),
-                region_name='ru-central1',
-                config=Config(signature_version='s3v4')
-            )
-            
-            s3_client.delete_object(
-                Bucket=s3_bucket_name,
-                Key=s3_key
-            )
-            print(f'[S3] Deleted orphaned photo: {s3_key}')
-        except Exception as e:
-            print(f'[S3] Failed to delete {photo_url}: {e}')
+    try:
+        s3_key = photo_url.replace(s3_url_prefix, '')
+        
+        s3_client = boto3.client(
+            's3',
+            endpoint_url='https://storage.yandexcloud.net',
+            aws_access_key_id=os.environ.get('S3_ACCESS_KEY'),
+            aws_secret_access_key=os.environ.get('S3_SECRET_KEY'),
+            region_name='ru-central1',
+            config=Config(signature_version='s3v4')
+        )
+        
+        s3_client.delete_object(
+            Bucket=s3_bucket_name,
+            Key=s3_key
+        )
+        print(f'[S3] Deleted orphaned photo: {s3_key}')
+    except Exception as e:
+        print(f'[S3] Failed to delete {photo_url}: {e}')
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -171,7 +237,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'kibbe_test_history',
             'archetype_test_history',
             'user_models',
-            'knowledge_posts'
+            'knowledge_posts',
+            'user_activity'
         ]
         
         if table not in allowed_tables:
@@ -200,6 +267,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
+        # user_activity — проекция, которую ведут триггеры (V0107); клиенту только чтение
+        if table == 'user_activity' and action != 'select':
+            return {
+                'statusCode': 403,
+                'headers': {
+                    'Access-Control-Allow-Origin': get_cors_origin(event),
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Credentials': 'true'
+                },
+                'body': json.dumps({'error': 'Only read access is allowed for user_activity'}),
+                'isBase64Encoded': False
+            }
+        
         # Connect to database
         dsn = os.environ.get('DATABASE_URL')
         if not dsn:
@@ -216,12 +296,36 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         if action == 'select':
             # SELECT query
             where = body.get('where', {})
-            limit = body.get('limit', 100)
+            limit = int(body.get('limit', 100))
             offset = body.get('offset', 0)
             order_by = body.get('order_by', 'created_at DESC')
-            columns_to_select = body.get('columns', [])
-            
-            # If columns specified, use them; otherwise SELECT *
+            columns_to_select = list(body.get('columns', []))
+            
+            # Без явных колонок — серверная проекция таблицы (по умолчанию 'list')
+            if not columns_to_select:
+                columns_to_select = _resolve_projection(table, body.get('projection')) or []
+            
+            # Keyset-пагинация: клиент передаёт after (курсор прошлой страницы)
+            # или keyset=true для первой страницы. Сортировка фиксирована по (created_at, id),
+            # чтобы глубокие страницы истории не деградировали как OFFSET.
+            after = body.get('after')
+            use_keyset = bool(after) or bool(body.get('keyset', False))
+            keyset_desc = True
+            if use_keyset:
+                normalized_order = ' '.join(str(order_by).split()).lower()
+                if normalized_order in ('created_at desc', 'created_at desc, id desc'):
+                    keyset_desc = True
+                elif normalized_order in ('created_at', 'created_at asc', 'created_at asc, id asc'):
+                    keyset_desc = False
+                else:
+                    raise Exception('Keyset pagination supports only order by created_at')
+                # Для курсора нужны created_at и id в выборке
+                if columns_to_select:
+                    for key_col in ('created_at', 'id'):
+                        if key_col not in columns_to_select:
+                            columns_to_select.append(key_col)
+            
+            # Колонки из запроса или проекции; SELECT * — только без проекции / projection='full'
             if columns_to_select:
                 columns_str = ', '.join(columns_to_select)
                 query = f'SELECT {columns_str} FROM {full_table}'
@@ -230,8 +334,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             
             params = []
             
-            # Для user_models принудительно ограничиваем выборку владельцем
-            if table == 'user_models':
+            # Для user_models и user_activity принудительно ограничиваем выборку владельцем
+            if table in ('user_models', 'user_activity'):
                 where = dict(where or {})
                 where['user_id'] = user_id
             
@@ -240,33 +344,76 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 where = dict(where or {})
                 where['published'] = True
             
+            where_parts = []
             if where:
-                where_parts = []
                 for key, value in where.items():
                     where_parts.append(f'{key} = %s')
                     params.append(value)
+            
+            # Удалённые из истории записи в пользовательскую ленту не попадают
+            if table == 'user_activity':
+                where_parts.append('removed_at IS NULL')
+            
+            # Условие курсора не участвует в подсчёте total
+            count_where_parts = list(where_parts)
+            count_params = list(params)
+            
+            if use_keyset and after:
+                after_created_at, after_id = decode_page_cursor(after)
+                cmp_op = '<' if keyset_desc else '>'
+                where_parts.append(f'(created_at, id) {cmp_op} (%s, %s)')
+                params.append(after_created_at)
+                params.append(after_id)
+            
+            if where_parts:
                 query += ' WHERE ' + ' AND '.join(where_parts)
             
+            # count_mode: 'exact' (по умолчанию, как раньше) или 'estimated' —
+            # оценка планировщика вместо полного COUNT(*) на больших таблицах
             with_count = bool(body.get('with_count', False))
+            count_mode = body.get('count_mode', 'exact')
             total_count = None
+            total_estimated = False
             if with_count:
-                count_query = f'SELECT COUNT(*) FROM {full_table}'
-                if where:
-                    count_query += ' WHERE ' + ' AND '.join(where_parts)
-                cursor.execute(count_query, list(params))
-                total_count = cursor.fetchone()[0]
-            
-            query += f' ORDER BY {order_by} LIMIT %s OFFSET %s'
-            params.append(limit)
-            params.append(offset)
+                count_from = full_table
+                if count_where_parts:
+                    count_from += ' WHERE ' + ' AND '.join(count_where_parts)
+                if count_mode == 'estimated':
+                    total_count = _estimate_count(cursor, count_from, count_params)
+                    total_estimated = total_count is not None and total_count >= ESTIMATE_EXACT_THRESHOLD
+                if total_count is None:
+                    cursor.execute(f'SELECT COUNT(*) FROM {count_from}', count_params)
+                    total_count = cursor.fetchone()[0]
+            
+            if use_keyset:
+                direction = 'DESC' if keyset_desc else 'ASC'
+                # Берём на одну строку больше, чтобы понять, есть ли следующая страница
+                query += f' ORDER BY created_at {direction}, id {direction} LIMIT %s'
+                params.append(limit + 1)
+            else:
+                query += f' ORDER BY {order_by} LIMIT %s OFFSET %s'
+                params.append(limit)
+                params.append(offset)
             
             cursor.execute(query, params)
             columns = [desc[0] for desc in cursor.description]
             rows = cursor.fetchall()
             
             rows_data = [dict(zip(columns, row)) for row in rows]
-            if with_count:
+            if use_keyset:
+                next_after = None
+                if len(rows_data) > limit:
+                    rows_data = rows_data[:limit]
+                    last_row = rows_data[-1]
+                    next_after = encode_page_cursor(last_row['created_at'], last_row['id'])
+                result_data = {'data': rows_data, 'next_after': next_after}
+                if with_count:
+                    result_data['total'] = total_count
+                    result_data['total_estimated'] = total_estimated
+            elif with_count:
                 result_data = {'data': rows_data, 'total': total_count}
+                if count_mode == 'estimated':
+                    result_data['total_estimated'] = total_estimated
             else:
                 result_data = rows_data
         
@@ -288,6 +435,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             row = cursor.fetchone()
             result_data = dict(zip(columns, row)) if row else None
             
+            # Учитываем ссылки на фото в той же транзакции
+            if result_data:
+                if table in ('try_on_history', 'freegen_history'):
+                    add_media_refs(cursor, result_data.get('user_id'), [result_data.get('result_image')])
+                elif table == 'lookbooks':
+                    add_media_refs(cursor, result_data.get('user_id'), result_data.get('photos') or [])
+            
             conn.commit()
         
         elif action == 'update':
@@ -300,8 +454,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             
             # user_id уже получен из validate_session выше
             
-            # Для lookbooks - проверяем удалённые фото
+            # Для lookbooks - проверяем удалённые и добавленные фото
             removed_photos = []
+            added_photos = []
             if table == 'lookbooks' and 'photos' in data and user_id:
                 where_parts = []
                 params = []
@@ -314,8 +469,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 row = cursor.fetchone()
                 if row and row[0]:
                     old_photos = set(row[0])
-                    new_photos = set(data['photos'])
+                    new_photos = set(data['photos'] or [])
                     removed_photos = list(old_photos - new_photos)
+                    added_photos = list(new_photos - old_photos)
+                elif row:
+                    added_photos = list(set(data['photos'] or []))
             
             # Выполняем UPDATE
             set_parts = []
@@ -336,6 +494,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             rows = cursor.fetchall()
             result_data = [dict(zip(columns, row)) for row in rows]
             
+            if result_data and (added_photos or removed_photos):
+                add_media_refs(cursor, user_id, added_photos)
+                release_media_refs(cursor, removed_photos)
+            
             conn.commit()
             
             # Проверяем и удаляем фото из S3
@@ -477,6 +639,18 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             rows = cursor.fetchall()
             result_data = [dict(zip(columns, row)) for row in rows]
             
+            # Снимаем ссылки удалённых записей в той же транзакции
+            if table in ('try_on_history', 'freegen_history'):
+                release_media_refs(cursor, [r.get('result_image') for r in result_data])
+            elif table == 'lookbooks':
+                for r in result_data:
+                    release_media_refs(cursor, r.get('photos') or [])
+            elif table == 'color_guide_tasks' and prefixes_to_force_delete:
+                # Исходные фото задачи (см. hold_media_ref в colorguide-worker)
+                s3_base = f"https://storage.yandexcloud.net/{os.environ.get('S3_BUCKET_NAME', 'fitting-room-images')}/"
+                for prefix in prefixes_to_force_delete:
+                    release_media_prefix(cursor, user_id, s3_base + prefix)
+            
             conn.commit()
             
             # Проверяем и удаляем фото из S3 (с проверкой, используется ли где-то ещё)
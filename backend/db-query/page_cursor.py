@@ -0,0 +1,29 @@
+"""
+Курсор keyset-пагинации для списков, упорядоченных по (created_at, id) DESC.
+
+Курсор непрозрачен для клиента: это последняя пара (created_at, id)
+страницы, сериализованная в base64. Файл общий для db-query и admin-api.
+
+    from page_cursor import encode_page_cursor, decode_page_cursor
+    next_after = encode_page_cursor(rows[-1]['created_at'], rows[-1]['id'])
+    after_created_at, after_id = decode_page_cursor(after)
+"""
+
+import base64
+import json
+from typing import Any
+
+
+def encode_page_cursor(created_at: Any, row_id: Any) -> str:
+    '''Непрозрачный курсор keyset-пагинации: последняя пара (created_at, id) страницы.'''
+    raw = json.dumps([str(created_at), str(row_id)])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_page_cursor(token: str) -> tuple:
+    '''Разбирает курсор из encode_page_cursor. Бросает Exception на мусорный токен.'''
+    try:
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+        return created_at, row_id
+    except Exception:
+        raise Exception('Invalid pagination cursor')
@@ -3,8 +3,6 @@ import os
 from typing import Dict, Any
 import psycopg2
 from psycopg2.extras import RealDictCursor
-import boto3
-from botocore.config import Config
 from session_utils import validate_session
 # redeploy v2
 
@@ -16,62 +14,17 @@ def get_db_connection():
         dsn += '?options=-c%20search_path%3Dt_p29007832_virtual_fitting_room'
     return psycopg2.connect(dsn)
 
-def delete_user_folder_from_s3(user_id: str) -> int:
+def enqueue_user_s3_deletion(cursor, user_id: str) -> None:
     '''
-    Delete ALL files of a user across every top-level folder in images/.
-    Removes any object whose key contains the segment "/{user_id}/" on any depth,
-    so new folders are handled automatically. Folders without per-user structure
-    (e.g. catalog) are skipped because they never contain "/{user_id}/".
-    Returns: number of deleted files
+    Ставит удаление файлов пользователя из S3 в очередь s3_deletion_jobs.
+    Вызывается в той же транзакции, что и удаление данных из БД; сами файлы
+    удаляет s3-gc (mode=user_jobs) по префиксам images/{folder}/{user_id}/
+    пачками delete_objects, без листинга всего бакета.
     '''
-    try:
-        s3_client = boto3.client(
-            's3',
-            endpoint_url='https://storage.yandexcloud.net',
-            aws_access_key_id=os.environ.get('S3_ACCESS_KEY'),
-            aws_secret_access_key=os.environ.get('S3_SECRET_KEY'),
-            region_name='ru-central1',
-            config=Config(signature_version='s3v4')
-        )
-
-        s3_bucket_name = os.environ.get('S3_BUCKET_NAME')
-        user_segment = f'/{user_id}/'
-
-        deleted_count = 0
-        continuation_token = None
-
-        # Scan the whole images/ tree once and delete any object that belongs
-        # to this user (path contains "/{user_id}/" at any nesting level).
-        while True:
-            list_params = {
-                'Bucket': s3_bucket_name,
-                'Prefix': 'images/'
-            }
-
-            if continuation_token:
-                list_params['ContinuationToken'] = continuation_token
-
-            response = s3_client.list_objects_v2(**list_params)
-
-            if 'Contents' in response:
-                for obj in response['Contents']:
-                    key = obj['Key']
-                    if user_segment in key:
-                        s3_client.delete_object(
-                            Bucket=s3_bucket_name,
-                            Key=key
-                        )
-                        deleted_count += 1
-
-            if response.get('IsTruncated'):
-                continuation_token = response.get('NextContinuationToken')
-            else:
-                break
-
-        return deleted_count
-    except Exception as e:
-        print(f'Error deleting S3 folder for user {user_id}: {str(e)}')
-        return 0
+    cursor.execute(
+        "INSERT INTO s3_deletion_jobs (user_id, status) VALUES (%s, 'pending')",
+        (str(user_id),)
+    )
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -206,10 +159,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         cursor.execute("DELETE FROM login_attempts WHERE email = (SELECT email FROM users WHERE id = %s)", (user_id,))
         cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
         
-        conn.commit()
+        # Файлы пользователя в S3 удалит фоновая задача (s3-gc)
+        enqueue_user_s3_deletion(cursor, user_id)
         
-        # Delete user's S3 folder after successful DB deletion
-        deleted_files_count = delete_user_folder_from_s3(user_id)
+        conn.commit()
         
         return {
             'statusCode': 200,
@@ -1,7 +1,12 @@
 """Промпт диалога-гадания: вопрос → карты → ответ → уточняющий вопрос.
 
-Чтобы запрос не разрастался с каждым шагом, в предысторию идут краткие
-выжимки прошлых шагов, а не полные ответы.
+Промпт делится на две части. Постоянная (build_dialog_prefix) — роль,
+правила, геометрия и чтение расклада — одинакова для всех шагов и всех
+диалогов на этом раскладе, поэтому провайдер кэширует её и не пересчитывает.
+Переменная (build_dialog_prompt) — параметры диалога, сжатая история и
+текущий вопрос с картами. История — не все прошлые шаги, а одна сводка
+разговора, которую модель обновляет в конце каждого ответа: запрос не
+растёт с длиной диалога.
 """
 
 from .decks import get_deck
@@ -23,23 +28,33 @@ _LENGTH_RULE = (
 # Разделитель: до него — ответ человеку, после — краткая выжимка для истории
 SUMMARY_MARKER = '###КРАТКО###'
 
+# Потолок сводки разговора: она целиком идёт в каждый следующий запрос
+DIGEST_MAX_CHARS = 1500
+
 _SUMMARY_RULE = (
     f'В САМОМ КОНЦЕ ответа поставь строку {SUMMARY_MARKER} и после неё '
-    'напиши краткую выжимку этого шага в 1-3 предложениях: '
-    'о чём спросили, что выпало и главный смысл ответа. '
-    'Выжимка нужна, чтобы не потерять нить в дальнейшем разговоре — '
-    'пиши её так, чтобы по ней был понятен смысл без полного текста. '
-    'Не упоминай саму выжимку в основном ответе.'
+    'напиши обновлённую сводку ВСЕГО разговора: возьми прежнюю сводку '
+    '(если она есть) и впиши в неё этот шаг — о чём спросили, что выпало '
+    'и главный смысл ответа. Старые шаги сжимай сильнее, свежий — подробнее, '
+    f'но не больше {DIGEST_MAX_CHARS * 2 // 3} знаков на всю сводку. '
+    'Сводка заменит собой предысторию в следующих вопросах — пиши её так, '
+    'чтобы по ней была понятна нить разговора без полных ответов. '
+    'Не упоминай саму сводку в основном ответе.'
 )
 
 
-def build_history_block(history: list) -> str:
-    """history — список словарей: step_no, question, cards, summary."""
-    if not history:
+def build_history_block(history: list, digest: str = '') -> str:
+    """digest — сводка разговора по уже учтённым в ней шагам;
+    history — шаги после неё (обычно пусто): словари step_no, question,
+    cards, summary."""
+    digest = (digest or '').strip()
+    if not history and not digest:
         return ''
 
-    lines = ['Предыстория разговора (кратко, по шагам):']
-    for item in history:
+    lines = ['Предыстория разговора (кратко):']
+    if digest:
+        lines.append(digest)
+    for item in history or []:
         step_no = item.get('step_no')
         question = (item.get('question') or '').strip()
         cards = item.get('cards') or []
@@ -79,6 +94,35 @@ def build_context_block(ctx: dict) -> str:
     return '\n'.join(lines)
 
 
+def build_dialog_prefix(spread_id: str) -> str:
+    """Постоянная часть промпта: зависит только от расклада.
+
+    Ни номера шага, ни вопроса, ни параметров человека здесь быть не должно —
+    любая переменная деталь ломает кэш провайдера для всех запросов.
+    """
+    spread = get_spread(spread_id)
+    deck = get_deck(spread['deck'])
+    return '\n'.join([
+        ROLE_INTRO,
+        '',
+        f'Это диалог-гадание на картах {deck["title"]}. '
+        'Человек задаёт вопрос и тянет карты, ты отвечаешь, '
+        'затем он уточняет дальше.',
+        '',
+        spread['geometry'],
+        '',
+        spread['chains'],
+        '',
+        _LENGTH_RULE,
+        '',
+        COMPLETENESS_RULE,
+        '',
+        TONE_RULES,
+        '',
+        _SUMMARY_RULE,
+    ])
+
+
 def build_dialog_prompt(
     spread_id: str,
     question: str,
@@ -86,12 +130,14 @@ def build_dialog_prompt(
     history: list = None,
     gender: str = 'female',
     context: dict = None,
+    digest: str = '',
+    step_no: int = None,
 ) -> str:
-    """Собирает промпт одного шага диалога."""
+    """Собирает переменную часть промпта одного шага диалога
+    (идёт после build_dialog_prefix)."""
     spread = get_spread(spread_id)
-    deck = get_deck(spread['deck'])
     history = history or []
-    step_no = len(history) + 1
+    step_no = step_no or len(history) + 1
 
     cards_lines = []
     positions = spread.get('positions')
@@ -104,42 +150,25 @@ def build_dialog_prompt(
         else:
             cards_lines.append(f'{i + 1}. карта {card}')
 
-    parts = [
-        ROLE_INTRO,
-        '',
-        f'Это диалог-гадание на картах {deck["title"]}. '
-        f'Сейчас шаг {step_no}. Человек задаёт вопрос и тянет карты, '
-        f'ты отвечаешь, затем он уточняет дальше.',
-    ]
-
+    # Параметры диалога не меняются от шага к шагу — идут первыми, чтобы
+    # общий с прошлым запросом префикс был как можно длиннее
+    parts = []
     context_block = build_context_block(context)
     if context_block:
-        parts += ['', context_block]
+        parts += [context_block, '']
 
-    history_block = build_history_block(history)
+    history_block = build_history_block(history, digest)
     if history_block:
-        parts += ['', history_block]
+        parts += [history_block, '']
 
     parts += [
-        '',
+        f'Сейчас шаг {step_no}.',
         f'ТЕКУЩИЙ вопрос человека: {question.strip()}',
         '',
-        spread['geometry'],
-        '',
         'Карты, выпавшие на этот вопрос:',
         '\n'.join(cards_lines) if cards_lines else '—',
         '',
-        spread['chains'],
-        '',
         'Отвечай именно на текущий вопрос, опираясь на выпавшие сейчас карты.',
-        '',
-        _LENGTH_RULE,
-        '',
-        COMPLETENESS_RULE,
-        '',
-        TONE_RULES,
-        '',
-        _SUMMARY_RULE,
     ]
 
     return '\n'.join(parts)
@@ -155,4 +184,28 @@ def split_answer_and_summary(text: str):
     # Модель забыла разделитель — берём хвост как выжимку
     clean = text.strip()
     tail = clean[-400:]
-    return clean, tail
\ No newline at end of file
+    return clean, tail
+
+
+def clip_digest(text: str) -> str:
+    """Держит сводку в пределах DIGEST_MAX_CHARS. Начало разговора (с чего
+    всё началось) ценнее хвоста, поэтому обрезаем конец — по границе
+    предложения, а если не выходит — просто по длине."""
+    text = (text or '').strip()
+    if len(text) <= DIGEST_MAX_CHARS:
+        return text
+    cut = text[:DIGEST_MAX_CHARS]
+    end = max(cut.rfind('. '), cut.rfind('\n'))
+    if end > DIGEST_MAX_CHARS // 2:
+        cut = cut[:end + 1]
+    return cut.strip()
+
+
+def fold_digest(digest: str, step: dict) -> str:
+    """Запасной путь, если модель не написала сводку: дописываем шаг к
+    прежней сводке сами. Старые строки уходят первыми — свежий шаг важнее."""
+    step_lines = build_history_block([step]).split('\n')[1:-1]
+    lines = [ln for ln in (digest or '').strip().split('\n') if ln] + step_lines
+    while len(lines) > 1 and len('\n'.join(lines)) > DIGEST_MAX_CHARS:
+        lines.pop(0)
+    return clip_digest('\n'.join(lines))
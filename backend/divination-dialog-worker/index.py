@@ -1,7 +1,9 @@
 """Воркер диалога-гадания: ходит в нейросеть и сохраняет ответ.
 
 Вынесен отдельно, потому что ответ модели идёт дольше лимита
-быстрой функции. При ошибке возвращает деньги за шаг.
+быстрой функции. Ответ идёт потоком: написанное сохраняется по ходу
+(его видно в step_status), а оборвавшийся ответ дописывается следующим
+запуском. При ошибке возвращает деньги за шаг.
 """
 
 import json
@@ -10,12 +12,29 @@ import time
 import uuid
 
 import psycopg2
-import requests
 
-from divination.dialog_prompt import build_dialog_prompt, split_answer_and_summary
+from divination.dialog_prompt import (
+    SUMMARY_MARKER, build_dialog_prefix, build_dialog_prompt, clip_digest,
+    fold_digest, split_answer_and_summary,
+)
+from openrouter_stream import build_continue_prompt, call_openrouter_retrying
+from task_timings import mark_stage
 
 DB_SCHEMA = 't_p29007832_virtual_fitting_room'
 
+# Ответ шага — до 4000 знаков; токенов берём с запасом на выжимку
+MAX_TOKENS = 3000
+# Через сколько секунд работы аккуратно прерваться и дописать следующим
+# запуском — с запасом до таймаута функции, чтобы успеть сохранить
+SOFT_DEADLINE_SEC = 100
+# Сколько раз максимум дописываем один ответ
+MAX_RESUMES = 4
+# Живой воркер обновляет stream_lock при каждом сохранении; дольше этого
+# молчит — значит оборвался, и шаг можно подхватить
+STALE_LOCK_SEC = 60
+
+WORKER_URL = 'https://functions.poehali.dev/a5284fc1-21a4-45a5-8e29-4672324b9193'
+
 CORS = {
     'Access-Control-Allow-Origin': '*',
     'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
@@ -30,99 +49,39 @@ def get_db():
     return psycopg2.connect(f'{dsn}{sep}options=-c%20search_path%3D{DB_SCHEMA}')
 
 
-def get_openrouter_proxies():
-    proxy_url = (os.environ.get('OPENROUTER_PROXY_URL') or '').strip()
-    if not proxy_url:
-        return None
-    return {'http': proxy_url, 'https': proxy_url}
-
-
-def call_openrouter(model: str, prompt_text: str):
-    api_key = (
-        os.environ.get('OPENROUTER_API_KEY_NEW')
-        or os.environ.get('OPENROUTER_API_KEY_OLD')
-        or ''
-    ).strip()
-    if not api_key:
-        return None, 'Ключ OpenRouter не настроен'
-
-    t0 = time.time()
+def save_partial(step_id, text, bump=False):
+    """Сохраняет уже написанное, чтобы оно пережило обрыв функции и было видно
+    в step_status. Заодно обновляет stream_lock — признак того, что воркер жив.
+    bump — заход закончен и передаёт шаг следующему: stream_lock снимается,
+    иначе разбуженный trigger_self воркер счёл бы шаг занятым."""
+    conn = get_db()
     try:
-        r = requests.post(
-            'https://openrouter.ai/api/v1/chat/completions',
-            headers={
-                'Authorization': f'Bearer {api_key}',
-                'Content-Type': 'application/json',
-            },
-            json={
-                'model': model,
-                'messages': [{'role': 'user', 'content': prompt_text}],
-                'max_tokens': 3000,
-                'temperature': 0.8,
-            },
-            timeout=110,
-            proxies=get_openrouter_proxies(),
-        )
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""UPDATE {DB_SCHEMA}.divination_dialog_steps
+                    SET partial_answer = %s,
+                        stream_lock = CASE WHEN %s THEN NULL ELSE NOW() END,
+                        resume_count = resume_count + %s, updated_at = NOW()
+                    WHERE id = %s""",
+                (text, bump, 1 if bump else 0, step_id),
+            )
+        conn.commit()
     except Exception as e:
-        return None, f'Сеть: {str(e)[:200]}'
-
-    print(
-        f'[timing] dialog model={model} prompt_chars={len(prompt_text)} '
-        f'total={time.time() - t0:.1f}s status={r.status_code}'
-    )
+        print(f'[{step_id}] partial save (non-critical): {e}')
+    finally:
+        conn.close()
 
-    if r.status_code != 200:
-        return None, f'Сервис ответил {r.status_code}: {r.text[:200]}'
 
+def trigger_self(step_id):
+    """Будит воркер, чтобы он дописал оборванный ответ. Ответ не ждём:
+    если пинг не дойдёт, step_status разбудит воркер при следующем опросе."""
     try:
-        data = r.json()
-        choice = (data.get('choices') or [{}])[0]
-        finish = choice.get('finish_reason') or choice.get('native_finish_reason')
-        content = (choice.get('message') or {}).get('content')
-        if not content or (finish and str(finish).lower() == 'error'):
-            # Провайдер ответил 200, но текста нет. Причина лежит рядом с
-            # ответом — печатаем её целиком, иначе разбираться потом не по чему
-            print(
-                f'[openrouter-fail] model={model} finish={finish} '
-                f'native={choice.get("native_finish_reason")} '
-                f'provider={data.get("provider")} '
-                f'err={json.dumps(data.get("error"), ensure_ascii=False)[:400]} '
-                f'choice_err={json.dumps(choice.get("error"), ensure_ascii=False)[:400]} '
-                f'raw={r.text[:600]}'
-            )
-            reason = 'Ответ оборван' if content else f'Пустой ответ (finish_reason={finish})'
-            return None, reason
-        return content, None
+        import urllib.request
+        worker_url = os.environ.get('DIALOG_WORKER_URL', WORKER_URL)
+        req = urllib.request.Request(f'{worker_url}?step_id={step_id}', method='GET')
+        urllib.request.urlopen(req, timeout=2)
     except Exception as e:
-        return None, f'Разбор ответа: {str(e)[:200]}'
-
-
-def call_openrouter_retrying(model: str, prompt_text: str, attempts: int = 3):
-    """Мгновенный отказ провайдера — обычно разовый сбой на его стороне.
-    Пробуем ещё раз, вместо того чтобы гонять человека нажимать «отправить».
-    Повторяем только пустые ответы: содержательные ошибки повтор не лечит."""
-    last_error = None
-    started = time.time()
-    for i in range(attempts):
-        # Повтор имеет смысл только для мгновенных отказов. Если время уже
-        # потрачено — не рискуем упереться в лимит выполнения функции
-        if i and time.time() - started > 60:
-            print('[openrouter-retry] времени на повтор не осталось')
-            break
-        text, error = call_openrouter(model, prompt_text)
-        if text and not error:
-            if i:
-                print(f'[openrouter-retry] успех с попытки {i + 1}')
-            return text, None
-        last_error = error
-        retryable = error and (
-            'оборван' in error or 'Пустой ответ' in error or error.startswith('Сеть')
-        )
-        if not retryable or i == attempts - 1:
-            break
-        print(f'[openrouter-retry] попытка {i + 1} не удалась ({error}), повтор')
-        time.sleep(1.5 * (i + 1))
-    return None, last_error
+        print(f'[{step_id}] self trigger (non-critical): {e}')
 
 
 def refund_step(conn, step_id, dialog_id, cost, user_id):
@@ -159,12 +118,15 @@ def refund_step(conn, step_id, dialog_id, cost, user_id):
 
 
 def process_step(step_id: str) -> dict:
+    started = time.time()
     conn = get_db()
     try:
         with conn.cursor() as cur:
             cur.execute(
                 f"""SELECT s.dialog_id, s.step_no, s.question, s.cards, s.status, s.cost,
-                           d.user_id, d.spread, d.model, d.context
+                           d.user_id, d.spread, d.model, d.context,
+                           s.partial_answer, s.resume_count, s.prompt,
+                           d.digest, d.digest_step
                     FROM {DB_SCHEMA}.divination_dialog_steps s
                     JOIN {DB_SCHEMA}.divination_dialogs d ON d.id = s.dialog_id
                     WHERE s.id = %s""",
@@ -175,28 +137,39 @@ def process_step(step_id: str) -> dict:
                 return {'error': 'step not found'}
 
             (dialog_id, step_no, question, cards, status, cost,
-             user_id, spread_id, model, ctx) = row
+             user_id, spread_id, model, ctx,
+             done_before, resume_count, sent_prompt,
+             digest, digest_step) = row
 
-            if status != 'pending':
+            if status not in ('pending', 'processing'):
                 return {'status': status, 'skipped': True}
 
-            # Атомарно занимаем шаг, чтобы не обработать дважды
+            # Атомарно занимаем шаг, чтобы не обработать дважды. Шаг в работе
+            # подхватываем, только если его воркер давно молчит — оборвался
             cur.execute(
                 f"""UPDATE {DB_SCHEMA}.divination_dialog_steps
-                    SET status = 'processing', updated_at = NOW()
-                    WHERE id = %s AND status = 'pending'""",
-                (step_id,),
+                    SET status = 'processing', stream_lock = NOW(), updated_at = NOW()
+                    WHERE id = %s
+                      AND (status = 'pending'
+                           OR (status = 'processing'
+                               AND resume_count < %s
+                               AND (stream_lock IS NULL
+                                    OR stream_lock < NOW() - make_interval(secs => %s))))""",
+                (step_id, MAX_RESUMES, STALE_LOCK_SEC),
             )
             if cur.rowcount == 0:
                 return {'status': 'busy'}
+            mark_stage(cur, 'divination_dialog', step_id, 'admitted')
 
-            # Предыстория: только готовые шаги до текущего
+            # Предыстория — сводка диалога плюс готовые шаги, которых в ней
+            # ещё нет (обычно ни одного: сводка обновляется каждым шагом)
             cur.execute(
                 f"""SELECT step_no, question, cards, summary
                     FROM {DB_SCHEMA}.divination_dialog_steps
-                    WHERE dialog_id = %s AND status = 'done' AND step_no < %s
+                    WHERE dialog_id = %s AND status = 'done'
+                      AND step_no > %s AND step_no < %s
                     ORDER BY step_no""",
-                (dialog_id, step_no),
+                (dialog_id, digest_step or 0, step_no),
             )
             history = [{
                 'step_no': h[0],
@@ -206,41 +179,98 @@ def process_step(step_id: str) -> dict:
             } for h in cur.fetchall()]
         conn.commit()
 
-        prompt_text = build_dialog_prompt(
-            spread_id,
-            question,
-            cards if isinstance(cards, list) else [],
-            history,
-            context=ctx if isinstance(ctx, dict) else None,
-        )
-        # Сохраняем отправленный текст — так его видно в базе для проверки
-        with conn.cursor() as cur:
-            cur.execute(
-                f"""UPDATE {DB_SCHEMA}.divination_dialog_steps
-                    SET prompt = %s WHERE id = %s""",
-                (prompt_text, step_id),
+        # Постоянная часть промпта одна на расклад — провайдер её кэширует
+        prefix = build_dialog_prefix(spread_id)
+        done_before = done_before or ''
+        if done_before and sent_prompt:
+            # Продолжение: промпт тот же, что при первом запуске
+            prompt_text = sent_prompt
+        else:
+            prompt_text = build_dialog_prompt(
+                spread_id,
+                question,
+                cards if isinstance(cards, list) else [],
+                history,
+                context=ctx if isinstance(ctx, dict) else None,
+                digest=digest or '',
+                step_no=step_no,
             )
+            # Сохраняем отправленный текст (без постоянной части — она
+            # одинакова у всех шагов расклада) — так его видно в базе для проверки
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""UPDATE {DB_SCHEMA}.divination_dialog_steps
+                        SET prompt = %s WHERE id = %s""",
+                    (prompt_text, step_id),
+                )
+            conn.commit()
+
+        with conn.cursor() as cur:
+            mark_stage(cur, 'divination_dialog', step_id, 'submitted')
         conn.commit()
 
-        ai_text, error = call_openrouter_retrying(model, prompt_text)
+        # Продолжаем с места обрыва: модель видит начало и дописывает хвост
+        ask = build_continue_prompt(prompt_text, done_before) if done_before else prompt_text
+        new_text, error, truncated = call_openrouter_retrying(
+            model,
+            ask,
+            on_partial=lambda txt: save_partial(step_id, done_before + txt),
+            soft_deadline=started + SOFT_DEADLINE_SEC,
+            max_tokens=MAX_TOKENS,
+            temperature=0.8,
+            read_timeout=110,
+            system_text=prefix,
+        )
+        provider_done = time.monotonic()
+        ai_text = done_before + (new_text or '')
+
+        # Связь оборвалась, но начало уже написано — не теряем его,
+        # дописываем следующим заходом вместо возврата денег
+        if error and done_before:
+            error = None
+            truncated = True
+
+        # Дописали не всё — сохраняем и просим себя же продолжить. Если
+        # попытки исчерпаны, отдаём то, что есть: почти полный ответ лучше
+        # ошибки и возврата денег
+        if truncated and ai_text and not error:
+            if resume_count + 1 < MAX_RESUMES:
+                save_partial(step_id, ai_text, bump=True)
+                print(f'[{step_id}] Сохранено {len(ai_text)} знаков, продолжу следующим заходом')
+                trigger_self(step_id)
+                return {'status': 'processing', 'written_chars': len(ai_text)}
+            print(f'[{step_id}] Лимит продолжений исчерпан, отдаю {len(ai_text)} знаков')
 
         if error or not ai_text:
             print(f'[{step_id}] Ошибка: {error}')
             with conn.cursor() as cur:
                 cur.execute(
                     f"""UPDATE {DB_SCHEMA}.divination_dialog_steps
-                        SET status = 'failed', updated_at = NOW() WHERE id = %s""",
+                        SET status = 'failed', stream_lock = NULL, updated_at = NOW()
+                        WHERE id = %s""",
                     (step_id,),
                 )
+                mark_stage(cur, 'divination_dialog', step_id, 'finalized')
             conn.commit()
             refund_step(conn, step_id, dialog_id, cost, user_id)
             return {'status': 'failed', 'error': error}
 
         answer, summary = split_answer_and_summary(ai_text)
+        if SUMMARY_MARKER in ai_text:
+            # После разделителя модель пишет сводку всего разговора
+            summary = clip_digest(summary)
+            new_digest = summary
+        else:
+            new_digest = digest or ''
+            for item in history + [{'step_no': step_no, 'question': question,
+                                    'cards': cards if isinstance(cards, list) else [],
+                                    'summary': summary}]:
+                new_digest = fold_digest(new_digest, item)
         with conn.cursor() as cur:
             cur.execute(
                 f"""UPDATE {DB_SCHEMA}.divination_dialog_steps
-                    SET status = 'done', answer_text = %s, summary = %s, updated_at = NOW()
+                    SET status = 'done', answer_text = %s, summary = %s,
+                        partial_answer = NULL, stream_lock = NULL, updated_at = NOW()
                     WHERE id = %s""",
                 (answer, summary, step_id),
             )
@@ -250,6 +280,15 @@ def process_step(step_id: str) -> dict:
                     WHERE id = %s""",
                 (step_no, cost, dialog_id),
             )
+            # Сводку двигаем только вперёд: опоздавший шаг не затрёт свежую
+            cur.execute(
+                f"""UPDATE {DB_SCHEMA}.divination_dialogs
+                    SET digest = %s, digest_step = %s
+                    WHERE id = %s AND digest_step < %s""",
+                (new_digest, step_no, dialog_id, step_no),
+            )
+            mark_stage(cur, 'divination_dialog', step_id, 'provider_done', since=provider_done)
+            mark_stage(cur, 'divination_dialog', step_id, 'finalized')
         conn.commit()
         return {'status': 'done', 'step_no': step_no}
     finally:
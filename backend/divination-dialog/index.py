@@ -15,8 +15,10 @@ from datetime import datetime
 import psycopg2
 
 from session_utils import validate_session
+from email_outbox import enqueue_email, wake_sender
 from divination import pricing
 from divination.spreads import get_spread
+from task_timings import mark_stage
 
 DB_SCHEMA = 't_p29007832_virtual_fitting_room'
 
@@ -262,6 +264,7 @@ def action_ask(body, user_id, event):
                 (step_id, dialog_id, step_no, question,
                  json.dumps(cards, ensure_ascii=False), cost),
             )
+            mark_stage(cur, 'divination_dialog', step_id, 'queued')
         conn.commit()
     finally:
         conn.close()
@@ -281,7 +284,8 @@ def action_ask(body, user_id, event):
 
 
 def action_step_status(body, user_id, event):
-    """Готов ли ответ на шаг диалога."""
+    """Готов ли ответ на шаг диалога. Пока ответ пишется, отдаёт уже
+    написанное — карточка растёт на глазах, а не висит пустой."""
     step_id = (body.get('step_id') or '').strip()
     try:
         uuid.UUID(step_id)
@@ -292,7 +296,11 @@ def action_step_status(body, user_id, event):
     try:
         with conn.cursor() as cur:
             cur.execute(
-                f"""SELECT s.status, s.answer_text, s.step_no, s.question, s.cards, d.user_id
+                f"""SELECT s.status, s.answer_text, s.step_no, s.question, s.cards, d.user_id,
+                           s.partial_answer,
+                           (s.status = 'processing'
+                            AND (s.stream_lock IS NULL
+                                 OR s.stream_lock < NOW() - INTERVAL '60 seconds')) AS stalled
                     FROM {DB_SCHEMA}.divination_dialog_steps s
                     JOIN {DB_SCHEMA}.divination_dialogs d ON d.id = s.dialog_id
                     WHERE s.id = %s""",
@@ -301,7 +309,7 @@ def action_step_status(body, user_id, event):
             row = cur.fetchone()
             if not row:
                 return resp(404, {'error': 'Шаг не найден'}, event)
-            status, answer, step_no, question, cards, owner = row
+            status, answer, step_no, question, cards, owner, partial, stalled = row
             if str(owner) != str(user_id):
                 return resp(403, {'error': 'Чужой диалог'}, event)
     finally:
@@ -314,35 +322,28 @@ def action_step_status(body, user_id, event):
                      'Попробуйте задать вопрос ещё раз.',
         }, event)
 
-    return resp(200, {
+    # Воркер оборвался и не успел позвать себя сам — будим его, он
+    # дописывает ответ с сохранённого места
+    if stalled:
+        trigger_worker(step_id)
+
+    result = {
         'status': status,
         'step_no': step_no,
         'question': question,
         'cards': cards if isinstance(cards, list) else [],
         'answer': answer or '',
-    }, event)
+    }
+    if status == 'processing' and partial:
+        result['answer_partial'] = partial
+        result['written_chars'] = len(partial)
+    return resp(200, result, event)
 
 
 
-def _send_email(to_email, subject, body_text):
-    """Письмо с того же ящика, что и остальные письма сервиса."""
+def _email_html(subject, body_text):
+    """HTML-версия письма с беседой."""
     import html as html_lib
-    import smtplib
-    from email.mime.text import MIMEText
-    from email.mime.multipart import MIMEMultipart
-
-    smtp_host = os.environ.get('SMTP_HOST')
-    smtp_port = int(os.environ.get('SMTP_PORT', '587'))
-    smtp_user = os.environ.get('SMTP_USER')
-    smtp_password = os.environ.get('SMTP_PASSWORD')
-
-    if not (smtp_host and smtp_user and smtp_password):
-        raise Exception('Почта не настроена')
-
-    message = MIMEMultipart('alternative')
-    message['Subject'] = subject
-    message['From'] = 'virtualfitting@mail.ru'
-    message['To'] = to_email
 
     paragraphs = ''.join(
         f'<p style="margin:0 0 14px;line-height:1.7">{html_lib.escape(par.strip())}</p>'
@@ -360,19 +361,7 @@ def _send_email(to_email, subject, body_text):
         '<p style="font-size:12px;color:#8a7f6b">fitting-room.ru</p>'
         '</div></body></html>'
     )
-
-    message.attach(MIMEText(body_text, 'plain', 'utf-8'))
-    message.attach(MIMEText(html_content, 'html', 'utf-8'))
-
-    if smtp_port == 465:
-        with smtplib.SMTP_SSL(smtp_host, smtp_port) as server:
-            server.login(smtp_user, smtp_password)
-            server.send_message(message)
-    else:
-        with smtplib.SMTP(smtp_host, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.send_message(message)
+    return html_content
 
 
 def action_email(body, user_id, event):
@@ -413,22 +402,27 @@ def action_email(body, user_id, event):
                 (dialog_id,),
             )
             steps = cur.fetchall()
+            if not steps:
+                return resp(200, {'sent': False, 'error': 'В беседе пока нет ответов'}, event)
+
+            parts = []
+            for step_no, question, cards, answer in steps:
+                card_list = ', '.join(cards or []) if isinstance(cards, list) else ''
+                parts.append(f'Вопрос {step_no}: {question}')
+                if card_list:
+                    parts.append(f'Карты: {card_list}')
+                parts.append(answer or '')
+            text = '\n\n'.join(p for p in parts if p)
+
+            # Письмо уходит через очередь — ответ не ждёт SMTP
+            subject = 'Ваша беседа с картами'
+            enqueue_email(cur, to_email, subject, text, _email_html(subject, text),
+                          source='divination-dialog')
+        conn.commit()
     finally:
         conn.close()
 
-    if not steps:
-        return resp(200, {'sent': False, 'error': 'В беседе пока нет ответов'}, event)
-
-    parts = []
-    for step_no, question, cards, answer in steps:
-        card_list = ', '.join(cards or []) if isinstance(cards, list) else ''
-        parts.append(f'Вопрос {step_no}: {question}')
-        if card_list:
-            parts.append(f'Карты: {card_list}')
-        parts.append(answer or '')
-    text = '\n\n'.join(p for p in parts if p)
-
-    _send_email(to_email, 'Ваша беседа с картами', text)
+    wake_sender()
     return resp(200, {'sent': True, 'email': to_email}, event)
 
 
@@ -0,0 +1,283 @@
+import json
+import os
+import smtplib
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import Dict, Any, List, Optional
+
+import psycopg2
+
+from email_outbox import OUTBOX_TABLE
+
+# Сколько писем забираем из очереди за раз
+BATCH_SIZE = 20
+# Лимиты отправки с общего ящика: почтовик режет ящик, который шлёт
+# слишком часто, поэтому держимся заметно ниже его порогов
+MAX_PER_MINUTE = 20
+MAX_PER_HOUR = 300
+# Пауза между письмами внутри одной SMTP-сессии
+SEND_INTERVAL_SEC = 1.0
+# Повторы временных ошибок: 1, 2, 4, 8... минут, но не реже раза в час
+MAX_ATTEMPTS = 6
+BACKOFF_BASE_SEC = 60
+BACKOFF_MAX_SEC = 3600
+# Письмо «в отправке» дольше этого — отправитель оборвался, берём заново
+STALE_SENDING = '10 minutes'
+# Сколько работает один запуск: с запасом до таймаута функции
+RUN_BUDGET_SEC = 50
+SMTP_TIMEOUT_SEC = 30
+
+QUOTA_SQL = f'''
+    SELECT COUNT(*) FILTER (WHERE sent_at > NOW() - INTERVAL '1 minute'),
+           COUNT(*)
+    FROM {OUTBOX_TABLE}
+    WHERE status = 'sent' AND sent_at > NOW() - INTERVAL '1 hour'
+'''
+
+# Забираем пачку атомарно: параллельный запуск пропустит занятые строки
+CLAIM_SQL = f'''
+    UPDATE {OUTBOX_TABLE}
+    SET status = 'sending', locked_at = NOW(), attempts = attempts + 1
+    WHERE id IN (
+        SELECT id FROM {OUTBOX_TABLE}
+        WHERE (status = 'pending' AND next_attempt_at <= NOW())
+           OR (status = 'sending' AND locked_at < NOW() - INTERVAL '{STALE_SENDING}')
+        ORDER BY next_attempt_at
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, to_email, from_addr, subject, text_body, html_body, attempts
+'''
+
+
+def get_cors_origin(event: Dict[str, Any]) -> str:
+    origin = event.get('headers', {}).get('origin') or event.get('headers', {}).get('Origin', '')
+    return origin if origin else 'https://fitting-room.ru'
+
+
+def get_db_connection():
+    return psycopg2.connect(os.environ['DATABASE_URL'])
+
+
+def open_smtp() -> smtplib.SMTP:
+    '''Одна авторизованная сессия на весь запуск — рукопожатие и вход один раз.'''
+    smtp_host = os.environ.get('SMTP_HOST')
+    smtp_port = int(os.environ.get('SMTP_PORT', '587'))
+    smtp_user = os.environ.get('SMTP_USER')
+    smtp_password = os.environ.get('SMTP_PASSWORD')
+
+    if not (smtp_host and smtp_user and smtp_password):
+        raise Exception('SMTP credentials not configured')
+
+    if smtp_port == 465:
+        server = smtplib.SMTP_SSL(smtp_host, smtp_port, timeout=SMTP_TIMEOUT_SEC)
+    else:
+        server = smtplib.SMTP(smtp_host, smtp_port, timeout=SMTP_TIMEOUT_SEC)
+        server.starttls()
+    server.login(smtp_user, smtp_password)
+    return server
+
+
+def close_smtp(server: Optional[smtplib.SMTP]) -> None:
+    if server is None:
+        return
+    try:
+        server.quit()
+    except Exception:
+        server.close()
+
+
+def build_message(row) -> MIMEMultipart:
+    _, to_email, from_addr, subject, text_body, html_body, _ = row
+    message = MIMEMultipart('alternative')
+    message['Subject'] = subject
+    message['From'] = from_addr
+    message['To'] = to_email
+    message.attach(MIMEText(text_body, 'plain', 'utf-8'))
+    if html_body:
+        message.attach(MIMEText(html_body, 'html', 'utf-8'))
+    return message
+
+
+def is_permanent(error: Exception) -> bool:
+    '''Отказ сервера 5xx по адресату или письму не пройдёт и при повторе.'''
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPAuthenticationError)):
+        return False
+    code = getattr(error, 'smtp_code', 0) or 0
+    return code >= 500
+
+
+def send_quota(cursor) -> int:
+    cursor.execute(QUOTA_SQL)
+    last_minute, last_hour = cursor.fetchone()
+    return max(0, min(BATCH_SIZE, MAX_PER_MINUTE - last_minute, MAX_PER_HOUR - last_hour))
+
+
+def mark_sent(cursor, message_id: int) -> None:
+    cursor.execute(
+        f'''UPDATE {OUTBOX_TABLE}
+            SET status = 'sent', sent_at = NOW(), locked_at = NULL, last_error = NULL
+            WHERE id = %s''',
+        (message_id,),
+    )
+
+
+def mark_retry(cursor, message_id: int, attempts: int, error: str, permanent: bool = False) -> str:
+    '''Временная ошибка — повтор с растущей паузой; постоянная или попытки
+    кончились — письмо помечается failed.'''
+    if permanent or attempts >= MAX_ATTEMPTS:
+        cursor.execute(
+            f'''UPDATE {OUTBOX_TABLE}
+                SET status = 'failed', locked_at = NULL, last_error = %s
+                WHERE id = %s''',
+            (error[:500], message_id),
+        )
+        return 'failed'
+    delay = min(BACKOFF_MAX_SEC, BACKOFF_BASE_SEC * 2 ** (attempts - 1))
+    cursor.execute(
+        f'''UPDATE {OUTBOX_TABLE}
+            SET status = 'pending', locked_at = NULL, last_error = %s,
+                next_attempt_at = NOW() + make_interval(secs => %s)
+            WHERE id = %s''',
+        (error[:500], delay, message_id),
+    )
+    return 'retry'
+
+
+def release(cursor, ids: List[int], error: str) -> None:
+    '''SMTP недоступен — письма не виноваты: возвращаем их в очередь без
+    учёта попытки, разберёт следующий запуск.'''
+    cursor.execute(
+        f'''UPDATE {OUTBOX_TABLE}
+            SET status = 'pending', locked_at = NULL, attempts = attempts - 1,
+                last_error = %s,
+                next_attempt_at = NOW() + make_interval(secs => %s)
+            WHERE id = ANY(%s)''',
+        (error[:500], BACKOFF_BASE_SEC, ids),
+    )
+
+
+def send_one(server: smtplib.SMTP, row) -> Optional[Exception]:
+    '''Отправляет письмо в открытой сессии. Обрыв сессии пробрасывает
+    наружу — на него переподключаемся; прочие ошибки возвращает.'''
+    try:
+        server.send_message(build_message(row))
+        return None
+    except smtplib.SMTPServerDisconnected:
+        raise
+    except smtplib.SMTPException as e:
+        return e
+    except OSError as e:
+        raise smtplib.SMTPServerDisconnected(str(e)) from e
+    except Exception as e:
+        # Письмо не собралось (битый заголовок и т.п.) — сессия тут ни при чём
+        return e
+
+
+def run_sender() -> Dict[str, Any]:
+    '''Разбирает очередь пачками, пока есть письма, квота и время.'''
+    started = time.time()
+    stats = {'sent': 0, 'retry': 0, 'failed': 0}
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    server = None
+    try:
+        while time.time() - started < RUN_BUDGET_SEC:
+            quota = send_quota(cursor)
+            if not quota:
+                print('[EmailSender] Лимит частоты исчерпан, остаток — следующим запуском')
+                break
+            cursor.execute(CLAIM_SQL, (quota,))
+            rows: List[tuple] = cursor.fetchall()
+            conn.commit()
+            if not rows:
+                break
+
+            for idx, row in enumerate(rows):
+                message_id, attempts = row[0], row[6]
+                error = None
+                # Сессия могла закрыться по простою — переподключаемся один раз
+                for _ in range(2):
+                    try:
+                        if server is None:
+                            server = open_smtp()
+                        error = send_one(server, row)
+                        break
+                    except Exception as e:
+                        close_smtp(server)
+                        server = None
+                        error = e
+
+                if server is None:
+                    # Не удалось даже подключиться — дальше пробовать нет смысла
+                    print(f'[EmailSender] SMTP недоступен: {error}')
+                    release(cursor, [r[0] for r in rows[idx:]], str(error))
+                    conn.commit()
+                    return stats
+
+                if error is None:
+                    mark_sent(cursor, message_id)
+                    stats['sent'] += 1
+                else:
+                    print(f'[EmailSender] {message_id}: {error}')
+                    outcome = mark_retry(cursor, message_id, attempts, str(error) or type(error).__name__,
+                                         permanent=is_permanent(error))
+                    stats[outcome] += 1
+                conn.commit()
+                time.sleep(SEND_INTERVAL_SEC)
+    finally:
+        close_smtp(server)
+        cursor.close()
+        conn.close()
+        print(f'[EmailSender] {stats} за {time.time() - started:.1f}s')
+
+    return stats
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Отправка писем из очереди email_outbox одной SMTP-сессией с лимитом частоты и повторами. Вызывается по расписанию (раз в минуту) и функциями, положившими письмо в очередь.
+    Args: event - dict с httpMethod
+          context - объект с request_id
+    Returns: HTTP-ответ со счётчиками отправленных, отложенных и неотправленных писем
+    '''
+    method = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': get_cors_origin(event),
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type',
+                'Access-Control-Max-Age': '86400',
+            },
+            'body': '',
+        }
+
+    # Без авторизации, как у воркеров: вызов только разбирает уже
+    # поставленные в очередь письма, а частоту держат лимиты выше
+    try:
+        result = run_sender()
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': get_cors_origin(event),
+            },
+            'isBase64Encoded': False,
+            'body': json.dumps({'ok': True, **result}),
+        }
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': get_cors_origin(event),
+            },
+            'isBase64Encoded': False,
+            'body': json.dumps({'error': f'Send failed: {str(e)}'}),
+        }
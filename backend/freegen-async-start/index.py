@@ -5,6 +5,7 @@ from typing import Dict, Any
 import uuid
 from datetime import datetime
 from session_utils import validate_session
+from task_timings import mark_stage
 from prompts import build_model_prompt
 
 MAX_REFERENCES = 8
@@ -86,6 +87,7 @@ def handle_model_start(database_url: str, user_id: str, model_params: dict, cors
             json.dumps(model_params, ensure_ascii=False),
             datetime.utcnow(),
         ))
+        mark_stage(cursor, 'freegen', task_id, 'queued')
         conn.commit()
         cursor.close()
     finally:
@@ -265,6 +267,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             aspect_ratio,
             datetime.utcnow()
         ))
+        mark_stage(cursor, 'freegen', task_id, 'queued')
 
         conn.commit()
         cursor.close()
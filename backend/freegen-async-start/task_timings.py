@@ -0,0 +1,68 @@
+"""
+Отметки этапов жизненного цикла задач (таблица task_timings).
+
+Одна строка на задачу (service, task_id), по колонке на этап:
+
+    queued         — задача создана (start-функция)
+    admitted       — воркер пропустил задачу через очередь (pending -> processing)
+    submitted      — запрос отправлен провайдеру (fal.ai / OpenRouter)
+    provider_done  — провайдер вернул результат
+    uploaded       — файл задачи загружен в S3: обычно результат провайдера;
+                     у цветотипа colorguide — исходное фото, до submitted
+    finalized      — задача переведена в итоговый статус (completed / failed)
+
+Каждая отметка ставится один раз (повторный вызов не перезаписывает время),
+поэтому ретраи и повторные вызовы воркера не искажают длительности.
+Перцентили по этапам считает admin-api (action=latency).
+
+Использование:
+
+    from task_timings import mark_stage
+    mark_stage(cursor, 'tryon', task_id, 'submitted')
+    conn.commit()
+
+Все отметки ставятся по часам базы (clock_timestamp()), чтобы в длительности
+этапов не попадало расхождение часов функции и БД. Если этап прошёл, пока
+воркер не держал соединение (долгий вызов провайдера), в коде запоминается
+time.monotonic(), а при записи передаётся since= — база вычитает прошедшее
+с тех пор время из своих часов:
+
+    provider_done = time.monotonic()
+    ...
+    mark_stage(cursor, 'colorguide', task_id, 'provider_done', since=provider_done)
+"""
+
+import time
+from typing import Optional
+
+SCHEMA = 't_p29007832_virtual_fitting_room'
+
+STAGES = ('queued', 'admitted', 'submitted', 'provider_done', 'uploaded', 'finalized')
+
+
+def mark_stage(cursor, service: str, task_id, stage: str, since: Optional[float] = None) -> None:
+    '''
+    Поставить отметку этапа по часам базы; since — time.monotonic() момента,
+    когда этап фактически прошёл (None — сейчас). Ошибка записи не ломает задачу:
+    запись идёт под SAVEPOINT, чтобы не прерывать транзакцию вызывающего кода.
+    '''
+    if stage not in STAGES:
+        raise ValueError(f'Unknown task stage: {stage}')
+    column = f'{stage}_at'
+    ago = max(0.0, time.monotonic() - since) if since is not None else 0.0
+    try:
+        cursor.execute('SAVEPOINT task_timing')
+        cursor.execute(
+            f'''INSERT INTO {SCHEMA}.task_timings (service, task_id, {column})
+                VALUES (%s, %s, clock_timestamp() - make_interval(secs => %s))
+                ON CONFLICT (service, task_id) DO UPDATE
+                SET {column} = COALESCE({SCHEMA}.task_timings.{column}, EXCLUDED.{column})''',
+            (service, str(task_id), ago)
+        )
+        cursor.execute('RELEASE SAVEPOINT task_timing')
+    except Exception as e:
+        print(f'[task_timings] {service}/{task_id} {stage} not recorded (non-critical): {e}')
+        try:
+            cursor.execute('ROLLBACK TO SAVEPOINT task_timing')
+        except Exception:
+            pass
@@ -9,10 +9,14 @@ import boto3
 import time
 import uuid
 import base64
+from media_refs import add_media_refs
+from task_timings import mark_stage
+from balance_ledger import refund_task
 
 GENERATION_COST = 50
 S3_BUCKET = os.environ.get('S3_BUCKET_NAME', 'fitting-room-images')
-WORKER_URL = 'https://functions.poehali.dev/8b34e115-88be-4740-887a-36c388980955'
+# Сколько зависших задач добивает один запуск в режиме sweep (его вызывает task-sweeper)
+SWEEP_BATCH = 20
 
 
 def translate_to_english(text: str) -> str:
@@ -228,38 +232,15 @@ def refund_balance_if_needed(conn, user_id: str, task_id: str) -> None:
     '''Возврат 50 руб, если не unlimited и ещё не возвращено'''
     try:
         cursor = conn.cursor()
-        cursor.execute('SELECT refunded FROM t_p29007832_virtual_fitting_room.freegen_tasks WHERE id = %s', (task_id,))
-        row = cursor.fetchone()
-        if row and row[0]:
-            cursor.close()
-            return
-
-        cursor.execute('SELECT unlimited_access, balance FROM users WHERE id = %s', (user_id,))
-        user_row = cursor.fetchone()
-        if not user_row:
-            cursor.close()
-            return
-
-        unlimited_access = user_row[0]
-        balance_before = float(user_row[1])
-
-        if unlimited_access:
-            cursor.execute('UPDATE t_p29007832_virtual_fitting_room.freegen_tasks SET refunded = true WHERE id = %s', (task_id,))
-            conn.commit()
-            cursor.close()
-            return
-
-        balance_after = balance_before + GENERATION_COST
-        cursor.execute('UPDATE users SET balance = balance + %s WHERE id = %s', (GENERATION_COST, user_id))
-        cursor.execute('UPDATE t_p29007832_virtual_fitting_room.freegen_tasks SET refunded = true WHERE id = %s', (task_id,))
-        cursor.execute('''
-            INSERT INTO balance_transactions
-            (user_id, type, amount, balance_before, balance_after, description, try_on_id)
-            VALUES (%s, 'refund', %s, %s, %s, 'Возврат: технический сбой свободной генерации', NULL)
-        ''', (user_id, GENERATION_COST, balance_before, balance_after))
+        # Флаг refunded, баланс и запись в журнале — одним запросом
+        claimed, balance_after = refund_task(
+            cursor, 'freegen_tasks', task_id, user_id, GENERATION_COST,
+            'Возврат: технический сбой свободной генерации',
+        )
         conn.commit()
-        print(f'[Refund] Refunded {GENERATION_COST}₽ to user {user_id} for task {task_id}')
         cursor.close()
+        if claimed and balance_after is not None:
+            print(f'[Refund] Refunded {GENERATION_COST}₽ to user {user_id} for task {task_id}')
     except Exception as e:
         print(f'[Refund] Error: {e}')
 
@@ -290,6 +271,7 @@ def save_to_history(conn, user_id: str, cdn_url: str, prompt: str, references_js
         ))
         hid = cursor.fetchone()
         history_id = str(hid[0]) if hid else None
+        add_media_refs(cursor, user_id, [cdn_url])
         conn.commit()
         cursor.close()
         print(f'[History] Saved to freegen_history id={history_id}')
@@ -350,6 +332,120 @@ def save_user_model(conn, user_id: str, cdn_url: str, prompt: str, model_params:
             pass
 
 
+def recover_stuck_tasks(conn, cursor, limit: int = SWEEP_BATCH) -> int:
+    '''
+    Добить зависшие processing-задачи (старше 3 минут без обновлений): забрать
+    готовый результат из fal.ai или вернуть деньги. Вызывается в режиме sweep.
+    '''
+    stuck_rows = []
+    try:
+        cursor.execute('''
+            SELECT id, fal_response_url, user_id, prompt, "references", aspect_ratio, saved_to_history, created_at, task_type, model_params
+            FROM t_p29007832_virtual_fitting_room.freegen_tasks
+            WHERE status = 'processing'
+              AND fal_response_url IS NOT NULL
+              AND updated_at < NOW() - INTERVAL '3 minutes'
+            ORDER BY created_at ASC
+            LIMIT %s
+        ''', (limit,))
+        stuck_rows = cursor.fetchall()
+        print(f'[Freegen] Found {len(stuck_rows)} stuck tasks')
+
+        for stuck in stuck_rows:
+            s_id, s_response_url, s_user_id, s_prompt, s_refs_json, s_aspect, s_saved, s_created, s_task_type, s_model_params = stuck
+            try:
+                s_refs = json.loads(s_refs_json) if s_refs_json else []
+                s_age = (datetime.utcnow() - s_created).total_seconds() if s_created else 0
+                s_data = check_fal_status(s_response_url)
+                s_fal_status = s_data.get('status', s_data.get('state', 'UNKNOWN'))
+
+                if s_fal_status.upper() == 'COMPLETED' or 'images' in s_data or 'image' in s_data:
+                    s_result_url = None
+                    if 'images' in s_data and len(s_data['images']) > 0:
+                        s_result_url = s_data['images'][0]['url']
+                    elif 'image' in s_data:
+                        s_result_url = s_data['image']['url'] if isinstance(s_data['image'], dict) else s_data['image']
+
+                    if s_result_url:
+                        try:
+                            s_cdn_url = upload_result_to_s3(s_result_url, s_user_id)
+                            cursor.execute('''
+                                UPDATE t_p29007832_virtual_fitting_room.freegen_tasks
+                                SET saved_to_history = true
+                                WHERE id = %s AND saved_to_history = false
+                                RETURNING id
+                            ''', (s_id,))
+                            s_atomic = cursor.fetchone()
+                            conn.commit()
+
+                            if s_atomic:
+                                save_to_history(conn, s_user_id, s_cdn_url, s_prompt or '', s_refs_json, s_aspect or '1:1', s_id)
+                                if s_task_type == 'model':
+                                    save_user_model(conn, s_user_id, s_cdn_url, s_prompt or '', s_model_params, s_id)
+
+                            cursor.execute('''
+                                UPDATE t_p29007832_virtual_fitting_room.freegen_tasks
+                                SET status = 'completed', result_url = %s, updated_at = %s
+                                WHERE id = %s
+                            ''', (s_cdn_url, datetime.utcnow(), s_id))
+                            conn.commit()
+                            delete_tmp_references(s_id, len(s_refs))
+                            print(f'[Freegen] Stuck task {s_id} recovered -> completed')
+                        except Exception as up_err:
+                            print(f'[Freegen] Stuck {s_id} S3 save error: {up_err}')
+                            cursor.execute('''
+                                UPDATE t_p29007832_virtual_fitting_room.freegen_tasks
+                                SET status = 'completed', result_url = %s, updated_at = %s, error_message = %s
+                                WHERE id = %s
+                            ''', (s_result_url, datetime.utcnow(), f'S3 save failed: {str(up_err)[:200]}', s_id))
+                            conn.commit()
+
+                elif s_fal_status.upper() in ('FAILED', 'EXPIRED'):
+                    s_err_raw = s_data.get('error', 'Generation failed')
+                    s_err_msg = (str(s_err_raw) if str(s_err_raw) == MODEL_REJECTED_ERROR
+                                 else f'Ошибка генерации: {str(s_err_raw)[:200]}')
+                    cursor.execute('''
+                        UPDATE t_p29007832_virtual_fitting_room.freegen_tasks
+                        SET status = 'failed', error_message = %s, updated_at = %s
+                        WHERE id = %s
+                    ''', (s_err_msg, datetime.utcnow(), s_id))
+                    conn.commit()
+                    refund_balance_if_needed(conn, s_user_id, s_id)
+                    delete_tmp_references(s_id, len(s_refs))
+                    print(f'[Freegen] Stuck task {s_id} marked failed')
+
+                elif s_age > 660:
+                    cursor.execute('''
+                        UPDATE t_p29007832_virtual_fitting_room.freegen_tasks
+                        SET status = 'failed', error_message = %s, updated_at = %s
+                        WHERE id = %s AND status = 'processing'
+                    ''', (f'Timeout after {int(s_age)}s (stuck recovery)', datetime.utcnow(), s_id))
+                    conn.commit()
+                    refund_balance_if_needed(conn, s_user_id, s_id)
+                    delete_tmp_references(s_id, len(s_refs))
+                    print(f'[Freegen] Stuck task {s_id} timed out, failed')
+            except Exception as se:
+                # Сбой по одной задаче не должен обрывать разбор остальных.
+                print(f'[Freegen] Stuck {s_id} processing error: {se}')
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+    except Exception as e:
+        print(f'[Freegen] Stuck scan error (non-critical): {e}')
+    return len(stuck_rows)
+
+
+def is_sweep_request(event: Dict[str, Any], params: Dict[str, Any]) -> bool:
+    '''Режим sweep: ?sweep=1 и системный токен (JWT_SECRET_KEY), как у крон-функций.'''
+    if params.get('sweep') != '1':
+        return False
+    headers = event.get('headers', {})
+    provided_token = headers.get('x-system-token') or headers.get('X-System-Token')
+    expected = os.environ.get('JWT_SECRET_KEY')
+    return bool(expected) and provided_token == expected
+
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Обработчик задачи свободной генерации NanoBanana 2 по task_id (асинхронный воркер)
@@ -377,6 +473,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 
     query_params = event.get('queryStringParameters') or {}
     task_id = query_params.get('task_id')
+
+    # Зависшие задачи добиваются пачкой по расписанию (task-sweeper), а не в каждом вызове
+    if is_sweep_request(event, query_params):
+        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        cursor = conn.cursor()
+        try:
+            recovered = recover_stuck_tasks(conn, cursor)
+        finally:
+            cursor.close()
+            conn.close()
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': get_cors_origin(event), 'Access-Control-Allow-Credentials': 'true'},
+            'isBase64Encoded': False,
+            'body': json.dumps({'status': 'swept', 'stuck_tasks_processed': recovered}),
+        }
+
     if not task_id:
         return {
             'statusCode': 400,
@@ -465,6 +578,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'body': json.dumps({'status': 'task_already_processing'}),
                     }
 
+                mark_stage(cursor, 'freegen', task_id, 'admitted')
+
                 try:
                     # Загрузить референсы как URL
                     ref_urls = []
@@ -479,6 +594,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     print(f'[Freegen] Prompt: {final_prompt[:200]}')
 
                     request_id, response_url = submit_to_fal_queue(final_prompt, ref_urls, aspect_ratio or '1:1')
+                    mark_stage(cursor, 'freegen', task_id, 'submitted')
 
                     cursor.execute('''
                         UPDATE t_p29007832_virtual_fitting_room.freegen_tasks
@@ -497,6 +613,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         SET status = 'failed', error_message = %s, updated_at = %s
                         WHERE id = %s
                     ''', (error_msg[:500], datetime.utcnow(), task_id))
+                    mark_stage(cursor, 'freegen', task_id, 'finalized')
                     conn.commit()
                     refund_balance_if_needed(conn, user_id, task_id)
                     delete_tmp_references(task_id, len(references))
@@ -519,8 +636,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
 
                     if fal_result_url:
                         print(f'[Freegen] Task {task_id} completed, fal URL: {fal_result_url[:60]}')
+                        mark_stage(cursor, 'freegen', task_id, 'provider_done')
                         try:
                             cdn_url = upload_result_to_s3(fal_result_url, user_id)
+                            mark_stage(cursor, 'freegen', task_id, 'uploaded')
 
                             cursor.execute('''
                                 UPDATE t_p29007832_virtual_fitting_room.freegen_tasks
@@ -541,6 +660,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                                 SET status = 'completed', result_url = %s, updated_at = %s
                                 WHERE id = %s
                             ''', (cdn_url, datetime.utcnow(), task_id))
+                            mark_stage(cursor, 'freegen', task_id, 'finalized')
                             conn.commit()
 
                             delete_tmp_references(task_id, len(references))
@@ -551,6 +671,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                                 SET status = 'completed', result_url = %s, updated_at = %s, error_message = %s
                                 WHERE id = %s
                             ''', (fal_result_url, datetime.utcnow(), f'S3 save failed: {str(save_err)[:200]}', task_id))
+                            mark_stage(cursor, 'freegen', task_id, 'finalized')
                             conn.commit()
 
                 elif fal_status.upper() in ('FAILED', 'EXPIRED'):
@@ -563,6 +684,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         SET status = 'failed', error_message = %s, updated_at = %s
                         WHERE id = %s
                     ''', (error_msg, datetime.utcnow(), task_id))
+                    mark_stage(cursor, 'freegen', task_id, 'finalized')
                     conn.commit()
                     refund_balance_if_needed(conn, user_id, task_id)
                     delete_tmp_references(task_id, len(references))
@@ -587,128 +709,6 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 except Exception as ie:
                     print(f'[Freegen] Fallback error: {ie}')
 
-        # --- STUCK RECOVERY: добить зависшие processing-задачи других пользователей
-        try:
-            cursor.execute('''
-                SELECT id, fal_response_url, user_id, prompt, "references", aspect_ratio, saved_to_history, created_at, task_type, model_params
-                FROM t_p29007832_virtual_fitting_room.freegen_tasks
-                WHERE status = 'processing'
-                  AND fal_response_url IS NOT NULL
-                  AND updated_at < NOW() - INTERVAL '3 minutes'
-                  AND id != %s
-                ORDER BY created_at ASC
-                LIMIT 5
-            ''', (task_id,))
-            stuck_rows = cursor.fetchall()
-            print(f'[Freegen] Found {len(stuck_rows)} stuck tasks')
-
-            for stuck in stuck_rows:
-                s_id, s_response_url, s_user_id, s_prompt, s_refs_json, s_aspect, s_saved, s_created, s_task_type, s_model_params = stuck
-                try:
-                    s_refs = json.loads(s_refs_json) if s_refs_json else []
-                    s_age = (datetime.utcnow() - s_created).total_seconds() if s_created else 0
-                    s_data = check_fal_status(s_response_url)
-                    s_fal_status = s_data.get('status', s_data.get('state', 'UNKNOWN'))
-
-                    if s_fal_status.upper() == 'COMPLETED' or 'images' in s_data or 'image' in s_data:
-                        s_result_url = None
-                        if 'images' in s_data and len(s_data['images']) > 0:
-                            s_result_url = s_data['images'][0]['url']
-                        elif 'image' in s_data:
-                            s_result_url = s_data['image']['url'] if isinstance(s_data['image'], dict) else s_data['image']
-
-                        if s_result_url:
-                            try:
-                                s_cdn_url = upload_result_to_s3(s_result_url, s_user_id)
-                                cursor.execute('''
-                                    UPDATE t_p29007832_virtual_fitting_room.freegen_tasks
-                                    SET saved_to_history = true
-                                    WHERE id = %s AND saved_to_history = false
-                                    RETURNING id
-                                ''', (s_id,))
-                                s_atomic = cursor.fetchone()
-                                conn.commit()
-
-                                if s_atomic:
-                                    save_to_history(conn, s_user_id, s_cdn_url, s_prompt or '', s_refs_json, s_aspect or '1:1', s_id)
-                                    if s_task_type == 'model':
-                                        save_user_model(conn, s_user_id, s_cdn_url, s_prompt or '', s_model_params, s_id)
-
-                                cursor.execute('''
-                                    UPDATE t_p29007832_virtual_fitting_room.freegen_tasks
-                                    SET status = 'completed', result_url = %s, updated_at = %s
-                                    WHERE id = %s
-                                ''', (s_cdn_url, datetime.utcnow(), s_id))
-                                conn.commit()
-                                delete_tmp_references(s_id, len(s_refs))
-                                print(f'[Freegen] Stuck task {s_id} recovered -> completed')
-                            except Exception as up_err:
-                                print(f'[Freegen] Stuck {s_id} S3 save error: {up_err}')
-                                cursor.execute('''
-                                    UPDATE t_p29007832_virtual_fitting_room.freegen_tasks
-                                    SET status = 'completed', result_url = %s, updated_at = %s, error_message = %s
-                                    WHERE id = %s
-                                ''', (s_result_url, datetime.utcnow(), f'S3 save failed: {str(up_err)[:200]}', s_id))
-                                conn.commit()
-
-                    elif s_fal_status.upper() in ('FAILED', 'EXPIRED'):
-                        s_err_raw = s_data.get('error', 'Generation failed')
-                        s_err_msg = (str(s_err_raw) if str(s_err_raw) == MODEL_REJECTED_ERROR
-                                     else f'Ошибка генерации: {str(s_err_raw)[:200]}')
-                        cursor.execute('''
-                            UPDATE t_p29007832_virtual_fitting_room.freegen_tasks
-                            SET status = 'failed', error_message = %s, updated_at = %s
-                            WHERE id = %s
-                        ''', (s_err_msg, datetime.utcnow(), s_id))
-                        conn.commit()
-                        refund_balance_if_needed(conn, s_user_id, s_id)
-                        delete_tmp_references(s_id, len(s_refs))
-                        print(f'[Freegen] Stuck task {s_id} marked failed')
-
-                    elif s_age > 660:
-                        cursor.execute('''
-                            UPDATE t_p29007832_virtual_fitting_room.freegen_tasks
-                            SET status = 'failed', error_message = %s, updated_at = %s
-                            WHERE id = %s AND status = 'processing'
-                        ''', (f'Timeout after {int(s_age)}s (stuck recovery)', datetime.utcnow(), s_id))
-                        conn.commit()
-                        refund_balance_if_needed(conn, s_user_id, s_id)
-                        delete_tmp_references(s_id, len(s_refs))
-                        print(f'[Freegen] Stuck task {s_id} timed out, failed')
-                except Exception as se:
-                    # Сбой по одной задаче не должен обрывать разбор остальных.
-                    print(f'[Freegen] Stuck {s_id} processing error: {se}')
-                    try:
-                        conn.rollback()
-                    except Exception:
-                        pass
-        except Exception as e:
-            print(f'[Freegen] Stuck scan error (non-critical): {e}')
-
-        # --- ORPHAN RECOVERY: триггернуть воркер для зависшей pending-задачи
-        try:
-            cursor.execute('''
-                SELECT id FROM t_p29007832_virtual_fitting_room.freegen_tasks
-                WHERE status = 'pending'
-                  AND fal_request_id IS NULL
-                  AND created_at < NOW() - INTERVAL '1 minute'
-                  AND id != %s
-                ORDER BY created_at ASC
-                LIMIT 1
-            ''', (task_id,))
-            orphan_row = cursor.fetchone()
-            if orphan_row:
-                orphan_id = orphan_row[0]
-                print(f'[Freegen] Found orphan pending task {orphan_id}, triggering worker')
-                try:
-                    import urllib.request
-                    req = urllib.request.Request(f'{WORKER_URL}?task_id={orphan_id}', method='GET')
-                    urllib.request.urlopen(req, timeout=2)
-                except Exception as te:
-                    print(f'[Freegen] Orphan trigger failed (non-critical): {te}')
-        except Exception as e:
-            print(f'[Freegen] Orphan scan error (non-critical): {e}')
-
         cursor.close()
         conn.close()
         return {
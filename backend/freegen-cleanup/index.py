@@ -7,6 +7,7 @@ from typing import Dict, Any, List, Tuple
 
 S3_BUCKET = os.environ.get('S3_BUCKET_NAME', 'fitting-room-images')
 DEFAULT_DAYS = 3
+DELETE_BATCH = 1000
 
 # Регекс для ключа S3 из URL https://storage.yandexcloud.net/{bucket}/{key}
 S3_URL_RE = re.compile(r'^https?://storage\.yandexcloud\.net/[^/]+/(.+)$')
@@ -80,6 +81,7 @@ def cleanup_references(days: int) -> Tuple[int, int, int, List[str]]:
     tasks_processed = 0
     files_deleted = 0
     errors: List[str] = []
+    keys_to_delete: List[str] = []
 
     for row in rows:
         task_id, refs_raw = row
@@ -99,11 +101,7 @@ def cleanup_references(days: int) -> Tuple[int, int, int, List[str]]:
             # Удаляем только референсы, НЕ результаты генерации
             if '/freegeneration/refs/' not in key and '/freegeneration/tmp/' not in key:
                 continue
-            try:
-                s3.delete_object(Bucket=S3_BUCKET, Key=key)
-                files_deleted += 1
-            except Exception as e:
-                errors.append(f'{key}: {str(e)[:100]}')
+            keys_to_delete.append(key)
 
         # Помечаем задачу как очищенную
         try:
@@ -115,6 +113,21 @@ def cleanup_references(days: int) -> Tuple[int, int, int, List[str]]:
         except Exception as e:
             errors.append(f'task {task_id} update: {str(e)[:100]}')
 
+    # Удаляем пачками delete_objects (до 1000 ключей за вызов) вместо delete_object на каждый файл
+    for start in range(0, len(keys_to_delete), DELETE_BATCH):
+        chunk = keys_to_delete[start:start + DELETE_BATCH]
+        try:
+            response = s3.delete_objects(
+                Bucket=S3_BUCKET,
+                Delete={'Objects': [{'Key': k} for k in chunk], 'Quiet': True},
+            )
+            failed = response.get('Errors', [])
+            files_deleted += len(chunk) - len(failed)
+            for err in failed:
+                errors.append(f"{err.get('Key')}: {err.get('Code')}")
+        except Exception as e:
+            errors.append(f'batch {start}: {str(e)[:100]}')
+
     conn.commit()
     cursor.close()
     conn.close()
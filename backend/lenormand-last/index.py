@@ -4,13 +4,11 @@ import json
 import os
 import base64
 import html as html_lib
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 
 import psycopg2
 
 from session_utils import validate_session
+from email_outbox import enqueue_email, wake_sender
 
 DB_SCHEMA = 't_p29007832_virtual_fitting_room'
 PAGE_SIZE_MAX = 50
@@ -29,21 +27,8 @@ def _decode(ai_response):
         return ai_response
 
 
-def _send_email(to_email, subject, body_text):
-    """Отправляет письмо через тот же почтовый ящик, что и остальные письма сервиса."""
-    smtp_host = os.environ.get('SMTP_HOST')
-    smtp_port = int(os.environ.get('SMTP_PORT', '587'))
-    smtp_user = os.environ.get('SMTP_USER')
-    smtp_password = os.environ.get('SMTP_PASSWORD')
-
-    if not (smtp_host and smtp_user and smtp_password):
-        raise Exception('Почта не настроена')
-
-    message = MIMEMultipart('alternative')
-    message['Subject'] = subject
-    message['From'] = 'virtualfitting@mail.ru'
-    message['To'] = to_email
-
+def _email_html(subject, body_text):
+    """HTML-версия письма с раскладом."""
     paragraphs = ''.join(
         f'<p style="margin:0 0 14px;line-height:1.7">{html_lib.escape(par.strip())}</p>'
         for par in body_text.split('\n\n') if par.strip()
@@ -60,19 +45,7 @@ def _send_email(to_email, subject, body_text):
         '<p style="font-size:12px;color:#8a7f6b">fitting-room.ru</p>'
         '</div></body></html>'
     )
-
-    message.attach(MIMEText(body_text, 'plain', 'utf-8'))
-    message.attach(MIMEText(html_content, 'html', 'utf-8'))
-
-    if smtp_port == 465:
-        with smtplib.SMTP_SSL(smtp_host, smtp_port) as server:
-            server.login(smtp_user, smtp_password)
-            server.send_message(message)
-    else:
-        with smtplib.SMTP(smtp_host, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.send_message(message)
+    return html_content
 
 
 def _email_reading(cur, safe_uid, task_id):
@@ -101,7 +74,10 @@ def _email_reading(cur, safe_uid, task_id):
     if not text:
         return {'sent': False, 'error': 'Пустое толкование'}
 
-    _send_email(to_email, 'Ваш расклад на картах', text)
+    # Письмо уходит через очередь — ответ не ждёт SMTP
+    subject = 'Ваш расклад на картах'
+    enqueue_email(cur, to_email, subject, text, _email_html(subject, text),
+                  source='lenormand-last')
     return {'sent': True, 'email': to_email}
 
 
@@ -228,6 +204,9 @@ def handler(event, context):
                     return {'statusCode': 400, 'headers': cors_headers,
                             'body': json.dumps({'error': 'id required'})}
                 result = _email_reading(cur, safe_uid, task_id)
+                conn.commit()
+                if result.get('sent'):
+                    wake_sender()
             elif action == 'delete':
                 task_id = body.get('id')
                 if not task_id:
@@ -4,10 +4,9 @@ from typing import Dict, Any, List, Optional
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import requests
-import boto3
-from botocore.config import Config
 from pydantic import BaseModel, Field, field_validator
 from session_utils import validate_session
+from media_refs import add_media_refs, release_media_refs
 
 def get_db_connection():
     # Force redeploy v2
@@ -497,6 +496,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             )
             
             lookbook = cursor.fetchone()
+            add_media_refs(cursor, user_id, saved_photos)
             
             # Mark photos as saved to lookbook in history
             for photo_url in saved_photos:
@@ -636,6 +636,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'body': json.dumps({'error': 'Lookbook not found'})
                 }
             
+            # Ссылки на фото: новые — +1, убранные — -1 (в той же транзакции)
+            if saved_photos is not None:
+                add_media_refs(cursor, user_id, [p for p in saved_photos if p not in (old_photos or [])])
+                release_media_refs(cursor, removed_photos)
+            
             # Mark new photos as saved to lookbook in history
             if saved_photos:
                 for photo_url in saved_photos:
@@ -648,51 +653,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         except Exception as e:
                             print(f'Failed to update history for photo {photo_url}: {e}')
             
-            # Check if removed photos should be deleted from S3
-            # Delete from S3 if photo is NOT in history AND NOT in any other lookbook
-            if removed_photos:
-                s3_bucket_name = os.environ.get('S3_BUCKET_NAME')
-                s3_url_prefix = f'https://storage.yandexcloud.net/{s3_bucket_name}/'
-                
-                for photo_url in removed_photos:
-                    if not photo_url.startswith(s3_url_prefix):
-                        continue
-                    
-                    # Check if in history (PUT method)
-                    cursor.execute(
-                        "SELECT COUNT(*) as count FROM try_on_history WHERE user_id = %s AND result_image = %s",
-                        (user_id, photo_url)
-                    )
-                    history_count = cursor.fetchone()['count']
-                    
-                    # Check if in other lookbooks (PUT method)
-                    cursor.execute(
-                        "SELECT COUNT(*) as count FROM lookbooks WHERE user_id = %s AND id != %s AND %s = ANY(photos)",
-                        (user_id, lookbook_id, photo_url)
-                    )
-                    other_lookbooks_count = cursor.fetchone()['count']
-                    
-                    # Delete from S3 only if NOT in history and NOT in other lookbooks
-                    if history_count == 0 and other_lookbooks_count == 0:
-                        try:
-                            s3_key = photo_url.replace(s3_url_prefix, '')
-                            
-                            s3_client = boto3.client(
-                                's3',
-                                endpoint_url='https://storage.yandexcloud.net',
-                                aws_access_key_id=os.environ.get('S3_ACCESS_KEY'),
-                                aws_secret_access_key=os.environ.get('S3_SECRET_KEY'),
-                                region_name='ru-central1',
-                                config=Config(signature_version='s3v4')
-                            )
-                            
-                            s3_client.delete_object(
-                                Bucket=s3_bucket_name,
-                                Key=s3_key
-                            )
-                            print(f'Deleted from S3 (removed from lookbook, not in history): {s3_key}')
-                        except Exception as e:
-                            print(f'Failed to delete from S3: {e}')
+            # Убранные фото без ссылок остаются в media_refs с ref_count = 0 —
+            # их удаляет из S3 сборщик s3-gc пачками, не этот запрос
             
             conn.commit()
             
@@ -771,6 +733,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             )
             deleted = cursor.fetchone()
             
+            if deleted:
+                release_media_refs(cursor, photos_to_check)
+            
             if not deleted:
                 conn.rollback()
                 return {
@@ -784,51 +749,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'body': json.dumps({'error': 'Lookbook not found'})
                 }
             
-            # Check if photos should be deleted from S3
-            # Delete from S3 if photo is NOT in history AND NOT in any other lookbook
-            if photos_to_check:
-                s3_bucket_name = os.environ.get('S3_BUCKET_NAME')
-                s3_url_prefix = f'https://storage.yandexcloud.net/{s3_bucket_name}/'
-                
-                for photo_url in photos_to_check:
-                    if not photo_url.startswith(s3_url_prefix):
-                        continue
-                    
-                    # Check if in history (DELETE method)
-                    cursor.execute(
-                        "SELECT COUNT(*) as count FROM try_on_history WHERE user_id = %s AND result_image = %s",
-                        (user_id, photo_url)
-                    )
-                    history_count = cursor.fetchone()['count']
-                    
-                    # Check if in other lookbooks (DELETE method)
-                    cursor.execute(
-                        "SELECT COUNT(*) as count FROM lookbooks WHERE user_id = %s AND id != %s AND %s = ANY(photos)",
-                        (user_id, lookbook_id, photo_url)
-                    )
-                    other_lookbooks_count = cursor.fetchone()['count']
-                    
-                    # Delete from S3 only if NOT in history and NOT in other lookbooks
-                    if history_count == 0 and other_lookbooks_count == 0:
-                        try:
-                            s3_key = photo_url.replace(s3_url_prefix, '')
-                            
-                            s3_client = boto3.client(
-                                's3',
-                                endpoint_url='https://storage.yandexcloud.net',
-                                aws_access_key_id=os.environ.get('S3_ACCESS_KEY'),
-                                aws_secret_access_key=os.environ.get('S3_SECRET_KEY'),
-                                region_name='ru-central1',
-                                config=Config(signature_version='s3v4')
-                            )
-                            
-                            s3_client.delete_object(
-                                Bucket=s3_bucket_name,
-                                Key=s3_key
-                            )
-                            print(f'Deleted from S3 (lookbook deleted, not in history or other lookbooks): {s3_key}')
-                        except Exception as e:
-                            print(f'Failed to delete from S3: {e}')
+            # Фото без ссылок удаляет из S3 сборщик s3-gc (очередь в media_refs)
             
             conn.commit()
             
@@ -0,0 +1,125 @@
+"""
+Счётчик ссылок на файлы в S3 (таблица media_refs).
+
+Каждая запись истории (try_on_history, freegen_history), каждое вхождение
+фото в лукбук и исходное фото задачи гида по цвету держит одну ссылку на URL. Писатели увеличивают/уменьшают
+счётчик в той же транзакции, что и саму запись, поэтому проверка
+"фото больше нигде не используется" — это один поиск по первичному ключу
+вместо COUNT(*) по трём таблицам (в т.ч. ANY(photos) без индекса).
+
+Использование:
+
+    from media_refs import add_media_refs, release_media_refs
+    add_media_refs(cursor, user_id, [cdn_url])            # после INSERT в историю
+    orphaned = release_media_refs(cursor, [photo_url])    # после DELETE, до commit
+    # orphaned — URL, на которые больше нет ссылок; сами файлы удаляет
+    # сборщик s3-gc пачками (очередь — строки с ref_count = 0)
+"""
+
+from typing import Iterable, List, Optional
+
+SCHEMA = 't_p29007832_virtual_fitting_room'
+
+
+def _first_value(row):
+    '''Первое поле строки для обычного курсора и для RealDictCursor.'''
+    if row is None:
+        return None
+    if isinstance(row, dict):
+        return next(iter(row.values()), None)
+    return row[0]
+
+
+def _unique_urls(urls: Iterable[Optional[str]]) -> List[str]:
+    '''Уникальные непустые URL с сохранением порядка.'''
+    seen = []
+    for url in urls or []:
+        if url and url not in seen:
+            seen.append(url)
+    return seen
+
+
+def add_media_refs(cursor, user_id: Optional[str], urls: Iterable[Optional[str]]) -> None:
+    '''Увеличить счётчик ссылок для каждого URL (создать запись при первой ссылке).'''
+    for url in _unique_urls(urls):
+        cursor.execute(
+            f'''INSERT INTO {SCHEMA}.media_refs (url, user_id, ref_count, orphaned_at, updated_at)
+                VALUES (%s, %s, 1, NULL, NOW())
+                ON CONFLICT (url) DO UPDATE
+                SET ref_count = {SCHEMA}.media_refs.ref_count + 1,
+                    orphaned_at = NULL,
+                    updated_at = NOW()''',
+            (url, str(user_id) if user_id else None)
+        )
+
+
+def hold_media_ref(cursor, user_id: Optional[str], url: Optional[str]) -> None:
+    '''
+    Единственная ссылка на файл, которым владеет одна запись (исходное фото
+    задачи). Повторный вызов для того же URL счётчик не увеличивает.
+    '''
+    if not url:
+        return
+    cursor.execute(
+        f'''INSERT INTO {SCHEMA}.media_refs (url, user_id, ref_count, orphaned_at, updated_at)
+            VALUES (%s, %s, 1, NULL, NOW())
+            ON CONFLICT (url) DO UPDATE
+            SET ref_count = GREATEST({SCHEMA}.media_refs.ref_count, 1),
+                orphaned_at = NULL,
+                updated_at = NOW()''',
+        (url, str(user_id) if user_id else None)
+    )
+
+
+def release_media_refs(cursor, urls: Iterable[Optional[str]]) -> List[str]:
+    '''
+    Уменьшить счётчик ссылок для каждого URL (одним запросом на весь список).
+    Возвращает URL, у которых ссылок не осталось (помечаются orphaned_at).
+    URL без записи в media_refs считаются неотслеживаемыми и не возвращаются.
+    '''
+    unique = _unique_urls(urls)
+    if not unique:
+        return []
+    cursor.execute(
+        f'''UPDATE {SCHEMA}.media_refs
+            SET ref_count = GREATEST(ref_count - 1, 0),
+                orphaned_at = CASE WHEN ref_count <= 1 THEN NOW() ELSE NULL END,
+                updated_at = NOW()
+            WHERE url = ANY(%s)
+            RETURNING url, ref_count''',
+        (unique,)
+    )
+    released = {}
+    for row in cursor.fetchall():
+        if isinstance(row, dict):
+            released[row['url']] = row['ref_count']
+        else:
+            released[row[0]] = row[1]
+    return [url for url in unique if url in released and int(released[url]) == 0]
+
+
+def release_media_prefix(cursor, user_id: str, url_prefix: str) -> List[str]:
+    '''
+    Снять ссылки со всех файлов пользователя, чей URL начинается с url_prefix
+    (файлы задачи с заранее неизвестным расширением). Ответ — как у release_media_refs.
+    '''
+    cursor.execute(
+        f'''SELECT url FROM {SCHEMA}.media_refs
+            WHERE user_id = %s AND ref_count > 0 AND url LIKE %s''',
+        (str(user_id), url_prefix.replace('%', r'\%').replace('_', r'\_') + '%')
+    )
+    return release_media_refs(cursor, [_first_value(row) for row in cursor.fetchall()])
+
+
+def media_ref_count(cursor, url: str) -> Optional[int]:
+    '''
+    Число ссылок на URL (поиск по первичному ключу).
+    None — URL не отслеживается (не из истории/лукбуков).
+    Отслеживаемые файлы с нулём ссылок удаляет s3-gc, не вызывающий код.
+    '''
+    cursor.execute(
+        f'SELECT ref_count FROM {SCHEMA}.media_refs WHERE url = %s',
+        (url,)
+    )
+    ref_count = _first_value(cursor.fetchone())
+    return int(ref_count) if ref_count is not None else None
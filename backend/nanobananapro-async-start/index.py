@@ -5,6 +5,7 @@ from typing import Dict, Any
 import uuid
 from datetime import datetime
 from session_utils import validate_session
+from task_timings import mark_stage
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -164,6 +165,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             prompt_hints,
             datetime.utcnow()
         ))
+        mark_stage(cursor, 'tryon', task_id, 'queued')
         
         conn.commit()
         print(f'[START-{request_id}] Task {task_id} saved to database')
@@ -8,9 +8,15 @@ from googletrans import Translator
 import boto3
 import time
 import uuid
+from media_refs import add_media_refs
+from task_timings import mark_stage
+from balance_ledger import refund_task
 
 GENERATION_COST = 50
 
+# Сколько зависших задач добивает один запуск в режиме sweep (его вызывает task-sweeper)
+SWEEP_BATCH = 20
+
 def normalize_image_format(image: str) -> str:
     '''Convert image to data URI format if needed'''
     if image.startswith('http://') or image.startswith('https://'):
@@ -229,51 +235,21 @@ def refund_balance_if_needed(conn, user_id: str, task_id: str) -> None:
     '''Refund 50 rubles to user balance if not unlimited and not already refunded'''
     try:
         cursor = conn.cursor()
-        
-        # Check if already refunded
-        cursor.execute('SELECT refunded FROM t_p29007832_virtual_fitting_room.nanobananapro_tasks WHERE id = %s', (task_id,))
-        refund_row = cursor.fetchone()
-        
-        if refund_row and refund_row[0]:
-            print(f'[Refund] Task {task_id} already refunded, skipping')
-            cursor.close()
-            return
-        
-        # Check if user has unlimited access and get balance
-        cursor.execute('SELECT unlimited_access, balance FROM users WHERE id = %s', (user_id,))
-        user_row = cursor.fetchone()
-        
-        if not user_row:
-            print(f'[Refund] User {user_id} not found')
-            cursor.close()
-            return
-        
-        unlimited_access = user_row[0]
-        balance_before = float(user_row[1])
-        
-        if unlimited_access:
-            print(f'[Refund] User {user_id} has unlimited access, no refund needed')
-            cursor.execute('UPDATE t_p29007832_virtual_fitting_room.nanobananapro_tasks SET refunded = true WHERE id = %s', (task_id,))
-            conn.commit()
-            cursor.close()
-            return
-        
-        balance_after = balance_before + GENERATION_COST
-        
-        cursor.execute('UPDATE users SET balance = balance + %s WHERE id = %s', (GENERATION_COST, user_id))
-        cursor.execute('UPDATE t_p29007832_virtual_fitting_room.nanobananapro_tasks SET refunded = true WHERE id = %s', (task_id,))
-        
-        cursor.execute('''
-            INSERT INTO balance_transactions
-            (user_id, type, amount, balance_before, balance_after, description, try_on_id)
-            VALUES (%s, 'refund', %s, %s, %s, 'Возврат: технический сбой примерочной', NULL)
-        ''', (user_id, GENERATION_COST, balance_before, balance_after))
-        
+        # Флаг refunded, баланс и запись в журнале — одним запросом
+        claimed, balance_after = refund_task(
+            cursor, 'nanobananapro_tasks', task_id, user_id, GENERATION_COST,
+            'Возврат: технический сбой примерочной',
+        )
         conn.commit()
-        
-        print(f'[Refund] Refunded {GENERATION_COST} rubles to user {user_id} for task {task_id}')
         cursor.close()
-        
+
+        if not claimed:
+            print(f'[Refund] Task {task_id} already refunded, skipping')
+        elif balance_after is None:
+            print(f'[Refund] User {user_id} has unlimited access, no refund needed')
+        else:
+            print(f'[Refund] Refunded {GENERATION_COST} rubles to user {user_id} for task {task_id}')
+
     except Exception as e:
         print(f'[Refund] Error refunding balance: {str(e)}')
 
@@ -316,6 +292,7 @@ def save_to_history(conn, user_id: str, cdn_url: str, person_image: str, garment
         
         history_row = cursor.fetchone()
         history_id = str(history_row[0]) if history_row else None
+        add_media_refs(cursor, user_id, [cdn_url])
         
         conn.commit()
         cursor.close()
@@ -333,6 +310,168 @@ def save_to_history(conn, user_id: str, cdn_url: str, person_image: str, garment
         return None
 
 
+def recover_stuck_tasks(conn, cursor, limit: int = SWEEP_BATCH) -> int:
+    '''
+    Добить зависшие processing-задачи (старше 3 минут без обновлений): забрать
+    готовый результат из fal.ai или вернуть деньги. Вызывается в режиме sweep.
+    '''
+    cursor.execute('''
+        SELECT id, fal_response_url, user_id, created_at
+        FROM t_p29007832_virtual_fitting_room.nanobananapro_tasks
+        WHERE status = 'processing' 
+          AND fal_response_url IS NOT NULL
+          AND updated_at < NOW() - INTERVAL '3 minutes'
+        ORDER BY created_at ASC
+        LIMIT %s
+    ''', (limit,))
+
+    stuck_tasks = cursor.fetchall()
+    print(f'[NanoBanana] Found {len(stuck_tasks)} stuck tasks')
+
+    for stuck_task in stuck_tasks:
+        stuck_id, stuck_response_url, stuck_user_id, stuck_created = stuck_task
+        print(f'[NanoBanana] Processing stuck task {stuck_id} (created {stuck_created})')
+
+        try:
+            status_data = check_fal_status(stuck_response_url)
+            fal_status = status_data.get('status', status_data.get('state', 'UNKNOWN'))
+
+            if fal_status.upper() == 'COMPLETED' or 'images' in status_data or 'image' in status_data:
+                if 'images' in status_data and len(status_data['images']) > 0:
+                    fal_result_url = status_data['images'][0]['url']
+                elif 'image' in status_data:
+                    if isinstance(status_data['image'], dict):
+                        fal_result_url = status_data['image']['url']
+                    else:
+                        fal_result_url = status_data['image']
+                else:
+                    continue
+
+                print(f'[NanoBanana] Stuck task {stuck_id} completed! Uploading to S3...')
+                mark_stage(cursor, 'tryon', stuck_id, 'provider_done')
+
+                try:
+                    cdn_url = upload_to_s3(fal_result_url, stuck_user_id)
+                    mark_stage(cursor, 'tryon', stuck_id, 'uploaded')
+
+                    # Get task details for history
+                    cursor.execute('''
+                        SELECT person_image, garments, prompt_hints
+                        FROM t_p29007832_virtual_fitting_room.nanobananapro_tasks
+                        WHERE id = %s
+                    ''', (stuck_id,))
+                    task_details = cursor.fetchone()
+                    if task_details:
+                        person_img, garments_json, prompt = task_details
+                        garments = json.loads(garments_json)
+
+                        # ATOMIC: Mark as saved BEFORE actual save to prevent race condition
+                        print(f'[NanoBanana] Atomically marking stuck task {stuck_id} as saved_to_history')
+                        cursor.execute('''
+                            UPDATE t_p29007832_virtual_fitting_room.nanobananapro_tasks
+                            SET saved_to_history = true
+                            WHERE id = %s AND saved_to_history = false
+                            RETURNING id
+                        ''', (stuck_id,))
+                        atomic_check = cursor.fetchone()
+                        conn.commit()
+
+                        if not atomic_check:
+                            print(f'[NanoBanana] Stuck task {stuck_id} already marked as saved by another worker, aborting save')
+                        else:
+                            print(f'[NanoBanana] Stuck task {stuck_id} marked, proceeding with save to history')
+                            save_to_history(conn, stuck_user_id, cdn_url, person_img, garments, prompt or '', stuck_id)
+
+                    # Update task status (saved_to_history already set above)
+                    cursor.execute('''
+                        UPDATE t_p29007832_virtual_fitting_room.nanobananapro_tasks
+                        SET status = 'completed',
+                            result_url = %s,
+                            updated_at = %s
+                        WHERE id = %s
+                    ''', (cdn_url, datetime.utcnow(), stuck_id))
+                    mark_stage(cursor, 'tryon', stuck_id, 'finalized')
+                    conn.commit()
+                    print(f'[NanoBanana] Stuck task {stuck_id} SAVED!')
+
+                except Exception as save_error:
+                    print(f'[NanoBanana] Failed to save stuck task {stuck_id}: {str(save_error)}')
+                    cursor.execute('''
+                        UPDATE t_p29007832_virtual_fitting_room.nanobananapro_tasks
+                        SET status = 'completed',
+                            result_url = %s,
+                            updated_at = %s
+                        WHERE id = %s
+                    ''', (fal_result_url, datetime.utcnow(), stuck_id))
+                    mark_stage(cursor, 'tryon', stuck_id, 'finalized')
+                    conn.commit()
+
+            elif fal_status.upper() in ['FAILED', 'EXPIRED']:
+                error_msg = f'Ошибка генерации: {str(status_data.get("error", "Generation failed"))[:100]}'
+                print(f'[NanoBanana] Stuck task {stuck_id} failed')
+                cursor.execute('''
+                    UPDATE t_p29007832_virtual_fitting_room.nanobananapro_tasks
+                    SET status = 'failed',
+                        error_message = %s,
+                        updated_at = %s
+                    WHERE id = %s
+                ''', (error_msg, datetime.utcnow(), stuck_id))
+                mark_stage(cursor, 'tryon', stuck_id, 'finalized')
+                conn.commit()
+                refund_balance_if_needed(conn, stuck_user_id, stuck_id)
+
+        except Exception as e:
+            error_str = str(e)
+            print(f'[NanoBanana] Error processing stuck task {stuck_id}: {error_str}')
+            try:
+                age_seconds = (datetime.utcnow() - stuck_created).total_seconds()
+                if age_seconds > 660:
+                    print(f'[NanoBanana] Stuck task {stuck_id} aged {age_seconds}s, marking failed')
+                    cursor.execute('''
+                        UPDATE t_p29007832_virtual_fitting_room.nanobananapro_tasks
+                        SET status = 'failed', error_message = %s, updated_at = %s
+                        WHERE id = %s AND status = 'processing'
+                    ''', (f'Timeout after {int(age_seconds)}s: {error_str[:100]}', datetime.utcnow(), stuck_id))
+                    conn.commit()
+                    refund_balance_if_needed(conn, stuck_user_id, stuck_id)
+            except Exception as inner_e:
+                print(f'[NanoBanana] Error in stuck fallback: {str(inner_e)}')
+    
+    return len(stuck_tasks)
+
+
+def reset_zombie_tasks(conn, cursor) -> int:
+    '''Вернуть в pending задачи, застрявшие в processing без fal_request_id дольше 2 минут.'''
+    try:
+        cursor.execute('''
+            UPDATE t_p29007832_virtual_fitting_room.nanobananapro_tasks
+            SET status = 'pending', updated_at = %s
+            WHERE status = 'processing'
+              AND fal_request_id IS NULL
+              AND created_at < NOW() - INTERVAL '2 minutes'
+            RETURNING id
+        ''', (datetime.utcnow(),))
+        zombie_rows = cursor.fetchall()
+        conn.commit()
+        if zombie_rows:
+            zombie_ids = [r[0] for r in zombie_rows]
+            print(f'[NanoBanana] Reset {len(zombie_ids)} zombie tasks back to pending: {zombie_ids}')
+        return len(zombie_rows)
+    except Exception as e:
+        print(f'[NanoBanana] Error resetting zombie tasks: {str(e)}')
+        return 0
+
+
+def is_sweep_request(event: Dict[str, Any], params: Dict[str, Any]) -> bool:
+    '''Режим sweep: ?sweep=1 и системный токен (JWT_SECRET_KEY), как у крон-функций.'''
+    if params.get('sweep') != '1':
+        return False
+    headers = event.get('headers', {})
+    provided_token = headers.get('x-system-token') or headers.get('X-System-Token')
+    expected = os.environ.get('JWT_SECRET_KEY')
+    return bool(expected) and provided_token == expected
+
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Process specific NanoBanana task by task_id
@@ -363,6 +502,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     query_params = event.get('queryStringParameters') or {}
     task_id = query_params.get('task_id')
     
+    # Зависшие задачи добиваются пачкой по расписанию (task-sweeper), а не в каждом вызове
+    if is_sweep_request(event, query_params):
+        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        cursor = conn.cursor()
+        try:
+            recovered = recover_stuck_tasks(conn, cursor)
+            zombies = reset_zombie_tasks(conn, cursor)
+        finally:
+            cursor.close()
+            conn.close()
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': get_cors_origin(event), 'Access-Control-Allow-Credentials': 'true'},
+            'isBase64Encoded': False,
+            'body': json.dumps({'status': 'swept', 'stuck_tasks_processed': recovered, 'zombies_reset': zombies})
+        }
+    
     if not task_id:
         return {
             'statusCode': 400,
@@ -462,9 +618,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'body': json.dumps({'status': 'task_already_processing'})
                     }
                 
+                mark_stage(cursor, 'tryon', task_id, 'admitted')
+                
                 try:
                     request_id, response_url = submit_to_fal_queue(person_image, garments, prompt_hints or '')
                     print(f'[NanoBanana] Task {task_id} submitted to fal.ai: request_id={request_id}')
+                    mark_stage(cursor, 'tryon', task_id, 'submitted')
                     
                     cursor.execute('''
                         UPDATE t_p29007832_virtual_fitting_room.nanobananapro_tasks
@@ -486,6 +645,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                             updated_at = %s
                         WHERE id = %s
                     ''', (error_msg, datetime.utcnow(), task_id))
+                    mark_stage(cursor, 'tryon', task_id, 'finalized')
                     conn.commit()
                     
                     # Refund balance for failed submission
@@ -511,12 +671,14 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         raise Exception('No image in response')
                     
                     print(f'[NanoBanana] Task {task_id} completed! FAL URL: {fal_result_url}')
+                    mark_stage(cursor, 'tryon', task_id, 'provider_done')
                     
                     # Worker now does FULL save: download from FAL → upload to S3 → save to history
                     try:
                         # Upload to Yandex.Cloud S3
                         cdn_url = upload_to_s3(fal_result_url, user_id)
                         print(f'[NanoBanana] Task {task_id} uploaded to S3: {cdn_url}')
+                        mark_stage(cursor, 'tryon', task_id, 'uploaded')
                         
                         # Get task details for history
                         cursor.execute('''
@@ -555,6 +717,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                                 updated_at = %s
                             WHERE id = %s
                         ''', (cdn_url, datetime.utcnow(), task_id))
+                        mark_stage(cursor, 'tryon', task_id, 'finalized')
                         conn.commit()
                         print(f'[NanoBanana] Task {task_id} FULLY saved: S3 + history + DB')
                         
@@ -570,6 +733,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                                 error_message = %s
                             WHERE id = %s
                         ''', (fal_result_url, datetime.utcnow(), f'S3 upload failed: {str(save_error)}', task_id))
+                        mark_stage(cursor, 'tryon', task_id, 'finalized')
                         conn.commit()
                 
                 elif fal_status.upper() in ['FAILED', 'EXPIRED']:
@@ -584,6 +748,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                             updated_at = %s
                         WHERE id = %s
                     ''', (error_msg, datetime.utcnow(), task_id))
+                    mark_stage(cursor, 'tryon', task_id, 'finalized')
                     conn.commit()
                     
                     # Refund balance for failed task
@@ -617,182 +782,16 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         print(f'[NanoBanana] Worker completed processing task {task_id}')
         
-        # Check for stuck tasks (older than 3 minutes in 'processing' status)
-        print(f'[NanoBanana] Checking for stuck tasks older than 3 minutes...')
-        cursor.execute('''
-            SELECT id, fal_response_url, user_id, created_at
-            FROM t_p29007832_virtual_fitting_room.nanobananapro_tasks
-            WHERE status = 'processing' 
-              AND fal_response_url IS NOT NULL
-              AND updated_at < NOW() - INTERVAL '3 minutes'
-              AND id != %s
-            ORDER BY created_at ASC
-            LIMIT 5
-        ''', (task_id,))
-        
-        stuck_tasks = cursor.fetchall()
-        print(f'[NanoBanana] Found {len(stuck_tasks)} stuck tasks')
-        
-        for stuck_task in stuck_tasks:
-            stuck_id, stuck_response_url, stuck_user_id, stuck_created = stuck_task
-            print(f'[NanoBanana] Processing stuck task {stuck_id} (created {stuck_created})')
-            
-            try:
-                status_data = check_fal_status(stuck_response_url)
-                fal_status = status_data.get('status', status_data.get('state', 'UNKNOWN'))
-                
-                if fal_status.upper() == 'COMPLETED' or 'images' in status_data or 'image' in status_data:
-                    if 'images' in status_data and len(status_data['images']) > 0:
-                        fal_result_url = status_data['images'][0]['url']
-                    elif 'image' in status_data:
-                        if isinstance(status_data['image'], dict):
-                            fal_result_url = status_data['image']['url']
-                        else:
-                            fal_result_url = status_data['image']
-                    else:
-                        continue
-                    
-                    print(f'[NanoBanana] Stuck task {stuck_id} completed! Uploading to S3...')
-                    
-                    try:
-                        cdn_url = upload_to_s3(fal_result_url, stuck_user_id)
-                        
-                        # Get task details for history
-                        cursor.execute('''
-                            SELECT person_image, garments, prompt_hints
-                            FROM t_p29007832_virtual_fitting_room.nanobananapro_tasks
-                            WHERE id = %s
-                        ''', (stuck_id,))
-                        task_details = cursor.fetchone()
-                        if task_details:
-                            person_img, garments_json, prompt = task_details
-                            garments = json.loads(garments_json)
-                            
-                            # ATOMIC: Mark as saved BEFORE actual save to prevent race condition
-                            print(f'[NanoBanana] Atomically marking stuck task {stuck_id} as saved_to_history')
-                            cursor.execute('''
-                                UPDATE t_p29007832_virtual_fitting_room.nanobananapro_tasks
-                                SET saved_to_history = true
-                                WHERE id = %s AND saved_to_history = false
-                                RETURNING id
-                            ''', (stuck_id,))
-                            atomic_check = cursor.fetchone()
-                            conn.commit()
-                            
-                            if not atomic_check:
-                                print(f'[NanoBanana] Stuck task {stuck_id} already marked as saved by another worker, aborting save')
-                            else:
-                                print(f'[NanoBanana] Stuck task {stuck_id} marked, proceeding with save to history')
-                                save_to_history(conn, stuck_user_id, cdn_url, person_img, garments, prompt or '', stuck_id)
-                        
-                        # Update task status (saved_to_history already set above)
-                        cursor.execute('''
-                            UPDATE t_p29007832_virtual_fitting_room.nanobananapro_tasks
-                            SET status = 'completed',
-                                result_url = %s,
-                                updated_at = %s
-                            WHERE id = %s
-                        ''', (cdn_url, datetime.utcnow(), stuck_id))
-                        conn.commit()
-                        print(f'[NanoBanana] Stuck task {stuck_id} SAVED!')
-                        
-                    except Exception as save_error:
-                        print(f'[NanoBanana] Failed to save stuck task {stuck_id}: {str(save_error)}')
-                        cursor.execute('''
-                            UPDATE t_p29007832_virtual_fitting_room.nanobananapro_tasks
-                            SET status = 'completed',
-                                result_url = %s,
-                                updated_at = %s
-                            WHERE id = %s
-                        ''', (fal_result_url, datetime.utcnow(), stuck_id))
-                        conn.commit()
-                
-                elif fal_status.upper() in ['FAILED', 'EXPIRED']:
-                    error_msg = f'Ошибка генерации: {str(status_data.get("error", "Generation failed"))[:100]}'
-                    print(f'[NanoBanana] Stuck task {stuck_id} failed')
-                    cursor.execute('''
-                        UPDATE t_p29007832_virtual_fitting_room.nanobananapro_tasks
-                        SET status = 'failed',
-                            error_message = %s,
-                            updated_at = %s
-                        WHERE id = %s
-                    ''', (error_msg, datetime.utcnow(), stuck_id))
-                    conn.commit()
-                    refund_balance_if_needed(conn, stuck_user_id, stuck_id)
-                
-            except Exception as e:
-                error_str = str(e)
-                print(f'[NanoBanana] Error processing stuck task {stuck_id}: {error_str}')
-                try:
-                    age_seconds = (datetime.utcnow() - stuck_created).total_seconds()
-                    if age_seconds > 660:
-                        print(f'[NanoBanana] Stuck task {stuck_id} aged {age_seconds}s, marking failed')
-                        cursor.execute('''
-                            UPDATE t_p29007832_virtual_fitting_room.nanobananapro_tasks
-                            SET status = 'failed', error_message = %s, updated_at = %s
-                            WHERE id = %s AND status = 'processing'
-                        ''', (f'Timeout after {int(age_seconds)}s: {error_str[:100]}', datetime.utcnow(), stuck_id))
-                        conn.commit()
-                        refund_balance_if_needed(conn, stuck_user_id, stuck_id)
-                except Exception as inner_e:
-                    print(f'[NanoBanana] Error in stuck fallback: {str(inner_e)}')
-        
-        # Reset zombie tasks: processing without fal_request_id for >2 minutes
-        try:
-            cursor.execute('''
-                UPDATE t_p29007832_virtual_fitting_room.nanobananapro_tasks
-                SET status = 'pending', updated_at = %s
-                WHERE status = 'processing'
-                  AND fal_request_id IS NULL
-                  AND created_at < NOW() - INTERVAL '2 minutes'
-                RETURNING id
-            ''', (datetime.utcnow(),))
-            zombie_rows = cursor.fetchall()
-            conn.commit()
-            if zombie_rows:
-                zombie_ids = [r[0] for r in zombie_rows]
-                print(f'[NanoBanana] Reset {len(zombie_ids)} zombie tasks back to pending: {zombie_ids}')
-        except Exception as e:
-            print(f'[NanoBanana] Error resetting zombie tasks: {str(e)}')
-        
-        # Pick up orphan pending tasks older than 1 minute (user closed browser)
-        try:
-            cursor.execute('''
-                SELECT id FROM t_p29007832_virtual_fitting_room.nanobananapro_tasks
-                WHERE status = 'pending'
-                  AND fal_request_id IS NULL
-                  AND created_at < NOW() - INTERVAL '1 minute'
-                  AND id != %s
-                ORDER BY created_at ASC
-                LIMIT 1
-            ''', (task_id,))
-            orphan_row = cursor.fetchone()
-            if orphan_row:
-                orphan_id = orphan_row[0]
-                print(f'[NanoBanana] Found orphan pending task {orphan_id}, triggering worker')
-                try:
-                    import urllib.request
-                    worker_url = f'https://functions.poehali.dev/1f4c772e-0425-4fe4-98a6-baa3979ba94d?task_id={orphan_id}'
-                    req = urllib.request.Request(worker_url, method='GET')
-                    urllib.request.urlopen(req, timeout=2)
-                except Exception as trigger_err:
-                    print(f'[NanoBanana] Orphan trigger failed (non-critical): {trigger_err}')
-        except Exception as e:
-            print(f'[NanoBanana] Error checking orphan tasks: {str(e)}')
-        
         cursor.close()
         conn.close()
         
-        print(f'[NanoBanana] Worker finished: main task + {len(stuck_tasks)} stuck tasks processed')
-        
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': get_cors_origin(event), 'Access-Control-Allow-Credentials': 'true'},
             'isBase64Encoded': False,
             'body': json.dumps({
                 'status': 'task_processed', 
-                'task_id': task_id,
-                'stuck_tasks_processed': len(stuck_tasks)
+                'task_id': task_id
             })
         }
         
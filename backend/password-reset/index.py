@@ -5,9 +5,8 @@ import psycopg2
 from psycopg2.extras import RealDictCursor
 from datetime import datetime, timedelta
 import secrets
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+
+from email_outbox import DEFAULT_FROM, enqueue_email, wake_sender
 
 def get_db_connection():
     # Force redeploy v2
@@ -18,19 +17,9 @@ def get_db_connection():
         dsn += '?options=-c%20search_path%3Dt_p29007832_virtual_fitting_room'
     return psycopg2.connect(dsn)
 
-def send_reset_email(email: str, token: str, user_name: str):
-    smtp_host = os.environ.get('SMTP_HOST')
-    smtp_port = int(os.environ.get('SMTP_PORT', '587'))
-    smtp_user = os.environ.get('SMTP_USER')
-    smtp_password = os.environ.get('SMTP_PASSWORD')
-    
+def send_reset_email(cursor, email: str, token: str, user_name: str):
     reset_url = f"https://fitting-room.ru/reset-password?token={token}"
     
-    message = MIMEMultipart('alternative')
-    message['Subject'] = 'Сброс пароля - Виртуальная примерочная'
-    message['From'] = smtp_user
-    message['To'] = email
-    
     text_content = f"""
 Здравствуйте, {user_name}!
 
@@ -76,21 +65,12 @@ def send_reset_email(email: str, token: str, user_name: str):
 </html>
 """
     
-    text_part = MIMEText(text_content, 'plain', 'utf-8')
-    html_part = MIMEText(html_content, 'html', 'utf-8')
-    
-    message.attach(text_part)
-    message.attach(html_part)
-    
-    if smtp_port == 465:
-        with smtplib.SMTP_SSL(smtp_host, smtp_port) as server:
-            server.login(smtp_user, smtp_password)
-            server.send_message(message)
-    else:
-        with smtplib.SMTP(smtp_host, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.send_message(message)
+    # Письмо уходит через очередь email_outbox — запрос не ждёт SMTP
+    enqueue_email(
+        cursor, email, 'Сброс пароля - Виртуальная примерочная',
+        text_content, html_content, source='password-reset',
+        from_addr=os.environ.get('SMTP_USER') or DEFAULT_FROM,
+    )
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -165,9 +145,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     """,
                     (user['id'], token, expires_at)
                 )
+                send_reset_email(cursor, email, token, user['name'])
                 conn.commit()
-                
-                send_reset_email(email, token, user['name'])
+                wake_sender()
                 
                 return {
                     'statusCode': 200,
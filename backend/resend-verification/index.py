@@ -3,9 +3,6 @@ import os
 from typing import Dict, Any
 from datetime import datetime, timedelta
 import secrets
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 
 try:
     import psycopg2
@@ -14,6 +11,8 @@ except ImportError:
     import psycopg2cffi as psycopg2
     from psycopg2cffi.extras import RealDictCursor
 
+from email_outbox import enqueue_email, wake_sender
+
 def get_db_connection():
     # Force redeploy v2
     dsn = os.environ.get('DATABASE_URL')
@@ -23,19 +22,9 @@ def get_db_connection():
         dsn += '?options=-c%20search_path%3Dt_p29007832_virtual_fitting_room'
     return psycopg2.connect(dsn)
 
-def send_verification_email(email: str, token: str, user_name: str):
-    smtp_host = os.environ.get('SMTP_HOST')
-    smtp_port = int(os.environ.get('SMTP_PORT', '587'))
-    smtp_user = os.environ.get('SMTP_USER')
-    smtp_password = os.environ.get('SMTP_PASSWORD')
-    
+def send_verification_email(cursor, email: str, token: str, user_name: str):
     verify_url = f"https://fitting-room.ru/verify-email?token={token}"
     
-    message = MIMEMultipart('alternative')
-    message['Subject'] = 'Подтверждение email - Виртуальная примерочная'
-    message['From'] = 'virtualfitting@mail.ru'
-    message['To'] = email
-    
     text_content = f"""
 Здравствуйте, {user_name}!
 
@@ -75,21 +64,11 @@ def send_verification_email(email: str, token: str, user_name: str):
 </html>
 """
     
-    text_part = MIMEText(text_content, 'plain', 'utf-8')
-    html_part = MIMEText(html_content, 'html', 'utf-8')
-    
-    message.attach(text_part)
-    message.attach(html_part)
-    
-    if smtp_port == 465:
-        with smtplib.SMTP_SSL(smtp_host, smtp_port) as server:
-            server.login(smtp_user, smtp_password)
-            server.send_message(message)
-    else:
-        with smtplib.SMTP(smtp_host, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.send_message(message)
+    # Письмо уходит через очередь email_outbox — запрос не ждёт SMTP
+    enqueue_email(
+        cursor, email, 'Подтверждение email - Виртуальная примерочная',
+        text_content, html_content, source='resend-verification',
+    )
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -221,9 +200,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             (user['id'], verification_token, expires_at)
         )
         
+        send_verification_email(cursor, email, verification_token, user['name'])
         conn.commit()
-        
-        send_verification_email(email, verification_token, user['name'])
+        wake_sender()
         
         return {
             'statusCode': 200,
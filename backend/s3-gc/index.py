@@ -0,0 +1,568 @@
+import json
+import os
+import re
+import time
+import boto3
+import psycopg2
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+S3_BUCKET = os.environ.get('S3_BUCKET_NAME', 'fitting-room-images')
+SCHEMA = 't_p29007832_virtual_fitting_room'
+
+# Файлы моложе этого срока не трогаем: запись в БД могла ещё не появиться
+DEFAULT_GRACE_HOURS = 72
+
+# delete_objects принимает не больше 1000 ключей за вызов
+DELETE_BATCH = 1000
+
+# Сколько строк тянуть из серверного курсора за раз при сборе живых ссылок
+FETCH_BATCH = 2000
+
+# Запас до таймаута функции: по истечении отдаём resume-токен
+TIME_BUDGET_SEC = 240
+
+# Папки с пользовательскими файлами, которые целиком описаны ссылками из БД.
+# Каталог, эталоны цветотипов и прочие статические папки сюда не входят.
+GC_PREFIXES = [
+    'images/lookbooks/',
+    'images/freegeneration/',
+    'images/colortypes/',
+    'images/colorguide/',
+    'images/styleanalysis/',
+]
+
+# Вложенные папки с user_id глубже второго уровня (images/{folder}/{user_id}/ находятся листингом)
+USER_NESTED_PREFIXES = [
+    'images/freegeneration/refs/{user_id}/',
+]
+
+# Задача удаления считается брошенной, если её не обновляли столько минут
+JOB_LOCK_MINUTES = 10
+
+# Все колонки, в которых может лежать ссылка на файл (включая JSON/массивы).
+# Ключи вытаскиваются регуляркой, поэтому колонка может содержать несколько URL.
+LIVE_SOURCES = [
+    f'SELECT result_image FROM {SCHEMA}.try_on_history',
+    f'SELECT result_image FROM {SCHEMA}.freegen_history',
+    f'''SELECT concat_ws(' ', array_to_string(photos, ' '), array_to_string(capsule_photos, ' '),
+                         array_to_string(grid_photos, ' '), template_data)
+        FROM {SCHEMA}.lookbooks''',
+    f'SELECT result_url FROM {SCHEMA}.nanobananapro_tasks WHERE result_url IS NOT NULL',
+    f'''SELECT concat_ws(' ', result_url, "references") FROM {SCHEMA}.freegen_tasks''',
+    f'''SELECT concat_ws(' ', cdn_url, CASE WHEN person_image LIKE 'http%' THEN person_image END)
+        FROM {SCHEMA}.color_type_history''',
+    f'''SELECT concat_ws(' ', cdn_url,
+                         CASE WHEN person_image LIKE 'http%' THEN person_image END,
+                         CASE WHEN partner_image LIKE 'http%' THEN partner_image END,
+                         result_json::text)
+        FROM {SCHEMA}.color_guide_tasks''',
+    f'SELECT image_url FROM {SCHEMA}.user_models',
+    f'SELECT url FROM {SCHEMA}.media_refs WHERE ref_count > 0',
+]
+
+# Ссылки на наш бакет в двух формах: path-style и virtual-host
+S3_URL_RE = re.compile(
+    r'https?://(?:storage\.yandexcloud\.net/' + re.escape(S3_BUCKET) + r'|'
+    + re.escape(S3_BUCKET) + r'\.storage\.yandexcloud\.net)/([^\s"\'<>?#,\\]+)'
+)
+
+
+def get_cors_origin(event: Dict[str, Any]) -> str:
+    origin = event.get('headers', {}).get('origin') or event.get('headers', {}).get('Origin', '')
+    return origin if origin else 'https://fitting-room.ru'
+
+
+def get_s3_client():
+    s3_access_key = os.environ.get('S3_ACCESS_KEY')
+    s3_secret_key = os.environ.get('S3_SECRET_KEY')
+    if not s3_access_key or not s3_secret_key:
+        raise Exception('S3 credentials not configured')
+    return boto3.client(
+        's3',
+        endpoint_url='https://storage.yandexcloud.net',
+        aws_access_key_id=s3_access_key,
+        aws_secret_access_key=s3_secret_key,
+    )
+
+
+def get_db_connection():
+    dsn = os.environ.get('DATABASE_URL')
+    if '?' in dsn:
+        dsn += '&options=-c%20search_path%3Dt_p29007832_virtual_fitting_room'
+    else:
+        dsn += '?options=-c%20search_path%3Dt_p29007832_virtual_fitting_room'
+    return psycopg2.connect(dsn)
+
+
+def extract_s3_keys(text: Optional[str]) -> List[str]:
+    '''Все ключи нашего бакета, упомянутые в тексте (URL, JSON, массив фото).'''
+    if not text or not isinstance(text, str):
+        return []
+    return S3_URL_RE.findall(text)
+
+
+def collect_live_keys(conn) -> Set[str]:
+    '''
+    Mark-фаза: множество ключей, на которые ссылается БД.
+    Каждый источник читается именованным (серверным) курсором порциями по FETCH_BATCH,
+    чтобы не держать в памяти целые таблицы с JSON.
+    '''
+    live: Set[str] = set()
+    for i, sql in enumerate(LIVE_SOURCES):
+        cursor = conn.cursor(name=f'gc_live_{i}')
+        cursor.itersize = FETCH_BATCH
+        cursor.execute(sql)
+        for (value,) in cursor:
+            for key in extract_s3_keys(value):
+                live.add(key)
+        cursor.close()
+    return live
+
+
+def delete_keys_batched(s3, keys: List[str]) -> Tuple[int, List[str]]:
+    '''Удаляет ключи пачками delete_objects по DELETE_BATCH. Возвращает (удалено, ошибки).'''
+    deleted = 0
+    errors: List[str] = []
+    for start in range(0, len(keys), DELETE_BATCH):
+        chunk = keys[start:start + DELETE_BATCH]
+        try:
+            response = s3.delete_objects(
+                Bucket=S3_BUCKET,
+                Delete={'Objects': [{'Key': k} for k in chunk], 'Quiet': True},
+            )
+            failed = response.get('Errors', [])
+            deleted += len(chunk) - len(failed)
+            for err in failed:
+                errors.append(f"{err.get('Key')}: {err.get('Code')}")
+        except Exception as e:
+            errors.append(f'batch {start}: {str(e)[:100]}')
+    return deleted, errors
+
+
+def clear_orphan_refs(conn, s3, live: Set[str], marked_at, grace_hours: int,
+                      dry_run: bool) -> Tuple[int, int, List[str]]:
+    '''
+    Разбор очереди media_refs (ref_count = 0) после полного прохода.
+    Файлы под GC_PREFIXES проход уже удалил или пропустил как живые — их строки
+    просто снимаются. Файлы вне GC_PREFIXES листинг не видит: их удаляем здесь,
+    если ссылка осиротела дольше grace_hours и ключ не живой, и только потом
+    снимаем строку (при ошибке удаления строка остаётся до следующего прохода).
+    Возвращает (снято строк, удалено файлов вне префиксов, ошибки).
+    '''
+    cursor = conn.cursor()
+    cursor.execute(
+        f'''SELECT url, orphaned_at < %s - make_interval(hours => %s)
+            FROM {SCHEMA}.media_refs
+            WHERE ref_count = 0 AND orphaned_at < %s''',
+        (marked_at, grace_hours, marked_at)
+    )
+    rows = cursor.fetchall()
+
+    clear_urls: List[str] = []
+    outside: List[Tuple[str, List[str]]] = []
+    for url, aged in rows:
+        keys = [k for k in extract_s3_keys(url) if k not in live]
+        if all(k.startswith(tuple(GC_PREFIXES)) for k in keys):
+            clear_urls.append(url)
+        elif aged:
+            outside.append((url, keys))
+
+    deleted = 0
+    errors: List[str] = []
+    if not dry_run:
+        for start in range(0, len(outside), DELETE_BATCH):
+            chunk = outside[start:start + DELETE_BATCH]
+            chunk_deleted, chunk_errors = delete_keys_batched(s3, [k for _, keys in chunk for k in keys])
+            deleted += chunk_deleted
+            errors.extend(chunk_errors)
+            failed_keys = {e.split(':', 1)[0] for e in chunk_errors}
+            if any(e.startswith('batch ') for e in chunk_errors):
+                continue
+            clear_urls.extend(url for url, keys in chunk if not failed_keys.intersection(keys))
+
+        cursor.execute(
+            f'DELETE FROM {SCHEMA}.media_refs WHERE url = ANY(%s) AND ref_count = 0',
+            (clear_urls,)
+        )
+        cleared = cursor.rowcount
+        conn.commit()
+    else:
+        cleared = len(clear_urls) + len(outside)
+        deleted = sum(len(keys) for _, keys in outside)
+    cursor.close()
+    return cleared, deleted, errors
+
+
+def sweep(grace_hours: int, dry_run: bool, resume: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    '''
+    Mark-and-sweep по GC_PREFIXES: листинг бакета постранично, удаление
+    объектов без ссылок в БД старше grace_hours. При нехватке времени
+    возвращает resume — с него продолжит следующий вызов.
+    '''
+    started = time.time()
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT NOW()')
+        marked_at = cursor.fetchone()[0]
+        cursor.close()
+
+        live = collect_live_keys(conn)
+        s3 = get_s3_client()
+        cutoff = started - grace_hours * 3600
+
+        prefix_index = int((resume or {}).get('prefix_index') or 0)
+        continuation = (resume or {}).get('continuation')
+
+        report: Dict[str, Any] = {
+            'live_keys': len(live),
+            'scanned': 0,
+            'skipped_live': 0,
+            'candidates': 0,
+            'candidate_bytes': 0,
+            'deleted': 0,
+            'by_prefix': {},
+            'sample': [],
+            'errors_sample': [],
+        }
+        errors: List[str] = []
+        pending: List[str] = []
+        next_resume = None
+
+        while prefix_index < len(GC_PREFIXES):
+            prefix = GC_PREFIXES[prefix_index]
+            stats = report['by_prefix'].setdefault(prefix, {'scanned': 0, 'skipped_live': 0, 'candidates': 0, 'bytes': 0})
+            list_params = {'Bucket': S3_BUCKET, 'Prefix': prefix, 'MaxKeys': DELETE_BATCH}
+            if continuation:
+                list_params['ContinuationToken'] = continuation
+            page = s3.list_objects_v2(**list_params)
+
+            for obj in page.get('Contents', []):
+                key = obj['Key']
+                report['scanned'] += 1
+                stats['scanned'] += 1
+                if key in live:
+                    report['skipped_live'] += 1
+                    stats['skipped_live'] += 1
+                    continue
+                last_modified = obj.get('LastModified')
+                if last_modified is not None and last_modified.timestamp() > cutoff:
+                    continue
+                report['candidates'] += 1
+                report['candidate_bytes'] += int(obj.get('Size') or 0)
+                stats['candidates'] += 1
+                stats['bytes'] += int(obj.get('Size') or 0)
+                if len(report['sample']) < 20:
+                    report['sample'].append(key)
+                if not dry_run:
+                    pending.append(key)
+
+            if not dry_run and len(pending) >= DELETE_BATCH:
+                deleted, batch_errors = delete_keys_batched(s3, pending)
+                report['deleted'] += deleted
+                errors.extend(batch_errors)
+                pending = []
+
+            if page.get('IsTruncated'):
+                continuation = page.get('NextContinuationToken')
+            else:
+                prefix_index += 1
+                continuation = None
+
+            if time.time() - started > TIME_BUDGET_SEC and prefix_index < len(GC_PREFIXES):
+                next_resume = {'prefix_index': prefix_index, 'continuation': continuation}
+                break
+
+        if not dry_run and pending:
+            deleted, batch_errors = delete_keys_batched(s3, pending)
+            report['deleted'] += deleted
+            errors.extend(batch_errors)
+
+        # Очередь из media_refs (ref_count = 0) закрыта этим проходом
+        if next_resume is None:
+            cleared, outside_deleted, outside_errors = clear_orphan_refs(
+                conn, s3, live, marked_at, grace_hours, dry_run
+            )
+            report['orphan_refs_cleared'] = cleared
+            report['orphan_outside_deleted'] = outside_deleted
+            errors.extend(outside_errors)
+
+        report['errors_count'] = len(errors)
+        report['errors_sample'] = errors[:10]
+        report['resume'] = next_resume
+        report['elapsed_sec'] = round(time.time() - started, 1)
+        return report
+    finally:
+        conn.close()
+
+
+def build_user_prefixes(s3, user_id: str) -> List[str]:
+    '''
+    Префиксы, под которыми лежат файлы пользователя: images/{folder}/{user_id}/
+    для каждой папки верхнего уровня (один листинг с Delimiter) + вложенные.
+    '''
+    folders: List[str] = []
+    continuation = None
+    while True:
+        list_params = {'Bucket': S3_BUCKET, 'Prefix': 'images/', 'Delimiter': '/'}
+        if continuation:
+            list_params['ContinuationToken'] = continuation
+        page = s3.list_objects_v2(**list_params)
+        folders.extend(cp['Prefix'] for cp in page.get('CommonPrefixes', []))
+        if not page.get('IsTruncated'):
+            break
+        continuation = page.get('NextContinuationToken')
+    prefixes = [f'{folder}{user_id}/' for folder in folders]
+    prefixes.extend(t.format(user_id=user_id) for t in USER_NESTED_PREFIXES)
+    return prefixes
+
+
+def process_user_job(conn, s3, job: Dict[str, Any], deadline: float) -> bool:
+    '''
+    Удаляет файлы одного пользователя постранично. После каждой страницы
+    сохраняет позицию в s3_deletion_jobs. Возвращает True, если задача завершена.
+    '''
+    job_id = job['id']
+    user_id = str(job['user_id'])
+    cursor = conn.cursor()
+
+    prefixes = job.get('prefixes')
+    if isinstance(prefixes, str):
+        prefixes = json.loads(prefixes)
+    if not prefixes:
+        prefixes = build_user_prefixes(s3, user_id)
+        cursor.execute(
+            f'''UPDATE {SCHEMA}.s3_deletion_jobs
+                SET prefixes = %s, prefix_index = 0, continuation = NULL, updated_at = NOW()
+                WHERE id = %s''',
+            (json.dumps(prefixes), job_id)
+        )
+        conn.commit()
+
+    prefix_index = int(job.get('prefix_index') or 0)
+    continuation = job.get('continuation')
+
+    while prefix_index < len(prefixes):
+        if time.time() > deadline:
+            cursor.close()
+            return False
+        list_params = {'Bucket': S3_BUCKET, 'Prefix': prefixes[prefix_index], 'MaxKeys': DELETE_BATCH}
+        if continuation:
+            list_params['ContinuationToken'] = continuation
+        page = s3.list_objects_v2(**list_params)
+        keys = [obj['Key'] for obj in page.get('Contents', [])]
+        deleted, errors = delete_keys_batched(s3, keys)
+        if errors:
+            print(f'[S3-GC] job {job_id}: {len(errors)} delete errors, e.g. {errors[0]}')
+
+        if page.get('IsTruncated'):
+            continuation = page.get('NextContinuationToken')
+        else:
+            prefix_index += 1
+            continuation = None
+
+        cursor.execute(
+            f'''UPDATE {SCHEMA}.s3_deletion_jobs
+                SET prefix_index = %s, continuation = %s, deleted_count = deleted_count + %s,
+                    locked_at = NOW(), updated_at = NOW()
+                WHERE id = %s''',
+            (prefix_index, continuation, deleted, job_id)
+        )
+        conn.commit()
+
+    # Файлы вне пользовательских папок, известные по media_refs
+    cursor.execute(f'SELECT url FROM {SCHEMA}.media_refs WHERE user_id = %s', (user_id,))
+    extra_keys = [k for (url,) in cursor.fetchall() for k in extract_s3_keys(url)]
+    deleted, _ = delete_keys_batched(s3, extra_keys)
+    cursor.execute(f'DELETE FROM {SCHEMA}.media_refs WHERE user_id = %s', (user_id,))
+    cursor.execute(
+        f'''UPDATE {SCHEMA}.s3_deletion_jobs
+            SET status = 'done', deleted_count = deleted_count + %s,
+                locked_at = NULL, finished_at = NOW(), updated_at = NOW()
+            WHERE id = %s''',
+        (deleted, job_id)
+    )
+    conn.commit()
+    cursor.close()
+    return True
+
+
+def process_user_jobs() -> Dict[str, Any]:
+    '''
+    Обрабатывает очередь s3_deletion_jobs до исчерпания TIME_BUDGET_SEC.
+    Задача захватывается через SKIP LOCKED + locked_at, так что параллельный
+    вызов её не возьмёт, а оборванная освободится через JOB_LOCK_MINUTES.
+    '''
+    started = time.time()
+    deadline = started + TIME_BUDGET_SEC
+    conn = get_db_connection()
+    s3 = get_s3_client()
+    done = 0
+    paused = 0
+    failed = 0
+    try:
+        while time.time() < deadline:
+            cursor = conn.cursor()
+            cursor.execute(
+                f'''UPDATE {SCHEMA}.s3_deletion_jobs
+                    SET status = 'processing', locked_at = NOW(), attempts = attempts + 1, updated_at = NOW()
+                    WHERE id = (
+                        SELECT id FROM {SCHEMA}.s3_deletion_jobs
+                        WHERE status IN ('pending', 'processing')
+                          AND (locked_at IS NULL OR locked_at < NOW() - INTERVAL '{JOB_LOCK_MINUTES} minutes')
+                        ORDER BY created_at
+                        LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, user_id, prefixes, prefix_index, continuation'''
+            )
+            row = cursor.fetchone()
+            conn.commit()
+            cursor.close()
+            if not row:
+                break
+            job = dict(zip(['id', 'user_id', 'prefixes', 'prefix_index', 'continuation'], row))
+            try:
+                if process_user_job(conn, s3, job, deadline):
+                    done += 1
+                else:
+                    paused += 1
+                    # Освобождаем замок: следующий вызов продолжит с сохранённой позиции
+                    cursor = conn.cursor()
+                    cursor.execute(
+                        f'UPDATE {SCHEMA}.s3_deletion_jobs SET locked_at = NULL WHERE id = %s',
+                        (job['id'],)
+                    )
+                    conn.commit()
+                    cursor.close()
+                    break
+            except Exception as e:
+                conn.rollback()
+                failed += 1
+                print(f"[S3-GC] job {job['id']} failed: {e}")
+                cursor = conn.cursor()
+                cursor.execute(
+                    f'''UPDATE {SCHEMA}.s3_deletion_jobs
+                        SET error_message = %s, locked_at = NULL, updated_at = NOW(),
+                            status = CASE WHEN attempts >= 5 THEN 'failed' ELSE status END
+                        WHERE id = %s''',
+                    (str(e)[:500], job['id'])
+                )
+                conn.commit()
+                cursor.close()
+    finally:
+        conn.close()
+    return {
+        'jobs_done': done,
+        'jobs_paused': paused,
+        'jobs_failed': failed,
+        'elapsed_sec': round(time.time() - started, 1),
+    }
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Сборщик мусора S3 (mark-and-sweep). Удаляет файлы пользовательских папок,
+              на которые нет ссылок в БД, пачками delete_objects. По умолчанию dry-run.
+              mode=user_jobs — обработка очереди удаления файлов удалённых аккаунтов.
+    Args: event - dict с httpMethod, queryStringParameters {mode, dry_run, grace_hours, resume, system_token}
+          context - объект с request_id
+    Returns: HTTP-ответ с отчётом (кандидаты, объём, удалено, resume для продолжения)
+    '''
+    method = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': get_cors_origin(event),
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-System-Token',
+                'Access-Control-Max-Age': '86400',
+            },
+            'body': '',
+        }
+
+    params = event.get('queryStringParameters') or {}
+
+    # Авторизация как у freegen-cleanup: системный токен (JWT_SECRET_KEY) для крона
+    headers = event.get('headers', {})
+    provided_token = (
+        headers.get('x-system-token')
+        or headers.get('X-System-Token')
+        or params.get('system_token')
+    )
+    expected = os.environ.get('JWT_SECRET_KEY')
+
+    if not expected or provided_token != expected:
+        return {
+            'statusCode': 401,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': get_cors_origin(event),
+            },
+            'isBase64Encoded': False,
+            'body': json.dumps({'error': 'Unauthorized'}),
+        }
+
+    if params.get('mode') == 'user_jobs':
+        try:
+            result = process_user_jobs()
+            print(f"[S3-GC] user_jobs done={result['jobs_done']} paused={result['jobs_paused']} failed={result['jobs_failed']}")
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': get_cors_origin(event),
+                },
+                'isBase64Encoded': False,
+                'body': json.dumps({'ok': True, **result}),
+            }
+        except Exception as e:
+            return {
+                'statusCode': 500,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': get_cors_origin(event),
+                },
+                'isBase64Encoded': False,
+                'body': json.dumps({'error': f'User jobs failed: {str(e)}'}),
+            }
+
+    # Удаление только по явному dry_run=0
+    dry_run = str(params.get('dry_run', '1')).lower() not in ('0', 'false', 'no')
+    try:
+        grace_hours = int(params.get('grace_hours') or DEFAULT_GRACE_HOURS)
+    except (ValueError, TypeError):
+        grace_hours = DEFAULT_GRACE_HOURS
+    grace_hours = max(grace_hours, 24)
+
+    resume = None
+    if params.get('resume'):
+        try:
+            resume = json.loads(params['resume'])
+        except Exception:
+            resume = None
+
+    try:
+        report = sweep(grace_hours, dry_run, resume)
+        print(f"[S3-GC] dry_run={dry_run} scanned={report['scanned']} skipped_live={report['skipped_live']} candidates={report['candidates']} deleted={report['deleted']}")
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': get_cors_origin(event),
+            },
+            'isBase64Encoded': False,
+            'body': json.dumps({'ok': True, 'dry_run': dry_run, 'grace_hours': grace_hours, **report}),
+        }
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': get_cors_origin(event),
+            },
+            'isBase64Encoded': False,
+            'body': json.dumps({'error': f'GC failed: {str(e)}'}),
+        }
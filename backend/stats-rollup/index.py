@@ -0,0 +1,232 @@
+import json
+import os
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from datetime import date, datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple
+
+from daily_stats import STAT_COLUMNS, missing_days, rollup_days, stats_by_day
+
+# Самопроверка (?selftest=1): смена статуса у старой строки, которую
+# RECOMPUTE_DAYS уже не пересчитывает, должна сбросить свёрнутый день
+# (триггер invalidate_daily_stats_row), а пересвёртка — совпасть с живым
+# подсчётом. Идёт в одной транзакции и всегда откатывается.
+SELFTEST_FLIPS = [
+    ('payment_transactions', "CASE WHEN status = 'completed' THEN 'pending' ELSE 'completed' END"),
+    ('color_type_history', "CASE WHEN status = 'completed' THEN 'failed' ELSE 'completed' END"),
+]
+
+# Сколько последних свёрнутых дней пересчитывать заново (поздние смены статусов платежей/анализов)
+RECOMPUTE_DAYS = 2
+
+
+def get_cors_origin(event: Dict[str, Any]) -> str:
+    origin = event.get('headers', {}).get('origin') or event.get('headers', {}).get('Origin', '')
+    return origin if origin else 'https://fitting-room.ru'
+
+
+def get_db_connection():
+    dsn = os.environ.get('DATABASE_URL')
+    if '?' in dsn:
+        dsn += '&options=-c%20search_path%3Dt_p29007832_virtual_fitting_room'
+    else:
+        dsn += '?options=-c%20search_path%3Dt_p29007832_virtual_fitting_room'
+    return psycopg2.connect(dsn)
+
+
+def first_activity_day(cursor) -> Optional[date]:
+    '''Самый ранний день, с которого есть данные в таблицах-источниках.'''
+    cursor.execute('''
+        SELECT LEAST(
+            (SELECT MIN(created_at) FROM try_on_history),
+            (SELECT MIN(created_at) FROM payment_transactions),
+            (SELECT MIN(created_at) FROM color_type_history),
+            (SELECT MIN(created_at) FROM balance_transactions)
+        )::date AS day
+    ''')
+    return cursor.fetchone()['day']
+
+
+def run_rollup(today: date) -> Tuple[Optional[date], int]:
+    '''
+    Досчитывает daily_stats до вчерашнего дня включительно и заново
+    записывает дни, сброшенные удалением строк-источников.
+    Возвращает (первый пересчитанный день, число записанных дней).
+    '''
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        # Сброшенные дни пересчитываем одним диапазоном (соседние дни просто перезапишутся)
+        holes = missing_days(cursor)
+        refilled = rollup_days(cursor, holes[0], holes[-1] + timedelta(days=1)) if holes else 0
+
+        cursor.execute('SELECT MAX(day) AS last_day FROM daily_stats')
+        last_day = cursor.fetchone()['last_day']
+
+        if last_day:
+            start = min(last_day - timedelta(days=RECOMPUTE_DAYS - 1), today - timedelta(days=RECOMPUTE_DAYS))
+        else:
+            start = first_activity_day(cursor)
+
+        if not start or start >= today:
+            conn.commit()
+            return (None, refilled)
+
+        written = rollup_days(cursor, start, today)
+        conn.commit()
+        return (start, refilled + written)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def run_selftest(today: date) -> List[Dict[str, Any]]:
+    '''
+    Для каждой таблицы из SELFTEST_FLIPS: берёт самую свежую строку в уже
+    свёрнутом дне старше окна RECOMPUTE_DAYS, меняет ей статус, проверяет,
+    что день сброшен, сворачивает его заново и сверяет с живым подсчётом.
+    Все изменения откатываются.
+    '''
+    conn = get_db_connection()
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    results: List[Dict[str, Any]] = []
+    try:
+        before = datetime.combine(today - timedelta(days=RECOMPUTE_DAYS), datetime.min.time())
+        for table, flip in SELFTEST_FLIPS:
+            cursor.execute(
+                f'''SELECT t.id, t.created_at::date AS day
+                    FROM {table} t
+                    WHERE t.created_at < %s
+                      AND EXISTS (SELECT 1 FROM daily_stats d WHERE d.day = t.created_at::date)
+                    ORDER BY t.created_at DESC
+                    LIMIT 1''',
+                (before,)
+            )
+            row = cursor.fetchone()
+            if not row:
+                results.append({'table': table, 'skipped': True})
+                continue
+            day = row['day']
+
+            cursor.execute(f'UPDATE {table} SET status = {flip} WHERE id = %s', (row['id'],))
+            cursor.execute('SELECT 1 FROM daily_stats WHERE day = %s', (day,))
+            invalidated = cursor.fetchone() is None
+
+            next_day = day + timedelta(days=1)
+            rollup_days(cursor, day, next_day)
+            cursor.execute('SELECT * FROM daily_stats WHERE day = %s', (day,))
+            stored = cursor.fetchone()
+            live = stats_by_day(cursor, day, next_day).get(day, {})
+            mismatched = [
+                col for col in STAT_COLUMNS
+                if stored is None or float(stored[col] or 0) != float(live.get(col) or 0)
+            ]
+            results.append({
+                'table': table,
+                'day': day.isoformat(),
+                'invalidated': invalidated,
+                'mismatched': mismatched,
+                'passed': invalidated and not mismatched,
+            })
+    finally:
+        conn.rollback()
+        cursor.close()
+        conn.close()
+    return results
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Свёртка дневной статистики админки в daily_stats. Вызывается по расписанию (раз в день или чаще).
+    Args: event - dict с httpMethod, headers {X-System-Token}
+          context - объект с request_id
+    Returns: HTTP-ответ с диапазоном пересчитанных дней
+    '''
+    method = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': get_cors_origin(event),
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-System-Token',
+                'Access-Control-Max-Age': '86400',
+            },
+            'body': '',
+        }
+
+    params = event.get('queryStringParameters') or {}
+
+    # Проверка авторизации: системный токен через JWT_SECRET_KEY (для крона)
+    headers = event.get('headers', {})
+    provided_token = (
+        headers.get('x-system-token')
+        or headers.get('X-System-Token')
+        or params.get('system_token')
+    )
+    expected = os.environ.get('JWT_SECRET_KEY')
+
+    if not expected or provided_token != expected:
+        return {
+            'statusCode': 401,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': get_cors_origin(event),
+            },
+            'isBase64Encoded': False,
+            'body': json.dumps({'error': 'Unauthorized'}),
+        }
+
+    if params.get('selftest') == '1':
+        try:
+            checks = run_selftest(datetime.now().date())
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': get_cors_origin(event),
+                },
+                'isBase64Encoded': False,
+                'body': json.dumps({
+                    'ok': all(c.get('passed', True) for c in checks),
+                    'checks': checks,
+                }),
+            }
+        except Exception as e:
+            return {
+                'statusCode': 500,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': get_cors_origin(event),
+                },
+                'isBase64Encoded': False,
+                'body': json.dumps({'error': f'Selftest failed: {str(e)}'}),
+            }
+
+    try:
+        start, days_written = run_rollup(datetime.now().date())
+
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': get_cors_origin(event),
+            },
+            'isBase64Encoded': False,
+            'body': json.dumps({
+                'ok': True,
+                'from_day': start.isoformat() if start else None,
+                'days_written': days_written,
+            }),
+        }
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': get_cors_origin(event),
+            },
+            'isBase64Encoded': False,
+            'body': json.dumps({'error': f'Rollup failed: {str(e)}'}),
+        }
@@ -0,0 +1,209 @@
+import json
+import os
+import urllib.request
+import psycopg2
+from typing import Dict, Any, List
+
+from queue_guard import count_global_active, GLOBAL_CONCURRENCY
+
+# Pending-задача без воркера дольше этого срока считается брошенной (клиент закрыл вкладку)
+ORPHAN_AGE = '1 minute'
+
+# Воркеры с режимом sweep и проверка «есть ли что разбирать» — те же условия,
+# что у самого воркера, по частичным индексам (status, created_at) на pending/processing.
+# colorguide добирает результат fal и у failed-задач — для него отдельный
+# индекс idx_color_guide_tasks_recovery (V0119).
+SWEEP_TARGETS = [
+    {
+        'service': 'tryon',
+        'url': 'https://functions.poehali.dev/1f4c772e-0425-4fe4-98a6-baa3979ba94d',
+        'probe': '''
+            SELECT EXISTS (
+                SELECT 1 FROM nanobananapro_tasks
+                WHERE status = 'processing'
+                  AND ((fal_response_url IS NOT NULL AND updated_at < NOW() - INTERVAL '3 minutes')
+                       OR (fal_request_id IS NULL AND created_at < NOW() - INTERVAL '2 minutes'))
+            )''',
+    },
+    {
+        'service': 'freegen',
+        'url': 'https://functions.poehali.dev/8b34e115-88be-4740-887a-36c388980955',
+        'probe': '''
+            SELECT EXISTS (
+                SELECT 1 FROM freegen_tasks
+                WHERE status = 'processing'
+                  AND fal_response_url IS NOT NULL
+                  AND updated_at < NOW() - INTERVAL '3 minutes'
+            )''',
+    },
+    {
+        'service': 'colorguide',
+        'url': 'https://functions.poehali.dev/12f108e3-fe83-4618-9e8b-48411bb69390',
+        'probe': '''
+            SELECT EXISTS (
+                SELECT 1 FROM color_guide_tasks
+                WHERE status IN ('pending', 'processing', 'failed')
+                  AND fal_response_url IS NOT NULL
+                  AND COALESCE(recovery_done, FALSE) = FALSE
+                  AND created_at < NOW() - INTERVAL '3 minutes'
+                  AND created_at > NOW() - INTERVAL '24 hours'
+            )''',
+    },
+    {
+        'service': 'colortype',
+        'url': 'https://functions.poehali.dev/c13ce63e-ae23-419d-84f1-b6958e4ea586',
+        'probe': '''
+            SELECT EXISTS (
+                SELECT 1 FROM color_type_history
+                WHERE status = 'processing'
+                  AND replicate_prediction_id IS NULL
+                  AND created_at < NOW() - INTERVAL '3 minutes'
+            )''',
+    },
+]
+
+# Брошенные pending-задачи общей очереди nanobanana2 — самые старые первыми
+ORPHANS_SQL = f'''
+    SELECT service, id FROM (
+        SELECT 'tryon' AS service, id, created_at FROM nanobananapro_tasks
+        WHERE status = 'pending' AND fal_request_id IS NULL
+          AND created_at < NOW() - INTERVAL '{ORPHAN_AGE}'
+        UNION ALL
+        SELECT 'freegen', id, created_at FROM freegen_tasks
+        WHERE status = 'pending' AND fal_request_id IS NULL
+          AND created_at < NOW() - INTERVAL '{ORPHAN_AGE}'
+        UNION ALL
+        SELECT 'colorguide', id, created_at FROM color_guide_tasks
+        WHERE status = 'pending'
+          AND created_at < NOW() - INTERVAL '{ORPHAN_AGE}'
+    ) pending
+    ORDER BY created_at ASC
+    LIMIT %s
+'''
+
+
+def get_cors_origin(event: Dict[str, Any]) -> str:
+    origin = event.get('headers', {}).get('origin') or event.get('headers', {}).get('Origin', '')
+    return origin if origin else 'https://fitting-room.ru'
+
+
+def get_db_connection():
+    dsn = os.environ.get('DATABASE_URL')
+    if '?' in dsn:
+        dsn += '&options=-c%20search_path%3Dt_p29007832_virtual_fitting_room'
+    else:
+        dsn += '?options=-c%20search_path%3Dt_p29007832_virtual_fitting_room'
+    return psycopg2.connect(dsn)
+
+
+def trigger_worker(url: str, system_token: str = None) -> bool:
+    '''Вызов воркера без ожидания результата (как триггеры в start-функциях).'''
+    headers = {'X-System-Token': system_token} if system_token else {}
+    try:
+        req = urllib.request.Request(url, headers=headers, method='GET')
+        urllib.request.urlopen(req, timeout=2)
+    except Exception as e:
+        # Таймаут ожидаем: воркер продолжает работу после обрыва соединения
+        if 'timed out' not in str(e):
+            print(f'[TaskSweeper] Trigger {url} failed: {e}')
+            return False
+    return True
+
+
+def run_sweep(system_token: str) -> Dict[str, Any]:
+    '''
+    Один проход: запускает sweep у воркеров, где есть зависшие задачи,
+    и будит брошенные pending-задачи очереди на число свободных слотов.
+    '''
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        swept: List[str] = []
+        for target in SWEEP_TARGETS:
+            cursor.execute(target['probe'])
+            if cursor.fetchone()[0]:
+                if trigger_worker(f"{target['url']}?sweep=1", system_token):
+                    swept.append(target['service'])
+
+        active = count_global_active(cursor)
+        free_slots = max(0, GLOBAL_CONCURRENCY - active)
+        woken: List[str] = []
+        if free_slots:
+            cursor.execute(ORPHANS_SQL, (free_slots,))
+            urls = {t['service']: t['url'] for t in SWEEP_TARGETS}
+            for service, task_id in cursor.fetchall():
+                if trigger_worker(f'{urls[service]}?task_id={task_id}'):
+                    woken.append(str(task_id))
+    finally:
+        cursor.close()
+        conn.close()
+
+    print(f'[TaskSweeper] swept={swept} active={active} woken={woken}')
+    return {'swept': swept, 'active': active, 'woken': woken}
+
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Единый подметальщик задач: добивание зависших, возвраты и пробуждение очереди пачкой. Вызывается по расписанию (раз в минуту).
+    Args: event - dict с httpMethod, headers {X-System-Token}
+          context - объект с request_id
+    Returns: HTTP-ответ со списком обработанных сервисов и разбуженных задач
+    '''
+    method = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': get_cors_origin(event),
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-System-Token',
+                'Access-Control-Max-Age': '86400',
+            },
+            'body': '',
+        }
+
+    params = event.get('queryStringParameters') or {}
+
+    # Проверка авторизации: системный токен через JWT_SECRET_KEY (для крона)
+    headers = event.get('headers', {})
+    provided_token = (
+        headers.get('x-system-token')
+        or headers.get('X-System-Token')
+        or params.get('system_token')
+    )
+    expected = os.environ.get('JWT_SECRET_KEY')
+
+    if not expected or provided_token != expected:
+        return {
+            'statusCode': 401,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': get_cors_origin(event),
+            },
+            'isBase64Encoded': False,
+            'body': json.dumps({'error': 'Unauthorized'}),
+        }
+
+    try:
+        result = run_sweep(expected)
+
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': get_cors_origin(event),
+            },
+            'isBase64Encoded': False,
+            'body': json.dumps({'ok': True, **result}),
+        }
+    except Exception as e:
+        return {
+            'statusCode': 500,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': get_cors_origin(event),
+            },
+            'isBase64Encoded': False,
+            'body': json.dumps({'error': f'Sweep failed: {str(e)}'}),
+        }
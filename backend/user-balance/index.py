@@ -9,6 +9,7 @@ import os
 import psycopg2
 from typing import Dict, Any
 from session_utils import validate_session
+from balance_ledger import charge, refund
 
 GENERATION_COST = 50
 COLORTYPE_COST = 50
@@ -90,40 +91,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 generation_type = body_data.get('generation_type', 'try_on')
                 generation_id = body_data.get('generation_id')
                 
-                cur.execute('''
-                    SELECT balance, unlimited_access 
-                    FROM t_p29007832_virtual_fitting_room.users 
-                    WHERE id = %s
-                ''', (user_id,))
-                
-                result = cur.fetchone()
+                service_name = 'Виртуальная примерочная' if generation_type == 'try_on' else 'Определение цветотипа'
+                # Проверка баланса, списание и запись в журнал — один запрос
+                result = charge(
+                    cur, user_id, total_cost, service_name,
+                    unlimited_description=f'{service_name} (безлимитный доступ)',
+                    try_on_id=generation_id if generation_type == 'try_on' else None,
+                    color_type_id=generation_id if generation_type == 'color_type' else None,
+                )
                 if not result:
                     return {
                         'statusCode': 404,
                         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': get_cors_origin(event), 'Access-Control-Allow-Credentials': 'true'},
                         'body': json.dumps({'error': 'Пользователь не найден'})
                     }
-                
-                balance, unlimited_access = result
-                balance_before = float(balance)
-                
-                if unlimited_access:
-                    description = f'{"Виртуальная примерочная" if generation_type == "try_on" else "Определение цветотипа"} (безлимитный доступ)'
-                    
-                    cur.execute('''
-                        INSERT INTO t_p29007832_virtual_fitting_room.balance_transactions
-                        (user_id, type, amount, balance_before, balance_after, description, try_on_id, color_type_id)
-                        VALUES (%s, 'charge', 0, %s, %s, %s, %s, %s)
-                    ''', (
-                        user_id, 
-                        balance_before, 
-                        balance_before, 
-                        description,
-                        generation_id if generation_type == 'try_on' else None,
-                        generation_id if generation_type == 'color_type' else None
-                    ))
-                    conn.commit()
-                    
+                conn.commit()
+
+                if result['unlimited']:
                     return {
                         'statusCode': 200,
                         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': get_cors_origin(event), 'Access-Control-Allow-Credentials': 'true'},
@@ -133,54 +117,29 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                             'message': 'Безлимитный доступ'
                         })
                     }
-                
-                if balance >= total_cost:
-                    balance_after = balance_before - total_cost
-                    description = 'Виртуальная примерочная' if generation_type == 'try_on' else 'Определение цветотипа'
-                    
-                    cur.execute('''
-                        UPDATE t_p29007832_virtual_fitting_room.users 
-                        SET balance = balance - %s, updated_at = CURRENT_TIMESTAMP
-                        WHERE id = %s
-                    ''', (total_cost, user_id))
-                    
-                    cur.execute('''
-                        INSERT INTO t_p29007832_virtual_fitting_room.balance_transactions
-                        (user_id, type, amount, balance_before, balance_after, description, try_on_id, color_type_id)
-                        VALUES (%s, 'charge', %s, %s, %s, %s, %s, %s)
-                    ''', (
-                        user_id, 
-                        -total_cost,
-                        balance_before, 
-                        balance_after, 
-                        description,
-                        generation_id if generation_type == 'try_on' else None,
-                        generation_id if generation_type == 'color_type' else None
-                    ))
-                    
-                    conn.commit()
-                    
+
+                if result['done']:
                     return {
                         'statusCode': 200,
                         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': get_cors_origin(event), 'Access-Control-Allow-Credentials': 'true'},
                         'body': json.dumps({
                             'success': True,
                             'paid_try': True,
-                            'new_balance': balance_after,
+                            'new_balance': result['balance_after'],
                             'cost': total_cost
                         })
                     }
-                
+
                 return {
                     'statusCode': 402,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': get_cors_origin(event), 'Access-Control-Allow-Credentials': 'true'},
                     'body': json.dumps({
                         'error': 'Недостаточно средств',
-                        'balance': balance_before,
+                        'balance': result['balance_before'],
                         'required': total_cost
                     })
                 }
-            
+
             elif action == 'refund':
                 cost_per_step = GENERATION_COST
                 total_refund = cost_per_step
@@ -188,24 +147,22 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 generation_id = body_data.get('generation_id')
                 reason = body_data.get('reason', 'Технический сбой')
                 
-                cur.execute('''
-                    SELECT balance, unlimited_access 
-                    FROM t_p29007832_virtual_fitting_room.users 
-                    WHERE id = %s
-                ''', (user_id,))
-                
-                result = cur.fetchone()
+                service_name = 'примерочной' if generation_type == 'try_on' else 'цветотипа'
+                # Возврат и запись в журнал — один запрос; безлимитным возвращать нечего
+                result = refund(
+                    cur, user_id, total_refund, f'Возврат: {reason} {service_name}',
+                    try_on_id=generation_id if generation_type == 'try_on' else None,
+                    color_type_id=generation_id if generation_type == 'color_type' else None,
+                )
                 if not result:
                     return {
                         'statusCode': 404,
                         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': get_cors_origin(event), 'Access-Control-Allow-Credentials': 'true'},
                         'body': json.dumps({'error': 'Пользователь не найден'})
                     }
-                
-                balance, unlimited_access = result
-                balance_before = float(balance)
-                
-                if unlimited_access:
+                conn.commit()
+
+                if result['unlimited']:
                     return {
                         'statusCode': 200,
                         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': get_cors_origin(event), 'Access-Control-Allow-Credentials': 'true'},
@@ -215,33 +172,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                             'message': 'Безлимитный пользователь - возврат не требуется'
                         })
                     }
-                
-                balance_after = balance_before + total_refund
-                service_name = 'примерочной' if generation_type == 'try_on' else 'цветотипа'
-                description = f'Возврат: {reason} {service_name}'
-                
-                cur.execute('''
-                    UPDATE t_p29007832_virtual_fitting_room.users 
-                    SET balance = balance + %s, updated_at = CURRENT_TIMESTAMP
-                    WHERE id = %s
-                ''', (total_refund, user_id))
-                
-                cur.execute('''
-                    INSERT INTO t_p29007832_virtual_fitting_room.balance_transactions
-                    (user_id, type, amount, balance_before, balance_after, description, try_on_id, color_type_id)
-                    VALUES (%s, 'refund', %s, %s, %s, %s, %s, %s)
-                ''', (
-                    user_id, 
-                    total_refund,
-                    balance_before, 
-                    balance_after, 
-                    description,
-                    generation_id if generation_type == 'try_on' else None,
-                    generation_id if generation_type == 'color_type' else None
-                ))
-                
-                conn.commit()
-                
+
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': get_cors_origin(event), 'Access-Control-Allow-Credentials': 'true'},
@@ -250,10 +181,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'refunded': True,
                         'refund_type': 'paid',
                         'refund_amount': total_refund,
-                        'new_balance': balance_after
+                        'new_balance': result['balance_after']
                     })
                 }
-            
+
             return {
                 'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': get_cors_origin(event), 'Access-Control-Allow-Credentials': 'true'},
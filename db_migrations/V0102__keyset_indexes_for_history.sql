@@ -0,0 +1,10 @@
+-- Индексы под keyset-пагинацию истории в db-query:
+-- WHERE user_id = ? AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC
+CREATE INDEX IF NOT EXISTS idx_try_on_history_user_created_id
+    ON t_p29007832_virtual_fitting_room.try_on_history (user_id, created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_freegen_history_user_created_id
+    ON t_p29007832_virtual_fitting_room.freegen_history (user_id, created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_lookbooks_user_created_id
+    ON t_p29007832_virtual_fitting_room.lookbooks (user_id, created_at DESC, id DESC);
@@ -0,0 +1,42 @@
+-- Счётчик ссылок на файлы в S3: одна ссылка = одна запись истории
+-- (try_on_history, freegen_history) или одно вхождение фото в лукбук.
+-- Проверка "фото больше не используется" — поиск по PK вместо COUNT(*) по трём таблицам.
+CREATE TABLE IF NOT EXISTS t_p29007832_virtual_fitting_room.media_refs (
+    url TEXT PRIMARY KEY,
+    user_id TEXT,
+    ref_count INTEGER NOT NULL DEFAULT 0,
+    orphaned_at TIMESTAMP,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Очередь на удаление: файлы без ссылок
+CREATE INDEX IF NOT EXISTS idx_media_refs_orphaned
+    ON t_p29007832_virtual_fitting_room.media_refs (orphaned_at)
+    WHERE ref_count = 0;
+
+CREATE INDEX IF NOT EXISTS idx_media_refs_user
+    ON t_p29007832_virtual_fitting_room.media_refs (user_id);
+
+-- Заполняем по текущим данным
+INSERT INTO t_p29007832_virtual_fitting_room.media_refs (url, user_id, ref_count)
+SELECT url, MIN(user_id), COUNT(*)
+FROM (
+    SELECT result_image AS url, user_id::text AS user_id
+    FROM t_p29007832_virtual_fitting_room.try_on_history
+    WHERE result_image IS NOT NULL AND result_image <> ''
+    UNION ALL
+    SELECT result_image, user_id::text
+    FROM t_p29007832_virtual_fitting_room.freegen_history
+    WHERE result_image IS NOT NULL AND result_image <> ''
+    UNION ALL
+    SELECT photo, user_id
+    FROM (
+        SELECT DISTINCT lb.id, p.photo, lb.user_id::text AS user_id
+        FROM t_p29007832_virtual_fitting_room.lookbooks lb,
+             unnest(lb.photos) AS p(photo)
+        WHERE p.photo IS NOT NULL AND p.photo <> ''
+    ) lookbook_photos
+) refs
+GROUP BY url
+ON CONFLICT (url) DO NOTHING;
@@ -0,0 +1,23 @@
+-- Фоновое удаление файлов пользователя из S3 после удаления аккаунта.
+-- Задачу обрабатывает s3-gc (mode=user_jobs) порциями: состояние листинга
+-- (prefixes / prefix_index / continuation) сохраняется после каждой страницы,
+-- поэтому большой аккаунт не упирается в таймаут функции.
+CREATE TABLE IF NOT EXISTS t_p29007832_virtual_fitting_room.s3_deletion_jobs (
+    id SERIAL PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    prefixes JSONB,
+    prefix_index INTEGER NOT NULL DEFAULT 0,
+    continuation TEXT,
+    deleted_count INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error_message TEXT,
+    locked_at TIMESTAMP,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_s3_deletion_jobs_active
+    ON t_p29007832_virtual_fitting_room.s3_deletion_jobs (created_at)
+    WHERE status IN ('pending', 'processing');
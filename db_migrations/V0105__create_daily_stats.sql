@@ -0,0 +1,24 @@
+-- Дневная свёртка статистики админки. Закрытые дни пишет функция stats-rollup,
+-- admin-api (action=stats) суммирует свёртку и считает вживую только хвост
+-- после последнего свёрнутого дня.
+CREATE TABLE IF NOT EXISTS t_p29007832_virtual_fitting_room.daily_stats (
+    day DATE PRIMARY KEY,
+    tryon_replicate INTEGER NOT NULL DEFAULT 0,
+    tryon_seedream INTEGER NOT NULL DEFAULT 0,
+    tryon_nanobana INTEGER NOT NULL DEFAULT 0,
+    payments_count INTEGER NOT NULL DEFAULT 0,
+    revenue NUMERIC(12, 2) NOT NULL DEFAULT 0,
+    colortypes_total INTEGER NOT NULL DEFAULT 0,
+    colortypes_completed INTEGER NOT NULL DEFAULT 0,
+    colortypes_failed INTEGER NOT NULL DEFAULT 0,
+    refunds NUMERIC(12, 2) NOT NULL DEFAULT 0,
+    charges_colortype NUMERIC(12, 2) NOT NULL DEFAULT 0,
+    charges_tryon NUMERIC(12, 2) NOT NULL DEFAULT 0,
+    charges_manual NUMERIC(12, 2) NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Диапазонный фильтр по created_at для живого хвоста и свёртки
+-- (у try_on_history, color_type_history и balance_transactions индекс уже есть)
+CREATE INDEX IF NOT EXISTS idx_payment_transactions_created_at
+    ON t_p29007832_virtual_fitting_room.payment_transactions (created_at);
@@ -0,0 +1,23 @@
+-- Поиск в админке (action=payments / action=users) идёт подстрокой через ILIKE '%term%'.
+-- Триграммные GIN-индексы позволяют обслуживать такие шаблоны без полного чтения таблиц.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_users_email_trgm
+    ON t_p29007832_virtual_fitting_room.users USING gin (email gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_name_trgm
+    ON t_p29007832_virtual_fitting_room.users USING gin (name gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS idx_balance_transactions_yookassa_trgm
+    ON t_p29007832_virtual_fitting_room.balance_transactions USING gin (yookassa_payment_id gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_balance_transactions_description_trgm
+    ON t_p29007832_virtual_fitting_room.balance_transactions USING gin (description gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_balance_transactions_removed_email_trgm
+    ON t_p29007832_virtual_fitting_room.balance_transactions USING gin (removed_user_email gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_balance_transactions_removed_name_trgm
+    ON t_p29007832_virtual_fitting_room.balance_transactions USING gin (removed_user_name gin_trgm_ops);
+
+-- Порядок страниц (created_at DESC, id DESC) для keyset-пагинации
+CREATE INDEX IF NOT EXISTS idx_balance_transactions_created_id
+    ON t_p29007832_virtual_fitting_room.balance_transactions (created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_users_created_id
+    ON t_p29007832_virtual_fitting_room.users (created_at DESC, id DESC);
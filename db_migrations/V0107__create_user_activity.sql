@@ -0,0 +1,212 @@
+-- Единая лента активности по всем сервисам (примерки, свободная генерация,
+-- цветотипы, гиды, тесты Кибби/архетипов, гадания). Строки общего вида
+-- поддерживаются триггерами на исходных таблицах — в той же транзакции,
+-- что и запись задачи, поэтому ни один писатель не нужно менять и лента
+-- не отстаёт. Лента для пользователя и для админки — один индексный запрос.
+CREATE TABLE IF NOT EXISTS t_p29007832_virtual_fitting_room.user_activity (
+    service TEXT NOT NULL,
+    id TEXT NOT NULL,
+    user_id TEXT,
+    status TEXT,
+    cost NUMERIC(10, 2) NOT NULL DEFAULT 0,
+    thumbnail TEXT,
+    title TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    removed_at TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (service, id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_activity_user_created
+    ON t_p29007832_virtual_fitting_room.user_activity (user_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_user_activity_created
+    ON t_p29007832_virtual_fitting_room.user_activity (created_at DESC, id DESC);
+
+-- Общий upsert строки ленты. data:-URI (старые записи) в миниатюру не попадают.
+CREATE OR REPLACE FUNCTION t_p29007832_virtual_fitting_room.upsert_user_activity(
+    p_service TEXT, p_id TEXT, p_user_id TEXT, p_status TEXT, p_cost NUMERIC,
+    p_thumbnail TEXT, p_title TEXT, p_created_at TIMESTAMP, p_removed_at TIMESTAMP
+) RETURNS VOID AS $$
+BEGIN
+    INSERT INTO t_p29007832_virtual_fitting_room.user_activity
+        (service, id, user_id, status, cost, thumbnail, title, created_at, removed_at, updated_at)
+    VALUES (
+        p_service, p_id, p_user_id, p_status, COALESCE(p_cost, 0),
+        CASE WHEN p_thumbnail LIKE 'data:%' THEN NULL ELSE p_thumbnail END,
+        p_title, COALESCE(p_created_at, NOW()), p_removed_at, NOW()
+    )
+    ON CONFLICT (service, id) DO UPDATE SET
+        user_id = EXCLUDED.user_id,
+        status = EXCLUDED.status,
+        cost = EXCLUDED.cost,
+        thumbnail = EXCLUDED.thumbnail,
+        title = EXCLUDED.title,
+        created_at = EXCLUDED.created_at,
+        removed_at = EXCLUDED.removed_at,
+        updated_at = NOW();
+END;
+$$ LANGUAGE plpgsql;
+
+-- Один триггер на все таблицы: форма строки выбирается по TG_TABLE_NAME
+CREATE OR REPLACE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity() RETURNS TRIGGER AS $$
+DECLARE
+    svc TEXT;
+BEGIN
+    svc := CASE TG_TABLE_NAME
+        WHEN 'try_on_history' THEN 'tryon'
+        WHEN 'freegen_history' THEN 'freegen'
+        WHEN 'color_type_history' THEN 'colortype'
+        WHEN 'color_guide_tasks' THEN 'colorguide'
+        WHEN 'kibbe_test_history' THEN 'kibbe'
+        WHEN 'archetype_test_history' THEN 'archetype'
+        WHEN 'ai_editor_tasks' THEN 'divination'
+        WHEN 'divination_dialogs' THEN 'divination_dialog'
+    END;
+
+    IF TG_OP = 'DELETE' THEN
+        DELETE FROM t_p29007832_virtual_fitting_room.user_activity
+        WHERE service = svc AND id = OLD.id::text;
+        RETURN OLD;
+    END IF;
+
+    IF TG_TABLE_NAME = 'try_on_history' THEN
+        PERFORM t_p29007832_virtual_fitting_room.upsert_user_activity(
+            svc, NEW.id::text, NEW.user_id::text, 'completed', NEW.cost,
+            NEW.result_image, NEW.model_used, NEW.created_at, NEW.removed_at);
+    ELSIF TG_TABLE_NAME = 'freegen_history' THEN
+        PERFORM t_p29007832_virtual_fitting_room.upsert_user_activity(
+            svc, NEW.id::text, NEW.user_id::text, 'completed', NEW.cost,
+            NEW.result_image, LEFT(NEW.prompt, 200), NEW.created_at, NEW.removed_at);
+    ELSIF TG_TABLE_NAME = 'color_type_history' THEN
+        PERFORM t_p29007832_virtual_fitting_room.upsert_user_activity(
+            svc, NEW.id::text, NEW.user_id::text, NEW.status, NEW.cost,
+            NEW.cdn_url, NEW.color_type, NEW.created_at, NEW.removed_at);
+    ELSIF TG_TABLE_NAME = 'color_guide_tasks' THEN
+        PERFORM t_p29007832_virtual_fitting_room.upsert_user_activity(
+            svc, NEW.id::text, NEW.user_id::text, NEW.status, NEW.cost,
+            NEW.cdn_url, NEW.colortype_slug, NEW.created_at, NULL);
+    ELSIF TG_TABLE_NAME = 'kibbe_test_history' THEN
+        PERFORM t_p29007832_virtual_fitting_room.upsert_user_activity(
+            svc, NEW.id::text, NEW.user_id::text, NEW.status, 0,
+            NULL, NEW.kibbe_type, NEW.created_at, NULL);
+    ELSIF TG_TABLE_NAME = 'archetype_test_history' THEN
+        PERFORM t_p29007832_virtual_fitting_room.upsert_user_activity(
+            svc, NEW.id::text, NEW.user_id::text, NEW.status, 0,
+            NULL, NEW.top_archetype_name, NEW.created_at, NULL);
+    ELSIF TG_TABLE_NAME = 'ai_editor_tasks' THEN
+        PERFORM t_p29007832_virtual_fitting_room.upsert_user_activity(
+            svc, NEW.id::text, NEW.user_id::text, NEW.status, NEW.cost,
+            NULL, NEW.divination_meta->>'system', NEW.created_at, NULL);
+    ELSIF TG_TABLE_NAME = 'divination_dialogs' THEN
+        PERFORM t_p29007832_virtual_fitting_room.upsert_user_activity(
+            svc, NEW.id::text, NEW.user_id::text, NEW.status, NEW.total_spent,
+            NULL, NEW.deck, NEW.created_at, NULL);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_user_activity ON t_p29007832_virtual_fitting_room.try_on_history;
+CREATE TRIGGER trg_user_activity AFTER INSERT OR UPDATE OR DELETE
+    ON t_p29007832_virtual_fitting_room.try_on_history
+    FOR EACH ROW EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+
+DROP TRIGGER IF EXISTS trg_user_activity ON t_p29007832_virtual_fitting_room.freegen_history;
+CREATE TRIGGER trg_user_activity AFTER INSERT OR UPDATE OR DELETE
+    ON t_p29007832_virtual_fitting_room.freegen_history
+    FOR EACH ROW EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+
+DROP TRIGGER IF EXISTS trg_user_activity ON t_p29007832_virtual_fitting_room.color_type_history;
+CREATE TRIGGER trg_user_activity AFTER INSERT OR UPDATE OR DELETE
+    ON t_p29007832_virtual_fitting_room.color_type_history
+    FOR EACH ROW EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+
+DROP TRIGGER IF EXISTS trg_user_activity ON t_p29007832_virtual_fitting_room.color_guide_tasks;
+CREATE TRIGGER trg_user_activity AFTER INSERT OR UPDATE OR DELETE
+    ON t_p29007832_virtual_fitting_room.color_guide_tasks
+    FOR EACH ROW EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+
+DROP TRIGGER IF EXISTS trg_user_activity ON t_p29007832_virtual_fitting_room.kibbe_test_history;
+CREATE TRIGGER trg_user_activity AFTER INSERT OR UPDATE OR DELETE
+    ON t_p29007832_virtual_fitting_room.kibbe_test_history
+    FOR EACH ROW EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+
+DROP TRIGGER IF EXISTS trg_user_activity ON t_p29007832_virtual_fitting_room.archetype_test_history;
+CREATE TRIGGER trg_user_activity AFTER INSERT OR UPDATE OR DELETE
+    ON t_p29007832_virtual_fitting_room.archetype_test_history
+    FOR EACH ROW EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+
+-- ai_editor_tasks общая с редактором кода — в ленту идут только гадания.
+-- Стриминг часто пишет partial_text, поэтому UPDATE синхронизируется
+-- только при смене статуса/стоимости.
+DROP TRIGGER IF EXISTS trg_user_activity ON t_p29007832_virtual_fitting_room.ai_editor_tasks;
+CREATE TRIGGER trg_user_activity AFTER INSERT
+    ON t_p29007832_virtual_fitting_room.ai_editor_tasks
+    FOR EACH ROW WHEN (NEW.task_type = 'lenormand')
+    EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+DROP TRIGGER IF EXISTS trg_user_activity_update ON t_p29007832_virtual_fitting_room.ai_editor_tasks;
+CREATE TRIGGER trg_user_activity_update AFTER UPDATE
+    ON t_p29007832_virtual_fitting_room.ai_editor_tasks
+    FOR EACH ROW WHEN (NEW.task_type = 'lenormand'
+        AND (OLD.status IS DISTINCT FROM NEW.status OR OLD.cost IS DISTINCT FROM NEW.cost))
+    EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+DROP TRIGGER IF EXISTS trg_user_activity_delete ON t_p29007832_virtual_fitting_room.ai_editor_tasks;
+CREATE TRIGGER trg_user_activity_delete AFTER DELETE
+    ON t_p29007832_virtual_fitting_room.ai_editor_tasks
+    FOR EACH ROW WHEN (OLD.task_type = 'lenormand')
+    EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+
+DROP TRIGGER IF EXISTS trg_user_activity ON t_p29007832_virtual_fitting_room.divination_dialogs;
+CREATE TRIGGER trg_user_activity AFTER INSERT OR UPDATE OR DELETE
+    ON t_p29007832_virtual_fitting_room.divination_dialogs
+    FOR EACH ROW EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+
+-- Заполнение ленты существующими записями
+INSERT INTO t_p29007832_virtual_fitting_room.user_activity (service, id, user_id, status, cost, thumbnail, title, created_at, removed_at)
+SELECT 'tryon', id::text, user_id::text, 'completed', COALESCE(cost, 0),
+       CASE WHEN result_image LIKE 'data:%' THEN NULL ELSE result_image END, model_used,
+       COALESCE(created_at, NOW()), removed_at
+FROM t_p29007832_virtual_fitting_room.try_on_history
+ON CONFLICT (service, id) DO NOTHING;
+
+INSERT INTO t_p29007832_virtual_fitting_room.user_activity (service, id, user_id, status, cost, thumbnail, title, created_at, removed_at)
+SELECT 'freegen', id::text, user_id::text, 'completed', COALESCE(cost, 0),
+       CASE WHEN result_image LIKE 'data:%' THEN NULL ELSE result_image END, LEFT(prompt, 200),
+       COALESCE(created_at, NOW()), removed_at
+FROM t_p29007832_virtual_fitting_room.freegen_history
+ON CONFLICT (service, id) DO NOTHING;
+
+INSERT INTO t_p29007832_virtual_fitting_room.user_activity (service, id, user_id, status, cost, thumbnail, title, created_at, removed_at)
+SELECT 'colortype', id::text, user_id::text, status, COALESCE(cost, 0),
+       CASE WHEN cdn_url LIKE 'data:%' THEN NULL ELSE cdn_url END, color_type,
+       COALESCE(created_at, NOW()), removed_at
+FROM t_p29007832_virtual_fitting_room.color_type_history
+ON CONFLICT (service, id) DO NOTHING;
+
+INSERT INTO t_p29007832_virtual_fitting_room.user_activity (service, id, user_id, status, cost, thumbnail, title, created_at)
+SELECT 'colorguide', id::text, user_id::text, status, COALESCE(cost, 0),
+       CASE WHEN cdn_url LIKE 'data:%' THEN NULL ELSE cdn_url END, colortype_slug,
+       COALESCE(created_at, NOW())
+FROM t_p29007832_virtual_fitting_room.color_guide_tasks
+ON CONFLICT (service, id) DO NOTHING;
+
+INSERT INTO t_p29007832_virtual_fitting_room.user_activity (service, id, user_id, status, title, created_at)
+SELECT 'kibbe', id::text, user_id::text, status, kibbe_type, COALESCE(created_at, NOW())
+FROM t_p29007832_virtual_fitting_room.kibbe_test_history
+ON CONFLICT (service, id) DO NOTHING;
+
+INSERT INTO t_p29007832_virtual_fitting_room.user_activity (service, id, user_id, status, title, created_at)
+SELECT 'archetype', id::text, user_id::text, status, top_archetype_name, COALESCE(created_at, NOW())
+FROM t_p29007832_virtual_fitting_room.archetype_test_history
+ON CONFLICT (service, id) DO NOTHING;
+
+INSERT INTO t_p29007832_virtual_fitting_room.user_activity (service, id, user_id, status, cost, title, created_at)
+SELECT 'divination', id::text, user_id::text, status, COALESCE(cost, 0), divination_meta->>'system', created_at
+FROM t_p29007832_virtual_fitting_room.ai_editor_tasks
+WHERE task_type = 'lenormand'
+ON CONFLICT (service, id) DO NOTHING;
+
+INSERT INTO t_p29007832_virtual_fitting_room.user_activity (service, id, user_id, status, cost, title, created_at)
+SELECT 'divination_dialog', id::text, user_id::text, status, total_spent, deck, created_at
+FROM t_p29007832_virtual_fitting_room.divination_dialogs
+ON CONFLICT (service, id) DO NOTHING;
@@ -0,0 +1,18 @@
+-- Отметки этапов жизненного цикла задач: очередь → допуск воркером →
+-- отправка провайдеру → ответ провайдера → загрузка в S3 → итоговый статус.
+-- Одна строка на задачу; пишут start-функции и воркеры (task_timings.py),
+-- перцентили по этапам отдаёт admin-api (action=latency).
+CREATE TABLE IF NOT EXISTS t_p29007832_virtual_fitting_room.task_timings (
+    service TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    queued_at TIMESTAMP,
+    admitted_at TIMESTAMP,
+    submitted_at TIMESTAMP,
+    provider_done_at TIMESTAMP,
+    uploaded_at TIMESTAMP,
+    finalized_at TIMESTAMP,
+    PRIMARY KEY (service, task_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_task_timings_service_queued
+    ON t_p29007832_virtual_fitting_room.task_timings (service, queued_at);
@@ -0,0 +1,23 @@
+-- Частичные индексы по незавершённым задачам для task-sweeper и очереди.
+-- Незавершённых задач единицы, а таблицы растут бесконечно: индекс только по
+-- pending/processing остаётся крошечным, и поиск зависших/ожидающих задач
+-- (status + created_at) не читает историю.
+CREATE INDEX IF NOT EXISTS idx_nanobananapro_tasks_active
+    ON t_p29007832_virtual_fitting_room.nanobananapro_tasks (status, created_at)
+    WHERE status IN ('pending', 'processing');
+
+CREATE INDEX IF NOT EXISTS idx_freegen_tasks_active
+    ON t_p29007832_virtual_fitting_room.freegen_tasks (status, created_at)
+    WHERE status IN ('pending', 'processing');
+
+CREATE INDEX IF NOT EXISTS idx_color_guide_tasks_active
+    ON t_p29007832_virtual_fitting_room.color_guide_tasks (status, created_at)
+    WHERE status IN ('pending', 'processing');
+
+CREATE INDEX IF NOT EXISTS idx_color_type_history_active
+    ON t_p29007832_virtual_fitting_room.color_type_history (status, created_at)
+    WHERE status IN ('pending', 'processing');
+
+CREATE INDEX IF NOT EXISTS idx_ai_editor_tasks_active
+    ON t_p29007832_virtual_fitting_room.ai_editor_tasks (status, created_at)
+    WHERE status IN ('pending', 'processing');
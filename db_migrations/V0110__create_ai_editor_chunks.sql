@@ -0,0 +1,12 @@
+-- Черновик длинного ответа пишется кусками только с новым текстом, а не
+-- перезаписью всего partial_text каждые 15 секунд (это O(n²) байт и WAL на задачу).
+-- Склеивается один раз при завершении; ai-editor-status отдаёт куски по seq.
+CREATE TABLE IF NOT EXISTS t_p29007832_virtual_fitting_room.ai_editor_chunks (
+    task_id UUID NOT NULL
+        REFERENCES t_p29007832_virtual_fitting_room.ai_editor_tasks(id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    body TEXT NOT NULL,
+    chars INTEGER NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (task_id, seq)
+);
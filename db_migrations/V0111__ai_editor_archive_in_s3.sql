@@ -0,0 +1,7 @@
+-- Архив задачи AI-редактора хранится в S3, а не base64 в строке задачи:
+-- каждый шаг больше не декодирует и не распаковывает весь архив.
+-- archive_manifest_key — манифест текстовых файлов (путь → хеш, размер, текст),
+-- который строится на первом шаге и читается всеми следующими.
+ALTER TABLE t_p29007832_virtual_fitting_room.ai_editor_tasks
+  ADD COLUMN IF NOT EXISTS archive_s3_key TEXT,
+  ADD COLUMN IF NOT EXISTS archive_manifest_key TEXT;
@@ -0,0 +1,16 @@
+-- Файлы плана архивной задачи AI-редактора как отдельные под-шаги:
+-- независимые файлы пишутся параллельно, у каждого свой счётчик попыток.
+-- depends_on — номера файлов плана, которые должны быть написаны раньше.
+CREATE TABLE IF NOT EXISTS t_p29007832_virtual_fitting_room.ai_editor_substeps (
+    task_id UUID NOT NULL
+        REFERENCES t_p29007832_virtual_fitting_room.ai_editor_tasks(id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    depends_on INTEGER[] NOT NULL DEFAULT '{}',
+    retries INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    lock_at TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (task_id, idx)
+);
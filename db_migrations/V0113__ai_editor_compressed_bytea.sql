@@ -0,0 +1,13 @@
+-- Тексты AI-редактора хранятся сжатыми (zlib) в bytea и пишутся параметрами
+-- запроса, а не base64 внутри SQL: строки и WAL меньше, запросы короче.
+-- Старые колонки (plan_files, plan_summary, plan_conventions, done_files,
+-- ai_editor_chunks.body) остаются для чтения задач, начатых раньше.
+ALTER TABLE t_p29007832_virtual_fitting_room.ai_editor_tasks
+  ADD COLUMN IF NOT EXISTS plan_z BYTEA;
+
+ALTER TABLE t_p29007832_virtual_fitting_room.ai_editor_substeps
+  ADD COLUMN IF NOT EXISTS content BYTEA;
+
+ALTER TABLE t_p29007832_virtual_fitting_room.ai_editor_chunks
+  ADD COLUMN IF NOT EXISTS data BYTEA,
+  ALTER COLUMN body DROP NOT NULL;
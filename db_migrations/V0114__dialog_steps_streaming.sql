@@ -0,0 +1,7 @@
+-- Потоковый ответ шага диалога-гадания: написанное сохраняется по ходу
+-- (partial_answer), stream_lock — когда воркер последний раз сохранялся,
+-- чтобы оборвавшийся ответ подхватил и дописал следующий запуск.
+ALTER TABLE t_p29007832_virtual_fitting_room.divination_dialog_steps
+  ADD COLUMN IF NOT EXISTS partial_answer TEXT,
+  ADD COLUMN IF NOT EXISTS stream_lock TIMESTAMP,
+  ADD COLUMN IF NOT EXISTS resume_count INTEGER NOT NULL DEFAULT 0;
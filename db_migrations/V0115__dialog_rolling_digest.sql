@@ -0,0 +1,7 @@
+-- Сводка диалога-гадания: модель обновляет её в конце каждого ответа, и
+-- следующий шаг получает одну сводку вместо всех прошлых шагов — запрос не
+-- растёт с длиной диалога. digest_step — последний шаг, учтённый в сводке;
+-- у старых диалогов 0, и прошлые шаги берутся по отдельности, как раньше.
+ALTER TABLE t_p29007832_virtual_fitting_room.divination_dialogs
+  ADD COLUMN IF NOT EXISTS digest TEXT,
+  ADD COLUMN IF NOT EXISTS digest_step INTEGER NOT NULL DEFAULT 0;
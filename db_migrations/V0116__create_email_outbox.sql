@@ -0,0 +1,33 @@
+-- Очередь исходящих писем. Функции кладут письмо сюда и сразу отвечают,
+-- отправляет email-sender: пачкой через одну SMTP-сессию, с лимитом частоты
+-- и повторами с растущей паузой (pending → sending → sent | failed).
+CREATE TABLE IF NOT EXISTS t_p29007832_virtual_fitting_room.email_outbox (
+  id BIGSERIAL PRIMARY KEY,
+  to_email TEXT NOT NULL,
+  from_addr TEXT NOT NULL,
+  subject TEXT NOT NULL,
+  text_body TEXT NOT NULL,
+  html_body TEXT,
+  source TEXT NOT NULL DEFAULT '',
+  status TEXT NOT NULL DEFAULT 'pending',
+  attempts INTEGER NOT NULL DEFAULT 0,
+  next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+  locked_at TIMESTAMP,
+  last_error TEXT,
+  created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+  sent_at TIMESTAMP
+);
+
+-- Выборка очереди: в ней единицы писем, история не читается
+CREATE INDEX IF NOT EXISTS idx_email_outbox_queue
+  ON t_p29007832_virtual_fitting_room.email_outbox (next_attempt_at)
+  WHERE status IN ('pending', 'sending');
+
+-- Подсчёт отправленных за минуту/час для лимита частоты
+CREATE INDEX IF NOT EXISTS idx_email_outbox_sent_at
+  ON t_p29007832_virtual_fitting_room.email_outbox (sent_at)
+  WHERE status = 'sent';
+
+-- Письма админа: статус доставки берётся из очереди
+ALTER TABLE t_p29007832_virtual_fitting_room.admin_emails_log
+  ADD COLUMN IF NOT EXISTS outbox_id BIGINT;
@@ -0,0 +1,37 @@
+-- Удаление строк из таблиц-источников статистики сбрасывает свёрнутые дни,
+-- к которым эти строки относились. admin-api досчитывает такие «дыры» вживую,
+-- stats-rollup записывает их заново — итоги дашборда совпадают с живым
+-- COUNT(*) по текущим данным, как и до свёртки.
+-- Триггер уровня оператора: массовое удаление (аккаунт, очистка истории)
+-- даёт один DELETE по daily_stats, а не по строке на каждую удалённую запись.
+CREATE OR REPLACE FUNCTION t_p29007832_virtual_fitting_room.invalidate_daily_stats() RETURNS TRIGGER AS $$
+BEGIN
+    DELETE FROM t_p29007832_virtual_fitting_room.daily_stats
+    WHERE day IN (SELECT DISTINCT created_at::date FROM old_rows WHERE created_at IS NOT NULL);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_daily_stats_invalidate ON t_p29007832_virtual_fitting_room.try_on_history;
+CREATE TRIGGER trg_daily_stats_invalidate AFTER DELETE
+    ON t_p29007832_virtual_fitting_room.try_on_history
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION t_p29007832_virtual_fitting_room.invalidate_daily_stats();
+
+DROP TRIGGER IF EXISTS trg_daily_stats_invalidate ON t_p29007832_virtual_fitting_room.payment_transactions;
+CREATE TRIGGER trg_daily_stats_invalidate AFTER DELETE
+    ON t_p29007832_virtual_fitting_room.payment_transactions
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION t_p29007832_virtual_fitting_room.invalidate_daily_stats();
+
+DROP TRIGGER IF EXISTS trg_daily_stats_invalidate ON t_p29007832_virtual_fitting_room.color_type_history;
+CREATE TRIGGER trg_daily_stats_invalidate AFTER DELETE
+    ON t_p29007832_virtual_fitting_room.color_type_history
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION t_p29007832_virtual_fitting_room.invalidate_daily_stats();
+
+DROP TRIGGER IF EXISTS trg_daily_stats_invalidate ON t_p29007832_virtual_fitting_room.balance_transactions;
+CREATE TRIGGER trg_daily_stats_invalidate AFTER DELETE
+    ON t_p29007832_virtual_fitting_room.balance_transactions
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION t_p29007832_virtual_fitting_room.invalidate_daily_stats();
@@ -0,0 +1,104 @@
+-- Триггеры ленты активности (V0107) срабатывали на любой UPDATE задач, в том
+-- числе на частые служебные записи воркеров (updated_at, прогресс, ссылки fal,
+-- дайджест беседы) — каждая такая запись давала лишнюю запись в user_activity.
+-- Теперь: INSERT и DELETE как раньше, UPDATE — только при изменении колонок,
+-- которые попадают в ленту.
+
+DROP TRIGGER IF EXISTS trg_user_activity ON t_p29007832_virtual_fitting_room.try_on_history;
+CREATE TRIGGER trg_user_activity AFTER INSERT OR DELETE
+    ON t_p29007832_virtual_fitting_room.try_on_history
+    FOR EACH ROW EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+DROP TRIGGER IF EXISTS trg_user_activity_update ON t_p29007832_virtual_fitting_room.try_on_history;
+CREATE TRIGGER trg_user_activity_update AFTER UPDATE OF result_image, model_used, cost, removed_at
+    ON t_p29007832_virtual_fitting_room.try_on_history
+    FOR EACH ROW WHEN (OLD.result_image IS DISTINCT FROM NEW.result_image
+        OR OLD.model_used IS DISTINCT FROM NEW.model_used
+        OR OLD.cost IS DISTINCT FROM NEW.cost
+        OR OLD.removed_at IS DISTINCT FROM NEW.removed_at)
+    EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+
+DROP TRIGGER IF EXISTS trg_user_activity ON t_p29007832_virtual_fitting_room.freegen_history;
+CREATE TRIGGER trg_user_activity AFTER INSERT OR DELETE
+    ON t_p29007832_virtual_fitting_room.freegen_history
+    FOR EACH ROW EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+DROP TRIGGER IF EXISTS trg_user_activity_update ON t_p29007832_virtual_fitting_room.freegen_history;
+CREATE TRIGGER trg_user_activity_update AFTER UPDATE OF result_image, prompt, cost, removed_at
+    ON t_p29007832_virtual_fitting_room.freegen_history
+    FOR EACH ROW WHEN (OLD.result_image IS DISTINCT FROM NEW.result_image
+        OR OLD.prompt IS DISTINCT FROM NEW.prompt
+        OR OLD.cost IS DISTINCT FROM NEW.cost
+        OR OLD.removed_at IS DISTINCT FROM NEW.removed_at)
+    EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+
+-- Задачи: смена статуса, а также поля, которые меняются вместе с результатом
+-- или при удалении из истории (removed_at без смены статуса)
+DROP TRIGGER IF EXISTS trg_user_activity ON t_p29007832_virtual_fitting_room.color_type_history;
+CREATE TRIGGER trg_user_activity AFTER INSERT OR DELETE
+    ON t_p29007832_virtual_fitting_room.color_type_history
+    FOR EACH ROW EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+DROP TRIGGER IF EXISTS trg_user_activity_update ON t_p29007832_virtual_fitting_room.color_type_history;
+CREATE TRIGGER trg_user_activity_update AFTER UPDATE OF status, cdn_url, color_type, cost, removed_at
+    ON t_p29007832_virtual_fitting_room.color_type_history
+    FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status
+        OR OLD.cdn_url IS DISTINCT FROM NEW.cdn_url
+        OR OLD.color_type IS DISTINCT FROM NEW.color_type
+        OR OLD.cost IS DISTINCT FROM NEW.cost
+        OR OLD.removed_at IS DISTINCT FROM NEW.removed_at)
+    EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+
+DROP TRIGGER IF EXISTS trg_user_activity ON t_p29007832_virtual_fitting_room.color_guide_tasks;
+CREATE TRIGGER trg_user_activity AFTER INSERT OR DELETE
+    ON t_p29007832_virtual_fitting_room.color_guide_tasks
+    FOR EACH ROW EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+DROP TRIGGER IF EXISTS trg_user_activity_update ON t_p29007832_virtual_fitting_room.color_guide_tasks;
+CREATE TRIGGER trg_user_activity_update AFTER UPDATE OF status, cdn_url, colortype_slug, cost
+    ON t_p29007832_virtual_fitting_room.color_guide_tasks
+    FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status
+        OR OLD.cdn_url IS DISTINCT FROM NEW.cdn_url
+        OR OLD.colortype_slug IS DISTINCT FROM NEW.colortype_slug
+        OR OLD.cost IS DISTINCT FROM NEW.cost)
+    EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+
+DROP TRIGGER IF EXISTS trg_user_activity ON t_p29007832_virtual_fitting_room.kibbe_test_history;
+CREATE TRIGGER trg_user_activity AFTER INSERT OR DELETE
+    ON t_p29007832_virtual_fitting_room.kibbe_test_history
+    FOR EACH ROW EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+DROP TRIGGER IF EXISTS trg_user_activity_update ON t_p29007832_virtual_fitting_room.kibbe_test_history;
+CREATE TRIGGER trg_user_activity_update AFTER UPDATE OF status, kibbe_type
+    ON t_p29007832_virtual_fitting_room.kibbe_test_history
+    FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status
+        OR OLD.kibbe_type IS DISTINCT FROM NEW.kibbe_type)
+    EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+
+DROP TRIGGER IF EXISTS trg_user_activity ON t_p29007832_virtual_fitting_room.archetype_test_history;
+CREATE TRIGGER trg_user_activity AFTER INSERT OR DELETE
+    ON t_p29007832_virtual_fitting_room.archetype_test_history
+    FOR EACH ROW EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+DROP TRIGGER IF EXISTS trg_user_activity_update ON t_p29007832_virtual_fitting_room.archetype_test_history;
+CREATE TRIGGER trg_user_activity_update AFTER UPDATE OF status, top_archetype_name
+    ON t_p29007832_virtual_fitting_room.archetype_test_history
+    FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status
+        OR OLD.top_archetype_name IS DISTINCT FROM NEW.top_archetype_name)
+    EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+
+-- ai_editor_tasks уже сужен в V0107; UPDATE OF добавляет отсечение
+-- по списку SET ещё до вычисления WHEN (частые записи partial_text)
+DROP TRIGGER IF EXISTS trg_user_activity_update ON t_p29007832_virtual_fitting_room.ai_editor_tasks;
+CREATE TRIGGER trg_user_activity_update AFTER UPDATE OF status, cost
+    ON t_p29007832_virtual_fitting_room.ai_editor_tasks
+    FOR EACH ROW WHEN (NEW.task_type = 'lenormand'
+        AND (OLD.status IS DISTINCT FROM NEW.status OR OLD.cost IS DISTINCT FROM NEW.cost))
+    EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+
+-- Беседа: стриминг и дайджест часто пишут в divination_dialogs
+DROP TRIGGER IF EXISTS trg_user_activity ON t_p29007832_virtual_fitting_room.divination_dialogs;
+CREATE TRIGGER trg_user_activity AFTER INSERT OR DELETE
+    ON t_p29007832_virtual_fitting_room.divination_dialogs
+    FOR EACH ROW EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
+DROP TRIGGER IF EXISTS trg_user_activity_update ON t_p29007832_virtual_fitting_room.divination_dialogs;
+CREATE TRIGGER trg_user_activity_update AFTER UPDATE OF status, total_spent, deck
+    ON t_p29007832_virtual_fitting_room.divination_dialogs
+    FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status
+        OR OLD.total_spent IS DISTINCT FROM NEW.total_spent
+        OR OLD.deck IS DISTINCT FROM NEW.deck)
+    EXECUTE FUNCTION t_p29007832_virtual_fitting_room.sync_user_activity();
@@ -0,0 +1,10 @@
+-- task-sweeper и colorguide-worker ищут задачи для добора результата fal
+-- в том числе среди failed (результат пришёл после таймаута), а частичный
+-- индекс V0109 покрывает только pending/processing — проба читала историю.
+-- Индекс по тем же условиям, что в запросе: строка выходит из него, как
+-- только recovery_done = TRUE.
+CREATE INDEX IF NOT EXISTS idx_color_guide_tasks_recovery
+    ON t_p29007832_virtual_fitting_room.color_guide_tasks (created_at)
+    WHERE status IN ('pending', 'processing', 'failed')
+      AND fal_response_url IS NOT NULL
+      AND COALESCE(recovery_done, FALSE) = FALSE;
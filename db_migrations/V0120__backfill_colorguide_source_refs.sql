@@ -0,0 +1,22 @@
+-- Исходные фото гида по цвету лежат в images/colorguide/{user_id}/{task_id}.{ext}
+-- (фото партнёра — {task_id}-partner.{ext}), а person_image/partner_image после
+-- обработки обнуляются: у старых задач на эти файлы в БД не ссылается ничего,
+-- и первый боевой проход s3-gc удалил бы их. Ссылки держателя (ref_count = 1,
+-- как hold_media_ref) для всех существующих задач.
+--
+-- Расширение в БД не сохранялось — берём все, что отдаёт фронтенд
+-- (jpeg сохраняется как jpg). Строки для несуществующих вариантов безвредны:
+-- удаление задачи снимает ссылки по префиксу (release_media_prefix), а s3-gc
+-- потом убирает осиротевшие строки.
+INSERT INTO t_p29007832_virtual_fitting_room.media_refs (url, user_id, ref_count)
+SELECT 'https://storage.yandexcloud.net/fitting-room-images/images/colorguide/'
+           || t.user_id::text || '/' || t.id::text || v.suffix || '.' || e.ext,
+       t.user_id::text,
+       1
+FROM t_p29007832_virtual_fitting_room.color_guide_tasks t
+CROSS JOIN (VALUES (''), ('-partner')) AS v(suffix)
+CROSS JOIN (VALUES ('jpg'), ('png'), ('webp'), ('gif')) AS e(ext)
+ON CONFLICT (url) DO UPDATE
+SET ref_count = GREATEST(t_p29007832_virtual_fitting_room.media_refs.ref_count, 1),
+    orphaned_at = NULL,
+    updated_at = NOW();
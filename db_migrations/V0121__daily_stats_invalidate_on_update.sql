@@ -0,0 +1,51 @@
+-- V0117 сбрасывал свёрнутые дни только при удалении строк-источников. Но
+-- метрики daily_stats фильтруют по статусу/типу: поздно подтверждённый платёж,
+-- смена статуса анализа админкой или sweeper'ом меняют итоги дня, который
+-- stats-rollup (RECOMPUTE_DAYS = 2) уже не пересчитывает. Теперь изменение
+-- колонок, от которых зависят метрики, тоже сбрасывает день строки (старый и
+-- новый, если сдвинулся created_at) — дыру досчитывают admin-api и stats-rollup.
+-- Триггер строчный: у UPDATE OF с переходными таблицами PostgreSQL не работает,
+-- а WHEN отсекает записи, не меняющие эти колонки.
+CREATE OR REPLACE FUNCTION t_p29007832_virtual_fitting_room.invalidate_daily_stats_row() RETURNS TRIGGER AS $$
+BEGIN
+    DELETE FROM t_p29007832_virtual_fitting_room.daily_stats
+    WHERE day IN (OLD.created_at::date, NEW.created_at::date);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_daily_stats_invalidate_update ON t_p29007832_virtual_fitting_room.try_on_history;
+CREATE TRIGGER trg_daily_stats_invalidate_update
+    AFTER UPDATE OF model_used, created_at ON t_p29007832_virtual_fitting_room.try_on_history
+    FOR EACH ROW
+    WHEN (OLD.model_used IS DISTINCT FROM NEW.model_used
+          OR OLD.created_at IS DISTINCT FROM NEW.created_at)
+    EXECUTE FUNCTION t_p29007832_virtual_fitting_room.invalidate_daily_stats_row();
+
+DROP TRIGGER IF EXISTS trg_daily_stats_invalidate_update ON t_p29007832_virtual_fitting_room.payment_transactions;
+CREATE TRIGGER trg_daily_stats_invalidate_update
+    AFTER UPDATE OF status, amount, created_at ON t_p29007832_virtual_fitting_room.payment_transactions
+    FOR EACH ROW
+    WHEN (OLD.status IS DISTINCT FROM NEW.status
+          OR OLD.amount IS DISTINCT FROM NEW.amount
+          OR OLD.created_at IS DISTINCT FROM NEW.created_at)
+    EXECUTE FUNCTION t_p29007832_virtual_fitting_room.invalidate_daily_stats_row();
+
+DROP TRIGGER IF EXISTS trg_daily_stats_invalidate_update ON t_p29007832_virtual_fitting_room.color_type_history;
+CREATE TRIGGER trg_daily_stats_invalidate_update
+    AFTER UPDATE OF status, created_at ON t_p29007832_virtual_fitting_room.color_type_history
+    FOR EACH ROW
+    WHEN (OLD.status IS DISTINCT FROM NEW.status
+          OR OLD.created_at IS DISTINCT FROM NEW.created_at)
+    EXECUTE FUNCTION t_p29007832_virtual_fitting_room.invalidate_daily_stats_row();
+
+DROP TRIGGER IF EXISTS trg_daily_stats_invalidate_update ON t_p29007832_virtual_fitting_room.balance_transactions;
+CREATE TRIGGER trg_daily_stats_invalidate_update
+    AFTER UPDATE OF type, amount, color_type_id, try_on_id, created_at ON t_p29007832_virtual_fitting_room.balance_transactions
+    FOR EACH ROW
+    WHEN (OLD.type IS DISTINCT FROM NEW.type
+          OR OLD.amount IS DISTINCT FROM NEW.amount
+          OR OLD.color_type_id IS DISTINCT FROM NEW.color_type_id
+          OR OLD.try_on_id IS DISTINCT FROM NEW.try_on_id
+          OR OLD.created_at IS DISTINCT FROM NEW.created_at)
+    EXECUTE FUNCTION t_p29007832_virtual_fitting_room.invalidate_daily_stats_row();
@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+"""
+Дискретно-событийный симулятор очереди генераций.
+
+Моделирует то, как задачи проходят через воркеры, и позволяет подобрать
+константы до их изменения в проде:
+
+  * GLOBAL_CONCURRENCY и ACTIVE_WINDOW из queue_guard.py — общий лимит
+    fal.ai на примерку (tryon), свободную генерацию (freegen) и гид по
+    цвету (colorguide). Активной считается processing-задача, отправленная
+    в fal не раньше ACTIVE_WINDOW назад, поэтому долгие задачи выпадают из
+    счёта и лимит может превышаться;
+  * порог возврата денег за зависшую задачу (colorguide — 12 минут,
+    freegen — 11 минут);
+  * 3-минутный порог зависших задач colortype-worker: синхронный вызов
+    OpenRouter с повторами, старше порога задачу помечает failed и
+    возвращает деньги sweep-режим воркера;
+  * период task-sweeper (sweep_period), ORPHAN_AGE (orphan_age) и
+    SWEEP_BATCH (sweep_batch) из task-sweeper / воркеров.
+
+Воркер задачи запускается при создании задачи и на каждом опросе статуса
+клиентом (фронт опрашивает раз в poll_interval секунд, пока не сработает
+client_timeout). Чужие задачи воркер не трогает: раз в sweep_period
+task-sweeper запускает sweep у воркеров, где есть зависшие задачи (каждый
+разбирает не больше sweep_batch: дочитывает готовый результат или
+возвращает деньги), и будит брошенные pending-задачи старше orphan_age —
+самые старые, не больше числа свободных слотов очереди.
+
+Политики допуска (--policy):
+  current      — как в проде: любой запуск воркера занимает свободный слот;
+  fifo         — слот получает только самая старая pending-задача;
+  per-service  — отдельный лимит GLOBAL_CONCURRENCY на каждый сервис.
+
+Распределения латентности провайдеров — логнормальные, задаются медианой
+и p90 в секундах. Подогнать их (и интенсивность потока) по нашим данным
+можно подкомандой fit: она читает task_timings за последние дни.
+
+Примеры:
+
+    python simulate_queue.py --hours 24 --seed 1
+    python simulate_queue.py --sweep concurrency=1,2,3 active_window=120,300 --replications 5
+    python simulate_queue.py --policy fifo --concurrency 2 --config fitted.json
+    DATABASE_URL=... python simulate_queue.py fit --days 14 > fitted.json
+"""
+
+import argparse
+import copy
+import heapq
+import itertools
+import json
+import math
+import os
+import random
+import sys
+from typing import Any, Dict, List, Optional
+
+# Сервисы и их параметры по умолчанию. queue='nanobanana' — общий лимит fal.ai,
+# queue=None — синхронный вызов в воркере (colortype через OpenRouter).
+DEFAULT_CONFIG: Dict[str, Any] = {
+    'concurrency': 1,          # queue_guard.GLOBAL_CONCURRENCY
+    'active_window': 120,      # queue_guard.ACTIVE_WINDOW, секунды
+    'poll_interval': 3,        # интервал опроса статуса клиентом
+    'client_timeout': 600,     # клиент перестаёт опрашивать
+    'sweep_period': 60,        # task-sweeper вызывается по расписанию раз в минуту
+    'orphan_age': 60,          # task-sweeper ORPHAN_AGE: pending старше 1 минуты — брошенная
+    'sweep_batch': 20,         # SWEEP_BATCH: задач за один sweep воркера
+    'wake_delay': 1,           # задержка вызова воркера из task-sweeper
+    'stuck_recovery_after': 180,  # stuck recovery: processing без обновлений дольше 3 минут
+    'policy': 'current',
+    'services': {
+        'tryon': {
+            'queue': 'nanobanana', 'rate_per_hour': 20,
+            'provider': {'median': 45, 'p90': 110}, 'failure_rate': 0.03,
+            'refund_after': 660,
+        },
+        'freegen': {
+            'queue': 'nanobanana', 'rate_per_hour': 15,
+            'provider': {'median': 40, 'p90': 100}, 'failure_rate': 0.03,
+            'refund_after': 660,
+        },
+        'colorguide': {
+            'queue': 'nanobanana', 'rate_per_hour': 5,
+            'provider': {'median': 60, 'p90': 150}, 'failure_rate': 0.05,
+            'refund_after': 720,
+        },
+        'colortype': {
+            'queue': None, 'rate_per_hour': 10,
+            'provider': {'median': 25, 'p90': 55}, 'failure_rate': 0.05,
+            'attempts': 3, 'attempt_timeout': 60, 'stuck_cutoff': 180,
+        },
+    },
+}
+
+# Сокращённые имена параметров для --sweep и ключей командной строки
+TOP_LEVEL_KNOBS = ('concurrency', 'active_window', 'poll_interval', 'client_timeout',
+                   'sweep_period', 'orphan_age', 'sweep_batch', 'wake_delay',
+                   'stuck_recovery_after', 'policy')
+
+
+class LogNormal:
+    '''Логнормальное распределение по медиане и p90 (секунды).'''
+
+    Z90 = 1.2815515655446004
+
+    def __init__(self, median: float, p90: float):
+        self.mu = math.log(median)
+        self.sigma = max(1e-6, (math.log(max(p90, median * 1.0001)) - self.mu) / self.Z90)
+
+    def sample(self, rng: random.Random) -> float:
+        return rng.lognormvariate(self.mu, self.sigma)
+
+
+class Task:
+    __slots__ = ('id', 'service', 'created', 'status', 'admitted', 'provider_done',
+                 'provider_failed', 'finished', 'refunded', 'delivered_after_refund')
+
+    def __init__(self, task_id: int, service: str, created: float):
+        self.id = task_id
+        self.service = service
+        self.created = created
+        self.status = 'pending'
+        self.admitted: Optional[float] = None
+        self.provider_done: Optional[float] = None
+        self.provider_failed = False
+        self.finished: Optional[float] = None
+        self.refunded = False
+        self.delivered_after_refund = False
+
+
+class Simulation:
+    def __init__(self, config: Dict[str, Any], hours: float, seed: int):
+        self.config = config
+        self.horizon = hours * 3600
+        self.rng = random.Random(seed)
+        self.events: List[tuple] = []
+        self.seq = itertools.count()
+        self.tasks: List[Task] = []
+        self.latency = {name: LogNormal(**svc['provider']) for name, svc in config['services'].items()}
+        # Задачи очереди fal.ai: ожидающие (по времени создания) и отправленные в fal
+        self.pending: List[Task] = []
+        self.processing: List[Task] = []
+        self.max_active_fal = 0
+        self.over_limit_admissions = 0
+
+    # --- очередь событий ---
+
+    def schedule(self, at: float, kind: str, payload: Any = None) -> None:
+        heapq.heappush(self.events, (at, next(self.seq), kind, payload))
+
+    def run(self) -> 'Simulation':
+        for name, svc in self.config['services'].items():
+            if svc['rate_per_hour'] > 0:
+                self.schedule(self._next_arrival(0.0, svc), 'arrival', name)
+        # Фаза крона относительно потока задач случайна
+        self.schedule(self.rng.uniform(0, self.config['sweep_period']), 'sweeper')
+
+        # После горизонта новые задачи не приходят, но уже созданные дорабатываются
+        drain_until = self.horizon + 3 * 3600
+        while self.events:
+            now, _, kind, payload = heapq.heappop(self.events)
+            if now > drain_until:
+                break
+            getattr(self, f'_on_{kind}')(now, payload)
+            # Остался только следующий проход крона и разбирать нечего — конец
+            if (now > self.horizon and len(self.events) == 1
+                    and not self.pending and not self.processing):
+                break
+        return self
+
+    def _next_arrival(self, now: float, svc: Dict[str, Any]) -> float:
+        return now + self.rng.expovariate(svc['rate_per_hour'] / 3600)
+
+    # --- обработчики событий ---
+
+    def _on_arrival(self, now: float, service: str) -> None:
+        svc = self.config['services'][service]
+        task = Task(len(self.tasks), service, now)
+        self.tasks.append(task)
+        if svc['queue']:
+            self.pending.append(task)
+            self.schedule(now, 'worker', task)
+            self.schedule(now + self.config['poll_interval'], 'poll', task)
+        else:
+            self._run_colortype(now, task, svc)
+        next_at = self._next_arrival(now, svc)
+        if next_at < self.horizon:
+            self.schedule(next_at, 'arrival', service)
+
+    def _on_poll(self, now: float, task: Task) -> None:
+        if task.finished is not None or now - task.created > self.config['client_timeout']:
+            return
+        self.schedule(now, 'worker', task)
+        self.schedule(now + self.config['poll_interval'], 'poll', task)
+
+    def _on_provider(self, now: float, task: Task) -> None:
+        task.provider_done = now
+        if task.refunded and not task.provider_failed:
+            # Восстановление дочитает результат, хотя деньги уже вернули
+            task.delivered_after_refund = True
+
+    def _on_worker(self, now: float, task: Task) -> None:
+        svc = self.config['services'][task.service]
+        if task.finished is not None:
+            return
+
+        if task.status == 'pending':
+            if self._may_admit(now, task):
+                self._admit(now, task, svc)
+            return
+
+        # processing: результат готов — финализируем, иначе проверяем порог возврата
+        if task.provider_done is not None:
+            self._finish(now, task, failed=task.provider_failed)
+        elif now - task.admitted > svc['refund_after']:
+            task.refunded = True
+            self._finish(now, task, failed=True)
+
+    # --- task-sweeper ---
+
+    def _on_sweeper(self, now: float, _payload: Any) -> None:
+        '''
+        Один проход task-sweeper: sweep у воркеров с зависшими задачами
+        (не больше sweep_batch на сервис, самые старые первыми), затем
+        пробуждение брошенных pending-задач на число свободных слотов.
+        '''
+        batch = self.config['sweep_batch']
+        swept: Dict[str, int] = {}
+        for other in sorted(self.processing, key=lambda t: t.created):
+            if swept.get(other.service, 0) >= batch:
+                continue
+            age = now - other.admitted
+            if other.provider_done is not None and age > self.config['stuck_recovery_after']:
+                self._finish(now, other, failed=other.provider_failed)
+            elif other.provider_done is None and age > self.config['services'][other.service]['refund_after']:
+                other.refunded = True
+                self._finish(now, other, failed=True)
+            else:
+                continue
+            swept[other.service] = swept.get(other.service, 0) + 1
+
+        for name, svc in self.config['services'].items():
+            if svc['queue']:
+                continue
+            stuck = [t for t in self.tasks
+                     if t.service == name and t.status == 'processing' and not t.refunded
+                     and now - t.admitted > svc['stuck_cutoff']]
+            for other in stuck[:batch]:
+                # UPDATE ... AND status = 'processing': задача ещё не завершилась
+                other.refunded = True
+
+        free_slots = max(0, self.config['concurrency'] - self._active(now))
+        orphans = [t for t in self.pending if now - t.created >= self.config['orphan_age']]
+        for task in orphans[:free_slots]:
+            self.schedule(now + self.config['wake_delay'], 'worker', task)
+
+        self.schedule(now + self.config['sweep_period'], 'sweeper')
+
+    # --- допуск в очередь ---
+
+    def _active(self, now: float, service: Optional[str] = None) -> int:
+        window = self.config['active_window']
+        return sum(
+            1 for t in self.processing
+            if now - t.admitted < window and (service is None or t.service == service)
+        )
+
+    def _may_admit(self, now: float, task: Task) -> bool:
+        policy = self.config['policy']
+        limit = self.config['concurrency']
+        if policy == 'per-service':
+            return self._active(now, task.service) < limit
+        if self._active(now) >= limit:
+            return False
+        if policy == 'fifo':
+            return self.pending[0] is task
+        return True
+
+    def _admit(self, now: float, task: Task, svc: Dict[str, Any]) -> None:
+        task.status = 'processing'
+        task.admitted = now
+        self.pending.remove(task)
+        self.processing.append(task)
+        task.provider_failed = self.rng.random() < svc['failure_rate']
+        self.schedule(now + self.latency[task.service].sample(self.rng), 'provider', task)
+        in_flight = len(self.processing)
+        self.max_active_fal = max(self.max_active_fal, in_flight)
+        if in_flight > self.config['concurrency'] and self.config['policy'] != 'per-service':
+            self.over_limit_admissions += 1
+
+    def _finish(self, now: float, task: Task, failed: bool) -> None:
+        task.status = 'failed' if failed else 'completed'
+        task.finished = now
+        if task in self.processing:
+            self.processing.remove(task)
+        if failed:
+            task.refunded = True
+
+    # --- colortype: синхронный воркер ---
+
+    def _run_colortype(self, now: float, task: Task, svc: Dict[str, Any]) -> None:
+        # Зависшие задачи помечает failed с возвратом sweep-режим (_on_sweeper)
+        task.status = 'processing'
+        task.admitted = now
+        elapsed = 0.0
+        succeeded = False
+        for attempt in range(svc['attempts']):
+            duration = min(self.latency[task.service].sample(self.rng), svc['attempt_timeout'])
+            elapsed += duration
+            if duration < svc['attempt_timeout'] and self.rng.random() >= svc['failure_rate']:
+                succeeded = True
+                break
+            if attempt < svc['attempts'] - 1:
+                elapsed += 2 * (attempt + 1)
+        self.schedule(now + elapsed, 'colortype_done', (task, succeeded))
+
+    def _on_colortype_done(self, now: float, payload: tuple) -> None:
+        task, succeeded = payload
+        if task.refunded and succeeded:
+            task.delivered_after_refund = True
+        task.provider_done = now
+        self._finish(now, task, failed=not succeeded or task.refunded)
+
+
+# ---------------------------------------------------------------------------
+# Отчёт
+# ---------------------------------------------------------------------------
+
+def _pct(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))], 1)
+
+
+def summarize(sim: Simulation) -> Dict[str, Any]:
+    hours = sim.horizon / 3600
+    services = {}
+    for name in sim.config['services']:
+        tasks = [t for t in sim.tasks if t.service == name]
+        waits = [t.admitted - t.created for t in tasks if t.admitted is not None]
+        totals = [t.finished - t.created for t in tasks if t.finished is not None and t.status == 'completed']
+        completed = sum(1 for t in tasks if t.status == 'completed')
+        refunded = sum(1 for t in tasks if t.refunded)
+        services[name] = {
+            'arrivals': len(tasks),
+            'completed': completed,
+            'failed': sum(1 for t in tasks if t.status == 'failed'),
+            'stranded': sum(1 for t in tasks if t.finished is None),
+            'refund_rate': round(refunded / len(tasks), 4) if tasks else 0.0,
+            'delivered_after_refund': sum(1 for t in tasks if t.delivered_after_refund),
+            'throughput_per_hour': round(completed / hours, 2),
+            'wait_s': {'p50': _pct(waits, 0.5), 'p90': _pct(waits, 0.9), 'p99': _pct(waits, 0.99)},
+            'end_to_end_s': {'p50': _pct(totals, 0.5), 'p90': _pct(totals, 0.9), 'p99': _pct(totals, 0.99)},
+        }
+    return {
+        'services': services,
+        'max_in_flight_fal': sim.max_active_fal,
+        'over_limit_admissions': sim.over_limit_admissions,
+    }
+
+
+def average_summaries(summaries: List[Dict[str, Any]]) -> Dict[str, Any]:
+    '''Усреднение числовых полей по репликациям (None пропускаются).'''
+    def merge(values):
+        first = values[0]
+        if isinstance(first, dict):
+            return {k: merge([v[k] for v in values]) for k in first}
+        numbers = [v for v in values if isinstance(v, (int, float))]
+        return round(sum(numbers) / len(numbers), 3) if numbers else None
+    return merge(summaries)
+
+
+def print_summary(label: str, summary: Dict[str, Any]) -> None:
+    print(f'== {label} | max in-flight on fal: {summary["max_in_flight_fal"]}, '
+          f'admissions over limit: {summary["over_limit_admissions"]}')
+    print(f'   {"service":<11} {"arrived":>8} {"done":>7} {"failed":>7} {"strand":>6} {"refund%":>8} '
+          f'{"late":>5} {"wait p50/p90/p99 s":>22} {"total p50/p90/p99 s":>24}')
+    for name, s in summary['services'].items():
+        wait = '/'.join(str(s['wait_s'][k]) for k in ('p50', 'p90', 'p99'))
+        total = '/'.join(str(s['end_to_end_s'][k]) for k in ('p50', 'p90', 'p99'))
+        print(f'   {name:<11} {s["arrivals"]:>8} {s["completed"]:>7} {s["failed"]:>7} {s["stranded"]:>6} '
+              f'{s["refund_rate"] * 100:>7.1f}% {s["delivered_after_refund"]:>5} {wait:>22} {total:>24}')
+
+
+# ---------------------------------------------------------------------------
+# Подгонка по task_timings
+# ---------------------------------------------------------------------------
+
+FIT_SERVICE_MAP = {'tryon': 'tryon', 'freegen': 'freegen', 'colorguide': 'colorguide'}
+
+
+def fit_from_database(days: int) -> Dict[str, Any]:
+    '''Медиана/p90 времени провайдера и интенсивность потока по task_timings за days дней.'''
+    import psycopg2
+
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT service,
+               COUNT(*) AS tasks,
+               percentile_cont(0.5) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM provider_done_at - submitted_at))
+                   FILTER (WHERE provider_done_at IS NOT NULL AND submitted_at IS NOT NULL),
+               percentile_cont(0.9) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM provider_done_at - submitted_at))
+                   FILTER (WHERE provider_done_at IS NOT NULL AND submitted_at IS NOT NULL)
+        FROM t_p29007832_virtual_fitting_room.task_timings
+        WHERE queued_at > NOW() - make_interval(days => %s)
+        GROUP BY service
+    ''', (days,))
+    for service, tasks, median, p90 in cursor.fetchall():
+        name = FIT_SERVICE_MAP.get(service)
+        if not name:
+            continue
+        svc = config['services'][name]
+        svc['rate_per_hour'] = round(tasks / (days * 24), 3)
+        if median and p90:
+            svc['provider'] = {'median': round(float(median), 1), 'p90': round(float(p90), 1)}
+    cursor.close()
+    conn.close()
+    return config
+
+
+# ---------------------------------------------------------------------------
+# CLI
+# ---------------------------------------------------------------------------
+
+def _coerce(value: str) -> Any:
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+def apply_overrides(config: Dict[str, Any], overrides: Dict[str, Any]) -> Dict[str, Any]:
+    '''Ключи вида concurrency=2 или colorguide.refund_after=900.'''
+    config = copy.deepcopy(config)
+    for key, value in overrides.items():
+        if '.' in key:
+            service, field = key.split('.', 1)
+            target = config['services'][service]
+            if field in ('median', 'p90'):
+                target = target['provider']
+            target[field] = value
+        elif key in TOP_LEVEL_KNOBS:
+            config[key] = value
+        else:
+            raise SystemExit(f'Unknown parameter: {key}')
+    return config
+
+
+def run_replicated(config: Dict[str, Any], hours: float, seed: int, replications: int) -> Dict[str, Any]:
+    summaries = [summarize(Simulation(config, hours, seed + i).run()) for i in range(replications)]
+    return summaries[0] if replications == 1 else average_summaries(summaries)
+
+
+def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] == 'fit':
+        parser = argparse.ArgumentParser(description='Fit simulator inputs from task_timings')
+        parser.add_argument('fit')
+        parser.add_argument('--days', type=int, default=14)
+        args = parser.parse_args()
+        print(json.dumps(fit_from_database(args.days), ensure_ascii=False, indent=2))
+        return
+
+    parser = argparse.ArgumentParser(description='Discrete-event simulator for the generation queue')
+    parser.add_argument('--config', help='JSON config (e.g. output of the fit subcommand)')
+    parser.add_argument('--hours', type=float, default=24)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--replications', type=int, default=1)
+    parser.add_argument('--concurrency', type=int)
+    parser.add_argument('--active-window', type=int, help='seconds')
+    parser.add_argument('--policy', choices=('current', 'fifo', 'per-service'))
+    parser.add_argument('--set', nargs='*', default=[], metavar='KEY=VALUE',
+                        help='override, e.g. colorguide.refund_after=900 tryon.rate_per_hour=40')
+    parser.add_argument('--sweep', nargs='*', default=[], metavar='KEY=V1,V2',
+                        help='grid over parameters, e.g. concurrency=1,2,3 active_window=120,300')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    config = DEFAULT_CONFIG
+    if args.config:
+        with open(args.config, encoding='utf-8') as f:
+            config = json.load(f)
+
+    overrides = {k: _coerce(v) for k, v in (item.split('=', 1) for item in args.set)}
+    for key in ('concurrency', 'active_window', 'policy'):
+        if getattr(args, key) is not None:
+            overrides[key] = getattr(args, key)
+    config = apply_overrides(config, overrides)
+
+    grid = [(key, [_coerce(v) for v in values.split(',')])
+            for key, values in (item.split('=', 1) for item in args.sweep)]
+    runs = []
+    for combo in itertools.product(*(values for _, values in grid)) if grid else [()]:
+        point = dict(zip((key for key, _ in grid), combo))
+        summary = run_replicated(apply_overrides(config, point), args.hours, args.seed, args.replications)
+        runs.append({'parameters': point, 'summary': summary})
+
+    if args.json:
+        print(json.dumps(runs, ensure_ascii=False, indent=2))
+        return
+    for run in runs:
+        label = ', '.join(f'{k}={v}' for k, v in run['parameters'].items()) or 'baseline'
+        policy = run['parameters'].get('policy', config['policy'])
+        print_summary(f'{label} (policy={policy})', run['summary'])
+
+
+if __name__ == '__main__':
+    main()
@@ -112,6 +112,8 @@ const DialogChat = ({
   // Карты, уже выпавшие в этом диалоге (для режима «одна колода»)
   const [usedCards, setUsedCards] = useState<string[]>([]);
   const [busy, setBusy] = useState(false);
+  // Уже написанная часть ответа, пока нейросеть дописывает остальное
+  const [draft, setDraft] = useState("");
   const [closed, setClosed] = useState(false);
   const [shuffled, setShuffled] = useState(false);
   const [confirmClose, setConfirmClose] = useState(false);
@@ -327,6 +329,7 @@ const DialogChat = ({
           onBalanceChange();
           return;
         }
+        if (poll.data.answer_partial) setDraft(poll.data.answer_partial);
       }
 
       if (!ready) {
@@ -364,6 +367,7 @@ const DialogChat = ({
       toast.error("Ошибка соединения");
     } finally {
       setBusy(false);
+      setDraft("");
     }
   };
 
@@ -831,6 +835,12 @@ const DialogChat = ({
               Осталось вопросов: {stepsLeft}
             </span>
           </div>
+          {busy && draft && (
+            <div className="mb-4 whitespace-pre-line rounded-xl bg-white/[0.03] p-3 text-sm leading-relaxed text-[#e8e0f0] ring-1 ring-white/10">
+              {draft}
+              <span className="ml-0.5 animate-pulse text-[#c9a84c]">▍</span>
+            </div>
+          )}
           {/* РЕАЛЬНЫЙ расклад: карты лицом — вы уже разложили их у себя
               и просто отмечаете, что выпало. */}
           {picked.length < maxCards && mode === "real" && (
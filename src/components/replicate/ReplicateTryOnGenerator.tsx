@@ -306,6 +306,7 @@ export default function ReplicateTryOnGenerator({
           body: JSON.stringify({
             table: "nanobananapro_tasks",
             action: "select",
+            projection: "detail",
             where: { id: taskId },
             limit: 1,
           }),
@@ -52,6 +52,8 @@ export default function AdminPayments() {
   const [isLoading, setIsLoading] = useState(true);
   const [currentPage, setCurrentPage] = useState(1);
   const [totalPayments, setTotalPayments] = useState(0);
+  // total с сервера считается до потолка — дальше листаем, пока страницы полные
+  const [totalCapped, setTotalCapped] = useState(false);
   const [refundingId, setRefundingId] = useState<string | null>(null);
   const [typeFilter, setTypeFilter] = useState<string>("all");
   const [dateFilter, setDateFilter] = useState<string>("all");
@@ -149,6 +151,7 @@ export default function AdminPayments() {
       setTotalPayments(
         data.total || (data.payments ? data.payments.length : data.length),
       );
+      setTotalCapped(Boolean(data.total_capped));
     } catch (error) {
       toast.error("Ошибка загрузки платежей");
     } finally {
@@ -319,7 +322,8 @@ export default function AdminPayments() {
             <div className="mb-8">
               <h1 className="text-3xl font-bold mb-2">История операций</h1>
               <p className="text-muted-foreground">
-                Всего операций: {totalPayments} | Пополнения:{" "}
+                Всего операций: {totalPayments}
+                {totalCapped ? "+" : ""} | Пополнения:{" "}
                 {totalDeposits.toFixed(2)} ₽ | Списания:{" "}
                 {totalCharges.toFixed(2)} ₽
               </p>
@@ -765,20 +769,16 @@ export default function AdminPayments() {
                 <span className="text-sm text-muted-foreground px-4">
                   Страница {currentPage} из{" "}
                   {Math.ceil(totalPayments / paymentsPerPage)}
+                  {totalCapped ? "+" : ""}
                 </span>
                 <Button
                   variant="outline"
                   size="sm"
-                  onClick={() =>
-                    setCurrentPage((p) =>
-                      Math.min(
-                        Math.ceil(totalPayments / paymentsPerPage),
-                        p + 1,
-                      ),
-                    )
-                  }
+                  onClick={() => setCurrentPage((p) => p + 1)}
                   disabled={
-                    currentPage >= Math.ceil(totalPayments / paymentsPerPage)
+                    totalCapped
+                      ? payments.length < paymentsPerPage
+                      : currentPage >= Math.ceil(totalPayments / paymentsPerPage)
                   }
                 >
                   Вперёд
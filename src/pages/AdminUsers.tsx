@@ -79,6 +79,8 @@ export default function AdminUsers() {
   const [isLoading, setIsLoading] = useState(true);
   const [currentPage, setCurrentPage] = useState(1);
   const [totalUsers, setTotalUsers] = useState(0);
+  // total с сервера считается до потолка — дальше листаем, пока страницы полные
+  const [totalCapped, setTotalCapped] = useState(false);
   const usersPerPage = 50;
 
   const [emailDialogUser, setEmailDialogUser] = useState<User | null>(null);
@@ -174,7 +176,11 @@ export default function AdminUsers() {
       });
       const data = await response.json().catch(() => ({}));
       if (response.ok && data.success) {
-        toast.success(`Письмо отправлено на ${data.to_email || emailDialogUser.email}`);
+        toast.success(
+          data.queued
+            ? `Письмо поставлено в очередь на ${data.to_email || emailDialogUser.email}`
+            : `Письмо отправлено на ${data.to_email || emailDialogUser.email}`,
+        );
         if (historyPage === 1) {
           fetchHistory(emailDialogUser.id, 1);
         } else {
@@ -225,6 +231,7 @@ export default function AdminUsers() {
       const data = await response.json();
       setUsers(data.users);
       setTotalUsers(data.total);
+      setTotalCapped(Boolean(data.total_capped));
     } catch (error) {
       toast.error('Ошибка загрузки пользователей');
     } finally {
@@ -280,7 +287,7 @@ export default function AdminUsers() {
           <div className="flex-1">
             <div className="mb-8">
               <h1 className="text-3xl font-bold mb-2">Пользователи</h1>
-              <p className="text-muted-foreground">Всего пользователей: {totalUsers}</p>
+              <p className="text-muted-foreground">Всего пользователей: {totalUsers}{totalCapped ? '+' : ''}</p>
             </div>
 
             <Card>
@@ -386,13 +393,13 @@ export default function AdminUsers() {
                   Назад
                 </Button>
                 <span className="text-sm text-muted-foreground px-4">
-                  Страница {currentPage} из {Math.ceil(totalUsers / usersPerPage)}
+                  Страница {currentPage} из {Math.ceil(totalUsers / usersPerPage)}{totalCapped ? '+' : ''}
                 </span>
                 <Button
                   variant="outline"
                   size="sm"
-                  onClick={() => setCurrentPage(p => Math.min(Math.ceil(totalUsers / usersPerPage), p + 1))}
-                  disabled={currentPage >= Math.ceil(totalUsers / usersPerPage)}
+                  onClick={() => setCurrentPage(p => p + 1)}
+                  disabled={totalCapped ? users.length < usersPerPage : currentPage >= Math.ceil(totalUsers / usersPerPage)}
                 >
                   Вперёд
                   <Icon name="ChevronRight" size={16} />
@@ -489,6 +496,11 @@ export default function AdminUsers() {
                                     <Icon name="Check" size={11} />
                                     Отправлено
                                   </span>
+                                ) : item.status === 'queued' ? (
+                                  <span className="inline-flex items-center gap-1 px-2 py-0.5 bg-yellow-100 text-yellow-700 rounded text-xs">
+                                    <Icon name="Clock" size={11} />
+                                    В очереди
+                                  </span>
                                 ) : (
                                   <span className="inline-flex items-center gap-1 px-2 py-0.5 bg-red-100 text-red-700 rounded text-xs">
                                     <Icon name="X" size={11} />
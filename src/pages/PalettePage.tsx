@@ -78,6 +78,7 @@ export default function PalettePage() {
           body: JSON.stringify({
             table: 'color_type_history',
             action: 'select',
+            projection: 'detail',
             where: { id: analysisId },
           }),
         });
@@ -755,6 +755,7 @@ export default function ReplicateTryOn() {
           body: JSON.stringify({
             table: "nanobananapro_tasks",
             action: "select",
+            projection: "detail",
             where: { id: taskId },
             limit: 1,
           }),